@@ -15,6 +15,7 @@ All Rights Reserved
 Author: David Benjamin Gordon
 '''
 import sys, re, os, math, random
+import numpy
 
 from  TAMO            import MotifTools
 from  TAMO.util       import Arith
@@ -380,13 +381,7 @@ def minshortestoverhangdiff(A,B,minoverlap=6,want_offset=None,DFUNC=None):
     lastS = wS - wO
     Dmin = 1000
     if want_offset: Ds = []
-    key = '%s %s'%(self.oneletter,`[x['A'] for x in self.ll]`)
-    if 1:  #MEMOize rc when doing many, many comparisons (factor x2.5 speedup)
-        try: selfrc = rcmemo[key]
-        except:
-            selfrc = self.revcomp()
-            rcmemo[key] = selfrc
-    else: selfrc = self.revcomp()  #No Memo
+    selfrc = revcompmemo(self)
 
     Ds = []
     if want_offset: offinfo = []
@@ -422,6 +417,70 @@ def minshortestoverhangdiff(A,B,minoverlap=6,want_offset=None,DFUNC=None):
             offset = 0 - offset
         return offset, rc
 
+def revcompmemo(M):
+    '''
+    revcompmemo(M) -- M.revcomp(), MEMOized for doing many, many comparisons (factor x2.5 speedup)
+    '''
+    key = '%s %s'%(M.oneletter,`[x['A'] for x in M.ll]`)
+    try: rc = rcmemo[key]
+    except KeyError:
+        rc = M.revcomp()
+        rcmemo[key] = rc
+    return rc
+
+def minshortestoverhangdiffs(pairs,DFUNC=None):
+    '''
+    minshortestoverhangdiffs(pairs,DFUNC=None) -- minshortestoverhangdiff(A,B,OVLP(A,B),DFUNC=DFUNC) of every
+                                                  (A,B) in pairs, as an array.
+
+    For the default metric (diffrange) pairs of the same widths are compared together: the distances
+    between all columns of the wider motif (and of its reverse complement) and all columns of the other
+    are computed at once, every alignment is then a diagonal of that matrix.  Diagonals are summed
+    column by column, so the distances are the ones minshortestoverhangdiff computes.
+    '''
+    Ds = numpy.empty(len(pairs))
+    groups = {}
+    for k,(A,B) in enumerate(pairs):
+        minoverlap = OVLP(A,B)
+        if DFUNC not in (None,diffrange) or minoverlap < 1:
+            Ds[k] = minshortestoverhangdiff(A,B,minoverlap,DFUNC=DFUNC)
+            continue
+        if A.width < B.width: S, O = B, A
+        else:                 S, O = A, B
+        groups.setdefault((S.width,O.width,minoverlap),[]).append((k,S,O))
+
+    arrays = {}
+    def P(M,rc=0):
+        key = (id(M),rc)
+        if not arrays.has_key(key):
+            if rc: arrays[key] = MotifTools.probarray(revcompmemo(M))
+            else:  arrays[key] = MotifTools.probarray(M)
+        return arrays[key]
+
+    for (wS,wO,minoverlap),members in groups.items():
+        idxs = [k for k,s,o in members]
+        PS   = numpy.array([[P(s),P(s,1)] for k,s,o in members])                 #(pairs, strand, wS, 4)
+        PO   = numpy.array([P(o) for k,s,o in members])                           #(pairs, wO, 4)
+        D    = numpy.zeros((len(members),2,wS,wO))
+        for l in range(len(ACGT)):
+            D += (PS[:,:,:,None,l] - PO[:,None,None,:,l])**2
+        C = numpy.sqrt(D)/math.sqrt(2.0)                                          #Column distances
+
+        #Alignments as diagonals (offset of other - offset of self), same as minshortestoverhangdiff
+        diags = range(max(0,wO-minoverlap))                   #Other overhangs to the left
+        diags.extend([-Sstart for Sstart in range(0,wS-wO+1)]) #Other within self
+        diags.extend([ovlp-wS for ovlp in range(wO-1,minoverlap,-1)]) #Other overhangs to the right
+        diags = numpy.array(diags)
+        Sstart = numpy.maximum(0,-diags)
+        Ostart = numpy.maximum(0, diags)
+        length = numpy.minimum(wS-Sstart,wO-Ostart)
+        Dtot   = numpy.zeros((len(members),2,len(diags)))
+        for t in range(length.max()):
+            col  = C[:,:,numpy.minimum(Sstart+t,wS-1),numpy.minimum(Ostart+t,wO-1)]
+            Dtot += numpy.where(t < length,col,0.0)
+        Ds[idxs] = (Dtot/length).reshape(len(members),-1).min(axis=1)
+    return Ds
+
 def negcommonbitstest(t1,t2,OVLP_FCN=None):
     testdiff(t1,t2,OVLP_FCN,negcommonbitsrange)
 
@@ -569,6 +628,28 @@ def computeDmat(motifs,VERBOSE=0,DFUNC=DFUNC):
     if VERBOSE: print                               #End of Pretty status bar
     return dmat
 
+def computeDarray(motifs,VERBOSE=0,DFUNC=DFUNC):
+    '''
+    computeDarray(motifs,VERBOSE=0,DFUNC=DFUNC) -- computeDmat as a symmetric (N x N) array.  Each motif
+                                                   is compared to all the motifs after it at once (see
+                                                   minshortestoverhangdiffs).
+    '''
+    N = len(motifs)
+    dmat = numpy.zeros((N,N))
+    if VERBOSE: print "              |%s|"%('-'*(N-1))  #Pretty status bar
+    if VERBOSE: print "Computing ...  ",
+    Nhalf = int(.293*N)
+    for i in range(N-1):
+        if VERBOSE:
+            if i == Nhalf: sys.stdout.write('|'); sys.stdout.flush()
+            else:          sys.stdout.write('.'); sys.stdout.flush()
+        A  = motifs[i]
+        Ds = minshortestoverhangdiffs([(A,B) for B in motifs[i+1:]],DFUNC=DFUNC)
+        dmat[i,i+1:] = Ds                  #Symmetric
+        dmat[i+1:,i] = Ds                  #Symmetric
+    if VERBOSE: print                               #End of Pretty status bar
+    return dmat
+
 def main():
     import pickle
     global DFUNC, DMIN
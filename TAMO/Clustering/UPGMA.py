@@ -15,13 +15,19 @@ probability values in the aligned PSSMs within a cluster.
     2.4)  Compute the distance from (ij) to all other clusters (except i and j)
     2.5)  Delete columns/rows in Dmat corresponding to i and j
 
+Dmat is an array with room for all clusters, the pairs of clusters are kept on a heap so that
+finding the closest pair does not rescan Dmat.  (A nearest-neighbor chain would need distances
+to merged clusters to follow from the distances to their parts, here they are recomputed from the
+averaged motif.)
+
 Copyright (2005) Whitehead Institute for Biomedical Research (except as noted below)
 All Rights Reserved
 
 Author: David Benjamin Gordon
 
 '''
-import sys, re, os, math, getopt
+import sys, re, os, math, getopt, heapq
+import numpy
 GLOBALS = {}
 
 from TAMO.Clustering.MotifCompare import *
@@ -96,8 +102,12 @@ def UPGMA(motifs,DFUNC=None):
         clusters[i].clustDmax = 0.0
         clusters[i].clustDmin = 0.0
 
-    #1.2)  Compute Dmat of all clusters
-    Dmat = computeDmat(motifs,VERBOSE=1,DFUNC=DFUNC)
+    #1.2)  Compute Dmat of all clusters (with room for the clusters to come), and the heap of pairs
+    N = len(clusters)
+    Dmat = numpy.zeros((2*N-1,2*N-1))
+    Dmat[:N,:N] = computeDarray(motifs,VERBOSE=1,DFUNC=DFUNC)
+    heap = [(Dmat[i,j],i,j) for i in range(N) for j in range(i+1,N)]
+    heapq.heapify(heap)
     SKIPD = {}
 
     #2) Iteration
@@ -111,7 +121,7 @@ def UPGMA(motifs,DFUNC=None):
         counter = counter - 1
         #2.1)  Find the i and j with the smallest Distance
         #2.5)  Delete columns/rows in Dmat corresponding to i and j
-        i, j = find_min_ij(Dmat,SKIPD)
+        i, j = find_min_ij(heap,SKIPD)
         SKIPD[i] = 1
         SKIPD[j] = 1
     
@@ -123,7 +133,7 @@ def UPGMA(motifs,DFUNC=None):
         clusters.append(newclust)
     
         #2.4)  Compute the distance from (ij) to all other clusters (except i and j)
-        extendDmat(Dmat,clusters,SKIPD,DFUNC)
+        extendDmat(Dmat,clusters,SKIPD,DFUNC,heap)
 
     for i in range(len(clusters)):
         c = clusters[i]
@@ -135,17 +145,15 @@ def UPGMA(motifs,DFUNC=None):
 
         
 
-def find_min_ij(Dmat,SKIPD):
-    idxs = [x for x in Dmat.keys() if not SKIPD.has_key(x)]
-    N = len(Dmat)
-    min = 1e+1000
-    #print_dmat(Dmat,SKIPD)
-    for i in idxs:
-        for j in idxs:
-            if i>=j: continue
-            if Dmat[i][j] < min:
-                imin, jmin, min = i,j,Dmat[i][j]
-    return imin,jmin
+def find_min_ij(heap,SKIPD):
+    '''
+    Pop the closest pair of clusters that are both still unmerged off the heap of (D,i,j), i < j.
+    Ties go to the lowest i, then the lowest j.
+    '''
+    while 1:
+        D, i, j = heapq.heappop(heap)
+        if not (SKIPD.has_key(i) or SKIPD.has_key(j)):
+            return i,j
 
 def collapse_clusters(A,B,Dmat,_DFUNC=None):
     if not _DFUNC: _DFUNC = DFUNC
@@ -158,13 +166,9 @@ def collapse_clusters(A,B,Dmat,_DFUNC=None):
     size = len(motifs)
     idxs = [x.idx for x in motifs]
     idxs.sort()
-    avedists = []
-    for i in idxs:
-        dtot = 0
-        for j in idxs:
-            if i ==j: continue
-            dtot += Dmat[i][j]
-        avedists.append((dtot,i))
+    #cumsum adds up each row in order (Dmat[i][i] is 0)
+    dtots = Dmat[numpy.ix_(idxs,idxs)].cumsum(axis=1)[:,-1]
+    avedists = zip(dtots.tolist(),idxs)
     avedists.sort()
     bestdist,bestidx = avedists[0]
     centroid = [x for x in motifs if (x.idx == bestidx)][0]
@@ -174,12 +178,10 @@ def collapse_clusters(A,B,Dmat,_DFUNC=None):
     #Monther's Hack
     AVE.members = [A, B]
 
-    dists = []
+    dists = minshortestoverhangdiffs([(m,AVE) for m in motifs],DFUNC=_DFUNC).tolist()
     dtot  = 0.0
-    for m in motifs:
-        D = minshortestoverhangdiff(m,AVE,OVLP(m,AVE),DFUNC=_DFUNC)
+    for D in dists:
         dtot += D
-        dists.append(D)
 
     AVE.clustDmin = min(dists)
     AVE.clustDmax = max(dists)
@@ -196,21 +198,19 @@ def flatten_members(M):
         ans = [M]
     return ans
 
-def extendDmat(Dmat,clusters,SKIPD,_DFUNC=None):
+def extendDmat(Dmat,clusters,SKIPD,_DFUNC=None,heap=None):
     if _DFUNC==None: _DFUNC = DFUNC
-    #print_dmat(Dmat)
     #Must assume that last cluster is the new one
     N = len(clusters)
     last = N-1
     lastM = clusters[last]
-    Dmat[last] = {}
-    for i in range(last):
-        if SKIPD.has_key(i): continue
-        A = clusters[i]
-        D = minshortestoverhangdiff(A,lastM,OVLP(A,lastM),DFUNC=_DFUNC)
-        Dmat[i][last] = D
-        Dmat[last][i] = D
-    #print_dmat(Dmat)
+    idxs = [i for i in range(last) if not SKIPD.has_key(i)]
+    Ds = minshortestoverhangdiffs([(clusters[i],lastM) for i in idxs],DFUNC=_DFUNC)
+    Dmat[idxs,last] = Ds
+    Dmat[last,idxs] = Ds
+    if heap is not None:
+        for i,D in zip(idxs,Ds.tolist()):
+            heapq.heappush(heap,(D,i,last))
 
 
 def print_tree(tree,level=0):
@@ -54,6 +54,7 @@ Author: David Benjamin Gordon
 
 """
 import sys, re, os, math, string, tempfile, copy, pickle
+import numpy
 from   random import random,shuffle
 import TAMO.paths
 COPY = copy
@@ -92,6 +93,28 @@ def revcomplement(seq):
         revcomplement_memo[rc]  = seq
     return(rc)
 
+#Columns of the dense log-likelihood matrix (m.llarray): the bases, the two-base ambiguity codes and N/B
+PSSM_LETTERS = ACGT + ['W', 'S', 'M', 'K', 'Y', 'R', 'N', 'B']
+PSSM_INDEX   = numpy.empty(256, dtype=numpy.intp)
+PSSM_INDEX.fill(-1)
+for _i, _L in enumerate(PSSM_LETTERS): PSSM_INDEX[ord(_L)] = _i
+
+def encode_seq(seq):
+    """
+    encode_seq(seq) -- Integer-encode a sequence as indices into the columns of m.llarray (see PSSM_LETTERS).
+                       Letters without a column raise KeyError, like a lookup in m.ll would.
+
+    >>> encode_seq('ACGTN')
+    array([ 0,  1,  2,  3, 10])
+    """
+    if not seq:
+        return numpy.zeros(0, dtype=numpy.intp)
+    codes = PSSM_INDEX[numpy.frombuffer(str(seq), dtype=numpy.uint8)]
+    unknown = numpy.flatnonzero(codes < 0)
+    if len(unknown):
+        raise KeyError(seq[unknown[0]])
+    return codes
+
 
 def Motif_from_ll(ll):
     """
@@ -171,6 +194,7 @@ class Motif:
         self.fracs     = []
         self.logP      = []
         self.ll        = []
+        self.llarray   = numpy.zeros((0,len(PSSM_LETTERS)))
         self.bits      = []
         self.totalbits = 0
         self.maxscore  = 0
@@ -507,6 +531,25 @@ class Motif:
                 Dll[L] = max(Dll[one2two[L][0]],  Dll[one2two[L][1]] )
             Dll['N'] = 0.0
             Dll['B'] = 0.0
+        self._compute_llarray()
+
+    def _compute_llarray(self):
+        """
+        m._compute_llarray() -- [utility] Set m.llarray, the log-likelihood matrix as a dense
+                                (width x len(PSSM_LETTERS)) array.  Letters missing from a position are NaN.
+        """
+        self.llarray = numpy.array([[Dll.get(L,numpy.nan) for L in PSSM_LETTERS] for Dll in self.ll],
+                                   dtype=float).reshape(len(self.ll),len(PSSM_LETTERS))
+
+    def _llarray(self):
+        """
+        m._llarray() -- [utility] Return m.llarray, (re)computed if it is out of step with m.ll
+                        (e.g. motifs pickled before m.llarray existed)
+        """
+        llarray = getattr(self,'llarray',None)
+        if llarray is None or len(llarray) != len(self.ll):
+            self._compute_llarray()
+        return self.llarray
 
     def compute_from_nmer(self,nmer,beta=0.001):  #For reverse compatibility
         """
@@ -798,38 +841,41 @@ class Motif:
         else:
             return(self._scan(seq,threshold,factor=factor))
 
+    def scanmany(self, seqs, threshold = '', factor=0.7):
+        """
+        m.scanmany(seqs, threshold = '', factor=0.7) -- Scan many sequences at once.  Returns a list with the
+                                                        (matches, endpoints, scores) of m.scan(seq) for each
+                                                        sequence.
+        """
+        results = [None] * len(seqs)
+        longer  = []
+        for idx,seq in enumerate(seqs):
+            if len(seq) < self.width:
+                results[idx] = self._scan_smaller(seq,threshold)
+            else:
+                longer.append(idx)
+        if not threshold: threshold = factor * self.maxscore
+        windows = self._windowscoresmany([seqs[idx] for idx in longer])
+        for idx,(seq,total_f,total_r) in zip(longer,windows):
+            results[idx] = self._hits(seq,total_f,total_r,threshold)
+        return results
+
     def scansum(self,seq,threshold = -1000):
         """
         m.scansum(seq,threshold = -1000) -- Sum of scores over every window in the sequence.  Returns
                                             total, number of matches above threshold, average score, sum of exp(score)
         """
-        ll = self.ll
-        sum = 0
-        width        = self.width
-        width_r      = range(width)
-        width_rcr    = range(width-1,-1,-1)
-        width_ranges = zip(width_r,width_rcr)
-        seqcomp      = seq.translate(revcompTBL)
-
-        total = 0
-        hits  = 0
-        etotal= 0
-        for offset in range(len(seq)-width+1):
-            total_f = 0
-            total_r = 0
-            for i,ir in width_ranges:
-                pos = offset+i
-                total_f = total_f + ll[i][    seq[pos]]
-                total_r = total_r + ll[i][seqcomp[pos]]
-            total_max = max(total_f,total_r)
-            if total_max >= threshold:
-                total = total + total_max
-                etotal = etotal + math.exp(total_max)
-                hits  = hits + 1
-            if not hits:
-                ave = 0
-            else:
-                ave = float(total)/float(hits)
+        seqcomp          = seq.translate(revcompTBL)
+        total_f, total_r = self._windowscores(encode_seq(seq),encode_seq(seqcomp),reverse=False)
+        total_max        = numpy.maximum(total_f,total_r)
+        total_max        = total_max[total_max >= threshold]
+        hits   = len(total_max)
+        total  = float(total_max.sum())
+        etotal = float(numpy.exp(total_max).sum())
+        if not hits:
+            ave = 0
+        else:
+            ave = total/float(hits)
         return(total,hits,ave,math.log(etotal))
     def score(self, seq, fwd='Y'):
         """
@@ -841,57 +887,86 @@ class Motif:
         """
         m.bestscore(seq, fwd='') -- Returns the score of the best matching subsequence in seq.
         """
-        matches, endpoints, scores = self._scan(seq,threshold=-100000,forw_only=fwd)
-        if scores: return max(scores)
-        else:      return -1000
+        return self.bestscores([seq],fwd)[0]
+    def bestscores(self,seqs, fwd=''):
+        """
+        m.bestscores(seqs, fwd='') -- Returns the score of the best matching subsequence in each of seqs
+                                      (-1000 for sequences shorter than the motif).
+        """
+        best = []
+        for seq,total_f,total_r in self._windowscoresmany(seqs):
+            if len(total_f):
+                best.append(float(numpy.where(self._forward(total_f,total_r,-100000,fwd),
+                                              total_f,total_r).max()))
+            else:
+                best.append(-1000)
+        return best
+
+    def _windowscores(self, codes, compcodes, reverse=True):
+        """
+        m._windowscores(codes, compcodes, reverse=True) -- [utility] Score every window of an integer-encoded
+                                                           sequence (see encode_seq) on both strands at once.
+                                                           Returns forward and reverse (complement) score arrays.
+
+        The complement is scored against the motif reversed, unless reverse is false.  Scores are
+        accumulated one motif position at a time over all windows, in the order m.ll used to be summed in.
+        """
+        ll      = self._llarray()
+        width   = self.width
+        n       = max(len(codes)-width+1,0)
+        total_f = numpy.zeros(n)
+        total_r = numpy.zeros(n)
+        for i in range(width):
+            ir = width-i-1 if reverse else i
+            total_f += ll[i ][    codes[i:i+n]]
+            total_r += ll[ir][compcodes[i:i+n]]
+        return total_f, total_r
+
+    def _windowscoresmany(self, seqs):
+        """
+        m._windowscoresmany(seqs) -- [utility] Generates (seq, forward scores, reverse scores) for each sequence.
+                                     The sequences are scored in a single pass over their concatenation,
+                                     windows spanning two sequences are dropped.
+        """
+        seqs   = list(seqs)
+        joined = ''.join(seqs).upper()
+        total_f, total_r = self._windowscores(encode_seq(joined),encode_seq(joined.translate(revcompTBL)))
+        start = 0
+        for seq in seqs:
+            n = max(len(seq)-self.width+1,0)
+            yield seq, total_f[start:start+n], total_r[start:start+n]
+            start = start + len(seq)
+
+    def _forward(self, total_f, total_r, threshold, forw_only=''):
+        """
+        m._forward(total_f, total_r, threshold, forw_only='') -- [utility] Which windows match on the forward strand
+        """
+        fwd = total_f > threshold
+        if not forw_only:
+            fwd &= total_f > total_r
+        return fwd
+
+    def _hits(self, seq, total_f, total_r, threshold, forw_only=''):
+        """
+        m._hits(seq, total_f, total_r, threshold, forw_only='') -- [utility] Collect (matches, endpoints, scores)
+                                                                   of the windows scoring above threshold
+        """
+        fwd     = self._forward(total_f,total_r,threshold,forw_only)
+        offsets = numpy.flatnonzero(fwd | (total_r > threshold))
+        scores  = numpy.where(fwd,total_f,total_r)[offsets]
+        width   = self.width
+        offsets = offsets.tolist()
+        matches   = [seq[offset:offset+width] for offset in offsets]
+        endpoints = [(offset,offset+width-1) for offset in offsets]
+        return(matches,endpoints,scores.tolist())
 
     def _scan(self, seq,threshold='',forw_only='',factor=0.7):
         """
         m._scan(seq,threshold='',forw_only='',factor=0.7) -- Internal tility function for performing sequence scans
         """
-        ll = self.ll #Shortcut for Log-likelihood matrix
         if not threshold: threshold = factor * self.maxscore
-        
-        #print '%5.3f'%(threshold/self.maxscore)
-        matches       = []
-        endpoints     = []
-        scores        = []
-        width         = self.width
-        width_r       = range(width)
-        width_rcr     = range(width-1,-1,-1)
-        width_ranges  = zip(width_r,width_rcr)
-
-        
-        oseq = seq
-        seq  = seq.upper()
-        seqcomp = seq.translate(revcompTBL)
-        for offset in range(len(seq)-self.width+1):    #Check if +/-1 needed
-            total_f = 0
-            total_r = 0
-            for i,ir in width_ranges:
-                pos = offset+i
-                total_f = total_f + ll[i ][    seq[pos]]
-                total_r = total_r + ll[ir][seqcomp[pos]]
-
-            if 0 and total_f > 1:
-                for i,ir in width_ranges:
-                    print seq[offset+i],'%6.3f'%ll[i ][        seq[offset+i] ],'   ',
-                print '= %7.3f'%total_f
-                
-            if 0:
-                print "\t\t%s vs %s: F=%6.2f R=%6.2f %6.2f %4.2f"%(seq[offset:offset+self.width],
-                                                                   self.oneletter,total_f,total_r,
-                                                                   self.maxscore,
-                                                                   max([total_f,total_r])/self.maxscore)
-            if total_f > threshold and ((total_f > total_r) or forw_only):
-                endpoints.append( (offset,offset+self.width-1) )
-                scores.append(total_f)
-                matches.append(oseq[offset:offset+self.width])
-            elif total_r > threshold:
-                endpoints.append( (offset,offset+self.width-1) )
-                scores.append(total_r)
-                matches.append(oseq[offset:offset+self.width])
-        return(matches,endpoints,scores)
+        oseq, total_f, total_r = next(self._windowscoresmany([seq]))
+        return self._hits(oseq,total_f,total_r,threshold,forw_only)
     def _scan_smaller(self, seq, threshold=''):
         """
         m._scan_smaller(seq, threshold='') -- Internal utility function for performing sequence scans
@@ -899,36 +974,26 @@ class Motif:
         The sequence is smaller than the PSSM.  Are there
         good matches to regions of the PSSM?
         """
-        ll = self.ll #Shortcut for Log-likelihood matrix
-        matches   = []
-        endpoints = []
-        scores    = []
+        ll        = self._llarray()
         w         = self.width
         oseq      = seq
         seq       = seq.upper()
-        for offset in range(self.width-len(seq)+1):    #Check if +/-1 needed
+        offsets   = numpy.arange(max(w-len(seq)+1,0))    #Check if +/-1 needed
+        if not len(offsets):
+            return([],[],[])
+        if not threshold:
             maximum = 0
             for i in range(len(seq)):
-                maximum = maximum + max(ll[i+offset].values())
-            if not threshold: threshold = 0.8 * maximum
-            total_f = 0
-            total_r = 0
-            for i in range(len(seq)):
-                total_f = total_f + ll[i+offset      ][        seq[i] ]
-                total_r = total_r + ll[w-(i+offset)-1][revcomp[seq[i]]]
-            if 0:
-                print "\t\t%s vs %s: F=%6.2f R=%6.2f %6.2f %4.2f"%(oseq, self.oneletter[offset:offset+len(seq)],
-                                                                   total_f, total_r,  maximum,
-                                                                   max([total_f,total_r])/self.maxscore)
-            if total_f > threshold and total_f > total_r:
-                endpoints.append( (offset,offset+self.width-1) )
-                scores.append(total_f)
-                matches.append(oseq[offset:offset+self.width])
-            elif total_r > threshold:
-                endpoints.append( (offset,offset+self.width-1) )
-                scores.append(total_r)
-                matches.append(oseq[offset:offset+self.width])
-        return(matches,endpoints,scores)                
+                maximum = maximum + max(self.ll[i].values())
+            threshold = 0.8 * maximum
+        codes   = encode_seq(seq)
+        rccodes = encode_seq(''.join([revcomp[L] for L in seq]))
+        total_f = numpy.zeros(len(offsets))
+        total_r = numpy.zeros(len(offsets))
+        for i in range(len(seq)):
+            total_f += ll[offsets+i      ,   codes[i]]
+            total_r += ll[w-(offsets+i)-1, rccodes[i]]
+        return self._hits(oseq,total_f,total_r,threshold)
 
     def mask_seq(self,seq):
         """
@@ -1195,97 +1260,151 @@ class Motif:
 
 def minwindowdiff(M1,M2,overlap=5,diffmethod='diff'):
     """
-    m.minwindowdiff(M1,M2,overlap=5,diffmethod='diff')
+    m.minwindowdiff(M1,M2,overlap=5,diffmethod='diff') -- Minimum distance between any window of 'overlap'
+                                                           columns of the narrower motif and any window of
+                                                           the other motif or its reverse complement
     """
     #Alternate method: maskdiff, infomaskdiff
     if type(M1) != type(M2):
         print "Error: Attempted to compute alignment of objects that are not both Motifs"
         print "       types %s: %s  and %s: %s"%(M1,type(M1),M2,type(M2))
         sys.exit(1)
-
-    if M1.width <= M2.width: A = M1; Borig = M2
-    else:                    A = M2; Borig = M1
-    wA = A.width
-    wB = Borig.width
-    O  = overlap
-
-    if   diffmethod == 'diff':
-        diff_fcn = diff
-    elif diffmethod == 'maskdiff':
-        diff_fcn = maskdiff
-    elif diffmethod == 'infomaskdiff':
-        diff_fcn = infomaskdiff
-        
-    mindiff = 1000
-    #print 'minwindodebug    wA ', wA, 'wB ', wB, 'O ', O, 'wA-0', wA-O, 'wB-O', wB-O
-    for Astart in range(wA-O+1):
-        subA = A[Astart:Astart+O]
-        for B in [Borig, Borig.revcomp()]:
-            for Bstart in range(wB-O+1):
-                subB = B[Bstart:Bstart+O]
-                mindiff = min(mindiff, diff_fcn(subA,subB))
-                #print 'minwindodebug     ',subA, subB, diff_fcn(subA,subB)
-    return(mindiff)
-    
+    return minwindowdiffP(probarray(M1),probarray(M2),overlap,diffmethod,M1.background,M2.background)
 
 def minaligndiff(M1,M2,overlap=5,diffmethod='diff'):
+    """
+    m.minaligndiff(M1,M2,overlap=5,diffmethod='diff') -- Minimum distance between M1 and M2 over all
+                                                          alignments of the motifs (and the reverse
+                                                          complement of the wider one) that overlap
+                                                          by at least 'overlap' columns
+    """
     #Alternate method: maskdiff, infomaskdiff
     if type(M1) != type(M2):
         print "Error: Attempted to compute alignment of objects that are not both Motifs"
         print "       types %s: %s  and %s: %s"%(M1,type(M1),M2,type(M2))
         sys.exit(1)
+    return minaligndiffP(probarray(M1),probarray(M2),overlap,diffmethod,M1.background,M2.background)
 
-    if M1.width <= M2.width:
-        A = M1; Borig = M2
-        switch = 0
-    else:
-        A = M2; Borig = M1
-        switch = 1
-    wA = A.width
-    wB = Borig.width
+def minwindowdiffP(P1,P2,overlap=5,diffmethod='diff',bg1=None,bg2=None):
+    """
+    minwindowdiffP(P1,P2,overlap=5,diffmethod='diff',bg1=None,bg2=None) -- minwindowdiff of two probability
+                                                                            matrices (see probarray), with
+                                                                            all windows compared at once.
+                                                                            bg1/bg2 are the backgrounds
+                                                                            (needed by maskdiff, infomaskdiff)
+    """
+    if len(P1) <= len(P2): A = P1; B = P2; bg = bg2
+    else:                  A = P2; B = P1; bg = bg1
+    wA = len(A)
+    wB = len(B)
     O  = overlap
+    if wA < O: return(1000)
 
-    '''
+    #Windows of B and of its reverse complement (stacked after B)
+    Astarts, Bstarts = numpy.meshgrid(numpy.arange(wA-O+1),
+                                      numpy.concatenate([numpy.arange(wB-O+1),wB+numpy.arange(wB-O+1)]))
+    Ds = windowdiffs(A,numpy.concatenate([B,B[::-1,::-1]]),Astarts.ravel(),Bstarts.ravel(),O,diffmethod,bg)
+    return _mindiff(Ds)
+
+def minaligndiffP(P1,P2,overlap=5,diffmethod='diff',bg1=None,bg2=None):
+    """
+    minaligndiffP(P1,P2,overlap=5,diffmethod='diff',bg1=None,bg2=None) -- minaligndiff of two probability
+                                                                           matrices (see probarray), with
+                                                                           all alignments compared at once.
+                                                                           bg1/bg2 are the backgrounds
+                                                                           (needed by maskdiff, infomaskdiff)
+    
     Here is the figure to imagine:
        012345678901234567890   wA: 6  Bstart: 6-3     = 3
          A         (A)         wB: 11 Bstop:  6+11-3-1= 13
        ------     %%%%%%        O: 3  lastA:  6+11-3-3= 11
           -----------
           |O|  B
-    '''
+    """
+    if len(P1) <= len(P2): A = P1; B = P2; switch = 0
+    else:                  A = P2; B = P1; switch = 1
+    wA = len(A)
+    wB = len(B)
+    O  = overlap
+
+    #Shifts of B relative to A (column i of A faces column i+shift of B) that overlap by O or more
+    shifts  = numpy.arange(-(wA-O),wB-O+1)
+    Astarts = numpy.maximum(0,-shifts)
+    Bstarts = numpy.maximum(0, shifts)
+    lengths = numpy.minimum(wA-Astarts,wB-Bstarts)
+    overlaps = lengths > 0
+    Astarts, Bstarts, lengths = Astarts[overlaps], Bstarts[overlaps], lengths[overlaps]
+
+    #Both strands of B at once, the reverse complement is stacked after B
+    Bboth   = numpy.concatenate([B,B[::-1,::-1]])
+    Astarts = numpy.concatenate([Astarts,Astarts])
+    Bstarts = numpy.concatenate([Bstarts,wB+Bstarts])
+    lengths = numpy.concatenate([lengths,lengths])
+    if switch: Ds = windowdiffs(Bboth,A,Bstarts,Astarts,lengths,diffmethod,bg2)
+    else:      Ds = windowdiffs(A,Bboth,Astarts,Bstarts,lengths,diffmethod,bg2)
+    return _mindiff(Ds)
+
+def _mindiff(Ds):
+    """
+    _mindiff(Ds) -- [utility] Smallest of the distances (at most 1000), skipping undefined ones
+    """
+    Ds = Ds[~numpy.isnan(Ds)]
+    if not len(Ds): return(1000)
+    return(min(1000,float(Ds.min())))
+
+def windowdiffs(P1,P2,starts1,starts2,lengths,diffmethod='diff',bg2=None):
+    """
+    windowdiffs(P1,P2,starts1,starts2,lengths,diffmethod='diff',bg2=None) -- diff(P1[s1:s1+l],P2[s2:s2+l])
+                   (or maskdiff, infomaskdiff) for each s1,s2,l of starts1, starts2 and lengths, computed for
+                   all windows at once.  bg2 is the background of P2.  Windows that maskdiff masks completely
+                   are NaN.
+    """
+    P1 = numpy.asarray(P1)
+    P2 = numpy.asarray(P2)
+    starts1 = numpy.asarray(starts1)[:,None]
+    starts2 = numpy.asarray(starts2)[:,None]
+    lengths = numpy.asarray(lengths)
+    if lengths.ndim: lengths = lengths[:,None]
+    if not len(starts1): return numpy.zeros(0)
+    pos   = numpy.arange(numpy.max(lengths))[None,:]
+    valid = pos < lengths
+    i1    = numpy.minimum(starts1+pos,len(P1)-1)
+    i2    = numpy.minimum(starts2+pos,len(P2)-1)
+    coldiffs = numpy.sqrt(((P1[i1]-P2[i2])**2).sum(-1))/math.sqrt(2.0)
 
     if   diffmethod == 'diff':
-        diff_fcn = diff
+        weights = valid.astype(float)
     elif diffmethod == 'maskdiff':
-        diff_fcn = maskdiff
+        '''Implements mask: columns of P2 at the background are skipped'''
+        delta   = P2 - numpy.array([bg2[L] for L in ACGT])
+        kept    = ((delta <= -0.01) | (delta >= 0.01)).any(1)
+        weights = (valid & kept[i2]).astype(float)
     elif diffmethod == 'infomaskdiff':
-        diff_fcn = infomaskdiff
-    
-    Bstart = wA-O
-    Bstop  = wA+wB-O-1
-    lastA  = wA+wB-O-O
-    Dmin = 1000
-    Dmins=[]
-    #print A
-    #print '%s%s'%(' '*Bstart,Borig)
-    for B in [Borig, Borig.revcomp()]:
-        for start in range(0,lastA+1):
-            Bpos = []
-            Apos = []
-            for offset in range(wA):
-                abs = start+offset
-                if abs >= Bstart and abs <= Bstop:
-                    Apos.append(offset)
-                    Bpos.append(abs-Bstart)
-            subA = A[min(Apos),max(Apos)+1]
-            subB = B[min(Bpos),max(Bpos)+1]
-            #print '%s%s\n%s%s  %f'%(
-            #    ' '*start, subA,
-            #    ' '*start, subB,   diff_fcn(subA,subB))
-            if switch: _diff = diff_fcn(subB,subA)
-            else:      _diff = diff_fcn(subA,subB)
-            Dmin = min(Dmin, _diff)
-    return(Dmin)
+        '''Scales column distances by the information content of P2'''
+        weights = numpy.where(valid,bitsarray(P2,bg2)[i2],0.0)
+    else:
+        raise ValueError("Unknown diffmethod: %s"%diffmethod)
+
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        Ds = (coldiffs*weights).sum(1)/weights.sum(1)
+    if diffmethod == 'infomaskdiff':
+        Ds = numpy.where(weights.max(1) < 0.1,1.0,Ds)  #There is nothing important here
+    return Ds
+
+def probarray(M):
+    """
+    probarray(M) -- Probability matrix of M as a (width x 4) array, columns in ACGT order (so the
+                    reverse complement is P[::-1,::-1])
+    """
+    return numpy.array([[math.pow(2,M.logP[i][L]) for L in ACGT] for i in range(M.width)]).reshape(M.width,4)
+
+def bitsarray(P,bg):
+    """
+    bitsarray(P,bg) -- Information content (bits) of each column of a probability matrix, as m.bits
+    """
+    UNCERT = lambda x: numpy.where(x > 0,x*numpy.log(numpy.maximum(x,1e-300))/math.log(2.0),0.0)
+    bgbits = UNCERT(numpy.array([bg[L] for L in ACGT])).sum()
+    return numpy.maximum(0,UNCERT(numpy.asarray(P)).sum(-1)-bgbits)
     
 '''
 To compare 2 motifs of the same width, there are these five functions:
@@ -1313,6 +1432,9 @@ required while sliding.  Below, overlap is '2'.  The default is '5'.
 You can optionally specify the distance metric as a text string.
 The default is 'diff'.
 
+minaligndiffP and minwindowdiffP do the same for probability matrices
+(see probarray), scoring all alignments at once.
+
 '''
 
 
@@ -1,50 +1,93 @@
 import traceback
+import resource
 import sys
 
-from multiprocessing import Process, current_process, Lock, Value
+from multiprocessing import Process
 
 
 class AbSeqWorker(Process):
-    ops = FASTQC, ANNOT, ABUN, PROD, DIVER, SECR, UTR5, RSA, PRIM, SEQLEN = 'runFastqc', 'annotateClones', \
-                                                                          'analyzeAbundance',\
-                                                                          'analyzeProductivity',\
-                                                                          'analyzeDiversity', \
-                                                                          'analyzeSecretionSignal',\
-                                                                          'analyze5UTR', \
-                                                                          'analyzeRestrictionSites', \
-                                                                          'analyzePrimerSpecificity', \
-                                                                          'analyzeSeqLen'
+    ops = FASTQC, MERGE, ANNOT, ABUN, PROD, DIVER, SECR, UTR5, RSA, PRIM, SEQLEN = 'runFastqc', \
+                                                                                'mergePairedReads', \
+                                                                                'annotateClones', \
+                                                                                'analyzeAbundance',\
+                                                                                'analyzeProductivity',\
+                                                                                'analyzeDiversity', \
+                                                                                'analyzeSecretionSignal',\
+                                                                                'analyze5UTR', \
+                                                                                'analyzeRestrictionSites', \
+                                                                                'analyzePrimerSpecificity', \
+                                                                                'analyzeSeqLen'
 
-    def __init__(self, repertoire, resultQueue, resourcePool):
+    # stages that have to complete before an op starts, when they are part of the same sample's run. Every op
+    # reloads what it needs from its predecessors' output files (the annotation stage leaves the read counts and
+    # the filtering behind, see IgRepertoire._loadAnnot), so dependencies that are not part of the run are
+    # (re)computed by the op itself
+    requires = {
+        FASTQC: [],
+        MERGE: [],
+        ANNOT: [MERGE],
+        ABUN: [ANNOT],
+        PROD: [ANNOT],
+        DIVER: [PROD],
+        SECR: [ANNOT],
+        UTR5: [ANNOT],
+        RSA: [ANNOT],
+        # the primer analysis adds its columns to the unrefined annotation
+        PRIM: [ANNOT],
+        SEQLEN: [MERGE]
+    }
+
+    # ops that only ever use one core, the others (external tools, worker processes) use the sample's threads
+    singleThreaded = {ABUN, SEQLEN}
+
+    def __init__(self, repertoire, resultQueue, stage, cores):
+        """
+        runs one stage of a repertoire in its own process
+
+        :param repertoire: IgRepertoire
+        :param resultQueue: queue, ('done', stage key, peak memory in bytes) or
+                            ('failed', stage key, (message, errors, traceback)) is put on it when the stage finishes
+        :param stage: Stage
+        :param cores: int, number of cores granted to the stage
+        """
         super(AbSeqWorker, self).__init__()
         self.repertoire = repertoire
         self.resultQueue = resultQueue
-        self.resourcePool = resourcePool
+        self.stage = stage
+        self.cores = cores
 
     def run(self):
-        while True:
+        self.repertoire.threads = self.cores
+        try:
+            self.repertoire.runStage(self.stage.op, self.stage.kwargs)
+            self.resultQueue.put(('done', self.stage.key, peakMemory(self.cores)))
+        except Exception as e:
+            exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+            fmtMsg = ("Job name: " + str(self.repertoire.name) + " :: An error occurred while processing " +
+                      str(self.stage.op))
+            self.resultQueue.put(('failed', self.stage.key,
+                                  (str(e), fmtMsg, traceback.format_exception(exceptionType, exceptionValue,
+                                                                              exceptionTraceback))))
 
-            task, args, kwargs = self.repertoire._nextTask()
-            if task is None:
-                # all jobs done for this repertoire
-                self.repertoire._minimize()
-                self.resultQueue.put(self.repertoire)
-                # return resource to available pool
-                self.resourcePool.increment(self.repertoire.threads)
-                break
-            try:
-                self.repertoire.threads += self.resourcePool.consume()
-                getattr(self.repertoire, task)(*args, **kwargs)
-            except Exception as e:
-                exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-                fmtMsg = ("Job name: " + str(self.repertoire.name) + " :: An error occurred while processing " +
-                          str(task))
-                newE = e.message
-                if self.resultQueue is not None:
-                    self.resultQueue.put((newE, fmtMsg, traceback.format_exception(exceptionType, exceptionValue,
-                                                                                   exceptionTraceback)))
+    @staticmethod
+    def dependencies(op, ops):
+        """
+        :param op: string, one of AbSeqWorker.ops
+        :param ops: collection of the ops of the run
+        :return: list of the ops of the run that op has to wait for, directly or through ops that are not part of
+                 the run
+        """
+        waitFor, pending, seen = [], list(AbSeqWorker.requires[op]), set()
+        while pending:
+            dep = pending.pop()
+            if dep in seen:
                 continue
-        return
+            seen.add(dep)
+            if dep in ops:
+                waitFor.append(dep)
+            else:
+                pending.extend(AbSeqWorker.requires[dep])
+        return waitFor
 
 
 class AbSeqWorkerException(Exception):
@@ -54,28 +97,14 @@ class AbSeqWorkerException(Exception):
         self.tracebackMsg = ''.join(tracebackMsg)
 
 
-class ResourcePool:
-    # https://eli.thegreenplace.net/2012/01/04/shared-counter-with-pythons-multiprocessing
-    # beware multiprocessing.Value doesn't actually guarantee that 2 processes wont access the value at the same time,
-    # we need to warp it with a lock
-    def __init__(self, initResource):
-        self._lock = Lock()
-        self.n = Value('i', initResource)
-
-    def increment(self, n=1):
-        with self._lock:
-            self.n.value += n
-            assert self.n.value >= 0
-
-    def value(self):
-        with self._lock:
-            return self.n.value
-
-    def consume(self):
-        with self._lock:
-            if self.n.value > 0:
-                n = self.n.value
-                self.n.value = 0
-                return n
-            return 0
-
+def peakMemory(cores=1):
+    """
+    :param cores: int, number of worker processes the calling process may have run at once
+    :return: int, peak resident memory in bytes of the calling process plus cores times its largest
+             child process (worker processes and external tools), as if all children peaked at once
+    """
+    # kilobytes on linux, bytes on darwin
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (own + cores * children) * unit
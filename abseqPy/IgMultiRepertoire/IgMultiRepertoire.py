@@ -4,9 +4,12 @@ import sys
 import math
 
 from multiprocessing import Queue, cpu_count
+from Queue import Empty
 
-from abseqPy.config import AUX_FOLDER
-from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker, AbSeqWorkerException, ResourcePool
+from abseqPy.config import AUX_FOLDER, MEM_GB, GB
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker, AbSeqWorkerException
+from abseqPy.IgMultiRepertoire.MemoryModel import MemoryModel, estimateReads
+from abseqPy.IgMultiRepertoire.StageScheduler import Stage, StageScheduler
 from abseqPy.IgRepertoire.IgRepertoire import IgRepertoire
 from abseqPy.argsParser import parseYAML, parseArgs
 
@@ -31,25 +34,75 @@ class IgMultiRepertoire:
         availCPUs = cpu_count()
         requestedCPU = sum([s.threads for s in self.buffer])
 
-        if availCPUs and  requestedCPU > availCPUs:
+        # global budget of cores, shared by the stages of all samples
+        self.cores = requestedCPU
+        if availCPUs and requestedCPU > availCPUs:
             # only use 80% of max CPU please
-            cappedCPU = math.floor(availCPUs * 0.8)
+            self.cores = max(int(math.floor(availCPUs * 0.8)), 1)
 
             print("Detected {} available CPUs but jobs are running {}"
                   " processes in total.".format(availCPUs, requestedCPU))
-            print("Capping total processes to {}.".format(cappedCPU))
+            print("Capping total processes to {}.".format(self.cores))
             print("Please refer to abseqPy's README, under the 'Gotcha' section to learn more about this message.")
 
-            perSampleProcess = int(math.floor((cappedCPU * 1.0) / len(self.buffer)))
-
-            for sample in self.buffer:
-                sample.threads = max(perSampleProcess, 1)
-                sample.args['threads'] = sample.threads
-
-            # make sure that we're not going over the capped value unless there's already more samples than there
-            # are CPU counts, in that occasion, the code snippet above should've assigned (1) to sample.threads for
-            # all samples.
-            assert sum([s.threads for s in self.buffer]) <= cappedCPU or all([s.threads == 1 for s in self.buffer])
+        # global memory budget, stages are admitted as long as their estimated peaks fit in it
+        memory = getattr(args, 'memory', None)
+        self.memory = int((memory if memory is not None else MEM_GB * 0.8) * GB)
+        self.memoryModel = MemoryModel()
+        for rep in self.buffer:
+            self.memoryModel.load(rep.auxDir)
+        self.reads = [estimateReads(rep.readFile1) for rep in self.buffer]
+
+    def _scheduler(self):
+        """
+        :return: StageScheduler with the stages of every sample. A stage can use up to its sample's threads, or
+                 one core if it is single threaded
+        """
+        scheduler = StageScheduler(self.cores, self.memory)
+        for i, rep in enumerate(self.buffer):
+            ops = [op for op, _ in rep._tasks]
+            for op, kwargs in rep._tasks:
+                cores = 1 if op in AbSeqWorker.singleThreaded else min(rep.threads, self.cores)
+                scheduler.add(Stage(i, op, kwargs, cores=cores, memory=self.memoryModel.estimate(op, self.reads[i]),
+                                    after=AbSeqWorker.dependencies(op, ops)))
+        return scheduler
+
+    def _measured(self, scheduler, key, peak):
+        """
+        records the peak memory of a completed stage and re-estimates the stages of the same op that have not
+        started yet
+
+        :param scheduler: StageScheduler
+        :param key: (sample, op) tuple of the completed stage
+        :param peak: int, its peak memory in bytes
+        :return: None
+        """
+        sample, op = key
+        self.memoryModel.record(op, self.reads[sample], peak, self.buffer[sample].auxDir)
+        for stage in scheduler.stages.values():
+            if stage.op == op and stage.key not in scheduler.running and stage.key not in scheduler.completed:
+                stage.memory = self.memoryModel.estimate(op, self.reads[stage.sample])
+
+    def _nextResult(self, workers):
+        """
+        :param workers: dict of running AbSeqWorkers
+        :return: the next result put on the queue by a worker. A worker that died without reporting (e.g. killed
+                 by the OS) is reported as failed
+        """
+        while True:
+            try:
+                return self.result.get(timeout=5)
+            except Empty:
+                dead = [key for key, w in workers.items() if w.exitcode is not None]
+                if dead:
+                    try:
+                        # the worker might have reported right before exiting
+                        return self.result.get(timeout=1)
+                    except Empty:
+                        rep, w = self.buffer[dead[0][0]], workers[dead[0]]
+                        return ('failed', dead[0], ("exit code {}".format(w.exitcode),
+                                                    "Job name: {} :: {} exited unexpectedly"
+                                                    .format(rep.name, dead[0][1]), []))
 
     def __enter__(self):
         return self
@@ -60,29 +113,24 @@ class IgMultiRepertoire:
         self.result.join_thread()
 
     def start(self):
-
-        # resource pool - initially all consumed by repertoire objects
-        resourcePool = ResourcePool(0)
-
-        # initialize workers
-        workers = [AbSeqWorker(rep, self.result, resourcePool) for rep in self.buffer]
+        scheduler = self._scheduler()
+        workers = {}
 
         try:
-            # start workers
-            for w in workers:
-                w.start()
-
-            # wait for all workers to complete
-            for i in range(self.sampleCount):
-                res = self.result.get()
-                if isinstance(res, tuple):
+            while not scheduler.done():
+                for stage, cores in scheduler.admit():
+                    workers[stage.key] = AbSeqWorker(self.buffer[stage.sample], self.result, stage, cores)
+                    workers[stage.key].start()
+
+                # wait for any stage to complete
+                res = self._nextResult(workers)
+                if res[0] == 'failed':
                     # XXX: encountered an exception! - here, decide to raise it immediately.
                     # all accompanying processes will halt immediately due to this raise.
-                    raise AbSeqWorkerException(*res)
-                self.buffer.append(res)
-
-            for w in workers:
-                w.join()
+                    raise AbSeqWorkerException(*res[2])
+                workers.pop(res[1]).join()
+                scheduler.finish(res[1])
+                self._measured(scheduler, res[1], res[2])
             # done
 
         except AbSeqWorkerException as e:
@@ -98,6 +146,5 @@ class IgMultiRepertoire:
         except Exception as e:
             raise e
         finally:
-            for w in workers:
+            for w in workers.values():
                 w.terminate()
-
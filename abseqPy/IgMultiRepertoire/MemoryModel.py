@@ -0,0 +1,155 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import json
+import zlib
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgRepertoire.igRepUtils import detectFileFormat
+
+
+MB = 1024 ** 2
+
+# rough (fixed, per read) peak memory of each op in bytes, used until the op has been measured
+DEFAULT_COSTS = {
+    AbSeqWorker.FASTQC: (512 * MB, 0),
+    AbSeqWorker.MERGE: (256 * MB, 0),
+    AbSeqWorker.ANNOT: (256 * MB, 2048),
+    AbSeqWorker.ABUN: (192 * MB, 1024),
+    AbSeqWorker.PROD: (256 * MB, 4096),
+    AbSeqWorker.DIVER: (256 * MB, 3072),
+    AbSeqWorker.SECR: (256 * MB, 2048),
+    AbSeqWorker.UTR5: (256 * MB, 2048),
+    AbSeqWorker.RSA: (256 * MB, 3072),
+    AbSeqWorker.PRIM: (256 * MB, 3072),
+    AbSeqWorker.SEQLEN: (192 * MB, 128)
+}
+
+
+class MemoryModel(object):
+    """
+    estimates the peak memory of a stage as fixed + perRead * reads. Every op starts from DEFAULT_COSTS, once an op
+    has been measured (in this run or in a previous run over the same output directories), its per read cost is
+    the largest one measured.
+    """
+
+    # measured peaks of a sample's stages, in the sample's auxiliary directory
+    HISTORY = "stage_memory.json"
+
+    def __init__(self):
+        self.measured = {}
+
+    def load(self, directory):
+        """
+        :param directory: string, a sample's auxiliary directory
+        :return: None, the measurements recorded in directory (if any) are added to the model
+        """
+        filename = os.path.join(directory, self.HISTORY)
+        if not os.path.exists(filename):
+            return
+        try:
+            with open(filename) as fp:
+                history = json.load(fp)
+        except ValueError:
+            # interrupted write, the defaults will do
+            return
+        for op, (reads, peak) in history.items():
+            if op in DEFAULT_COSTS:
+                self._add(str(op), reads, peak)
+
+    def _add(self, op, reads, peak):
+        fixed, _ = DEFAULT_COSTS[op]
+        perRead = max(peak - fixed, 0) / max(reads, 1)
+        self.measured[op] = max(self.measured.get(op, 0), perRead)
+
+    def record(self, op, reads, peak, directory=None):
+        """
+        :param op: string, one of AbSeqWorker.ops
+        :param reads: int, number of reads of the sample
+        :param peak: int, measured peak memory of the stage in bytes
+        :param directory: string, the sample's auxiliary directory, the measurement is saved there if not None
+        :return: None
+        """
+        self._add(op, reads, peak)
+        if directory is None:
+            return
+        filename = os.path.join(directory, self.HISTORY)
+        history = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fp:
+                    history = json.load(fp)
+            except ValueError:
+                pass
+        history[op] = [reads, peak]
+        with open(filename, 'w') as fp:
+            json.dump(history, fp)
+
+    def estimate(self, op, reads):
+        """
+        :param op: string, one of AbSeqWorker.ops
+        :param reads: int, number of reads of the sample
+        :return: int, estimated peak memory in bytes
+
+        >>> model = MemoryModel()
+        >>> model.estimate(AbSeqWorker.PROD, 10 ** 6) // MB
+        4162
+        >>> model.record(AbSeqWorker.PROD, 10 ** 5, 300 * MB)
+        >>> model.estimate(AbSeqWorker.PROD, 10 ** 6) // MB
+        696
+        """
+        fixed, perRead = DEFAULT_COSTS[op]
+        perRead = self.measured.get(op, perRead)
+        return int(fixed + perRead * reads)
+
+
+def estimateReads(filename, sampleSize=MB):
+    """
+    estimates the number of reads in a FASTA / FASTQ file (can be gzipped) from its first sampleSize bytes
+
+    :param filename: string
+    :param sampleSize: int, number of (compressed) bytes to look at
+    :return: int, exact if the whole file fits in sampleSize
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as fp:
+        raw = fp.read(sampleSize)
+    if filename.endswith('.gz'):
+        text = _gunzip(raw)
+    else:
+        text = raw
+    whole = len(raw) < sampleSize
+    if detectFileFormat(filename) == 'fastq':
+        # only complete lines are counted, unless the whole file was read
+        lines = text.count(b'\n') + (whole and len(text) > 0 and not text.endswith(b'\n'))
+        records = lines // 4
+    else:
+        records = text.count(b'>')
+    if whole:
+        return records
+    return int(records * size / len(raw))
+
+
+def _gunzip(raw):
+    """
+    :param raw: bytes, the start of a gzip file
+    :return: bytes, as much of it as can be decompressed. Every gzip member is read, files written in blocks
+             (e.g. BGZF or concatenated gzip files) have many of them
+    """
+    text = []
+    while raw:
+        # 16 + MAX_WBITS expects a gzip header
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            text.append(decompressor.decompress(raw))
+        except zlib.error:
+            # trailing garbage (e.g. zero padding) after the last member
+            break
+        raw = decompressor.unused_data
+    return b''.join(text)
@@ -0,0 +1,152 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+
+
+class Stage(object):
+    """
+    one analysis step (an IgRepertoire method) of one sample
+    """
+
+    def __init__(self, sample, op, kwargs=None, cores=1, memory=0, after=()):
+        """
+        :param sample: int, index of the sample
+        :param op: string, name of the IgRepertoire method to run
+        :param kwargs: dict, keyword arguments of op
+        :param cores: int, number of cores the stage can make use of
+        :param memory: int, estimated peak memory of the stage in bytes
+        :param after: iterable of the ops (of the same sample) that have to complete before this stage starts
+        """
+        self.sample = sample
+        self.op = op
+        self.kwargs = kwargs or {}
+        self.cores = max(int(cores), 1)
+        self.memory = memory
+        self.after = set((sample, dep) for dep in after)
+        # number of stages on the longest chain of stages waiting for this one, set by the scheduler
+        self.depth = 0
+
+    @property
+    def key(self):
+        return self.sample, self.op
+
+    def __repr__(self):
+        return "Stage({}, {})".format(self.sample, self.op)
+
+
+class StageScheduler(object):
+    """
+    schedules the stages of all samples on a global budget of cores. A stage is ready once the stages it comes
+    after have completed. Ready stages are started by priority (stages with the longest chain of stages waiting
+    for them first, then in sample order) as long as their cores fit in what is left of the budget, so that the
+    multi-threaded stages of one sample (e.g. IgBLAST) overlap with the single-threaded stages (e.g. reporting)
+    of others.
+
+    A stage that does not fit is started with fewer cores when at least half of them are free, or when nothing
+    else is running, so that the budget is never left idle waiting for an exact fit. Stages are only admitted
+    while the estimated peak memory of the running stages fits in the memory budget, a stage that does not fit
+    waits (unless nothing else is running) and smaller stages are considered instead.
+
+    >>> scheduler = StageScheduler(4)
+    >>> scheduler.add(Stage(0, 'annotate', cores=4))
+    >>> scheduler.add(Stage(0, 'report', after=['annotate']))
+    >>> scheduler.add(Stage(1, 'annotate', cores=4))
+    >>> scheduler.admit()
+    [(Stage(0, annotate), 4)]
+    >>> scheduler.finish((0, 'annotate'))
+    >>> scheduler.admit()
+    [(Stage(0, report), 1), (Stage(1, annotate), 3)]
+
+    >>> scheduler = StageScheduler(8, memory=10)
+    >>> for sample, memory in enumerate([6, 6, 3]):
+    ...     scheduler.add(Stage(sample, 'refine', cores=2, memory=memory))
+    >>> scheduler.admit()
+    [(Stage(0, refine), 2), (Stage(2, refine), 2)]
+    """
+
+    def __init__(self, cores, memory=None):
+        """
+        :param cores: int, total number of cores stages can use at once
+        :param memory: int, memory budget in bytes, None for no limit
+        """
+        self.cores = max(int(cores), 1)
+        self.free = self.cores
+        self.memory = memory
+        self.usedMemory = 0
+        self.stages = {}
+        self.running = {}
+        self.completed = set()
+        self._order = []
+        self._sorted = True
+
+    def add(self, stage):
+        """
+        :param stage: Stage, dependencies that were not added (or are added later) are not waited for
+        :return: None
+        """
+        self.stages[stage.key] = stage
+        self._order.append(stage.key)
+        self._sorted = False
+
+    def _depths(self):
+        for stage in self.stages.values():
+            stage.depth = 0
+        # relax along the dependencies, the graph is small and acyclic
+        for _ in range(len(self.stages)):
+            changed = False
+            for stage in self.stages.values():
+                for dep in stage.after:
+                    if dep in self.stages and self.stages[dep].depth < stage.depth + 1:
+                        self.stages[dep].depth = stage.depth + 1
+                        changed = True
+            if not changed:
+                return
+        raise ValueError("Stages have circular dependencies")
+
+    def _ready(self):
+        ready = [self.stages[key] for key in self._order
+                 if key not in self.running and key not in self.completed and
+                 all(dep in self.completed or dep not in self.stages for dep in self.stages[key].after)]
+        # sort is stable, equally deep stages keep the sample order
+        return sorted(ready, key=lambda s: -s.depth)
+
+    def admit(self):
+        """
+        marks the stages to start now as running
+
+        :return: list of (stage, cores) tuples, the number of cores granted to each stage
+        """
+        if not self._sorted:
+            self._depths()
+            self._sorted = True
+        admitted = []
+        for stage in self._ready():
+            if self.free == 0:
+                break
+            fitsMemory = self.memory is None or self.usedMemory + stage.memory <= self.memory
+            if (self.free * 2 >= stage.cores and fitsMemory) or not self.running:
+                grant = min(stage.cores, self.free)
+                self.free -= grant
+                self.usedMemory += stage.memory
+                self.running[stage.key] = (grant, stage.memory)
+                admitted.append((stage, grant))
+        return admitted
+
+    def finish(self, key):
+        """
+        :param key: (sample, op) tuple of a running stage
+        :return: None
+        """
+        grant, memory = self.running.pop(key)
+        self.free += grant
+        self.usedMemory -= memory
+        self.completed.add(key)
+
+    def done(self):
+        """
+        :return: bool, True if all stages have completed
+        """
+        return len(self.completed) == len(self.stages)
@@ -1,5 +1,7 @@
 __all__ = [
     'AbSeqWorker',
     'IgMultiRepertoire',
-    'PlotManager'
+    'MemoryModel',
+    'PlotManager',
+    'StageScheduler'
 ]
@@ -6,12 +6,14 @@
 '''
 
 import os
+import time
 import numpy as np
+import pandas as pd
 
 from multiprocessing import Process
 from pandas.core.frame import DataFrame
 
-from abseqPy.IgRepertoire.igRepUtils import runIgblastn, runIgblastp
+from abseqPy.IgRepertoire.igRepUtils import runIgblastn, runIgblastp, streamIgblast
 from abseqPy.logger import printto, LEVEL
 
 ANNOTATION_FIELDS = ['queryid', 'vgene', 'vqstart', 'vstart', 'vmismatches', 'vgaps',
@@ -28,6 +30,15 @@ ANNOTATION_FIELDS = ['queryid', 'vgene', 'vqstart', 'vstart', 'vmismatches', 'vg
                      'fr4.start', 'fr4.end', 'fr4.mismatches', 'fr4.gaps'
                      ]
 
+# column types used by the columnar (batched) IgBLAST parser. Scores stay float64 so that
+# they compare to the filtering thresholds exactly as parsed. Every field not listed
+# here (except queryid) is an integer position / count and is stored as int32
+CATEGORICAL_FIELDS = ['vgene', 'dgene', 'jgene', 'chain', 'strand', 'stopcodon', 'v-jframe']
+SCORE_FIELDS = ['identity', 'bitscore']
+
+# number of query records per columnar batch
+ANNOTATION_BATCH_SIZE = 10000
+
 
 def getAnnotationFields(chain):
     if chain == 'hv':
@@ -39,20 +50,6 @@ def getAnnotationFields(chain):
         raise ValueError("Unsupported chain type")
 
 
-def createCloneRecord(chain):
-    cdrRecord = {}
-    for field in getAnnotationFields(chain):
-        cdrRecord[field] = np.nan
-    return cdrRecord
-
-
-def convertCloneRecordToOrderedList(cdrRecord, chain):
-    orderedList = []
-    for field in getAnnotationFields(chain):
-        orderedList.append(cdrRecord[field])
-    return orderedList
-
-
 def to_int(x):
     try:
         return int(x.strip())
@@ -60,235 +57,347 @@ def to_int(x):
         return None
 
 
-def extractCDRInfo(blastOutput, chain, stream=None):
-    # Extract the top hits  
-    printto(stream, '\tExtracting top hit tables ... ' + os.path.basename(blastOutput))
-    # process igblast output and extract top hit 
-    cloneAnnot = []
-    filteredIDs = []
-    line = ""
+class _AnnotationBatch(object):
+    """
+    preallocated column store for up to batchSize annotated queries. While the batch is being
+    filled, each query occupies one row of raw IgBLAST tokens; columns are converted in bulk
+    when the batch is emitted: positions and counts to int32, gene names / flags to categoricals. Scores
+    are kept as float64
+    """
+    def __init__(self, fields, batchSize):
+        self.fields = fields
+        self.layout = _columnLayout(fields)
+        self.size = 0
+        self.tokens = np.empty((batchSize, len(fields)), dtype=object)
+        # numeric tokens default to 'nan' so that a whole column can be parsed in one go.
+        # The extra trailing slot absorbs fields that the chain does not have
+        self.template = [None if (f == 'queryid' or f in CATEGORICAL_FIELDS) else 'nan' for f in fields] + [None]
+
+    def newRecord(self):
+        return list(self.template)
+
+    def add(self, record):
+        self.tokens[self.size] = record[:-1]
+        self.size += 1
+
+    def toDataFrame(self):
+        """
+        :return: DataFrame indexed by queryid with columns ordered as in getAnnotationFields. Integer columns
+        that have missing values are float64 so that missing values are NaN
+        """
+        n = self.size
+        tokens = self.tokens[:n]
+        columns = {}
+        for j, field in enumerate(self.fields[1:], 1):
+            col = tokens[:, j]
+            if field in CATEGORICAL_FIELDS:
+                columns[field] = pd.Categorical(col)
+                continue
+            values = _parseNumericColumn(col)
+            if field in SCORE_FIELDS or np.isnan(values).any():
+                columns[field] = values
+            else:
+                columns[field] = values.astype(np.int32)
+        # IgBLAST did not report a CDR3, fallback to the germline FR3 end
+        fr3end = columns['fr3.end']
+        if fr3end.dtype == np.float64:
+            missing = np.isnan(fr3end)
+            fr3end[missing] = columns['fr3g.end'][missing]
+            if not np.isnan(fr3end).any():
+                columns['fr3.end'] = fr3end.astype(np.int32)
+        df = DataFrame(columns, columns=self.fields[1:], index=pd.Index(tokens[:, 0], name='queryid'))
+        self.tokens = None
+        return df
+
+
+def _parseNumericColumn(col):
+    """
+    :param col: numpy object array of numeric strings ('nan' if missing)
+    :return: float64 numpy array
+    """
+    values = np.fromstring(' '.join(col), dtype=np.float64, sep=' ')
+    if len(values) != len(col):
+        # unexpected non-numeric token (e.g. N/A), parse element-wise
+        values = pd.to_numeric(col, errors='coerce').astype(np.float64)
+    return values
+
+
+def _nextLine(block, pos):
+    """
+    :return: (line starting at pos without its newline, position of the following line)
+    """
+    end = block.find('\n', pos)
+    if end == -1:
+        return block[pos:], len(block)
+    return block[pos:end], end + 1
+
+
+def _findLine(block, prefix, pos):
+    """
+    :return: position of the first line at or after pos that starts with prefix, -1 if there is none
+    """
+    if block.startswith(prefix, pos):
+        return pos
+    found = block.find('\n' + prefix, pos)
+    return found + 1 if found != -1 else -1
+
+
+def _columnLayout(fields):
+    """
+    groups the positions of getAnnotationFields' columns in the order _parseQueryBlock assigns them.
+    Fields that do not exist for the chain (D gene fields of light chains) map to a scratch
+    position past the end of the record
+
+    :return: dict of tuples of int
+    """
+    index = dict((f, i) for i, f in enumerate(fields))
+    scratch = len(fields)
+
+    def pos(*names):
+        return tuple(index.get(name, scratch) for name in names)
+
+    layout = {
+        'heavy': pos('stopcodon', 'v-jframe', 'vgene', 'dgene', 'jgene', 'chain'),
+        'light': pos('stopcodon', 'v-jframe', 'vgene', 'jgene', 'chain'),
+        'strand': pos('strand')[0],
+        'subregion': pos('cdr3.start', 'cdr3.end', 'fr3.end'),
+        'v': pos('bitscore', 'identity', 'alignlen', 'vqstart', 'vstart', 'vmismatches', 'vgaps'),
+        'd': pos('dqstart', 'dqend', 'dstart', 'dmismatches', 'dgaps'),
+        'j': pos('jqstart', 'jqend', 'jstart', 'jend', 'jmismatches', 'jgaps')
+    }
+    for r in ('1', '2', '3'):
+        g = 'g' if r == '3' else ''
+        layout['fr' + r] = pos('fr' + r + '.start', 'fr' + r + g + '.end',
+                               'fr' + r + g + '.mismatches', 'fr' + r + g + '.gaps')
+        layout['cdr' + r] = pos('cdr' + r + g + '.start', 'cdr' + r + g + '.end',
+                                'cdr' + r + g + '.mismatches', 'cdr' + r + g + '.gaps')
+    return layout
+
+
+def _parseQueryBlock(block, rec, layout):
+    """
+    parses a single query block of IgBLAST's output (from its "# Query" line up to, but excluding,
+    the next "# Query" line) into the token list rec (see _columnLayout).
+
+    :return: True if the query was annotated, False if it should be filtered out.
+     Raises an exception if the record is malformed
+    """
+    line, pos = _nextLine(block, 0)
+    rec[0] = line.split()[2].strip()
+
+    # V-(D)-J rearrangement summary
+    pos = _findLine(block, '# V-(D)-J rearrangement', pos)
+    if pos == -1:
+        return False
+    line, pos = _nextLine(block, _nextLine(block, pos)[1])
+    line = line.strip().split('\t')
+    rec[layout['strand']] = 'forward' if line[-1] == '+' else 'reversed'
+    # XXX: a light chain can have 8 columns too, when there is a rogue D-gene hit
+    if len(line) == 8:
+        stop, frame, v, d, j, chain = layout['heavy']
+        rec[d] = line[1].split(',')[0]
+        rec[j] = line[2].split(',')[0]
+        rec[chain] = line[3]
+        rec[stop] = line[4]
+        rec[frame] = line[5]
+    else:
+        stop, frame, v, j, chain = layout['light']
+        rec[j] = line[1].split(',')[0]
+        rec[chain] = line[2]
+        rec[stop] = line[3]
+        rec[frame] = line[4]
+    rec[v] = line[0].split(',')[0]
+
+    # Sub-region (CDR3) is optional, Alignment summary is not
+    alignment = _findLine(block, '# Alignment', pos)
+    subregion = _findLine(block, '# Sub-region', pos)
+    if alignment == -1 and subregion == -1:
+        return False
+    if subregion != -1 and (alignment == -1 or subregion < alignment):
+        line, pos = _nextLine(block, _nextLine(block, subregion)[1])
+        subregionData = line.split()
+        assert subregionData[0] == 'CDR3'
+        if len(subregionData) >= 3 and subregionData[-1].isdigit() and subregionData[-2].isdigit():
+            cdr3Start, cdr3End, fr3End = layout['subregion']
+            rec[cdr3Start] = subregionData[-2]
+            rec[cdr3End] = subregionData[-1]
+            # true FR3 end is at position cdr3.start - 1
+            rec[fr3End] = str(int(subregionData[-2]) - 1)
+        alignment = _findLine(block, '# Alignment', pos)
+        if alignment == -1:
+            return False
+    start = _nextLine(block, alignment)[1]
+    line, pos = _nextLine(block, start)
+    for r in ('1', '2', '3'):
+        if line[:2].lower() == 'fr' and line[2:3] == r:
+            rstart, rend, rmismatches, rgaps = layout['fr' + r]
+            line = line.split()
+            rec[rstart], rec[rend], rec[rmismatches], rec[rgaps] = line[1], line[2], line[5], line[6]
+            start = pos
+            line, pos = _nextLine(block, start)
+        if line[:3].lower() == 'cdr' and line[3:4] == r:
+            rstart, rend, rmismatches, rgaps = layout['cdr' + r]
+            line = line.replace('(germline)', '').replace('(V gene only)', '').split()
+            rec[rstart], rec[rend], rec[rmismatches], rec[rgaps] = line[1], line[2], line[5], line[6]
+            start = pos
+            line, pos = _nextLine(block, start)
+
+    # hit table: top V, D and J hits
+    fields = _findLine(block, '# Fields', start)
+    if fields == -1:
+        return False
+    line, pos = _nextLine(block, _nextLine(block, fields)[1])
+    if to_int(line.split()[1]) == 0:
+        return False
+    line, pos = _nextLine(block, pos)
+    if not line.startswith('V'):
+        return False
+    hit = line.split()
+    # scores must be numeric, otherwise the record is malformed
+    float(hit[-1]), float(hit[3])
+    score, identity, align, qstart, sstart, mismatches, gaps = layout['v']
+    rec[score], rec[identity], rec[align] = hit[-1], hit[3], hit[4]
+    rec[qstart], rec[sstart], rec[mismatches], rec[gaps] = hit[8], hit[10], hit[5], hit[7]
+    d = _findLine(block, 'D', pos)
+    j = _findLine(block, 'J', pos)
+    if d != -1 and (j == -1 or d < j):
+        hit = _nextLine(block, d)[0].split()
+        qstart, qend, sstart, mismatches, gaps = layout['d']
+        rec[qstart], rec[qend], rec[sstart], rec[mismatches], rec[gaps] = hit[8], hit[9], hit[10], hit[5], hit[7]
+    if j != -1:
+        hit = _nextLine(block, j)[0].split()
+        qstart, qend, sstart, send, mismatches, gaps = layout['j']
+        rec[qstart], rec[qend], rec[sstart], rec[send] = hit[8], hit[9], hit[10], hit[11]
+        rec[mismatches], rec[gaps] = hit[5], hit[7]
+    return True
+
+
+def _iterQueryBlocks(blast, chunkSize=1 << 22):
+    """
+    reads IgBLAST's output in large chunks and yields one string per query,
+    each starting with its "# Query" line. Text before the first query is discarded
+    """
+    sep = '\n# Query'
+    buf = ''
+    first = True
+    while True:
+        chunk = blast.read(chunkSize)
+        if not chunk:
+            break
+        buf += chunk
+        blocks = buf.split(sep)
+        buf = blocks.pop()
+        for block in blocks:
+            if first:
+                first = False
+                if not block.startswith('# Query'):
+                    continue
+                yield block
+            else:
+                yield '# Query' + block
+    if buf:
+        if not first:
+            yield '# Query' + buf
+        elif buf.startswith('# Query'):
+            yield buf
+
+
+def iterCDRInfoBatches(blastOutput, chain, batchSize=ANNOTATION_BATCH_SIZE, stream=None):
+    """
+    streams IgBLAST's outfmt 7 output and yields the top hit annotations in fixed-size columnar batches.
+    Memory usage is bounded by batchSize rather than by the number of queries in the file.
+
+    :param blastOutput: string or file-like object
+                path to IgBLAST output file, or an open file-like object (e.g. a pipe) to read it from
+
+    :param chain: string
+                hv, kv, lv or klv
+
+    :param batchSize: int
+                maximum number of annotated queries per yielded batch
+
+    :param stream: logging stream
+
+    :return: generator of (DataFrame, list) tuples. Each DataFrame is indexed by queryid, has the columns of
+                getAnnotationFields(chain) with int32 positions, float64 scores and categorical gene names.
+                The list holds the query ids that were filtered out since the previous batch
+    """
+    fields = getAnnotationFields(chain)
+    fromFile = isinstance(blastOutput, basestring)
+    printto(stream, '\tExtracting top hit tables ... ' +
+            (os.path.basename(blastOutput) if fromFile else 'IgBLAST stream'))
 
     warning = False
-    # RE: parsing IGBLAST:
-    # VDJ junction details MAY give N/A instead of just missing:
-    # eg:
-    # V-(D)-J junction details based on top germline gene matches
-    # (V end, V-D junction, D region, D-J junction, J start).  Note that possible
-    # overlapping nucleotides at VDJ junction (i.e, nucleotides that could
-    # be assigned to either rearranging gene) are indicated in parentheses (i.e., (TACT)) but are
-    # not included under the V, D, or J gene itself
-    # GGGTC  TGTTCACGAGGGCATCTGTGTCCTGTTTTTAGGTTCTCCTCCC  TTTTGAC  N/A  N/A
-
-    # it also has a variable number of hits (depending on presence of region)
-    # EG:
-    # V-(D)-J junction details based on top germline gene matches (V end, V-J junction, J start).  Note that possible overlapping nucleotides at VDJ junction (i.e, nucleotides that could be assigned to either rearranging gene) are indicated in parentheses (i.e., (TACT)) but are not included under the V, D, or J gene itself
-    # CCTCT  N/A  GGTGT
-
-    with open(blastOutput) as blast:
-        while True:
+    batch = _AnnotationBatch(fields, batchSize)
+    filteredIDs = []
+    blast = open(blastOutput) if fromFile else blastOutput
+    try:
+        for block in _iterQueryBlocks(blast):
+            rec = batch.newRecord()
             try:
-                if not line.startswith('# Query'):
-                    line = blast.readline()
-                    if not line:
-                        break
-                    continue
-                cloneRecord = createCloneRecord(chain)
-                cloneRecord['queryid'] = line.split()[2].strip()
-                # parse  V-(D)-J rearrangement   
-                line = blast.readline()
-                while (line and
-                       not line.startswith('# Query') and
-                       not line.startswith('# V-(D)-J rearrangement')):
-                    line = blast.readline()
-                if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
-                    break
-                if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-                line = blast.readline().strip().split('\t')
-                cloneRecord['strand'] = 'forward' if line[-1] == '+' else 'reversed'
-                #                 print line, cloneRecord['strand']
-                #                 sys.exit()
-
-                # XXX: the or len(line) == 8 may happen to light chains too, when there is
-                # a rogue D-gene that was a hit. It then follows heavy chain's indexing
-                if len(line) == 8:
-                    cloneRecord['stopcodon'] = line[4]
-                    cloneRecord['v-jframe'] = line[5]
-                    cloneRecord['vgene'] = line[0].split(',')[0]
-                    cloneRecord['dgene'] = line[1].split(',')[0]
-                    cloneRecord['jgene'] = line[2].split(',')[0]
-                    cloneRecord['chain'] = line[3]
+                if _parseQueryBlock(block, rec, batch.layout):
+                    batch.add(rec)
                 else:
-                    cloneRecord['stopcodon'] = line[3]
-                    cloneRecord['v-jframe'] = line[4]
-                    cloneRecord['vgene'] = line[0].split(',')[0]
-                    cloneRecord['jgene'] = line[1].split(',')[0]
-                    cloneRecord['chain'] = line[2]
-                line = ' '.join(line)
-
-                # Parse Sub-region analysis and ignore it if there's no CDR3 hit by IGBLAST
-                while line and \
-                        not line.startswith("# Alignment") and \
-                        not line.startswith("# Sub-region") and \
-                        not line.startswith("# Query"):
-                    line = blast.readline()
-
-                # EOF
-                if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
-                    break
-
-                # there's no # Sub-region, nor is there # Alignment.
-                if line.startswith("# Query"):
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-
-                # this implies that IGBLAST successfully classified a CDR3 sequence
-                if line.startswith("# Sub-region"):
-                    line = blast.readline()
-                    subregionData = line.split()
-                    assert subregionData[0] == 'CDR3'
-                    if len(subregionData) >= 3 and subregionData[-1].isdigit() and subregionData[-2].isdigit():
-                        cloneRecord['cdr3.start'] = to_int(subregionData[-2])
-                        cloneRecord['cdr3.end'] = to_int(subregionData[-1])
-                        # true FR3 end is at position cdr3.start - 1
-                        # (the alignment table only tells us the FR3 germline)
-                        # but since fr3.start always begins in the germline, there's no special field for that
-                        # and is assumed that fr3.start == fr3g.start
-                        cloneRecord['fr3.end'] = cloneRecord['cdr3.start'] - 1
-
-                # parse Alignment Summary between query and top germline V gene
-                while (line and
-                       not line.startswith('# Query') and
-                       not line.startswith("# Alignment")):
-                    line = blast.readline()
-                if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
-                    break
-                if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-                line = blast.readline()
-                for i in range(1, 4):
-                    if line.lower().startswith('fr' + str(i)):
-                        line = line.split()
-                        cloneRecord['fr%d.start' % i] = to_int(line[1])
-                        cloneRecord['fr%d%s.end' % (i, 'g' if i == 3 else '')] = to_int(line[2])
-                        cloneRecord['fr%d%s.mismatches' % (i, 'g' if i == 3 else '')] = to_int(line[5])
-                        cloneRecord['fr%d%s.gaps' % (i, 'g' if i == 3 else '')] = to_int(line[6])
-                        line = blast.readline()
-                    if line.lower().startswith('cdr' + str(i)):
-                        # IgBLAST has parenthesis beside CDR3 germline start/end, depending on the domain system
-                        # if domain_system == imgt, (germline)
-                        # if domain_system == kabat, (V gene only)
-                        line = line.replace('(germline)', '').replace('(V gene only)', '').split()
-
-                        cloneRecord['cdr%d%s.start' % (i, 'g' if i == 3 else '')] = to_int(line[1])
-                        cloneRecord['cdr%d%s.end' % (i, 'g' if i == 3 else '')] = to_int(line[2])
-                        cloneRecord['cdr%d%s.mismatches' % (i, 'g' if i == 3 else '')] = to_int(line[5])
-                        cloneRecord['cdr%d%s.gaps' % (i, 'g' if i == 3 else '')] = to_int(line[6])
-                        line = blast.readline()
-
-                # if the CDR3 region wasn't identified by IgBlast, we can't get FR3 end, so we fallback to
-                # FR3 germline end. Since CDR3.start and CDR3.end isn't really used unitl the refinement process,
-                # we ignore the fallback options for them.
-                if np.isnan(cloneRecord['fr3.end']):
-                    cloneRecord['fr3.end'] = cloneRecord['fr3g.end']
-
-                # parse alignment information between query and V, D and J genes
-                while (line and
-                       not line.startswith('# Query') and
-                       not line.startswith("# Fields")):
-                    line = blast.readline()
-                if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
-                    break
-                if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-                line = blast.readline()
-                noHits = to_int(line.split()[1])
-                if noHits == 0:
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-                    # retrieve the top hit
-                # parse the top V gene info
-                line = blast.readline()
-                if not line.startswith("V"):
-                    filteredIDs.append(cloneRecord['queryid'])
-                    continue
-                hit = line.split()
-                score = float(hit[-1])
-                align = to_int(hit[4])
-                sStart = to_int(hit[10])
-                cloneRecord['identity'] = float(hit[3])
-                cloneRecord['alignlen'] = align
-                cloneRecord['bitscore'] = score
-                cloneRecord['vqstart'] = to_int(hit[8])
-                cloneRecord['vstart'] = sStart
-                cloneRecord['vmismatches'] = to_int(hit[5])
-                cloneRecord['vgaps'] = to_int(hit[7])
-                # parse the top D gene info
-                line = blast.readline()
-                while (line and
-                       not line.startswith("# Query") and
-                       not line.startswith("D") and
-                       not line.startswith("J")):
-                    line = blast.readline()
-                if not line:
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
-                    break
-                if line.startswith('# Query'):
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
-                    continue
-                if line.startswith("D"):
-                    hit = line.split()
-                    cloneRecord['dqstart'] = to_int(hit[8])
-                    cloneRecord['dqend'] = to_int(hit[9])
-                    cloneRecord['dstart'] = to_int(hit[10])
-                    cloneRecord['dmismatches'] = to_int(hit[5])
-                    cloneRecord['dgaps'] = to_int(hit[7])
-                # parse the top J gene info
-                while (line and
-                       not line.startswith("# Query") and
-                       not line.startswith("J")):
-                    line = blast.readline()
-                if not line:
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
-                    break
-                if line.startswith('# Query'):
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
-                    continue
-                if line.startswith("J"):
-                    hit = line.split()
-                    cloneRecord['jqstart'] = to_int(hit[8])
-                    cloneRecord['jqend'] = to_int(hit[9])
-                    cloneRecord['jstart'] = to_int(hit[10])
-                    # jend is a little special, we need it for FR4 end deduction
-                    cloneRecord['jend'] = to_int(hit[11])
-                    cloneRecord['jmismatches'] = to_int(hit[5])
-                    cloneRecord['jgaps'] = to_int(hit[7])
-                cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                    filteredIDs.append(rec[0])
             except Exception:
                 warning = True
-                continue
-    if len(cloneAnnot) > 0:
-        # productive = no stop and in-frame
-        # v-jframe: in-frame, out-of-frame, N/A (no J gene) 
-        # stopcodon: yes, no
-        cloneAnnot = DataFrame(cloneAnnot, columns=getAnnotationFields(chain))
-        cloneAnnot.set_index('queryid', drop=True, inplace=True)
-    else:
-        cloneAnnot = DataFrame()
+            if batch.size == batchSize:
+                yield batch.toDataFrame(), filteredIDs
+                batch = _AnnotationBatch(fields, batchSize)
+                filteredIDs = []
+    finally:
+        if fromFile:
+            blast.close()
+    if batch.size or filteredIDs:
+        yield batch.toDataFrame(), filteredIDs
     if warning:
-        printto(stream, "WARNING: something went wrong while parsing {}".format(blastOutput), LEVEL.WARN)
+        printto(stream, "WARNING: something went wrong while parsing {}"
+                .format(blastOutput if fromFile else 'IgBLAST output'), LEVEL.WARN)
+
+
+def extractCDRInfoColumnar(blastOutput, chain, batchSize=ANNOTATION_BATCH_SIZE, stream=None):
+    """
+    extracts the top hit annotations of IgBLAST's output in one DataFrame, backed by iterCDRInfoBatches.
+    Categorical columns are converted back to plain strings so that the returned DataFrame can be stored in
+    fixed-format HDF5
+
+    :return: (DataFrame, list) annotations indexed by queryid and the query ids that were filtered out
+    """
+    frames = []
+    filteredIDs = []
+    for df, filteredi in iterCDRInfoBatches(blastOutput, chain, batchSize=batchSize, stream=stream):
+        if len(df):
+            frames.append(df)
+        filteredIDs += filteredi
+    if not frames:
+        return DataFrame(), filteredIDs
+    cloneAnnot = pd.concat(frames) if len(frames) > 1 else frames[0]
+    for field in CATEGORICAL_FIELDS:
+        if field in cloneAnnot.columns:
+            cloneAnnot[field] = np.asarray(cloneAnnot[field], dtype=object)
     return cloneAnnot, filteredIDs
 
 
 def analyzeSmallFile(fastaFile, chain, igBlastDB, seqType='dna', threads=8,
-                     outdir="", domainSystem='imgt', stream=None):
+                     outdir="", domainSystem='imgt', igblastStream='off', stream=None):
+    """
+    runs IgBLAST on fastaFile and parses its output
+
+    :param igblastStream: string
+                'off' writes IgBLAST's output into a .out file before parsing it. 'on' parses IgBLAST's output
+                directly from a pipe while IgBLAST is running and 'keep' does the same but also retains a
+                gzip-compressed copy of the raw output (.out.gz) for auditing
+    :return: (DataFrame, list) see extractCDRInfoColumnar
+    """
+    if igblastStream in ('on', 'keep'):
+        rawOutput = None
+        if igblastStream == 'keep':
+            head, tail = os.path.split(fastaFile)
+            rawOutput = os.path.join(outdir or head, os.path.splitext(tail)[0] + '.out.gz')
+        with streamIgblast(fastaFile, chain, threads, igBlastDB, domainSystem=domainSystem,
+                           protein=seqType.lower() != 'dna', rawOutput=rawOutput, stream=stream) as blastOutput:
+            return extractCDRInfoColumnar(blastOutput, chain, stream=stream)
+
     # Run igblast
     if seqType.lower() == 'dna':
         blastOutput = runIgblastn(fastaFile, chain, threads, igBlastDB,
@@ -297,12 +406,12 @@ def analyzeSmallFile(fastaFile, chain, igBlastDB, seqType='dna', threads=8,
         # argparse already checks that it's ether dna or protein, so nothing fishy can pass into else statement here
         blastOutput = runIgblastp(fastaFile, chain, threads, igBlastDB,
                                   domainSystem=domainSystem, outputDir=outdir, stream=stream)
-    return extractCDRInfo(blastOutput, chain, stream=stream)
+    return extractCDRInfoColumnar(blastOutput, chain, stream=stream)
 
 
 class IgBlastWorker(Process):
     def __init__(self, chain, igBlastDB,
-                 seqType, threads, domainSystem='imgt', stream=None):
+                 seqType, threads, domainSystem='imgt', igblastStream='off', stream=None):
         super(IgBlastWorker, self).__init__()
         self.chain = chain
         self.igBlastDB = igBlastDB
@@ -313,6 +422,7 @@ class IgBlastWorker(Process):
         self.exitQueue = None
         self.stream = stream
         self.domainSystem = domainSystem
+        self.igblastStream = igblastStream
 
     def run(self):
         while True:
@@ -323,13 +433,16 @@ class IgBlastWorker(Process):
                 self.exitQueue.put("exit")
                 #                 self.terminate()
                 break
+            # a task is either a FASTA filename or a (FASTA filename, number of IgBLAST threads) tuple
+            fastaFile, threads = nextTask if isinstance(nextTask, tuple) else (nextTask, self.threads)
+            start = time.time()
             try:
-                result = analyzeSmallFile(nextTask, self.chain, self.igBlastDB,
-                                          self.seqType, self.threads, domainSystem=self.domainSystem,
-                                          stream=self.stream)
-                self.resultsQueue.put(result)
+                result = analyzeSmallFile(fastaFile, self.chain, self.igBlastDB,
+                                          self.seqType, threads, domainSystem=self.domainSystem,
+                                          igblastStream=self.igblastStream, stream=self.stream)
+                self.resultsQueue.put((fastaFile, result, time.time() - start))
             except Exception:
-                printto(self.stream, "An error occurred while processing " + os.path.basename(nextTask), LEVEL.EXCEPT)
-                self.resultsQueue.put(None)
+                printto(self.stream, "An error occurred while processing " + os.path.basename(fastaFile), LEVEL.EXCEPT)
+                self.resultsQueue.put((fastaFile, None, time.time() - start))
                 continue
         return
@@ -10,10 +10,11 @@ from abseqPy.logger import printto, LEVEL
 
 
 class PrimerWorker(Process):
-    def __init__(self, procCounter, fr4cut, trim5end,
+    def __init__(self, reads, procCounter, fr4cut, trim5end,
                  trim3end, actualQstart, end5, end3,
                  end5offset, tasks, exitQueue, resultsQueue, stream=None):
         super(PrimerWorker, self).__init__()
+        self.reads = reads
         self.procCounter = procCounter
         self.fr4cut = fr4cut
         self.trim5end = trim5end
@@ -43,7 +44,8 @@ class PrimerWorker(Process):
                 if not self.firstJobTaken:
                     printto(self.stream, self.name + " process commenced a new task ... ")
                     self.firstJobTaken = True
-                for record, qsRec in zip(nextTask[0], nextTask[1]):
+                start, ids, qsRecs = nextTask
+                for record, qsRec in zip(self.reads.records(start, ids), qsRecs):
                     qsRec['queryid'] = record.id
                     recs.append(_matchClosestPrimer(qsRec, record, self.actualQstart, self.trim5end,
                                                     self.trim3end, self.end5offset, self.fr4cut, self.maxPrimer5Length,
@@ -9,18 +9,22 @@ from multiprocessing import Process
 from Bio.SeqRecord import SeqRecord
 from collections import defaultdict
 from numpy import isnan, nan
+from pandas.core.frame import DataFrame
+
+import numpy as np
 
 from abseqPy.config import FR4_CONSENSUS, FR4_CONSENSUS_DNA
 from abseqPy.IgRepertoire.igRepUtils import extractProteinFrag, \
     findBestAlignment, extractCDRsandFRsProtein, calMaxIUPACAlignScores, findBestMatchedPattern
-from abseqPy.IgRepAuxiliary.IgBlastWorker import convertCloneRecordToOrderedList
+from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
 from abseqPy.logger import LEVEL, printto
 
 
 class RefineWorker(Process):
-    def __init__(self, procCounter, chain, actualQstart,
+    def __init__(self, reads, procCounter, chain, actualQstart,
                  fr4cut, trim5End, trim3End, refineFlagNames, stream=None):
         super(RefineWorker, self).__init__()
+        self.reads = reads
         self.procCounter = procCounter
         self.chain = chain
         self.actualQstart = actualQstart
@@ -47,27 +51,12 @@ class RefineWorker(Process):
                 if not self.firstJobTaken:
                     printto(self.stream, self.name + " process commenced a new task ... ")
                     self.firstJobTaken = True
-                qsRecs = []
-                seqsAll = []
-                recordLengths = defaultdict(_defaultdefaultInt)
-                flags = {}
-                for f in self.refineFlagNames:
-                    flags[f] = []
-                for (record, qsRec) in zip(nextTask[0], nextTask[1]):
-                    seqs = refineCloneAnnotation(qsRec, record,
-                                                 self.actualQstart, self.chain, self.fr4cut,
-                                                 self.trim5End, self.trim3End, flags, stream=self.stream)
-                    # out-of-frame clones are excluded
-                    if qsRec['v-jframe'] != 'Out-of-frame':
-                        stillInFrame = refineInFramePrediction(qsRec, record, self.actualQstart,
-                                                               flags, stream=self.stream)
-                        if stillInFrame:
-                            _recordFRLength(qsRec, recordLengths)
-
-                    # append the FR and CDR protein clones
-                    qsRec['queryid'] = record.id
-                    qsRecs.append(convertCloneRecordToOrderedList(qsRec, self.chain))
-                    seqsAll.append(seqs)
+                start, cloneAnnot = nextTask
+                records = self.reads.records(start, cloneAnnot.index)
+                qsRecs, seqsAll, flags, recordLengths = refineChunk(cloneAnnot, records, self.actualQstart,
+                                                                    self.chain, self.fr4cut, self.trim5End,
+                                                                    self.trim3End, self.refineFlagNames,
+                                                                    stream=self.stream)
                 self.procCounter.increment(len(qsRecs))
                 self.resultsQueue.put((qsRecs, seqsAll, flags, recordLengths))
             except Exception as e:
@@ -77,9 +66,54 @@ class RefineWorker(Process):
         return
 
 
+def refineChunk(cloneAnnot, records, actualQstart, chain, fr4cut, trim5End, trim3End, refineFlagNames,
+                stream=None):
+    """
+    refines a chunk of clones. FR4 identification and the translation of FRs and CDRs are done read by read,
+    the gap/mismatch corrections and the in-frame prediction are computed on whole columns of the chunk.
+
+    :param cloneAnnot: DataFrame, annotation of the clones in the chunk (indexed by query ID)
+    :param records: list of SeqRecords, in the same order as cloneAnnot
+    :return: (list of ordered annotation lists, list of FR/CDR protein sequence lists, flags, FR lengths)
+    """
+    flags = {}
+    for f in refineFlagNames:
+        flags[f] = []
+    qsRecs = cloneAnnot.to_dict('records')
+    seqsAll = []
+    offsets = np.full(len(qsRecs), nan)
+    for i, (record, qsRec) in enumerate(zip(records, qsRecs)):
+        seqs, offset = refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut,
+                                             trim5End, trim3End, flags, stream=stream)
+        seqsAll.append(seqs)
+        if offset is not None:
+            offsets[i] = offset
+    refined = DataFrame(qsRecs, columns=cloneAnnot.columns)
+    refined['queryid'] = [record.id for record in records]
+
+    refineGapsAndMismatches(refined, offsets)
+
+    # out-of-frame clones are excluded
+    candidates = (refined['v-jframe'] != 'Out-of-frame').values
+    frameFlags = refineInFramePredictions(refined, actualQstart, candidates)
+    for f, mask in frameFlags.items():
+        flags[f] += refined['queryid'][mask].tolist()
+    inFrame = candidates & ~frameFlags['updatedInFrame']
+    refined.loc[frameFlags['updatedInFrame'], 'v-jframe'] = 'Out-of-frame'
+
+    recordLengths = _recordFRLengths(refined[inFrame])
+    return refined[getAnnotationFields(chain)].values.tolist(), seqsAll, flags, recordLengths
+
+
 def refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut,
                           trim5End, trim3End, flags, stream=None):
+    """
+    :return: (list of FR and CDR protein sequences, zero-based offset of the V domain in the read or None if
+             the clone could not be refined). The gaps and mismatches at the start of the V gene are not updated
+             here, see refineGapsAndMismatches
+    """
     seqs = [record.id, qsRec['vgene']]
+    refinedOffset = None
 
     if qsRec['chain'] in ['VH', 'VK', 'VL']:
         chain = qsRec['chain']
@@ -217,83 +251,100 @@ def refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut,
                 flags['updatedStopCodon'] += [record.id]
                 qsRec['stopcodon'] = 'Yes'
 
-                # update the annotation fields with the new calculated values
-        gaps = int(abs(qsRec['vqstart'] - qsRec['vstart']) - offset)
-        mismatches = qsRec['vstart'] - 1
-        if qsRec['vstart'] > qsRec['vqstart'] and gaps > 0:
-            mismatches -= gaps
-
-        # Only update gaps if the actual query start position is known 
-        if gaps > 0:
-            qsRec['fr1.gaps'] += gaps
-            qsRec['vgaps'] += gaps
-
-        # if igblast ignores mismatches at the beginning ==> update
-        if mismatches > 0:
-            qsRec['fr1.mismatches'] += mismatches
-            qsRec['vmismatches'] += mismatches
-            qsRec['vstart'] -= mismatches
-            qsRec['vqstart'] -= mismatches
+        refinedOffset = offset
         # TODO: update gaps and mismatches in FR4 and CDR3 based on D and J germlines
         # TODO: update the start and end fields based on the trim5End
     except Exception as e:
         if "partitioning" in str(e):
             flags['partitioning'] += [record.id]
-    return seqs
-
-
-def refineInFramePrediction(qsRec, record, actualQstart, flags, stream=None):
-    inframe = True
-
-    # check the the v-jframe value is not NA
-    if (qsRec['v-jframe'] == 'N/A' or
-            (not isinstance(qsRec['v-jframe'], str) and isnan(qsRec['v-jframe']))):
-        flags['updatedInFrameNA'] += [record.id]
-        inframe = False
-
-    # the query clone is not in concordance with the start of the germline gene
-    offset = int(qsRec['vqstart'] - qsRec['vstart']) + 1  # 1-based
-    if (inframe and (offset < 1 or
-                     (actualQstart != -1 and (offset - 1 - actualQstart) % 3 != 0))):
-        inframe = False
-        flags['updatedInFrameConc'] += [record.id]
-
-    # if no CDR3 or FR4 ==> Out-of-frame
-    if (inframe and (isnan(qsRec['fr4.start']) or
-                     isnan(qsRec['fr4.end']) or isnan(qsRec['cdr3.start']) or
-                     qsRec['cdr3.start'] >= qsRec['cdr3.end'])):
-        inframe = False
-        flags['updatedInFrameNo3or4'] += [record.id]
-
-    # doesn't start/end properly .. not multiple of 3
-    if (inframe and ((qsRec['fr4.end'] - qsRec['fr1.start'] + 1) % 3 != 0 or
-                     (actualQstart != -1 and
-                      ((qsRec['fr4.end'] - actualQstart) % 3 != 0)))):
-        inframe = False
-        flags['updatedInFrame3x'] += [record.id]
-    # print(str(record.seq))
-
-    # indels (gaps) in FRs or CDRs cause frame-shift ==> out-of-frame
-    if (inframe and (
-            qsRec['fr1.gaps'] % 3 != 0 or
-            qsRec['fr2.gaps'] % 3 != 0 or
-            qsRec['fr3g.gaps'] % 3 != 0 or
-            qsRec['cdr1.gaps'] % 3 != 0 or
-            qsRec['cdr2.gaps'] % 3 != 0 or
-            (not isnan(qsRec['cdr3g.gaps']) and qsRec['cdr3g.gaps'] % 3 != 0)
-    )):
-        inframe = False
-        flags['updatedInFrameIndel'] += [record.id]
-
-    # FR1 start is not aligned with query start
-    #             if (not inframe or qsRec['vqstart'] != qsRec['fr1.start']):
-    #                 inframe = False
-
-    if not inframe:
-        qsRec['v-jframe'] = 'Out-of-frame'
-        flags['updatedInFrame'] += [record.id]
-
-    return inframe
+    return seqs, refinedOffset
+
+
+def refineGapsAndMismatches(cloneAnnot, offsets):
+    """
+    the part of the V gene before the first aligned nucleotide is either a gap or a mismatch that
+    IgBLAST ignored. Updates the gap and mismatch counts (and V start positions) of cloneAnnot in place
+
+    :param cloneAnnot: DataFrame
+    :param offsets: array of zero-based V domain offsets, NaN for clones that were not refined
+    :return: None
+    """
+    vstart = cloneAnnot['vstart'].values
+    vqstart = cloneAnnot['vqstart'].values
+    with np.errstate(invalid='ignore'):
+        gaps = np.trunc(np.abs(vqstart - vstart) - offsets)
+        # clones without a V query or germline start are left untouched
+        refined = ~isnan(gaps)
+        mismatches = vstart - 1 - np.where((vstart > vqstart) & (gaps > 0), gaps, 0)
+        # Only update gaps if the actual query start position is known
+        gapped = refined & (gaps > 0)
+        # if igblast ignores mismatches at the beginning ==> update
+        mismatched = refined & (mismatches > 0)
+    for col in ('fr1.gaps', 'vgaps'):
+        _addToColumn(cloneAnnot, col, gapped, gaps)
+    for col, sign in (('fr1.mismatches', 1), ('vmismatches', 1), ('vstart', -1), ('vqstart', -1)):
+        _addToColumn(cloneAnnot, col, mismatched, sign * mismatches)
+
+
+def _addToColumn(cloneAnnot, col, mask, delta):
+    values = cloneAnnot[col].values.copy()
+    # integer columns stay integers, gaps and mismatches are always whole numbers
+    values[mask] += delta[mask].astype(values.dtype)
+    cloneAnnot[col] = values
+
+
+def refineInFramePredictions(cloneAnnot, actualQstart, candidates):
+    """
+    flag the clones of cloneAnnot whose in-frame prediction does not hold up: no v-jframe, V domain not in
+    concordance with the germline start, no CDR3 or FR4, a length that is not a multiple of 3 or frame-shifting
+    indels. A clone without a V query or germline start has no offset to check and is flagged as discordant
+
+    :param cloneAnnot: DataFrame
+    :param actualQstart: int, -1 if unknown
+    :param candidates: boolean array, clones that are not yet known to be out of frame
+    :return: dict of flag name -> boolean array. updatedInFrame marks the clones that are out of frame
+    """
+    def col(name):
+        return cloneAnnot[name].values.astype(float)
+
+    flags = {}
+    inframe = candidates.copy()
+    with np.errstate(invalid='ignore'):
+        # check the the v-jframe value is not NA
+        flags['updatedInFrameNA'] = inframe & (cloneAnnot['v-jframe'].isnull() |
+                                               (cloneAnnot['v-jframe'] == 'N/A')).values
+        inframe &= ~flags['updatedInFrameNA']
+
+        # the query clone is not in concordance with the start of the germline gene
+        offset = np.trunc(col('vqstart') - col('vstart')) + 1  # 1-based
+        # NaN compares as False below, so an unknown offset has to be flagged explicitly
+        discordant = isnan(offset) | (offset < 1)
+        if actualQstart != -1:
+            discordant |= (offset - 1 - actualQstart) % 3 != 0
+        flags['updatedInFrameConc'] = inframe & discordant
+        inframe &= ~discordant
+
+        # if no CDR3 or FR4 ==> Out-of-frame
+        flags['updatedInFrameNo3or4'] = inframe & (isnan(col('fr4.start')) | isnan(col('fr4.end')) |
+                                                   isnan(col('cdr3.start')) | (col('cdr3.start') >= col('cdr3.end')))
+        inframe &= ~flags['updatedInFrameNo3or4']
+
+        # doesn't start/end properly .. not multiple of 3
+        notMultipleOf3 = (col('fr4.end') - col('fr1.start') + 1) % 3 != 0
+        if actualQstart != -1:
+            notMultipleOf3 |= (col('fr4.end') - actualQstart) % 3 != 0
+        flags['updatedInFrame3x'] = inframe & notMultipleOf3
+        inframe &= ~notMultipleOf3
+
+        # indels (gaps) in FRs or CDRs cause frame-shift ==> out-of-frame
+        indels = ~isnan(col('cdr3g.gaps')) & (col('cdr3g.gaps') % 3 != 0)
+        for region in ('fr1.gaps', 'fr2.gaps', 'fr3g.gaps', 'cdr1.gaps', 'cdr2.gaps'):
+            indels |= col(region) % 3 != 0
+        flags['updatedInFrameIndel'] = inframe & indels
+        inframe &= ~indels
+
+    flags['updatedInFrame'] = candidates & ~inframe
+    return flags
 
 
 def _parse3EndSeqs(seqs):
@@ -307,16 +358,23 @@ def _parse3EndSeqs(seqs):
     return zip(targetids, seqs, maxScores)
 
 
-def _recordFRLength(qsRec, germlineConsensusLength):
-    vgene = qsRec['vgene'].split('*')[0]
-    jgene = qsRec['jgene'].split('*')[0]
+def _recordFRLengths(cloneAnnot):
+    """
+    :param cloneAnnot: DataFrame of in-frame clones
+    :return: nested dict of germline gene -> region -> FR length -> number of reads
+    """
+    germlineConsensusLength = defaultdict(_defaultdefaultInt)
+    if cloneAnnot.shape[0] == 0:
+        return germlineConsensusLength
+    # collapsed identical reads count once per read
+    weights = cloneAnnot['count'].values if 'count' in cloneAnnot.columns else np.ones(cloneAnnot.shape[0], int)
+    vgenes = cloneAnnot['vgene'].str.split('*').str[0].values
+    jgenes = cloneAnnot['jgene'].str.split('*').str[0].values
     for region in ('fr1', 'fr2', 'fr3', 'fr4'):
-        start = region + ".start"
-        end = region + '.end'
-        length = qsRec[end] - qsRec[start] + 1
-        gene = vgene if region != 'fr4' else jgene
-        if not isnan(length):
-            germlineConsensusLength[gene][region][length] += 1
+        lengths = cloneAnnot[region + '.end'].values - cloneAnnot[region + '.start'].values + 1
+        tally = DataFrame({'gene': vgenes if region != 'fr4' else jgenes, 'length': lengths, 'weight': weights})
+        for (gene, length), weight in tally.groupby(['gene', 'length'], sort=False)['weight'].sum().iteritems():
+            germlineConsensusLength[gene][region][length] += weight
     return germlineConsensusLength
 
 
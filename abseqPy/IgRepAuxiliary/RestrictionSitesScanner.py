@@ -16,13 +16,13 @@ from abseqPy.logger import printto, LEVEL
 
 
 class RestrictionSitesScanner(Process):
-    # todo(RSA): remove cloneAnnot. using (xthreads) expensive memory multiplier
-    def __init__(self, records, cloneAnnot, procCounter, sites, simpleScan=True, stream=None):
+    def __init__(self, records, procCounter, sites, simpleScan=True, stream=None):
         super(RestrictionSitesScanner, self).__init__()
         self.records = records
-        self.cloneAnnot = cloneAnnot
         self.procCounter = procCounter
         self.sites = sites
+        # all sites are searched for in one pass over each strand
+        self.matcher = abseqPy.IgRepAuxiliary.restrictionAuxiliary.SitesMatcher(sites)
         self.simpleScan = simpleScan
         self.tasksQueue = None
         self.exitQueue = None
@@ -54,62 +54,60 @@ class RestrictionSitesScanner(Process):
         """
         Runs Restriction sites simple analysis
 
-        :param nextTask: iterable of sequence ids that should exist in self.records
+        :param nextTask: (first row, cloneAnnot rows) tuple, the rows are consecutive rows of self.records.
+                        cloneAnnot only has the RSA_SIMPLE_COLUMNS (RSA_DETAILED_COLUMNS for runDetailed), and
+                        the count column if identical reads were collapsed. All statistics are in number of reads
         :return: None
         """
         stats = abseqPy.IgRepAuxiliary.restrictionAuxiliary.initRSAStats(simple=True)
-        stats['total'] = len(nextTask)
-        for id_ in nextTask:
-            # record = raw sequence (taken from m.dict())
-            record = self.records[id_]
-            qsRec = self.cloneAnnot.loc[id_].to_dict()
+        start, cloneAnnot = nextTask
+        ids = cloneAnnot.index
+        stats['total'] = len(ids)
+        for row, (id_, qsRec) in enumerate(zip(ids, cloneAnnot.to_dict('records')), start):
+            # record = raw sequence (taken from the read store)
+            record = self.records[row]
             seq = sliceRecord(record, qsRec)
+            reads = int(qsRec.get('count', 1))
+            stats['reads'] += reads
             cut = False
-            for site, siteRegex in self.sites.items():
-                hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seq, siteRegex)
-                if len(hits) == 0:
-                    seqRC = str(Seq(seq).reverse_complement())
-                    hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seqRC, siteRegex)
+            for site, hits, _ in self.scan(seq):
                 if len(hits) > 0:
                     # how many times has this site found a match on this sequence (seq / seqRC)
-                    stats["siteHitsCount"][site] += len(hits)
+                    stats["siteHitsCount"][site] += len(hits) * reads
                     # how many times has this site found a match on *a* sequence
                     # (yes, this is a "duplicate" field of siteHitsSeqsIDs, we could've taken the length of
                     # siteHitsSeqsIDs, it would be equal to this)
-                    stats["siteHitSeqsCount"][site] += 1
+                    stats["siteHitSeqsCount"][site] += reads
                     # add the ids of sequences where this site has a match for
                     stats["siteHitsSeqsIDs"][site].add(id_)
                     cut = True
 
             # total number of sequences that are cut by *at least* one site
-            stats["seqsCutByAny"] += cut
+            stats["seqsCutByAny"] += cut * reads
 
-        self.procCounter.increment(len(nextTask))                         
+        self.procCounter.increment(len(ids))                         
         self.resultsQueue.put(stats)
         
     def runDetailed(self, nextTask):
         stats = abseqPy.IgRepAuxiliary.restrictionAuxiliary.initRSAStats(simple=False)
-        stats['total'] = len(nextTask)
-        for id_ in nextTask:
-            # record = raw sequence (taken from m.dict())
-            record = self.records[id_]
-            qsRec = self.cloneAnnot.loc[id_].to_dict()
+        start, cloneAnnot = nextTask
+        ids = cloneAnnot.index
+        stats['total'] = len(ids)
+        for row, (id_, qsRec) in enumerate(zip(ids, cloneAnnot.to_dict('records')), start):
+            # record = raw sequence (taken from the read store)
+            record = self.records[row]
             seq = sliceRecord(record, qsRec)
-            strand = "forward"
+            reads = int(qsRec.get('count', 1))
+            stats['reads'] += reads
             cut = False
-            for site, siteRegex in self.sites.items():
-                hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seq, siteRegex)
-                if len(hits) == 0:
-                    seqRC = str(Seq(seq).reverse_complement())
-                    strand = "reversed"
-                    hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seqRC, siteRegex)
+            for site, hits, strand in self.scan(seq):
                 if len(hits) > 0:
                     # how many times has this site found a match on this sequence (seq / seqRC)
-                    stats["siteHitsCount"][site] += len(hits)
+                    stats["siteHitsCount"][site] += len(hits) * reads
                     # how many times has this site found a match on *a* sequence
                     # (yes, this is a "duplicate" field of siteHitsSeqsIDs, we could've taken the length of
                     # siteHitsSeqsIDs, it would be equal to this)
-                    stats["siteHitSeqsCount"][site] += 1
+                    stats["siteHitSeqsCount"][site] += reads
                     # add the ids of sequences where this site has a match for
                     stats["siteHitsSeqsIDs"][site].add(id_)
                     hitsRegion = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHitsRegion(qsRec, hits)
@@ -118,16 +116,40 @@ class RestrictionSitesScanner(Process):
                             len(stats["siteHitSeqsGermline"][site]) < 10000:
                         stats["siteHitSeqsGermline"][site].append((strand, record))
                         stats["siteHitsSeqsIGV"][site].add(qsRec['vgene'].split('*')[0])
-                    stats["hitRegion"][site] += Counter(hitsRegion)
+                    stats["hitRegion"][site] += Counter(dict((region, reads) for region in hitsRegion))
                     cut = True
 
             # total number of sequences that are cut by *at least* one site
-            stats["seqsCutByAny"] += cut
+            stats["seqsCutByAny"] += cut * reads
 
-        self.procCounter.increment(len(nextTask))
+        self.procCounter.increment(len(ids))
         self.resultsQueue.put(stats)
 
-  
+    def scan(self, seq):
+        """
+        finds the hits of all sites in seq. A site is searched for on the reverse complement of seq only if it
+        has no hits on seq, the reverse complement is computed (and scanned for all sites) at most once.
+
+        :param seq: nucleotide string
+        :return: list of (site, list of hit start indices, strand) tuples in the order of self.sites, one for each
+                    site. strand is "reversed" from the first site that had to be searched on the reverse
+                    complement onwards, "forward" before it
+        """
+        forward = self.matcher.findAll(seq)
+        reverse = None
+        strand = "forward"
+        found = []
+        for site in self.sites:
+            hits = forward.get(site)
+            if not hits:
+                if reverse is None:
+                    reverse = self.matcher.findAll(str(Seq(seq).reverse_complement()))
+                strand = "reversed"
+                hits = reverse.get(site, [])
+            found.append((site, hits, strand))
+        return found
+
+
 def sliceRecord(rec, qsRec):
     """
     given a string of nucleotides denoted by 'rec', return a sliced string with starting index at
@@ -7,10 +7,14 @@
 
 __all__ = [
     'annotateAuxiliary',
+    'annotationCache',
     'diversityAuxiliary',
+    'fr4Search',
+    'histograms',
     'IgBlastWorker',
     'primerAuxiliary',
     'productivityAuxiliary',
+    'readStore',
     'RefineWorker',
     'restrictionAuxiliary',
     'RestrictionSitesScanner',
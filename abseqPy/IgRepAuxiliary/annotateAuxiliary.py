@@ -10,26 +10,35 @@ import sys
 import glob
 import gc
 
+import pandas as pd
+
 from multiprocessing import Queue
 from collections import Counter
 from Bio import SeqIO
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from pandas.core.frame import DataFrame
 from math import ceil
 
 from abseqPy.IgRepAuxiliary.IgBlastWorker import analyzeSmallFile, IgBlastWorker
-from abseqPy.IgRepertoire.igRepUtils import splitFastaFile, safeOpen
+from abseqPy.IgRepertoire.igRepUtils import safeOpen, detectFileFormat
 from abseqPy.logger import printto, LEVEL
 
 
 def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
-                      seqType='dna', outdir="", domainSystem='imgt', stream=None):
+                      seqType='dna', outdir="", domainSystem='imgt', igblastStream='off', format=None, stream=None):
+        """
+        :param fastaFile: string, the reads. FASTA or FASTQ, can be gzipped. Only an uncompressed FASTA file is
+                    handed to IgBLAST as it is, other files are converted on the fly into FASTA chunks
+        :param format: "fasta" or "fastq", detected from fastaFile's extension if None
+        """
         if fastaFile is None:
             return Counter()
 
         # Estimate the IGV diversity in a library from igblast output 
         printto(stream, 'The IGV clones of ' + os.path.basename(fastaFile) + ' are being annotated ...')
-        with open(fastaFile) as f:
-            noSeqs = sum(1 for line in f if line.startswith(">"))
+        format = format or detectFileFormat(fastaFile)
+        with safeOpen(fastaFile) as f:
+            noSeqs = sum(1 for _ in _iterRecords(f, format))
         totalFiles = int(ceil(noSeqs / seqsPerFile))
         if totalFiles < noWorkers:
             seqsPerFile = int(noSeqs / noWorkers) if noSeqs >= noWorkers else noSeqs
@@ -57,33 +66,42 @@ def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
         #     newFastFile = fastaFile
 
         newFastFile = fastaFile
+        readable = format == 'fasta' and not fastaFile.endswith('.gz')
 
         # if we only asked for one worker or if the sequences within the fasta file is smaller than the threshold in
-        # in seqsPerFile, we can just analyze the file without splitting it
-        if noWorkers == 1 or noSplit:
+        # in seqsPerFile, we can just analyze the file without splitting it (if IgBLAST can read it)
+        if readable and (noWorkers == 1 or noSplit):
             cloneAnnot, filteredIDs = analyzeSmallFile(newFastFile, chain, db,
                                                        seqType, noWorkers, outdir,
-                                                       domainSystem=domainSystem, stream=stream)
+                                                       domainSystem=domainSystem, igblastStream=igblastStream,
+                                                       stream=stream)
         else:
-            # split FASTA file into smaller files
-            prefix, ext = os.path.splitext(os.path.basename(fastaFile))
+            # chunks are cut from the FASTA file on the fly and handed out to idle workers
+            prefix, ext = os.path.splitext(os.path.basename(fastaFile.replace(".gz", "")))
+            ext = ".fasta"
             filesDir = os.path.join(outdir,  "tmp")
             prefix = prefix[prefix.find("_R")+1:prefix.find("_R")+3] + "_" if (prefix.find("_R") != -1) else ""
-            splitFastaFile(fastaFile, totalFiles, seqsPerFile, filesDir, prefix, ext, stream=stream)
+            if not os.path.isdir(filesDir):
+                os.makedirs(filesDir)
+            # chunk boundaries differ between runs, the chunks and IgBLAST outputs of a previous run cannot be
+            # reused. Compressed outputs kept for auditing ('keep') are checked against their input before reuse
+            for f in _chunkFiles(filesDir, prefix, ext):
+                os.remove(f)
 
             # Prepare the multiprocessing queues
             tasks = Queue()    
             outcomes = Queue()   
             exitQueue = Queue()              
-            cloneAnnot = DataFrame()
+            frames = []
             filteredIDs = []
             workers = []
+            scheduler = ChunkScheduler(noSeqs, noWorkers, maxChunkSize=seqsPerFile)
             try:
-                # Initialize workers
+                # Initialize workers, the number of IgBLAST threads is decided per chunk
                 for _ in range(noWorkers):
                     w = IgBlastWorker(chain, db,
-                                      seqType, int(ceil(noWorkers / totalFiles)),
-                                      domainSystem=domainSystem, stream=stream)
+                                      seqType, 1,
+                                      domainSystem=domainSystem, igblastStream=igblastStream, stream=stream)
                     w.tasksQueue = tasks
                     w.resultsQueue = outcomes
                     w.exitQueue = exitQueue      
@@ -91,9 +109,44 @@ def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
                     w.start()       
                     sys.stdout.flush()
 
-                # initialize tasks queue with file names     
-                for i in range(totalFiles):
-                    tasks.put(os.path.join(filesDir, prefix + "part" + str(i + 1) + ext))
+                printto(stream, "\tThe clones are distributed into multiple workers .. ")
+                inFlight = {}
+                freeCores = noWorkers
+                chunkNo = 0
+                with safeOpen(fastaFile) as fp:
+                    records = _iterRecords(fp, format)
+                    exhausted = False
+                    while True:
+                        # keep every core busy while there are sequences left
+                        while freeCores > 0 and not exhausted:
+                            size, threads = scheduler.nextChunk(freeCores)
+                            chunkNo += 1
+                            chunkFile = os.path.join(filesDir, "{}chunk{}{}".format(prefix, chunkNo, ext))
+                            n = _writeFastaChunk(records, size, chunkFile)
+                            if n == 0:
+                                exhausted = True
+                                os.remove(chunkFile)
+                                break
+                            scheduler.dispatched(n)
+                            tasks.put((chunkFile, threads))
+                            inFlight[chunkFile] = (n, threads)
+                            freeCores -= threads
+                        if not inFlight:
+                            break
+                        chunkFile, outcome, elapsed = outcomes.get()
+                        n, threads = inFlight.pop(chunkFile)
+                        freeCores += threads
+                        scheduler.completed(n, threads, elapsed)
+                        if outcome is None:
+                            continue
+                        (cloneAnnoti, fileteredIDsi) = outcome
+                        if len(cloneAnnoti):
+                            frames.append(cloneAnnoti)
+                        filteredIDs += fileteredIDsi
+                        sys.stdout.flush()
+                        gc.collect()
+                printto(stream, "\t{:,} sequences were annotated in {:,} chunks (mean throughput {:,.1f} "
+                                "sequences/s per thread)".format(noSeqs, len(scheduler.history), scheduler.rate))
 
                 # Add a poison pill for each worker
                 for _ in range(noWorkers + 10):
@@ -105,22 +158,9 @@ def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
                     m = exitQueue.get()
                     if m == "exit":
                         i += 1
-                
-                # Collect results
-                printto(stream, "Results are being collated from all workers ...")
-                sys.stdout.flush()
-                while totalFiles:
-                    outcome = outcomes.get()
-                    totalFiles -= 1                    
-                    if outcome is None:
-                        continue                    
-                    (cloneAnnoti, fileteredIDsi) = outcome
-                    cloneAnnot = cloneAnnot.append(cloneAnnoti)
-                    filteredIDs += fileteredIDsi
-                    sys.stdout.flush()
-                    gc.collect()
                 printto(stream, "\tResults were collated successfully.")
-                    
+                cloneAnnot = pd.concat(frames) if frames else DataFrame()
+
             except Exception:
                 printto(stream, "Something went wrong during the annotation process!", LEVEL.EXCEPT)
                 raise
@@ -129,8 +169,103 @@ def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
                     w.terminate()
 
             # Clean folders to save space
-            # TODO: remove .fasta and .out files
-            if noSeqs > seqsPerFile and os.path.exists(filesDir + os.path.sep + prefix + "part1" + ext):
-                map(os.remove, glob.glob(filesDir + os.path.sep + "*" + ext))
+            map(os.remove, _chunkFiles(filesDir, prefix, ext))
 
         return cloneAnnot, filteredIDs
+
+
+class ChunkScheduler(object):
+    """
+    decides how many sequences go into the next IgBLAST chunk and how many IgBLAST threads it gets.
+
+    Chunk sizes are picked from the measured per-thread throughput so that a chunk takes roughly
+    targetSeconds to annotate. Chunks get smaller towards the end of the file so that all workers
+    finish at about the same time, and when there are fewer chunks left than idle cores, the idle
+    cores are handed to the remaining chunks as extra IgBLAST threads.
+    """
+    def __init__(self, noSeqs, cores, maxChunkSize=50000, minChunkSize=500, targetSeconds=60.0):
+        self.noSeqs = noSeqs
+        self.cores = cores
+        self.maxChunkSize = maxChunkSize
+        self.minChunkSize = min(minChunkSize, maxChunkSize)
+        self.targetSeconds = targetSeconds
+        self.remaining = noSeqs
+        # sequences annotated per second per IgBLAST thread, None until the first chunk completes
+        self.rate = None
+        # (sequences, threads, seconds) of completed chunks
+        self.history = []
+
+    def nextChunk(self, freeCores):
+        """
+        :param freeCores: int, number of cores that are not used by running chunks
+        :return: (chunk size, number of IgBLAST threads)
+        """
+        if self.rate is None:
+            # no measurement yet: start with small chunks, so that every core gets several chunks
+            size = self.noSeqs // (self.cores * 8)
+        else:
+            size = int(self.rate * self.targetSeconds)
+        # split the tail evenly between all cores
+        size = min(size, int(ceil(self.remaining / self.cores)))
+        size = max(self.minChunkSize, min(self.maxChunkSize, size))
+        chunksLeft = max(1, int(ceil(self.remaining / size)))
+        threads = max(1, freeCores // chunksLeft) if chunksLeft < freeCores else 1
+        return size, threads
+
+    def dispatched(self, size):
+        self.remaining -= size
+
+    def completed(self, size, threads, seconds):
+        self.history.append((size, threads, seconds))
+        # IgBLAST scales close to linearly with its threads on a single chunk
+        rate = size / max(seconds * threads, 1e-3)
+        # exponentially weighted so the estimate follows the data as it changes along the file
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+
+
+def _chunkFiles(filesDir, prefix, ext):
+    """
+    :return: list of the FASTA chunks in filesDir and the IgBLAST outputs written next to them ('off'), the
+             compressed IgBLAST outputs ('keep') are not included
+    """
+    return glob.glob(os.path.join(filesDir, prefix + "chunk*" + ext)) + \
+        glob.glob(os.path.join(filesDir, prefix + "chunk*.out"))
+
+
+def _iterFastaRecords(fp):
+    """
+    yields the raw text of each record in an open FASTA file
+    """
+    record = []
+    for line in fp:
+        if line.startswith(">") and record:
+            yield ''.join(record)
+            record = []
+        record.append(line)
+    if record:
+        yield ''.join(record)
+
+
+def _iterRecords(fp, format):
+    """
+    yields the raw text of each record in an open FASTA or FASTQ file, as FASTA. FASTQ records are converted on the fly
+    """
+    if format == 'fastq':
+        return (">{}\n{}\n".format(title, seq) for title, seq, _ in FastqGeneralIterator(fp))
+    return _iterFastaRecords(fp)
+
+
+def _writeFastaChunk(records, size, filename):
+    """
+    writes the next size records from the records iterator into filename
+
+    :return: number of records written
+    """
+    n = 0
+    with open(filename, 'w') as out:
+        for record in records:
+            out.write(record)
+            n += 1
+            if n == size:
+                break
+    return n
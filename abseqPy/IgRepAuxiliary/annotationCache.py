@@ -0,0 +1,220 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+import os
+import json
+import hashlib
+import sqlite3
+
+from pandas.core.frame import DataFrame
+
+from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
+from abseqPy.IgRepAuxiliary.annotateAuxiliary import annotateIGSeqRead, _iterRecords
+from abseqPy.IgRepertoire.igRepUtils import safeOpen, detectFileFormat, germlineFingerprint
+from abseqPy.versionManager import _getSoftwareVersion
+from abseqPy.config import VERSION
+from abseqPy.logger import printto, LEVEL
+
+
+# default maximum number of sequences kept in an annotation cache, least recently used sequences are evicted first
+ANNOTATION_CACHE_MAX_ENTRIES = 20000000
+
+# number of sequences looked up / inserted per SQL statement
+_SQL_BATCH = 500
+
+# fraction of maxEntries that is evicted at once when the cache is full
+_EVICTION_BATCH = 0.1
+
+
+class AnnotationCache:
+    """
+    persistent, content-addressed store of IgBLAST annotations. Entries are keyed by a hash of the read's
+    sequence and are only valid for the fingerprint (germline database, IgBLAST version and parameters) they
+    were produced with. Queries that IgBLAST could not annotate are cached too (as filtered).
+    """
+
+    def __init__(self, filename, fingerprint, maxEntries=ANNOTATION_CACHE_MAX_ENTRIES):
+        """
+        :param filename: string
+                    path to the SQLite database file, created if it does not exist
+        :param fingerprint: string
+                    identifies the germline database and IgBLAST parameters, see annotationFingerprint
+        :param maxEntries: int
+                    maximum number of sequences (over all fingerprints) to keep
+        """
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        # samples running in parallel may share the same cache
+        self._db = sqlite3.connect(filename, timeout=600)
+        self._db.execute("CREATE TABLE IF NOT EXISTS annotation ("
+                         "fingerprint TEXT NOT NULL, "
+                         "seqhash TEXT NOT NULL, "
+                         "fields TEXT NOT NULL, "
+                         "annotation TEXT, "
+                         "lastused INTEGER NOT NULL, "
+                         "PRIMARY KEY (fingerprint, seqhash))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS annotation_lastused ON annotation (lastused)")
+        self._db.commit()
+        # upper bound of the number of entries, only counted again when it exceeds maxEntries
+        self._count = self._db.execute("SELECT COUNT(*) FROM annotation").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @staticmethod
+    def hashSequence(seq):
+        return hashlib.sha1(seq.upper().encode('ascii')).hexdigest()
+
+    def get(self, hashes):
+        """
+        looks up sequence hashes and marks the ones found as recently used
+
+        :param hashes: iterable of sequence hashes
+        :return: dict of seqhash -> (fields, annotation row or None if the sequence was filtered by IgBLAST)
+        """
+        found = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), _SQL_BATCH):
+            batch = hashes[i:i + _SQL_BATCH]
+            rows = self._db.execute("SELECT seqhash, fields, annotation FROM annotation WHERE fingerprint = ? "
+                                    "AND seqhash IN ({})".format(','.join('?' * len(batch))),
+                                    [self.fingerprint] + batch)
+            for seqhash, fields, annotation in rows:
+                found[seqhash] = (json.loads(fields), json.loads(annotation) if annotation is not None else None)
+        if found:
+            stamp = self._nextStamp()
+            keys = list(found.keys())
+            for i in range(0, len(keys), _SQL_BATCH):
+                batch = keys[i:i + _SQL_BATCH]
+                self._db.execute("UPDATE annotation SET lastused = ? WHERE fingerprint = ? AND seqhash IN ({})"
+                                 .format(','.join('?' * len(batch))), [stamp, self.fingerprint] + batch)
+            self._db.commit()
+        return found
+
+    def put(self, fields, entries):
+        """
+        :param fields: list of strings, the column names of every annotation row
+        :param entries: iterable of (seqhash, annotation row or None if filtered) tuples
+        :return: None
+        """
+        stamp = self._nextStamp()
+        fields = json.dumps(fields)
+        rows = [(self.fingerprint, h, fields, json.dumps(row) if row is not None else None, stamp)
+                for h, row in entries]
+        self._db.executemany("INSERT OR REPLACE INTO annotation VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+        # replaced entries and entries added by other processes make this an estimate
+        self._count += len(rows)
+        if self._count > self.maxEntries:
+            self._evict()
+
+    def _nextStamp(self):
+        stamp = self._db.execute("SELECT MAX(lastused) FROM annotation").fetchone()[0]
+        return (stamp or 0) + 1
+
+    def _evict(self):
+        """
+        evicts the least recently used entries in one go, down to maxEntries less a batch, so that the next
+        evictions (and counts) only happen after that many more entries were added
+        """
+        count = self._db.execute("SELECT COUNT(*) FROM annotation").fetchone()[0]
+        if count > self.maxEntries:
+            keep = self.maxEntries - int(self.maxEntries * _EVICTION_BATCH)
+            self._db.execute("DELETE FROM annotation WHERE rowid IN "
+                             "(SELECT rowid FROM annotation ORDER BY lastused LIMIT ?)", (count - keep,))
+            self._db.commit()
+            count = keep
+        self._count = count
+
+
+def annotationFingerprint(db, chain, seqType, domainSystem, species='human'):
+    """
+    :return: string that changes whenever IgBLAST could produce a different annotation for the same sequence.
+             The germline files are identified by their contents, see germlineFingerprint
+    """
+    return '|'.join([germlineFingerprint(db, chain, species, protein=seqType.lower() != 'dna'), chain,
+                     seqType.lower(), domainSystem, species, _getSoftwareVersion('igblast'), VERSION])
+
+
+def annotateIGSeqReadCached(fastaFile, chain, db, noWorkers, seqsPerFile, cacheFile,
+                            seqType='dna', outdir="", domainSystem='imgt', igblastStream='off',
+                            maxEntries=ANNOTATION_CACHE_MAX_ENTRIES, format=None, stream=None):
+    """
+    same as annotateIGSeqRead, but only sequences that are not found in the annotation cache are sent to IgBLAST.
+    Cached annotations are joined back by query ID.
+
+    :param cacheFile: string
+                path to the (SQLite) annotation cache
+    :param maxEntries: int
+                maximum number of sequences in the cache
+    :param format: string
+                "fasta" or "fastq", detected from fastaFile's extension if None
+    :return: (DataFrame, list, int, int) the same DataFrame and filtered IDs as annotateIGSeqRead,
+                followed by the number of cache hits and misses
+    """
+    fingerprint = annotationFingerprint(db, chain, seqType, domainSystem)
+    format = format or detectFileFormat(fastaFile)
+    fields = getAnnotationFields(chain)
+    with AnnotationCache(cacheFile, fingerprint, maxEntries=maxEntries) as cache:
+        # first pass: hash every sequence
+        queryHashes = {}
+        with safeOpen(fastaFile) as fp:
+            for record in _iterRecords(fp, format):
+                header, _, seq = record.partition('\n')
+                queryHashes[header[1:].split()[0]] = cache.hashSequence(seq.replace('\n', '').strip())
+        cached = cache.get(set(queryHashes.values()))
+
+        # second pass: join cached annotations back by query ID and collect the misses for IgBLAST
+        missesFile = os.path.join(outdir, os.path.splitext(os.path.basename(fastaFile.replace(".gz", "")))[0] +
+                                  "_cache_misses.fasta")
+        hitRows, filteredIDs = [], []
+        noMisses = 0
+        with safeOpen(fastaFile) as fp, open(missesFile, 'w') as out:
+            for record in _iterRecords(fp, format):
+                qid = record[1:].split()[0]
+                entry = cached.get(queryHashes[qid])
+                if entry is None or entry[0] != fields[1:]:
+                    out.write(record if record.endswith('\n') else record + '\n')
+                    noMisses += 1
+                elif entry[1] is None:
+                    filteredIDs.append(qid)
+                else:
+                    hitRows.append([qid] + entry[1])
+        del cached
+        cache.hits, cache.misses = len(queryHashes) - noMisses, noMisses
+        printto(stream, "\tAnnotation cache: {:,} hits, {:,} misses".format(cache.hits, cache.misses), LEVEL.INFO)
+
+        if noMisses:
+            cloneAnnot, missFiltered = annotateIGSeqRead(missesFile, chain, db, noWorkers, seqsPerFile,
+                                                         seqType, outdir=outdir, domainSystem=domainSystem,
+                                                         igblastStream=igblastStream, stream=stream)
+            filteredIDs += missFiltered
+            # store new annotations, keyed by their sequence's hash
+            columns = [cloneAnnot[f].tolist() for f in fields[1:]] if len(cloneAnnot) else []
+            entries = dict((queryHashes[qid], list(row)) for qid, row in zip(cloneAnnot.index, zip(*columns)))
+            entries.update((queryHashes[qid], None) for qid in missFiltered)
+            cache.put(fields[1:], entries.items())
+        else:
+            cloneAnnot = DataFrame()
+        os.remove(missesFile)
+
+        if hitRows:
+            hits = DataFrame(hitRows, columns=fields)
+            hits.set_index('queryid', drop=True, inplace=True)
+            cloneAnnot = hits if not len(cloneAnnot) else cloneAnnot.append(hits)
+        return cloneAnnot, filteredIDs, cache.hits, cache.misses
@@ -4,10 +4,21 @@
     Python Version: 2.7
     Changes log: check git commits. 
 '''
-from collections import Counter, defaultdict
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from pandas import DataFrame, Series
+
+from abseqPy.IgRepAuxiliary.histograms import lengthHistogram
+from abseqPy.IgRepertoire.igRepUtils import cloneCounts
 
 _REGIONS = ['fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3', 'fr4']
 
+# gene of the clones without a V germline, NaN is labelled as in the productivity report
+_MISSING_GENE = 'NaN'
+
 
 #  spectratype, that is, histogram of clone counts by CDR/FR nucleotide length.
 #  The spectratype is useful to detect pathological and highly clonal repertoires, 
@@ -15,64 +26,162 @@ _REGIONS = ['fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3', 'fr4']
 def annotateSpectratypes(cloneAnnot, amino=True):
     # TODO: add annotation to clonotypes, e.g., germline genes
     denom = 3 if amino else 1
+    counts = cloneCounts(cloneAnnot)
+    weights = None if counts is None else counts.loc[cloneAnnot.index].values
     spectraTypes = {}
     for region in _REGIONS:
         spectraType = ((cloneAnnot[region + '.end'] - cloneAnnot[region + '.start'] + 1) / denom).astype(int)
-        spectraTypes[region] = Counter(spectraType)
+        spectraTypes[region] = lengthHistogram(spectraType.values, weights)
     # V domain
     spectraType = ((cloneAnnot['fr4.end'] - cloneAnnot['fr1.start'] + 1) / denom).astype(int)
-    spectraTypes['v'] = Counter(spectraType)
+    spectraTypes['v'] = lengthHistogram(spectraType.values, weights)
 
     return spectraTypes
 
 
-# clonotype is the histogram of clone counts by CDR/FR amino acid sequence, partitioned by V germline (gene level)
-def annotateClonotypes(cloneSeqs, segregate=False, removeNone=True):
-    if segregate:
-        clonoTypes = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-
-        for row in cloneSeqs.itertuples():
-            geneName = row.germline.split("*")[0]
-            variableAA = ""
-            badAA = False
-            for region in _REGIONS:
-                regionAA = getattr(row, region)
-                variableAA += regionAA
-                if regionAA == 'None' or regionAA == '':
-                    badAA = True
-                if not (removeNone and (regionAA == "None" or regionAA == "")):
-                    clonoTypes[geneName][region][regionAA] += 1
-            if not (badAA and removeNone):
-                clonoTypes[geneName]['v'][variableAA] += 1
-    else:
-        clonoTypes = {}
-
-        for region in _REGIONS:
-            seqs = cloneSeqs[region].tolist()
-            clonoTypes[region] = Counter(seqs)
-            if removeNone:
-                clonoTypes[region].pop("None", None)
-                clonoTypes[region].pop("", None)
-
-        def _join(frcdr):
-            if removeNone and ('None' in frcdr or '' in frcdr):
-                return "None"
-            return "".join(frcdr)
-
-        # V domain
-        seqs = map(_join, zip(cloneSeqs['fr1'].tolist(),
-                              cloneSeqs['cdr1'].tolist(),
-                              cloneSeqs['fr2'].tolist(),
-                              cloneSeqs['cdr2'].tolist(),
-                              cloneSeqs['fr3'].tolist(),
-                              cloneSeqs['cdr3'].tolist(),
-                              cloneSeqs['fr4'].tolist()
-                              )
-                   )
-        clonoTypes['v'] = Counter(seqs)
-        if removeNone:
-            clonoTypes['v'].pop("None", None)
-            clonoTypes['v'].pop("", None)
-
-    return clonoTypes
+class Clonotypes(object):
+    """
+    clonotype table, that is, the clone counts of each distinct CDR/FR (and V domain) amino acid sequence per
+    V germline (gene level). Every region column is factorized once, sequences are referred to by integer codes
+    and the counts are kept in one (gene, region, code, count) dataframe, flattening over genes is a groupby.
+    """
+
+    def __init__(self, table, sequences):
+        """
+        :param table: DataFrame with gene, region, code and count columns, one row per distinct
+                    (gene, region, sequence)
+        :param sequences: dict of region -> array of the region's sequences indexed by code
+        """
+        self.table = table
+        self.sequences = sequences
+
+    def regions(self):
+        """
+        :return: sorted list of the regions that have at least one clonotype
+        """
+        return sorted(self.table['region'].unique())
+
+    def counts(self, region, gene=None):
+        """
+        :param region: string, one of fr1, cdr1, ..., fr4 or v (V domain)
+        :param gene: string, only count the clones of this V germline gene, all genes combined if None
+        :return: Series of counts indexed by amino acid sequence
+        """
+        selected = self.table['region'] == region
+        if gene is not None:
+            selected &= self.table['gene'] == gene
+        summed = self.table[selected].groupby('code')['count'].sum()
+        return Series(summed.values, index=self.sequences[region][summed.index.values.astype(np.int64)])
+
+    def geneCounts(self, region):
+        """
+        :param region: string, one of fr1, cdr1, ..., fr4 or v (V domain)
+        :return: (genes, counts, groups) tuple. genes is the sorted list of V germline genes, counts a Series of
+                 counts indexed by sequence, one entry per gene and sequence, and groups the index in genes of the
+                 gene of each entry
+        """
+        rows = self.table[self.table['region'] == region]
+        groups, genes = pd.factorize(rows['gene'].astype(object), sort=True)
+        return list(genes), Series(rows['count'].values, index=self.sequences[region][rows['code'].values]), groups
+
+    def byGene(self):
+        """
+        :return: generator of (gene, region, counts) tuples, counts as returned by counts()
+        """
+        for (gene, region), rows in self.table.groupby(['gene', 'region'], sort=True, observed=True):
+            yield gene, region, Series(rows['count'].values, index=self.sequences[region][rows['code'].values])
+
+    def toDict(self, segregate=False):
+        """
+        :param segregate: bool, nest the counts under their V germline gene
+        :return: dict of region -> {sequence: count}, or gene -> region -> {sequence: count} if segregate
+        """
+        if not segregate:
+            return dict((region, _countDict(self.counts(region))) for region in self.regions())
+        clonoTypes = defaultdict(dict)
+        for gene, region, counts in self.byGene():
+            clonoTypes[gene][region] = _countDict(counts)
+        return dict(clonoTypes)
+
+
+def _countDict(counts):
+    return dict(zip(counts.index.tolist(), counts.values.tolist()))
 
+
+def _factorize(values, removeNone):
+    """
+    :return: codes and uniques of values, codes of missing values (and of "None" and empty sequences if
+             removeNone) being -1
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    if removeNone:
+        bad = np.flatnonzero((uniques == 'None') | (uniques == ''))
+        if len(bad):
+            codes[np.in1d(codes, bad)] = -1
+    return codes, uniques
+
+
+def clonotypeTable(cloneSeqs, removeNone=True, counts=None):
+    """
+    :param cloneSeqs: DataFrame with a germline column and one amino acid column per region
+    :param removeNone: bool, skip "None" and empty sequences, and V domains having such a region
+    :param counts: Series, number of identical reads each row of cloneSeqs stands for (indexed by query ID),
+                if reads were collapsed
+    :return: Clonotypes
+
+    >>> seqs = pd.DataFrame({'germline': ['IGHV1-2*01', 'IGHV1-2*02', 'IGHV3-3*01'], 'fr1': ['QV', 'QV', 'None'],
+    ...                      'cdr1': ['GY', 'GF', 'GY'], 'fr2': ['M'] * 3, 'cdr2': ['I'] * 3, 'fr3': ['R'] * 3,
+    ...                      'cdr3': ['AR', 'AR', 'AK'], 'fr4': ['WG'] * 3})
+    >>> clonoTypes = clonotypeTable(seqs)
+    >>> clonoTypes.counts('cdr1').sort_index().to_dict()
+    {'GF': 1, 'GY': 2}
+    >>> clonoTypes.counts('v', gene='IGHV1-2').sort_index().to_dict()
+    {'QVGFMIRARWG': 1, 'QVGYMIRARWG': 1}
+    """
+    weights = np.ones(len(cloneSeqs), dtype=np.int64) if counts is None else \
+        counts.loc[cloneSeqs.index].values.astype(np.int64)
+
+    # germlines are factorized before being trimmed to gene level, there are far fewer of them than reads
+    germlineCodes, germlines = pd.factorize(cloneSeqs['germline'])
+    # a missing germline is factorized to -1, which indexes the trailing _MISSING_GENE instead of a real gene
+    geneNames = np.asarray([g.split("*")[0] for g in germlines] + [_MISSING_GENE], dtype=object)
+    geneCodes, genes = pd.factorize(geneNames[germlineCodes])
+
+    codes, sequences = {}, {}
+    for region in _REGIONS:
+        codes[region], sequences[region] = _factorize(cloneSeqs[region], removeNone)
+
+    # V domain: rows with the same combination of region codes share a V domain, only the distinct combinations
+    # are concatenated (then factorized again, different combinations can concatenate to the same sequence)
+    combination = np.zeros(len(cloneSeqs), dtype=np.int64)
+    valid = np.ones(len(cloneSeqs), dtype=bool)
+    for region in _REGIONS:
+        valid &= codes[region] >= 0
+        combination, _ = pd.factorize(combination * (len(sequences[region]) + 1) + codes[region] + 1)
+    _, first = np.unique(combination, return_index=True)
+    domains = ["".join(sequences[region][codes[region][row]] if codes[region][row] >= 0 else "None"
+                       for region in _REGIONS) for row in first]
+    domainCodes, sequences['v'] = _factorize(np.asarray(domains, dtype=object), removeNone)
+    codes['v'] = domainCodes[combination]
+    if removeNone:
+        codes['v'][~valid] = -1
+
+    tables = []
+    for region in _REGIONS + ['v']:
+        kept = codes[region] >= 0
+        table = DataFrame({'gene': geneCodes[kept], 'code': codes[region][kept], 'count': weights[kept]}) \
+            .groupby(['gene', 'code'], sort=False)['count'].sum().reset_index()
+        table['region'] = region
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+    table[['code', 'count']] = table[['code', 'count']].astype(np.int64)
+    table['gene'] = pd.Categorical.from_codes(table['gene'].values, genes)
+    table['region'] = table['region'].astype('category')
+    return Clonotypes(table[['gene', 'region', 'code', 'count']], sequences)
+
+
+# clonotype is the histogram of clone counts by CDR/FR amino acid sequence, partitioned by V germline (gene level)
+# counts is the number of identical reads each row of cloneSeqs stands for (indexed by query ID), if reads were collapsed
+def annotateClonotypes(cloneSeqs, segregate=False, removeNone=True, counts=None):
+    return clonotypeTable(cloneSeqs, removeNone=removeNone, counts=counts).toDict(segregate)
@@ -0,0 +1,134 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import numpy as np
+
+from Bio.SubsMat import MatrixInfo as matlist
+
+
+# scoring schemes of findBestAlignment, kept in sync with its pairwise2 calls
+PROTEIN_GAP = -100
+DNA_MATCH, DNA_MISMATCH, DNA_GAP = 1, -2, -2
+
+_NEG = -1e9
+
+
+def _protein(matrix):
+    """
+    :param matrix: Bio.SubsMat.MatrixInfo dictionary
+    :return: 128 x 128 score lookup table indexed by character codes, NaN for pairs missing from the matrix
+    """
+    table = np.full((128, 128), np.nan)
+    for (a, b), score in matrix.items():
+        table[ord(a), ord(b)] = table[ord(b), ord(a)] = score
+    return table
+
+
+_BLOSUM62 = _protein(matlist.blosum62)
+
+
+def _encode(seq):
+    codes = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+    if codes.size and codes.max() >= 128:
+        raise ValueError("non-ASCII sequence")
+    return codes
+
+
+def localAlignment(seq, query, dna=False):
+    """
+    best local alignment of query in seq, scored like findBestAlignment's pairwise2 calls (BLOSUM62 with
+    prohibitive gaps for proteins, +1/-2/-2 for DNA). Only the alignment scores are computed for all cells,
+    the winning alignment is ungapped and is rebuilt in pairwise2's format from its diagonal.
+
+    :param seq: string, sequence to search in ('*' already replaced for proteins)
+    :param query: string, consensus to look for
+    :param dna: bool
+    :return: (alignedSeq, alignedQuery, score, begin, end) as returned by pairwise2, [] if nothing aligns or
+             None if the optimum is not unique or might be gapped, in which case pairwise2 has to decide
+    """
+    n, m = len(seq), len(query)
+    if n == 0 or m == 0:
+        return []
+    try:
+        s, q = _encode(seq), _encode(query)
+    except (UnicodeError, ValueError):
+        return None
+    if dna:
+        scores = np.where(s[:, None] == q[None, :], DNA_MATCH, DNA_MISMATCH).astype(float)
+    else:
+        scores = _BLOSUM62[s[:, None], q[None, :]]
+        if np.isnan(scores).any():
+            return None
+
+    # lay the diagonals of the score matrix out as rows: cell (k, j) is (k - m + 1 + j, j) of the score matrix,
+    # cells outside of it score 0 and are never part of an alignment
+    rows = np.arange(n + m - 1)[:, None] - (m - 1) + np.arange(m)[None, :]
+    inside = (rows >= 0) & (rows < n)
+    diagonals = np.where(inside, scores[np.clip(rows, 0, n - 1), np.arange(m)[None, :]], 0)
+
+    # Kadane along each diagonal: the best ungapped alignment ending at a cell is its prefix sum minus
+    # the lowest prefix sum before it (or 0 when the alignment starts at the diagonal's first cell)
+    prefix = np.cumsum(diagonals, axis=1)
+    lowest = np.minimum.accumulate(np.minimum(prefix, 0), axis=1)
+    raw = prefix.copy()
+    raw[:, 1:] -= lowest[:, :-1]
+    best = np.where(inside, prefix - lowest, -1)
+
+    top = best.max()
+    if top <= 0:
+        return []
+    ends = np.argwhere(best == top)
+    if len(ends) != 1:
+        return None
+    if _bestGappedScore(scores, dna) >= top:
+        return None
+
+    k, jEnd = ends[0]
+    j = jEnd
+    while j > 0 and best[k, j - 1] > 0:
+        j -= 1
+    if j > 0 and inside[k, j - 1] and raw[k, j - 1] == 0:
+        # a zero scoring extension, both alignments are optimal
+        return None
+    i, iEnd = rows[k, j], rows[k, jEnd]
+
+    diagonal = j - i
+    alignedSeq = '-' * max(diagonal, 0) + seq
+    alignedQuery = '-' * max(-diagonal, 0) + query
+    width = max(len(alignedSeq), len(alignedQuery))
+    begin = max(i, j)
+    return (alignedSeq.ljust(width, '-'), alignedQuery.ljust(width, '-'), float(top),
+            begin, begin + (iEnd - i) + 1)
+
+
+def _bestGappedScore(scores, dna):
+    """
+    :return: upper bound (exact for DNA) of the best score of a local alignment with at least one gap
+    """
+    if not dna:
+        # every gap costs more than a perfect match of the whole query could gain
+        return np.clip(np.nanmax(scores, axis=0), 0, None).sum() + PROTEIN_GAP
+    n, m = scores.shape
+    steps = DNA_GAP * np.arange(n)
+    ungapped = np.zeros(n)
+    gapped = np.full(n, _NEG)
+    top = _NEG
+    for j in range(m):
+        # matches come from the previous diagonal, gaps in the query (deletions) from the previous column
+        base = np.maximum(gapped, ungapped) + DNA_GAP
+        base[1:] = np.maximum(base[1:], gapped[:-1] + scores[1:, j])
+        ungapped[1:] = ungapped[:-1] + scores[1:, j]
+        ungapped[0] = scores[0, j]
+        np.maximum(ungapped, 0, out=ungapped)
+        anchor = np.maximum(base, ungapped)
+        # gaps in the sequence (insertions) run down the column
+        vertical = np.full(n, _NEG)
+        vertical[1:] = np.maximum.accumulate(anchor - steps)[:-1] + steps[1:]
+        gapped = np.maximum(base, vertical)
+        top = max(top, gapped.max())
+    return top
@@ -0,0 +1,63 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from collections import Counter
+
+import numpy as np
+
+
+def lengthHistogram(lengths, weights=None):
+    """
+    histogram of integer values (sequence lengths, spectratypes) in one bincount
+
+    :param lengths: iterable of ints
+    :param weights: iterable of the same length as lengths, or None to count every value once
+    :return: Counter of length -> total weight, only lengths that appear are keys
+
+    >>> sorted(lengthHistogram([12, 10, 12, 15], [2, 1, 3, 1]).items())
+    [(10, 1), (12, 5), (15, 1)]
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if not lengths.size:
+        return Counter()
+    weights = None if weights is None else np.asarray(weights)
+    low, high = lengths.min(), lengths.max()
+    if high - low < max(lengths.size, 1 << 16):
+        totals = np.bincount(lengths - low, weights=weights)
+        values = np.arange(low, high + 1)
+        # lengths that appear, even with a weight of 0
+        present = np.flatnonzero(totals if weights is None else np.bincount(lengths - low))
+        values, totals = values[present], totals[present]
+    else:
+        # sparse values (e.g. garbage coordinates), do not allocate the whole range
+        values, inverse = np.unique(lengths, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+    if weights is None or weights.dtype.kind in 'iub':
+        totals = np.rint(totals).astype(np.int64)
+    return Counter(dict(zip(values.tolist(), totals.tolist())))
+
+
+def duplicationLevels(frequencies, atLeast=(), exactly=()):
+    """
+    the frequencies are sorted once, every threshold is then a binary search into their cumulative sums
+
+    :param frequencies: iterable of clone sizes (duplication levels)
+    :param atLeast: thresholds x, the proportion of the total frequency in clones of size >= x is returned
+    :param exactly: sizes i, the number of clones of size i (over the total frequency) is returned
+    :return: tuple of two lists of floats, one value per threshold of atLeast and exactly respectively
+
+    >>> duplicationLevels([1, 1, 2, 6], atLeast=[2, 5, 7], exactly=[1, 2, 3])
+    ([0.8, 0.6, 0.0], [0.2, 0.1, 0.0])
+    """
+    freqs = np.sort(np.asarray(frequencies))
+    cumulative = np.concatenate(([0], np.cumsum(freqs)))
+    total = float(cumulative[-1])
+    atLeast = np.asarray(atLeast)
+    exactly = np.asarray(exactly)
+    above = cumulative[-1] - cumulative[np.searchsorted(freqs, atLeast, side='left')]
+    equal = np.searchsorted(freqs, exactly, side='right') - np.searchsorted(freqs, exactly, side='left')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (above / total).tolist(), (equal / total).tolist()
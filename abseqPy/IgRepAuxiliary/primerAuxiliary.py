@@ -12,26 +12,24 @@ import numpy as np
 
 from math import ceil
 from multiprocessing import Queue
-from Bio import SeqIO
-from collections import Counter
 from pandas import DataFrame
 
 from abseqPy.IgRepAuxiliary.productivityAuxiliary import ProcCounter
 from abseqPy.IgRepReporting.igRepPlots import plotDist, plotVenn
 from abseqPy.IgRepAuxiliary.PrimerWorker import PrimerWorker
-from abseqPy.IgRepertoire.igRepUtils import gunzip, compressCountsGeneLevel
-from abseqPy.utilities import hasLargeMem
+from abseqPy.IgRepAuxiliary.readStore import ReadStore
+from abseqPy.IgRepertoire.igRepUtils import compressCountsGeneLevel, cloneCounts, countColumn, totalReads
 from abseqPy.logger import printto, LEVEL
 
 
 def addPrimerData(cloneAnnot, readFile, format, fr4cut, trim5end,
-                  trim3end, actualQstart, end5, end3, end5offset, threads, stream=None):
+                  trim3end, actualQstart, end5, end3, end5offset, threads, outDir=None, stream=None):
     printto(stream, "Primer specificity analysis has begun ...")
     queryIds = cloneAnnot.index
     seqsPerFile = 100
     _addPrimerColumns(cloneAnnot, end5, end3)
     workers = []
-    records = SeqIO.index(gunzip(readFile), format)
+    records = ReadStore.build(readFile, queryIds, format, outDir=outDir, stream=stream)
     newColumns = ['queryid'] + list(cloneAnnot.columns)
     try:
         printto(stream, "\t " + format + " index created and primer analysis started ...")
@@ -41,19 +39,17 @@ def addPrimerData(cloneAnnot, readFile, format, fr4cut, trim5end,
         exitQueue = Queue()
         resultsQueue = Queue()
         procCounter = ProcCounter(noSeqs, stream=stream)
+        # workers share the memory-mapped reads, the number of stages running at once is bounded by
+        # IgMultiRepertoire's memory budget instead
         threads = min(threads, totalTasks)
-        if not hasLargeMem():
-            threads = 2
         for _ in range(threads):
-            w = PrimerWorker(procCounter, fr4cut, trim5end, trim3end, actualQstart, end5,
+            w = PrimerWorker(records, procCounter, fr4cut, trim5end, trim3end, actualQstart, end5,
                              end3, end5offset, tasks, exitQueue, resultsQueue, stream=stream)
             workers.append(w)
             w.start()
         for i in range(totalTasks):
-            ids = queryIds[i * seqsPerFile:(i + 1) * seqsPerFile]
-            recs = map(lambda x: records[x], ids)
-            qsRecs = map(lambda x: cloneAnnot.loc[x].to_dict(), ids)
-            tasks.put((recs, qsRecs))
+            chunk = cloneAnnot.iloc[i * seqsPerFile:(i + 1) * seqsPerFile]
+            tasks.put((i * seqsPerFile, chunk.index.tolist(), chunk.to_dict('records')))
 
         # poison pills
         for _ in range(threads + 10):
@@ -73,7 +69,7 @@ def addPrimerData(cloneAnnot, readFile, format, fr4cut, trim5end,
     finally:
         for w in workers:
             w.terminate()
-        records.close()
+        records.close(delete=True)
 
     primerAnnot = DataFrame(cloneAnnotList, columns=newColumns)
     primerAnnot.set_index('queryid', drop=True, inplace=True)
@@ -123,11 +119,12 @@ def writePrimerStats(end, name, cloneAnnot, fileprefix, category="All", stream=N
     INDEL = str(end) + 'endIndelIndex'
 
     known = cloneAnnot[cloneAnnot[PRIMER] != NA]
+    # all counts are in number of reads, collapsed identical reads are weighted by their count
     integrity = {
-        'Unknown': (len(cloneAnnot) - len(known)),
-        'Indelled': sum(known[INDEL] != 0),
-        'Mismatched': sum(known[MISMATCH] != 0),
-        'Intact': len(known[(known[INDEL] == 0) & (known[MISMATCH] == 0)])
+        'Unknown': totalReads(cloneAnnot) - totalReads(known),
+        'Indelled': totalReads(known[known[INDEL] != 0]),
+        'Mismatched': totalReads(known[known[MISMATCH] != 0]),
+        'Intact': totalReads(known[(known[INDEL] == 0) & (known[MISMATCH] == 0)])
     }
 
     plotDist(integrity, name, fileprefix + 'integrity_dist.csv',
@@ -139,13 +136,13 @@ def writePrimerStats(end, name, cloneAnnot, fileprefix, category="All", stream=N
     printto(stream, "Example of Indelled {}'-end: {}".format(end, str(invalidClones[1:10])), LEVEL.INFO)
     printto(stream, "Example of non-indelled {}'-end: {}".format(end, str(valid[1:10])), LEVEL.INFO)
 
-    c1 = Counter(known[known[INDEL] != 0][PRIMER].tolist())
+    c1 = countColumn(known[known[INDEL] != 0], PRIMER)
     plotDist(c1, name, fileprefix +
              'indelled_dist.csv',
              title='Abundance of Indelled {}\'-end Primers ({})'.format(end, category),
              proportion=False, rotateLabels=False, vertical=False, top=50)
 
-    c = Counter(known[known[INDEL] != 0][INDEL].tolist())
+    c = countColumn(known[known[INDEL] != 0], INDEL)
     plotDist(c, name, fileprefix +
              'indel_pos_dist.csv',
              title='Abundance of Indel Positions in {}\'-end Primers ({})'.format(end, category),
@@ -159,7 +156,7 @@ def writePrimerStats(end, name, cloneAnnot, fileprefix, category="All", stream=N
         df = known[known[INDEL] != 0]
         df = df[df[PRIMER] == primer]
 
-        germLineDist = compressCountsGeneLevel(Counter(df['vgene'].tolist()))
+        germLineDist = compressCountsGeneLevel(countColumn(df, 'vgene'))
         plotDist(germLineDist, name, fileprefix + primer +
                  '_igv_dist.csv',
                  title='IGV Abundance of indelled {} ({})'.format(primer, category),
@@ -176,6 +173,10 @@ def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
     INDEL5 = '5endIndelIndex'
     INDEL3 = '3endIndelIndex'
 
+    counts = cloneCounts(cloneAnnot)
+    # the Venn diagrams count collapsed identical reads once per read
+    weights = None if counts is None else counts.to_dict()
+
     outOfFrameClones = cloneAnnot[cloneAnnot['v-jframe'] == 'Out-of-frame']
     productiveClones = cloneAnnot[(cloneAnnot['v-jframe'] == 'In-frame') & (cloneAnnot['stopcodon'] == 'No')]
 
@@ -218,7 +219,7 @@ def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
             ].tolist()
             plotVenn({"5'-end": set(allInvalid5Clones), "3'-end": set(invalid3Clones)},
                      os.path.join(outDir, name + '_all_invalid_primers.png'),
-                     "Intersection of indelled 5' and 3' sequences (All)", stream=stream)
+                     "Intersection of indelled 5' and 3' sequences (All)", weights=weights, stream=stream)
             del invalid3Clones, allInvalid5Clones
 
             outFrameInvalid3Clones = outOfFrameClones.index[
@@ -226,7 +227,7 @@ def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
             ].tolist()
             plotVenn({"5'-end": set(outFrameInvalid5Clones), "3'-end": set(outFrameInvalid3Clones)},
                      os.path.join(outDir, name + '_outframe_invalid_primers.png'),
-                     "Intersection of indelled 5' and 3' sequences (Out-of-frame)", stream=stream)
+                     "Intersection of indelled 5' and 3' sequences (Out-of-frame)", weights=weights, stream=stream)
             del outFrameInvalid3Clones, outFrameInvalid5Clones
 
             productiveInvalid3Clones = productiveClones.index[
@@ -234,7 +235,7 @@ def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
             ].tolist()
             plotVenn({"5'-end": set(productiveInvalid5Clones), "3'-end": set(productiveInvalid3Clones)},
                      os.path.join(outDir, name + "_productive_invalid_primers.png"),
-                     "Intersection of indelled 5' and 3' sequences (productive)", stream=stream)
+                     "Intersection of indelled 5' and 3' sequences (productive)", weights=weights, stream=stream)
     # similar with abundance analysis etc ..
     cloneAnnot.replace(nanString, np.nan, inplace=True)
     gc.collect()
@@ -9,7 +9,6 @@ import gc
 import sys
 import os
 
-from Bio import SeqIO
 from collections import defaultdict, Counter
 from pandas.core.frame import DataFrame
 from numpy import random, isnan
@@ -17,12 +16,16 @@ from multiprocessing import Queue, Value, Lock
 from math import ceil
 
 from abseqPy.IgRepAuxiliary.RefineWorker import RefineWorker
-from abseqPy.IgRepertoire.igRepUtils import gunzip
+from abseqPy.IgRepAuxiliary.readStore import ReadStore
 from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
 from abseqPy.logger import LEVEL, printto
 from abseqPy.utilities import hasLargeMem
 
 
+# maximum number of clones refined by a worker in one go
+REFINE_CHUNK_SIZE = 2000
+
+
 def loadRefineFlagInfo():
     refineFlagMsgs = {
         'fr1NotAtBegin': "{:,} clones have FR1 start not equal to query start (Excluded)",
@@ -59,22 +62,19 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
                            trim5End, trim3End,
                            seqsPerFile, threads, stream=None):
     printto(stream, "Clone annotation and in-frame prediction are being refined ...")
-    seqsPerFile = 100
     cloneAnnot = cloneAnnotOriginal.copy()
     queryIds = cloneAnnot.index
     (refineFlagNames, refineFlagMsgs) = loadRefineFlagInfo()
     records = None
     workers = None
     try:
-        # process clones from the FASTA/FASTQ file
-
-        # NOTE:
-        # if the readFile is gzipped, we need to unzip it in the same directory before passing into
-        # SeqIO.index because it doesn't accept gzipped nor opened files
-        records = SeqIO.index(gunzip(readFile), format)
+        # process clones from the FASTA/FASTQ file, workers attach to the read store and are only sent row ranges
+        records = ReadStore.build(readFile, queryIds, format, outDir=outDir, stream=stream)
         printto(stream, "\t " + format + " index created and refinement started ...")
         # Parallel implementation of the refinement
         noSeqs = len(queryIds)
+        # chunks are refined column-wise, but should still be small enough to keep all workers busy
+        seqsPerFile = int(min(REFINE_CHUNK_SIZE, max(100, ceil(noSeqs / (threads * 4)))))
         totalTasks = int(ceil(noSeqs / seqsPerFile))
         tasks = Queue()
         exitQueue = Queue()
@@ -84,7 +84,7 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
         # Initialize workers
         workers = []
         for i in range(threads):
-            w = RefineWorker(procCounter, chain, actualQstart, fr4cut,
+            w = RefineWorker(records, procCounter, chain, actualQstart, fr4cut,
                              trim5End, trim3End, refineFlagNames, stream=stream)
             w.tasksQueue = tasks
             w.exitQueue = exitQueue
@@ -95,10 +95,7 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
             # adding jobs to the tasks queue with subsets of query IDs
         assert (totalTasks >= 1)
         for i in range(totalTasks):
-            ids = queryIds[i * seqsPerFile:(i + 1) * seqsPerFile]
-            recs = map(lambda x: records[x], ids)
-            qsRecs = map(lambda x: cloneAnnot.loc[x].to_dict(), ids)
-            tasks.put((recs, qsRecs))
+            tasks.put((i * seqsPerFile, cloneAnnot.iloc[i * seqsPerFile:(i + 1) * seqsPerFile]))
         # Add a poison pill for each worker
         for i in range(threads + 10):
             tasks.put(None)
@@ -138,9 +135,11 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
                         "and 4 lengths".format(filtered / cloneAnnot.shape[0], filtered, cloneAnnot.shape[0]))
 
         # print refine flags
-        printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=stream)
+        def sequenceOf(id_):
+            return records[queryIds.get_loc(id_)]
+        printRefineFlags(flags, sequenceOf, refineFlagNames, refineFlagMsgs, stream=stream)
         printto(stream, "Flagged sequences are being written to an output file ... ")
-        writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs,
+        writeRefineFlags(flags, sequenceOf, refineFlagNames, refineFlagMsgs,
                          outDir, sampleName)
     except Exception as e:
         printto(stream, "Something went wrong during the refinement process!", LEVEL.EXCEPT)
@@ -149,8 +148,8 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
         if workers:
             for w in workers:
                 w.terminate()
-        if records:
-            records.close()
+        if records is not None:
+            records.close(delete=True)
 
     # Create new data frame of clone annotation
     # add new column for filtering based on FR region
@@ -222,7 +221,7 @@ def collectRefineResults(resultsQueue, totalTasks, noSeqs, refineFlagNames, stre
     return cloneAnnot, transSeqs, flags, frameworkLengths
 
 
-def printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=None):
+def printRefineFlags(flags, sequenceOf, refineFlagNames, refineFlagMsgs, stream=None):
     # print statistics and a few of the flagged clones
     for f in refineFlagNames:
         if len(flags[f]) > 0:
@@ -230,10 +229,10 @@ def printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=Non
             examples = random.choice(range(len(flags[f])), min(3, len(flags[f])), replace=False)
             for i in examples:
                 printto(stream, ">" + flags[f][i], LEVEL.INFO)
-                printto(stream, str(records[flags[f][i]].seq), LEVEL.INFO)
+                printto(stream, sequenceOf(flags[f][i]), LEVEL.INFO)
 
 
-def writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, outDir, sampleName):
+def writeRefineFlags(flags, sequenceOf, refineFlagNames, refineFlagMsgs, outDir, sampleName):
     # 8gb buffer size if system has large enough memory (-1 implies system buffer size)
     with open(os.path.join(outDir, sampleName + "_refinement_flagged.txt"), 'w',
               buffering=int(1 << 23) if hasLargeMem() else -1) as flaggedFp, \
@@ -244,7 +243,7 @@ def writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, outDir, sa
                 flaggedFp.write("# " + refineFlagMsgs[f].format(len(flags[f])) + "\n")
                 for i in range(len(flags[f])):
                     flaggedFp.write(">" + flags[f][i] + "\n")
-                    flaggedFp.write(str(records[flags[f][i]].seq) + "\n")
+                    flaggedFp.write(sequenceOf(flags[f][i]) + "\n")
                 flaggedFp.write("\n")
 
 
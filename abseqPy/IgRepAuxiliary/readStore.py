@@ -0,0 +1,139 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+import os
+import mmap
+import shutil
+import tempfile
+
+import numpy as np
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+from abseqPy.IgRepertoire.igRepUtils import safeOpen, detectFileFormat
+from abseqPy.logger import printto
+
+
+class ReadStore(object):
+    """
+    read-only store of the reads of a clone annotation dataframe. The sequences are packed back to back in one
+    file, row i of the store being the read of row i of the dataframe, and (start, end) byte offsets are kept
+    in a separate array. Both are memory-mapped: worker processes attach to the same pages and are only sent
+    row ranges, no SeqRecord has to be pickled through a queue.
+    """
+
+    SEQUENCES = "reads.seq"
+    BOUNDS = "bounds.npy"
+
+    def __init__(self, directory):
+        """
+        attaches to a store created by ReadStore.build
+
+        :param directory: string, directory of the store
+        """
+        self.directory = directory
+        self._bounds = None
+        self._fp = None
+        self._map = None
+
+    @classmethod
+    def build(cls, readFile, queryIds, format=None, outDir=None, stream=None):
+        """
+        :param readFile: string, FASTA or FASTQ file (can be gzipped)
+        :param queryIds: sequence of read IDs, the rows of the store
+        :param format: "fasta" or "fastq", detected from readFile's extension if None
+        :param outDir: string, the store is created in a new directory under outDir (system temporary
+                    directory if None)
+        :param stream: logging stream
+        :return: ReadStore. Reads that are not in queryIds are skipped, a KeyError is raised if a query ID
+                    is not found in readFile
+        """
+        format = format or detectFileFormat(readFile)
+        printto(stream, "\tIndexing {:,} reads of {} ...".format(len(queryIds), os.path.basename(readFile)))
+        rows = dict((id_, i) for i, id_ in enumerate(queryIds))
+        bounds = np.full((len(rows), 2), -1, dtype=np.int64)
+        directory = tempfile.mkdtemp(prefix="reads_", dir=outDir)
+        try:
+            with safeOpen(readFile) as fp, open(os.path.join(directory, cls.SEQUENCES), 'wb') as out:
+                parser = FastqGeneralIterator(fp) if format == 'fastq' else SimpleFastaParser(fp)
+                position = 0
+                for record in parser:
+                    row = rows.get(record[0].split(None, 1)[0] if record[0] else '')
+                    if row is None or bounds[row, 0] != -1:
+                        continue
+                    seq = record[1].encode('ascii')
+                    out.write(seq)
+                    bounds[row] = position, position + len(seq)
+                    position += len(seq)
+            missing = np.flatnonzero(bounds[:, 0] == -1)
+            if len(missing):
+                raise KeyError("{:,} reads, e.g. {}, were not found in {}"
+                               .format(len(missing), queryIds[missing[0]], readFile))
+            np.save(os.path.join(directory, cls.BOUNDS), bounds)
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return cls(directory)
+
+    def _attach(self):
+        self._bounds = np.load(os.path.join(self.directory, self.BOUNDS), mmap_mode='r')
+        self._fp = open(os.path.join(self.directory, self.SEQUENCES), 'rb')
+        if os.fstat(self._fp.fileno()).st_size:
+            self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # empty reads cannot be mapped
+            self._map = b''
+
+    def __len__(self):
+        if self._bounds is None:
+            self._attach()
+        return len(self._bounds)
+
+    def __getitem__(self, row):
+        """
+        :param row: int
+        :return: string, sequence of the read in row
+        """
+        if self._map is None:
+            self._attach()
+        start, end = self._bounds[row]
+        seq = self._map[start:end]
+        return seq if isinstance(seq, str) else seq.decode('ascii')
+
+    def records(self, start, ids):
+        """
+        :param start: int, first row
+        :param ids: read IDs of rows start, start + 1, ...
+        :return: list of SeqRecords
+        """
+        return [SeqRecord(Seq(self[row]), id=id_, name="", description="")
+                for row, id_ in enumerate(ids, start)]
+
+    def close(self, delete=False):
+        """
+        :param delete: bool, also remove the store from disk
+        :return: None
+        """
+        if self._map is not None and not isinstance(self._map, bytes):
+            self._map.close()
+        if self._fp is not None:
+            self._fp.close()
+        self._bounds = self._fp = self._map = None
+        if delete:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __getstate__(self):
+        # file handles and maps are not inherited by spawned processes, they re-attach on first access
+        return {'directory': self.directory, '_bounds': None, '_fp': None, '_map': None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(delete=True)
@@ -10,16 +10,24 @@ import re
 from collections import defaultdict, Counter
 
 from numpy import isnan, nan
-from multiprocessing import Queue, Manager
+from multiprocessing import Queue
 from math import ceil
 from pandas.core.frame import DataFrame
 
-from abseqPy.IgRepAuxiliary.seqUtils import readSeqFileIntoDict
+from abseqPy.IgRepAuxiliary.readStore import ReadStore
 from abseqPy.IgRepAuxiliary.RestrictionSitesScanner import RestrictionSitesScanner
 from abseqPy.IgRepAuxiliary.productivityAuxiliary import ProcCounter
+from abseqPy.IgRepertoire.igRepUtils import cloneCounts
 from abseqPy.logger import printto, LEVEL
 
 
+# cloneAnnot columns read by RestrictionSitesScanner, only these are sent to the workers
+RSA_SIMPLE_COLUMNS = ['vqstart', 'vstart', 'fr4.end']
+RSA_DETAILED_COLUMNS = RSA_SIMPLE_COLUMNS + ['vgene', 'fr4.start'] + \
+                       [region + pos for region in ['fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3']
+                        for pos in ['.start', '.end']]
+
+
 def initRSAStats(simple):
     stats = {
         "siteHitsCount": defaultdict(int),
@@ -27,6 +35,7 @@ def initRSAStats(simple):
         "siteHitsSeqsIDs": defaultdict(set),
         "seqsCutByAny": 0,
         "total": 0,
+        "reads": 0,
     }
 
     # additional fields for detailed RSA
@@ -38,12 +47,13 @@ def initRSAStats(simple):
     return stats
 
 
-def calcRSAOverlapOrder2(order1, sites, stream=None):
+def calcRSAOverlapOrder2(order1, sites, weights=None, stream=None):
     """
     returns a n by n matrix where n is len(sites) of jaccard index
 
     :param order1: dictionary of sets of ids
     :param sites: collection of enzymes
+    :param weights: dictionary of id -> number of reads, if identical reads were collapsed
     :param stream: logging stream
     :return: n by n dataframe that has the form of a named matrix:
 
@@ -57,8 +67,8 @@ def calcRSAOverlapOrder2(order1, sites, stream=None):
     for site1 in sites:
         overlap.append([])
         for site2 in sites:
-            inter = len(order1[site1].intersection(order1[site2]))
-            uni = len(order1[site1].union(order1[site2]))
+            inter = _reads(order1[site1].intersection(order1[site2]), weights)
+            uni = _reads(order1[site1].union(order1[site2]), weights)
             if uni != 0:
                 overlap[-1].append(inter / uni)
             else:
@@ -68,7 +78,16 @@ def calcRSAOverlapOrder2(order1, sites, stream=None):
     return overlap
 
 
-def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=True, stream=None):
+def _reads(ids, weights):
+    """
+    :param ids: set of sequence ids
+    :param weights: dictionary of id -> number of reads, or None if identical reads were not collapsed
+    :return: number of reads of ids
+    """
+    return len(ids) if weights is None else sum(weights[i] for i in ids)
+
+
+def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=True, outDir=None, stream=None):
     """
     :param name: string
             analysis name
@@ -78,7 +97,7 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
 
     :param cloneAnnot: dataframe
             IgRepertoire.cloneAnnot dataframe, depending on what the argument to 'simple' is, will require at least
-            ['vqstart', 'vstart', 'fr4.end'] and 'vgene' if simple=False columns defined in the dataframe
+            the RSA_SIMPLE_COLUMNS or RSA_DETAILED_COLUMNS columns defined in the dataframe
 
     :param sitesFile: string
             path to restriction sites enzyme whitespace separated file. Example:
@@ -91,6 +110,9 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
     :param simple: bool
             simple or detailed analysis
 
+    :param outDir: string
+            directory of the temporary read store, system temporary directory if None
+
     :param stream: logging stream
 
     :return: 2-tuple:
@@ -110,16 +132,20 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
                            that is identical (i.e. a "named matrix") - see calcRSAOverlapOrder2's return value
             }
             "order1" is always there, "order2" only appears if the number of enzymes is at least 3(len(sitesInfo)) >= 3)
+            "weights" : {'seq_id1': number of reads, ...}, only there if identical reads were collapsed
     )
     """
     sitesInfo = loadRestrictionSites(sitesFile, stream=stream)
     seqsPerWorker = len(sitesInfo)
     workers = []
+    records = None
     try:
-        m = Manager()
-        records = m.dict()
-        readSeqFileIntoDict(readFile, records, stream=stream)
         queryIds = cloneAnnot.index
+        records = ReadStore.build(readFile, queryIds, outDir=outDir, stream=stream)
+        # workers get the rows of their task only, and only the columns they need
+        counts = cloneCounts(cloneAnnot)
+        cloneAnnot = cloneAnnot[(RSA_SIMPLE_COLUMNS if simple else RSA_DETAILED_COLUMNS) +
+                                ([] if counts is None else ['count'])]
         noSeqs = len(queryIds)
         printto(stream, "{:,} restriction sites are being scanned for {:,} sequences ..."
                 .format(len(sitesInfo), noSeqs))
@@ -132,9 +158,7 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
 
         # Initialize workers
         for _ in range(threads):
-            # pass in a minified cloneAnnot, the bare minimum of what's required in the runSimple() / runDetailed()
-            # method
-            w = RestrictionSitesScanner(records, cloneAnnot, procCounter,
+            w = RestrictionSitesScanner(records, procCounter,
                                         sitesInfo.copy(), simpleScan=simple, stream=stream)
             w.tasksQueue = tasks
             w.exitQueue = exitQueue
@@ -145,7 +169,7 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
         assert totalTasks > 0
 
         for i in range(totalTasks):
-            tasks.put(queryIds[i * seqsPerWorker:(i + 1) * seqsPerWorker])
+            tasks.put((i * seqsPerWorker, cloneAnnot.iloc[i * seqsPerWorker:(i + 1) * seqsPerWorker]))
 
         # Add a poison pill for each worker
         for _ in range(threads + 10):
@@ -160,7 +184,9 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
         printto(stream, "All workers have completed their tasks successfully.")
         printto(stream, "Results are being collated from all workers ...")
         stats = collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=simple, stream=stream)
-        (rsaResults, overlapResults) = postProcessRSA(stats, sitesInfo, simple=simple, stream=stream)
+        (rsaResults, overlapResults) = postProcessRSA(stats, sitesInfo, simple=simple,
+                                                      weights=None if counts is None else counts.to_dict(),
+                                                      stream=stream)
         printto(stream, "Results were collated successfully.")
 
     except Exception as e:
@@ -169,6 +195,8 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
     finally:
         for w in workers:
             w.terminate()
+        if records is not None:
+            records.close(delete=True)
 
     return rsaResults, overlapResults
 
@@ -176,6 +204,7 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
 def collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=True, stream=None):
     stats = initRSAStats(simple=simple)
     total = 0
+    reads = 0
     while totalTasks:
         statsi = resultsQueue.get()
         if statsi is None:
@@ -214,23 +243,26 @@ def collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=True,
                 stats['siteHitsSeqsIGV'][site] = stats['siteHitsSeqsIGV'][site].union(statsi['siteHitsSeqsIGV'][site])
 
         total += statsi["total"]
+        reads += statsi["reads"]
         if total % 50000 == 0:
             printto(stream, '\t%d/%d records have been collected ... ' % (total, noSeqs))
 
     printto(stream, '\t%d/%d sequences have been collected ... ' % (total, noSeqs))
 
     assert total == noSeqs
-    stats["total"] = noSeqs
+    # the statistics are in number of reads, collapsed identical reads are counted once per read
+    stats["total"] = reads
     return stats
 
 
-def postProcessRSA(stats, sitesInfo, simple=True, stream=None):
+def postProcessRSA(stats, sitesInfo, simple=True, weights=None, stream=None):
     """
     returns a processed RSA result tuple. see return value for more information
 
     :param stats: dictionary of stats. see collectRSASimpleResults for the exact format
     :param sitesInfo: dictionary of enzymes mapped to their compiled regex
     :param simple: bool. simple or detailed RSA
+    :param weights: dictionary of sequence id -> number of reads, if identical reads were collapsed
     :param stream: logging stream
     :return: 2-tuple:
     (
@@ -251,6 +283,7 @@ def postProcessRSA(stats, sitesInfo, simple=True, stream=None):
                            pairwise comparison of the enzyme yields
             }
             "order1" is always there, "order2" only appears if the number of enzymes is at least 3(len(sitesInfo)) >= 3)
+            "weights" : {'seq_id1': number of reads, ...}, only there if identical reads were collapsed
     )
     """
     rsaResults = []
@@ -294,10 +327,13 @@ def postProcessRSA(stats, sitesInfo, simple=True, stream=None):
                            )
 
     overlapResults = {"order1": stats["siteHitsSeqsIDs"]}
+    if weights is not None:
+        overlapResults["weights"] = weights
 
     # if there are at least 3 sites, calculate overlap order2
     if len(stats["siteHitsSeqsIDs"]) >= 3:
-        overlapResults["order2"] = calcRSAOverlapOrder2(stats["siteHitsSeqsIDs"], sites, stream=stream)
+        overlapResults["order2"] = calcRSAOverlapOrder2(stats["siteHitsSeqsIDs"], sites, weights=weights,
+                                                        stream=stream)
 
     return rsaResults, overlapResults
 
@@ -417,3 +453,80 @@ def findHits(seq, site):
     """
     seq = seq.upper()
     return [match.start() for match in site.finditer(seq)]
+
+
+class SitesMatcher(object):
+    """
+    finds the hits of many restriction sites in one pass over a sequence. The sites (translated IUPAC sequences)
+    are laid out next to each other in one bit vector and run as a single shift-and automaton: after reading a
+    character, bit j is set if the last characters read match the site's prefix ending at position j.
+    Sites that are not a sequence of letters, [classes] and dots are searched for with their regex.
+    """
+
+    _TOKEN = re.compile(r'\[[^\]]+\]|\.|[A-Za-z]')
+
+    def __init__(self, sites):
+        """
+        :param sites: dictionary of enzymes mapped to their compiled regex, as returned by loadRestrictionSites
+        """
+        self.regexSites = {}
+        tokensOf = {}
+        for enzyme, regex in sites.items():
+            tokens = self._TOKEN.findall(regex.pattern)
+            if tokens and ''.join(tokens) == regex.pattern:
+                tokensOf[enzyme] = tokens
+            else:
+                self.regexSites[enzyme] = regex
+
+        # masks[c]: bits of the site positions accepting character c, dots accept any character
+        self.masks = {}
+        self.anyMask = self.starts = self.ends = 0
+        # (enzyme, site length) of each end bit
+        self.enzymeAt = {}
+        bit = 0
+        for enzyme, tokens in tokensOf.items():
+            self.starts |= 1 << bit
+            for token in tokens:
+                if token == '.':
+                    self.anyMask |= 1 << bit
+                else:
+                    for c in token.strip('[]'):
+                        self.masks[c] = self.masks.get(c, 0) | (1 << bit)
+                bit += 1
+            self.ends |= 1 << (bit - 1)
+            self.enzymeAt[1 << (bit - 1)] = (enzyme, len(tokens))
+        self.masks = dict((c, mask | self.anyMask) for c, mask in self.masks.items())
+
+    def findAll(self, seq):
+        """
+        returns, for each enzyme, the same non overlapping matching indices that findHits returns
+
+        :param seq: nucleotide string
+        :return: dictionary of enzyme to a list of start indices, enzymes without hits are not in the dictionary
+
+        >>> matcher = SitesMatcher({'ENZ1': re.compile('AA'), 'ENZ2': re.compile('A[AC]A'), 'ENZ3': re.compile('G+')})
+        >>> sorted(matcher.findAll('aaaacaag').items())
+        [('ENZ1', [0, 2, 5]), ('ENZ2', [0, 3]), ('ENZ3', [7])]
+        """
+        seq = seq.upper()
+        hits = {}
+        nextStart = {}
+        state = 0
+        masks, anyMask, starts, ends, enzymeAt = self.masks, self.anyMask, self.starts, self.ends, self.enzymeAt
+        for i, c in enumerate(seq):
+            state = ((state << 1) | starts) & masks.get(c, anyMask)
+            found = state & ends
+            while found:
+                last = found & -found
+                found ^= last
+                enzyme, length = enzymeAt[last]
+                start = i - length + 1
+                # like finditer, a site only matches again after the end of its previous match
+                if start >= nextStart.get(enzyme, 0):
+                    hits.setdefault(enzyme, []).append(start)
+                    nextStart[enzyme] = i + 1
+        for enzyme, regex in self.regexSites.items():
+            regexHits = findHits(seq, regex)
+            if regexHits:
+                hits[enzyme] = regexHits
+        return hits
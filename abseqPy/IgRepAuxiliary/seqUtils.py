@@ -14,21 +14,26 @@ import pickle
 import random
 import bisect
 import matplotlib.pyplot as plt
+import numpy as np
 import os
+import copy
+import multiprocessing
 
 from os.path import exists
 from collections import Sequence, defaultdict
+from matplotlib.font_manager import FontProperties
+from matplotlib.patches import PathPatch
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
 from Bio.Seq import Seq
 from Bio.Alphabet.IUPAC import IUPACProtein
 from Bio import SeqIO, motifs, Phylo
-from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import Alphabet
 from Bio import Alphabet
 
 from abseqPy.IgRepertoire.igRepUtils import alignListOfSeqs, safeOpen, detectFileFormat
-from abseqPy.config import WEBLOGO
 from abseqPy.logger import printto, LEVEL
-from abseqPy.utilities import ShortOpts, requires, quote
+from abseqPy.utilities import requires
 
 
 # the following are conditionally imported in functions that require them to reduce abseq's dependency list
@@ -153,64 +158,122 @@ def createAlphabet(align=False, transSeq=False, extendAlphabet=False, protein=Fa
 @requires("TAMO")
 def generateMotifs(seqGroups, align, outputPrefix, transSeq=False,
                         extendAlphabet=False, clusterMotifs=False, protein=False, threads=2, stream=None):
+    """
+    builds the motif (and logo) of every group of sequences, groups are processed concurrently by up to threads
+    worker processes. PWMs and consensus sequences are written in group order once all groups are done
+
+    :param seqGroups: dict, group name => list of sequences
+    :param align: bool, align sequences with CLUSTAL OMEGA?
+    :param outputPrefix: string, prefix of the PWM, consensus and logo outputs
+    :param transSeq: bool, translate sequences to protein?
+    :param extendAlphabet: bool, see createAlphabet
+    :param clusterMotifs: bool, cluster the motifs using TAMO?
+    :param protein: bool, are the sequences protein sequences?
+    :param threads: int, number of processes (shared by the CLUSTAL OMEGA alignments)
+    :param stream: logger stream
+    :return: None
+    """
     from TAMO.MotifTools import Motif
     ighvMotifs = []
     if clusterMotifs and 'gene' in outputPrefix:
         findMotifClusters(ighvMotifs, outputPrefix, stream=stream)
     printto(stream, '\t\tPWMs, consensus and logos are being generated for {} motifs ... '.format(len(seqGroups)))
-    pwmFile = open(outputPrefix + '_pwm.txt', 'w')
-    consensusFile = open(outputPrefix + '_consensus.txt', 'w')
     logosFolder = outputPrefix + '_logos'
 
     if not os.path.exists(logosFolder):
         os.makedirs(logosFolder)
 
-    # create the sequence alphabet: DNA or Protein
-    alphabet = createAlphabet(align, transSeq, extendAlphabet, protein)
     groups = seqGroups.keys()
-    groups.sort()        
-    
-    for group in groups:    
-        filename = os.path.join(logosFolder, group.replace('/', '') + '.png')
-        seqs = seqGroups[group]
-        m = generateMotif(seqs, group, alphabet, filename, align, transSeq, protein, outDir=logosFolder,
-                          threads=threads, stream=stream)
-        if m is None:
-            # motif file found, no further work required
+    groups.sort()
+    logos = [os.path.join(logosFolder, group.replace('/', '') + '.png') for group in groups]
+
+    # a logo of an earlier run means the motifs were generated before, only the groups before the first one
+    # found are built. This is checked before any group is built (or aligned)
+    found = [i for i, logo in enumerate(logos) if os.path.exists(logo)]
+    if found:
+        printto(stream, "\tMotif logo {} found, no further work required".format(os.path.basename(logos[found[0]])),
+                LEVEL.WARN)
+        groups, logos = groups[:found[0]], logos[:found[0]]
+        if not groups:
             return
-        motifSeqs = m.instances
-        pwm = m.counts.normalize(pseudocounts=None)  # {'A':0.6, 'C': 0.4, 'G': 0.4, 'T': 0.6}
-        consensusMax = str(m.consensus)      
-               
-        pwmFile.write('#{} {} sequences\n'.format(group, len(motifSeqs)))
-        pwmFile.write(str(pwm))  
-        consensusFile.write('>{} max_count\n'.format(group))
-        consensusFile.write(consensusMax + '\n')      
-    #             print(str(m.anticonsensus)) # smallest values in the columns
-        if not transSeq and not align and not protein:
-            consensusIupac = str(m.degenerate_consensus)
-    #             print(consensusIupac) # IUPAC ambiguous nucleotides            
-            consensusFile.write('>{} degenerate\n'.format(group))
-            consensusFile.write(consensusIupac + '\n')
-        
-        pwmFile.flush()
-        consensusFile.flush()
-        gc.collect()
-        if clusterMotifs and len(motifSeqs) > 10:
-            motif = Motif(map(lambda x: str(x), motifSeqs),
-                          backgroundD={'A': 0.6, 'C': 0.4, 'G': 0.4, 'T': 0.6}, id=group)
-            motif.addpseudocounts(0.1)
-            ighvMotifs.append(motif)
-            
-    pwmFile.close()
-    consensusFile.close()      
+
+    # create the sequence alphabet: DNA or Protein
+    alphabet = createAlphabet(align, transSeq, extendAlphabet, protein)
+    processes = max(1, min(threads, len(groups)))
+    tasks = [(seqGroups[group], group, alphabet, logo, align, transSeq, protein, logosFolder,
+              max(1, threads // processes)) for group, logo in zip(groups, logos)]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes=processes, initializer=_initMotifWorker, initargs=(stream,))
+        try:
+            results = [pool.apply_async(_groupMotif, args=task) for task in tasks]
+            summaries = [r.get() for r in results]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summaries = [_groupMotif(*task, stream=stream) for task in tasks]
+
+    with open(outputPrefix + '_pwm.txt', 'w') as pwmFile, open(outputPrefix + '_consensus.txt', 'w') as consensusFile:
+        for group, summary in zip(groups, summaries):
+            if summary is None:
+                # the logo was generated in the meantime
+                continue
+            motifSeqs, pwm, consensusMax, consensusIupac = summary
+
+            pwmFile.write('#{} {} sequences\n'.format(group, len(motifSeqs)))
+            pwmFile.write(pwm)
+            consensusFile.write('>{} max_count\n'.format(group))
+            consensusFile.write(consensusMax + '\n')
+            if consensusIupac is not None:
+                consensusFile.write('>{} degenerate\n'.format(group))
+                consensusFile.write(consensusIupac + '\n')
+
+            if clusterMotifs and len(motifSeqs) > 10:
+                motif = Motif(motifSeqs, backgroundD={'A': 0.6, 'C': 0.4, 'G': 0.4, 'T': 0.6}, id=group)
+                motif.addpseudocounts(0.1)
+                ighvMotifs.append(motif)
+
     gc.collect()
     printto(stream, "\tPosition weight matrices are written to " + os.path.basename(outputPrefix + '_pwm.txt'))
     printto(stream, "\tConsensus sequences are written to " + os.path.basename(outputPrefix + '_consensus.txt'))
-    if clusterMotifs:
+    # the motifs are only clustered once all of them have been built
+    if clusterMotifs and not found:
         findMotifClusters(ighvMotifs, outputPrefix, stream=stream)
 
 
+# logger of the processes of generateMotifs' pool (loggers cannot be sent along with the tasks)
+_workerStream = None
+
+
+def _initMotifWorker(stream):
+    global _workerStream
+    _workerStream = stream
+
+
+def _groupMotif(seqs, group, alphabet, filename, align, transSeq, protein, outDir, threads, stream=None):
+    """
+    builds the motif (and logo) of one group of generateMotifs
+
+    :return: None if the group's logo already exists, otherwise a tuple of the motif's instances (list of strings),
+             PWM, max count consensus and degenerate consensus (None unless it applies)
+    """
+    # every group starts from the same alphabet, generateMotif extends it for sequences of unequal lengths
+    m = generateMotif(seqs, group, copy.deepcopy(alphabet), filename, align, transSeq, protein, outDir=outDir,
+                      threads=threads, stream=stream or _workerStream)
+    if m is None:
+        return None
+    pwm = m.counts.normalize(pseudocounts=None)  # {'A':0.6, 'C': 0.4, 'G': 0.4, 'T': 0.6}
+    # smallest values in the columns: str(m.anticonsensus)
+    if not transSeq and not align and not protein:
+        # IUPAC ambiguous nucleotides
+        consensusIupac = str(m.degenerate_consensus)
+    else:
+        consensusIupac = None
+    summary = ([str(x) for x in m.instances], str(pwm), str(m.consensus), consensusIupac)
+    gc.collect()
+    return summary
+
+
 @requires("TAMO")
 def findMotifClusters(ighvMotifs, outputPrefix, stream=None):
     from TAMO.Clustering.UPGMA import UPGMA
@@ -302,28 +365,79 @@ def saveNewickdendrogram(newickClusterFile, tree, stream, title="", logger=None)
     plt.close()
 
 
+# outlines of the logo letters, built once per process and scaled into every stack that draws them
+_logoGlyphs = {}
+
+# weblogo's "medium" stacks, in points
+_LOGO_STACK_WIDTH = 10.8
+_LOGO_STACK_HEIGHT = _LOGO_STACK_WIDTH * 5
+
+
+def _logoGlyph(letter):
+    """
+    :param letter: string, single character
+    :return: (matplotlib.path.Path, Bbox) outline of letter and its extents
+    """
+    if letter not in _logoGlyphs:
+        path = TextPath((0, 0), letter, size=1, prop=FontProperties(family='DejaVu Sans', weight='bold'))
+        _logoGlyphs[letter] = (path, path.get_extents())
+    return _logoGlyphs[letter]
+
+
 @requires('weblogolib')
 def generateMotifLogo(m, filename, outdir='.', dna=True, stream=None):
-    instances = m.instances
-    records = []
-
-    for i in range(len(instances)):
-        records.append(SeqRecord(instances[i], id=str(i)))
-
-    # guarantees tha tmp file is unique (in the case where multiprocessing might override the file)
-    basename = os.path.splitext(os.path.basename(filename))[0]
-    tmpFile = os.path.join(outdir, 'temp_seq_logos_{}.fasta'.format(basename))
-
-    SeqIO.write(records, tmpFile, 'fasta')
-
-    weblogo = ShortOpts(exe=WEBLOGO, f=quote(tmpFile), o=quote(filename), A=("dna" if dna else "protein"), F="png",
-                        n=200, D="fasta", s="medium", c=("classic" if dna else "auto"),
-                        X="NO", Y="NO")\
-        .append("--errorbars NO --fineprint CSL --resolution 600")
-    # printto(stream, "Executing " + str(weblogo))
-    weblogo()
-    os.remove(tmpFile)
-        
+    """
+    draws the sequence logo of a motif in-process, straight from its counts. The letter heights are weblogo's
+    (bits, 'auto' composition, classic colours for DNA and hydrophobicity for protein) but no temporary FASTA file
+    is written and neither weblogo nor ghostscript are executed, which matters when thousands of logos are drawn
+
+    :param m: Bio.motifs.Motif
+    :param filename: string, output png file
+    :param outdir: string, unused, kept for compatibility
+    :param dna: bool, DNA or protein logo
+    :param stream: logger
+    :return: None
+    """
+    from weblogolib import LogoData, parse_prior, std_color_schemes
+    from corebio.seq import unambiguous_dna_alphabet, unambiguous_protein_alphabet
+
+    alphabet = unambiguous_dna_alphabet if dna else unambiguous_protein_alphabet
+    colors = std_color_schemes['classic' if dna else 'hydrophobicity']
+    letters = list(alphabet.letters())
+
+    # gaps, stop codons and ambiguous letters are not drawn, as when weblogo read the instances
+    counts = np.array([m.counts[l] if l in m.counts else [0] * m.length for l in letters], dtype=float).T
+    data = LogoData.from_counts(alphabet, counts, parse_prior('auto', alphabet))
+    totals = counts.sum(axis=1)
+    totals[totals == 0] = 1
+    # relative entropy is in nats, the logo in bits
+    heights = counts / totals[:, np.newaxis] * (data.entropy / np.log(2))[:, np.newaxis]
+
+    # figure size in points: the stacks, a 2pt margin and room for the fine print underneath
+    width, height = m.length * _LOGO_STACK_WIDTH + 4, _LOGO_STACK_HEIGHT + 12
+    fig = plt.figure(figsize=(width / 72., height / 72.))
+    ax = fig.add_axes([2 / width, 10 / height, (width - 4) / width, _LOGO_STACK_HEIGHT / height])
+    for i in range(m.length):
+        bottom = 0
+        # smallest letter at the bottom of the stack
+        for rank, j in enumerate(np.argsort(heights[i], kind='mergesort')):
+            if heights[i, j] <= 0:
+                continue
+            glyph, extents = _logoGlyph(letters[j])
+            transform = Affine2D().translate(-extents.x0, -extents.y0) \
+                .scale(0.9 / extents.width, heights[i, j] / extents.height) \
+                .translate(i + 0.05, bottom)
+            color = colors.symbol_color(i, letters[j], rank)
+            ax.add_patch(PathPatch(transform.transform_path(glyph), linewidth=0,
+                                   facecolor=(color.red, color.green, color.blue)))
+            bottom += heights[i, j]
+    ax.set_xlim(0, m.length)
+    ax.set_ylim(0, np.log2(len(letters)))
+    ax.axis('off')
+    fig.text(1 - 2 / width, 2 / height, 'CSL', ha='right', va='bottom', fontsize=4)
+    fig.savefig(filename, dpi=600)
+    plt.close(fig)
+
 
 def maxlen(x):
     return max(map(len, x))
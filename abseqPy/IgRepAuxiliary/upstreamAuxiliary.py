@@ -10,11 +10,13 @@ import gc
 
 from numpy import Inf, random
 from Bio import SeqIO
+from Bio.SeqRecord import SeqRecord
 from collections import defaultdict
 
+from abseqPy.IgRepAuxiliary.readStore import ReadStore
 from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, plotSeqLenDistClasses, plotDist
 from abseqPy.IgRepertoire.igRepUtils import gunzip, compressCountsFamilyLevel, \
-    compressCountsGeneLevel, safeOpen, compressSeqGeneLevel, compressSeqFamilyLevel
+    compressCountsGeneLevel, safeOpen, compressSeqGeneLevel, compressSeqFamilyLevel, cloneCounts
 from abseqPy.logger import LEVEL, printto
 from abseqPy.utilities import requires
 
@@ -74,12 +76,14 @@ def plotUpstreamLenDist(upstreamFile, expectLength, name, outDir, stream=None):
 
 def extractUpstreamSeqs(cloneAnnot, recordFile, upstream, upstreamFile, stream=None):
     """
-    extract the upstream DNA sequences and write them into a FASTA file named upstreamFile
+    extract the upstream DNA sequences and write them into a FASTA file named upstreamFile. If identical reads
+    were collapsed, the upstream sequence of a read is written once per read it stands for (the copies are named
+    <read id>#<copy number>), so that the analyses of the FASTA file count reads
     :param cloneAnnot:
                 cloneAnnot DataFrame
 
     :param recordFile:
-                raw record file (string)
+                raw record file (string), FASTA or FASTQ and can be gzipped
 
     :param upstream:
                 list of 2 numbers, denoting [start, end] inclusive in 1-index. np.Inf is also allowed for end value
@@ -95,6 +99,9 @@ def extractUpstreamSeqs(cloneAnnot, recordFile, upstream, upstreamFile, stream=N
     """
     printto(stream, "\tExtracting the upstream sequences ... ")
 
+    # number of reads each row stands for, if identical reads were collapsed
+    counts = cloneCounts(cloneAnnot)
+
     # alignments with - strand
     revAlign = 0
     # num. seqs with trimmed beginning (vstart > 3)
@@ -109,42 +116,50 @@ def extractUpstreamSeqs(cloneAnnot, recordFile, upstream, upstreamFile, stream=N
     # buffer to hold sequences before flushing into file
     recordsBuffer = []
     # max buffer size allowed
-    maxBufferSize = int(10.0 ** 5) / 2
+    maxBufferSize = int(10.0 ** 5) // 2
 
     # expected upstream length = expectLegth (end - start + 1) where start,end are both 1-index
     expectLength = upstream[1] - upstream[0] + 1
     queryIds = cloneAnnot.index
 
-    # NOTE: SeqIO.index can only index string filenames and it has to be unzipped
-    _, ext = os.path.splitext(os.path.basename(recordFile.rstrip(os.path.sep)))
-    records = SeqIO.index(gunzip(recordFile), ext.lstrip('.'))
+    # the reads are looked up in a store built in one pass over the (compressed) read file, row i of the store
+    # is the read of queryIds[i]
+    store = ReadStore.build(recordFile, queryIds, outDir=os.path.dirname(os.path.abspath(upstreamFile)),
+                            stream=stream)
+    records = itertools.chain.from_iterable(store.records(start, queryIds[start:start + maxBufferSize])
+                                            for start in range(0, len(queryIds), maxBufferSize))
 
-    with open(upstreamFile, 'w') as fp:
-        for id_ in queryIds:
-            record = records[id_]
+    with store, open(upstreamFile, 'w') as fp:
+        for record in records:
             qsRec = cloneAnnot.loc[record.id]
+            reads = 1 if counts is None else int(counts[record.id])
             if qsRec.strand != 'forward':
-                revAlign += 1
+                revAlign += reads
                 record.seq = record.seq.reverse_complement()
             if qsRec.vstart <= 3:
                 end = qsRec.vqstart - upstream[0] - qsRec.vstart + 1
                 if end <= 1:
-                    noSeq += 1
+                    noSeq += reads
                 else:
                     start = max(1, qsRec.vqstart - upstream[1] - qsRec.vstart + 1)
                     record.seq = record.seq[int(start - 1):int(end)]
                     if expectLength != Inf and len(record.seq) < expectLength:
-                        trimmedUpstream += 1
-                    record.id = record.id + _UPSTREAM_SEQ_FILE_SEP + qsRec.vgene
+                        trimmedUpstream += reads
+                    qid = record.id
+                    record.id = qid + _UPSTREAM_SEQ_FILE_SEP + qsRec.vgene
                     record.description = ""
                     recordsBuffer.append(record)
+                    # the other reads collapsed into this one
+                    recordsBuffer.extend(SeqRecord(record.seq, id="{}#{}{}{}".format(qid, copy, _UPSTREAM_SEQ_FILE_SEP,
+                                                                                     qsRec.vgene), description="")
+                                         for copy in range(1, reads))
                     procSeqs += 1
                     if procSeqs % maxBufferSize == 0:
                         printto(stream, '{}/{} sequences have been processed ... '.format(procSeqs, len(queryIds)))
                         SeqIO.write(recordsBuffer, fp, 'fasta')
                         recordsBuffer = []
             else:
-                trimmedBegin += 1
+                trimmedBegin += reads
 
         # flush remaining sequences
         if len(recordsBuffer) > 0:
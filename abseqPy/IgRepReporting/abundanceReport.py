@@ -10,12 +10,12 @@ from collections import Counter, defaultdict
 
 from abseqPy.IgRepReporting.igRepPlots import plotDist, generateStatsHeatmap, writeCSV
 from abseqPy.IgRepertoire.igRepUtils import compressCountsGeneLevel, \
-    compressCountsFamilyLevel
+    compressCountsFamilyLevel, countColumn, cloneCounts
 from abseqPy.logger import printto, LEVEL
 
 
 def writeVAbundanceToFiles(stats, sampleName, outDir, stream=None):
-    igvDist = Counter(stats["vgene"].tolist())
+    igvDist = countColumn(stats, 'vgene')
     if len(igvDist) == 0:
         printto(stream, "WARNING: No IGV hits were detected.", LEVEL.WARN)
         return
@@ -66,14 +66,14 @@ def writeVAbundanceToFiles(stats, sampleName, outDir, stream=None):
                          ['Alignment Length', 'Mismatches'], os.path.join(outDir, sampleName +
                                                                           '_igv_align_quality_mismatches_hm.tsv'),
                          stream=stream)
-    c = Counter(stats['vmismatches'].tolist())
+    c = countColumn(stats, 'vmismatches')
     plotDist(c, sampleName, os.path.join(outDir, sampleName +
                                          '_igv_mismatches_dist.csv'), title='Number of Mismatches in V gene',
              proportion=True, rotateLabels=False, top=20, stream=stream)
     generateStatsHeatmap(stats, sampleName, ['alignlen', 'vgaps'],
                          ['Alignment Length', 'Gaps'], os.path.join(outDir, sampleName +
                                                                     '_igv_align_quality_gaps_hm.tsv'), stream=stream)
-    c = Counter(stats['vgaps'].tolist())
+    c = countColumn(stats, 'vgaps')
     plotDist(c, sampleName, os.path.join(outDir, sampleName +
                                          '_igv_gaps_dist.csv'), title='Number of Gaps in V gene',
              proportion=True, rotateLabels=False, top=20, stream=stream)
@@ -82,7 +82,7 @@ def writeVAbundanceToFiles(stats, sampleName, outDir, stream=None):
 
 
 def writeJAbundanceToFiles(stats, sampleName, outDir, stream=None):
-    igjDist = Counter(stats["jgene"].tolist())
+    igjDist = countColumn(stats, 'jgene')
     igjDist = dict([(str(k), igjDist[k]) for k in igjDist])
     if len(igjDist) == 0:
         printto(stream, "WARNING: No IGJ hits were detected.", LEVEL.WARN)
@@ -106,7 +106,7 @@ def writeJAbundanceToFiles(stats, sampleName, outDir, stream=None):
 
 
 def writeDAbundanceToFiles(stats, sampleName, outDir, stream=None):
-    igdDist = Counter(stats["dgene"].tolist())
+    igdDist = countColumn(stats, 'dgene')
     igdDist = Counter(dict([(str(k), igdDist[k]) for k in igdDist]))
     if len(igdDist) == 0:
         printto(stream, "WARNING: No IGD hits were detected.", LEVEL.WARN)
@@ -144,12 +144,14 @@ def writeVJAssociationToFiles(stats, sampleName, outDir, stream=None):
     if os.path.exists(fname):
         return
 
+    counts = cloneCounts(stats)
+    weights = [1] * stats.shape[0] if counts is None else counts.tolist()
     tally = defaultdict(lambda: defaultdict(int))
-    for v, j in zip(stats['vgene'], stats['jgene']):
+    for v, j, weight in zip(stats['vgene'], stats['jgene'], weights):
         vFamily, jFamily = canonicalFamilyName(v, j)
         if vFamily is None:  # jFamily is implicitly None too
             continue
-        tally[vFamily][jFamily] += 1
+        tally[vFamily][jFamily] += weight
 
     with open(fname, "w") as fp:
         writeBuffer = ""
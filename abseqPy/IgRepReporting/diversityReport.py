@@ -8,26 +8,24 @@
 import os
 import gzip
 import multiprocessing
-
-from collections import Counter, defaultdict
+import numpy as np
 
 from abseqPy.IgRepAuxiliary.seqUtils import createAlphabet, generateMotif
 from abseqPy.IgRepertoire.igRepUtils import writeClonoTypesToFile, createIfNot
 from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, \
-    generateCumulativeLogo, plotSeqDuplication, plotSeqRarefaction, \
+    generateCumulativeLogo, generateCumulativeLogos, plotSeqDuplication, plotSeqRarefaction, \
     plotSeqRecaptureNew
 from abseqPy.logger import LEVEL, printto
-from abseqPy.utilities import hasLargeMem, requires
+from abseqPy.utilities import requires
 
 
 def generateDiversityReport(spectraTypes, clonoTypes, name, outDir, topClonotypes, threads=2, segregate=False,
-                            stream=None):
+                            bootstrap=0, stream=None):
     generateSpectraTypePlots(spectraTypes,  name, outDir, stream=stream)
 
-    flattened = flattenClonoTypeCountsDict(clonoTypes, stream=stream) if segregate else clonoTypes
-
-    writeClonoTypesToFiles(flattened, name, outDir, topClonotypes, stream=stream)
-    estimateDiversity(clonoTypes, flattened, name, outDir, threads=threads, segregate=segregate, stream=stream)
+    writeClonoTypesToFiles(clonoTypes, name, outDir, topClonotypes, stream=stream)
+    estimateDiversity(clonoTypes, name, outDir, threads=threads, segregate=segregate, bootstrap=bootstrap,
+                      stream=stream)
 #     generateCDRandFRLogos()
 
 
@@ -38,20 +36,21 @@ def writeClonoTypesToFiles(clonoTypes, name, outDir, topClonotypes=100, stream=N
     if not os.path.exists(cloneFolder):
         os.makedirs(cloneFolder)
 
-    for k in clonoTypes.keys():
+    for k in clonoTypes.regions():
+        counts = clonoTypes.counts(k)
         # check if the required topClonotypes went overboard, if so, cap to the max length
-        if topClonotypes != float('inf') and len(clonoTypes[k]) < topClonotypes:
-            stringTopClonotypes = str(len(clonoTypes[k]))
+        if topClonotypes != float('inf') and len(counts) < topClonotypes:
+            stringTopClonotypes = str(len(counts))
         else:
             stringTopClonotypes = 'all' if topClonotypes == float('inf') else str(topClonotypes)
 
         # descending order
         filename = os.path.join(cloneFolder, name + ("_{}_clonotypes_{}_over.csv".format(k, stringTopClonotypes)))
-        writeClonoTypesToFile(clonoTypes[k], filename, topClonotypes, overRepresented=True)
+        writeClonoTypesToFile(counts, filename, topClonotypes, overRepresented=True)
 
         # ascending order
         filename = os.path.join(cloneFolder, name + ("_{}_clonotypes_{}_under.csv".format(k, stringTopClonotypes)))
-        writeClonoTypesToFile(clonoTypes[k], filename, topClonotypes, overRepresented=False)
+        writeClonoTypesToFile(counts, filename, topClonotypes, overRepresented=False)
 
 
 def generateSpectraTypePlots(spectraTypes, name, outDir, stream=None):
@@ -71,18 +70,45 @@ def generateSpectraTypePlots(spectraTypes, name, outDir, stream=None):
                            removeOutliers=True, stream=stream)
 
 
-def estimateDiversity(clonoTypes, flatClonoTypes, name, outDir, threads=2, segregate=False, stream=None):
+def estimateDiversity(clonoTypes, name, outDir, threads=2, segregate=False, bootstrap=0, stream=None):
     # create Germline gene level composition logos
-    compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=threads, detailed=segregate, stream=stream)
-    generateSeqMotifs(flatClonoTypes, name, outDir, threads=threads, stream=stream)
-    generateRarefactionPlots(flatClonoTypes, name, outDir, threads=threads, stream=stream)
+    compositionLogos(name, clonoTypes, outDir, threads=threads, detailed=segregate, stream=stream)
+    generateSeqMotifs(clonoTypes, name, outDir, threads=threads, stream=stream)
+    generateRarefactionPlots(clonoTypes, name, outDir, threads=threads, bootstrap=bootstrap, stream=stream)
     printto(stream, "The diversity of the library is being estimated ... ")
 
 
-def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
-    regions = clonoTypes.keys()
-    regions.sort()
+def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, bootstrap=0, seed=None, stream=None):
+    """
+    duplication, rarefaction and percent recapture plots of the CDRs, the FRs and the CDRs with the V domain.
+    The recapture plots share one pool of workers and one seed, so a region is sampled the same way in every plot
+
+    :param clonoTypes: Clonotypes
+    :param name: string
+                sample name
+    :param outDir: string
+    :param threads: int
+    :param bootstrap: int
+                if > 0, number of sampled rarefaction curves used for the 95% confidence bands of the rarefaction plots
+    :param seed: int
+                seed of the recapture and rarefaction sampling, a random one is drawn (and logged) if None
+    :param stream: output stream
+    :return: None
+    """
+    regions = clonoTypes.regions()
     printto(stream, "Rarefaction files are being generated .... ")
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+    printto(stream, "\tThe percent recapture is sampled with seed {}".format(seed), LEVEL.INFO)
+    pool = multiprocessing.Pool(processes=threads)
+    try:
+        _rarefactionPlots(clonoTypes, regions, name, outDir, pool, seed, bootstrap=bootstrap, stream=stream)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _rarefactionPlots(clonoTypes, regions, name, outDir, pool, seed, bootstrap=0, stream=None):
     # select CDR regions only  
     cdrWeights = []
     cdrSeqs = []
@@ -91,8 +117,9 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
         if not region.startswith("cdr"):
             continue
         cdrRegions.append(region.upper())
-        cdrSeqs.append(clonoTypes[region].keys())
-        cdrWeights.append(map(lambda x: clonoTypes[region][x], cdrSeqs[-1]))
+        counts = clonoTypes.counts(region)
+        cdrSeqs.append(counts.index.tolist())
+        cdrWeights.append(counts.tolist())
     filename = os.path.join(outDir, name + "_cdr_duplication.csv")
     printto(stream, "\tThe duplication levels is being generated for CDRs .... ")
     plotSeqDuplication(cdrWeights,
@@ -105,13 +132,16 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
                        cdrRegions,
                        filename,
                        cdrWeights,
-                       'Rarefaction of CDR Sequences', threads=threads, stream=stream)
+                       'Rarefaction of CDR Sequences',
+                       bootstrap=bootstrap,
+                       seed=seed,
+                       stream=stream)
     printto(stream, " \tThe percent recapture is being generated for CDRs .... ")
     filename = os.path.join(outDir, name + "_cdr_recapture.csv")
     plotSeqRecaptureNew(cdrSeqs,
                         cdrRegions,
                         filename,
-                        'Percent Recapture of CDR Sequences', threads=threads, stream=stream)
+                        'Percent Recapture of CDR Sequences', pool=pool, seed=seed, stream=stream)
     # select FR regions only
     frWeights = []
     frSeqs = []
@@ -120,8 +150,9 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
         if not region.startswith("fr"):
             continue
         frRegions.append(region.upper())
-        frSeqs.append(clonoTypes[region].keys())
-        frWeights.append(map(lambda x: clonoTypes[region][x], frSeqs[-1]))
+        counts = clonoTypes.counts(region)
+        frSeqs.append(counts.index.tolist())
+        frWeights.append(counts.tolist())
     filename = os.path.join(outDir, name + "_fr_duplication.csv")
     printto(stream, "\tThe duplication levels is being generated for FRs .... ")
     plotSeqDuplication(frWeights,
@@ -134,13 +165,16 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
                        frRegions,
                        filename,
                        frWeights,
-                       'Rarefaction of FR Sequences', threads=threads, stream=stream)
+                       'Rarefaction of FR Sequences',
+                       bootstrap=bootstrap,
+                       seed=seed,
+                       stream=stream)
     printto(stream, "\tThe percent recapture is being generated for FRs .... ")
     filename = os.path.join(outDir, name + "_fr_recapture.csv")
     plotSeqRecaptureNew(frSeqs,
                         frRegions,
                         filename,
-                        'Percent Recapture of FR Sequences', threads=threads, stream=stream)
+                        'Percent Recapture of FR Sequences', pool=pool, seed=seed, stream=stream)
     # select CDR and V domain 
     cdrWeights = []
     cdrSeqs = []
@@ -149,8 +183,9 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
         if region.startswith("fr"):
             continue
         cdrRegions.append(region.upper())
-        cdrSeqs.append(clonoTypes[region].keys())
-        cdrWeights.append(map(lambda x: clonoTypes[region][x], cdrSeqs[-1]))
+        counts = clonoTypes.counts(region)
+        cdrSeqs.append(counts.index.tolist())
+        cdrWeights.append(counts.tolist())
     filename = os.path.join(outDir, name + "_cdr_v_duplication.csv")
     printto(stream, "\tThe duplication levels is being generated for CDRs and V domains .... ")
     plotSeqDuplication(cdrWeights,
@@ -163,38 +198,26 @@ def generateRarefactionPlots(clonoTypes, name, outDir, threads=2, stream=None):
                        cdrRegions,
                        filename,
                        cdrWeights,
-                       'Rarefaction of CDRs and V Domains', threads=threads, stream=stream)
+                       'Rarefaction of CDRs and V Domains',
+                       bootstrap=bootstrap,
+                       seed=seed,
+                       stream=stream)
     printto(stream, "\tThe percent recapture is being generated for CDRs and V domains .... ")
     filename = os.path.join(outDir, name + "_cdr_v_recapture.csv")
     plotSeqRecaptureNew(cdrSeqs,
                         cdrRegions,
                         filename,
-                        'Percent Recapture of CDRs and V Domains', threads=threads, stream=stream)
+                        'Percent Recapture of CDRs and V Domains', pool=pool, seed=seed, stream=stream)
 
 
-def compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=2, detailed=False, stream=None):
+def compositionLogos(name, clonoTypes, outDir, threads=2, detailed=False, stream=None):
     """
 
     :param name: string
                 sample name
 
-    :param clonoTypes: dict
-    dict with key for each V germline, each having keys of FR / CDR region,
-    which in turn, each having a value of Counter() where the AA sequences are tallied
-    For example:
-    {
-        'IGHV3-3': { 'FR1': Counter({"FGWSG": 32, ...}),  'CDR1': Counter(...) },
-        'IGHV2-1': { ... }
-    }
-
-    :param flatClonoTypes: dict
-                    dict with keys of FR / CDR region, each having a value of Counter() where the
-                    AA sequences are tallied
-                    For example:
-                    {
-                        'FR1': Counter({"FGWSG": 32, ...}),
-                        'CDR1': Counter(...)
-                    }
+    :param clonoTypes: Clonotypes
+                    clonotype table, AA sequences are tallied per IGV gene and FR / CDR region
 
     :param outDir: string
 
@@ -213,47 +236,28 @@ def compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=2, detail
     createIfNot(logosFolder)
     printto(stream, "Generating composition logos ...")
     if detailed:
-        argBuffer = []
-        for vgerm in clonoTypes:
-            regions = clonoTypes[vgerm].keys()
-            regions.sort()
-            for region in regions:
-                if region == 'v':
-                    continue
-                clonoType = clonoTypes[vgerm][region]
-                seqs = clonoType.keys()
-                weights = clonoType.values()
-
-                regionDirectory = os.path.join(logosFolder, region.upper())
-                createIfNot(regionDirectory)
-                filename = os.path.join(regionDirectory, name + "_{}_cumulative_logo.csv"
-                                        .format(vgerm.replace(os.path.sep, '_')))
-                if hasLargeMem():
-                    printto(stream, "\tbuffering {} for {}".format(region, vgerm))
-                    argBuffer.append((seqs, weights, region, filename))
-                else:
-                    printto(stream, "\tgenerating {} for {}".format(region, vgerm))
-                    generateCumulativeLogo(seqs, weights, region, filename, stream=stream)
-
-        if len(argBuffer):
-            printto(stream, "Asynchronously generating composition logos from buffer ...")
-            pool = multiprocessing.Pool(processes=threads)
-            # Generate cumulative sequence logos using Toby's approach
-            res = [pool.apply_async(generateCumulativeLogo, args=arg) for arg in argBuffer]
-            [p.get() for p in res]  # join processes
-            pool.close()
-            pool.join()
+        for region in clonoTypes.regions():
+            if region == 'v':
+                continue
+            regionDirectory = os.path.join(logosFolder, region.upper())
+            createIfNot(regionDirectory)
+            # all IGV genes of a region are counted in one pass
+            genes, clonoType, groups = clonoTypes.geneCounts(region)
+            filenames = [os.path.join(regionDirectory, name + "_{}_cumulative_logo.csv"
+                                      .format(vgerm.replace(os.path.sep, '_'))) for vgerm in genes]
+            printto(stream, "\tgenerating {} for {:,} IGV genes".format(region, len(genes)))
+            generateCumulativeLogos(clonoType.index.tolist(), clonoType.values, groups, region, filenames,
+                                    stream=stream)
         printto(stream, "Completed composition logos for IGV families")
 
     # composition logo for a region(CDR,FR) as a combination of all IGV - i.e. not segregated
-    regions = flatClonoTypes.keys()     # combined AA counts(V family) of each region into one sum
-    regions.sort()
-    for region in regions:
+    for region in clonoTypes.regions():
         if region == 'v':
             continue
-        clonoType = flatClonoTypes[region]
-        seqs = clonoType.keys()
-        weights = clonoType.values()
+        # combined AA counts(V family) of each region into one sum
+        clonoType = clonoTypes.counts(region)
+        seqs = clonoType.index.tolist()
+        weights = clonoType.tolist()
 
         regionDirectory = os.path.join(logosFolder, region.upper())
         createIfNot(regionDirectory)
@@ -262,17 +266,11 @@ def compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=2, detail
 
 
 @requires('weblogolib')
-def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
+def generateSeqMotifs(clonoTypes, name, outDir, threads=2, stream=None):
     """
     Create motif plots for FR and CDR regions
-    :param flatClonoTypes: dict
-                    dict with keys of FR / CDR region, each having a value of Counter() where the
-                    AA sequences are tallied
-                    For example:
-                    {
-                        'FR1': Counter({"FGWSG": 32, ...}),
-                        'CDR1': Counter(...)
-                    }
+    :param clonoTypes: Clonotypes
+                    clonotype table, AA sequences of each FR / CDR region are tallied over all IGV genes
 
     :param name: string
                     name of sample
@@ -294,16 +292,14 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
     printto(stream, "Generating motifs ...")
 
     # create motif logos
-    regions = flatClonoTypes.keys()
-    regions.sort()
     argBuffer = []
-    for region in regions:
+    for region in clonoTypes.regions():
         if region == 'v':
             continue
 
-        clonoType = flatClonoTypes[region]
-        seqs = clonoType.keys()
-        weights = clonoType.values()
+        clonoType = clonoTypes.counts(region)
+        seqs = clonoType.index.tolist()
+        weights = clonoType.tolist()
 
         # Generate sequence motif logos using weblogo
         # generate logos without alignment
@@ -384,35 +380,3 @@ def writeClonotypeDiversityRegionAnalysis(clonoTypes, sampleName, outDir, stream
                 writeBuffer = ""
         fp.write(writeBuffer)
 
-
-def flattenClonoTypeCountsDict(clonoTypes, stream=None):
-    """
-    reduces something of this structure:
-            'IGHV1-3': {
-                'FR1': { 'FWGCGC': 12, 'EVILK': 1, ... }
-                'CDR1': { 'FWGCGC': 12, 'EVILK': 1, ... }
-            },
-            'IGHV2-3': {
-                'FR1' : { 'FWGCGC': 12, 'EVILK': 1, ... }
-                'CDR1': { 'FWGCGC': 12, 'EVILK': 1, ... }
-            }, ...
-    to this:
-            {
-                'FR1': { 'FWGCGC': 24, 'EVILK': 2, ... }
-                'CDR1': { 'FWGCGC': 24, 'EVILK': 2, ... }
-            }
-
-    :param clonoTypes: dict
-                input nested dictionary
-
-    :return: dict
-            flattened dictionary
-    """
-    printto(stream, "Compressing clonotype table ... discarding IGV information ...")
-    flattened = defaultdict(Counter)
-    for geneName in clonoTypes:
-        for region, counts in clonoTypes[geneName].items():
-            flattened[region] += Counter(counts)
-    printto(stream, "Finish compressing clonotype table")
-    return flattened
-
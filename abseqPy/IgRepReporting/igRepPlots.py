@@ -13,15 +13,17 @@ import numpy
 import random
 import itertools
 import scipy.stats
-import multiprocessing
+import pandas as pd
 
-from collections import Counter, defaultdict
+from collections import Counter
 from os.path import exists
 from Bio import SeqIO
 from numpy import Inf, mean, isnan
+from scipy.special import gammaln
 
 import abseqPy.IgRepertoire.igRepUtils
-from abseqPy.IgRepAuxiliary.seqUtils import maxlen, WeightedPopulation
+from abseqPy.IgRepAuxiliary.seqUtils import WeightedPopulation
+from abseqPy.IgRepAuxiliary.histograms import lengthHistogram, duplicationLevels
 from abseqPy.IgMultiRepertoire.PlotManager import PlotManager
 from abseqPy.logger import printto, LEVEL
 
@@ -89,7 +91,7 @@ def plotSeqLenDist(counts, sampleName, outputFile, fileFormat='fasta',
             sizes = [len(rec) for rec in SeqIO.parse(fp, fileFormat) if len(rec) <= maxLen]
         if len(sizes) == 0:
             return
-        count = Counter(sizes)
+        count = lengthHistogram(sizes)
         sizes = count.keys()
         weights = count.values()
     elif isinstance(counts, list):
@@ -141,7 +143,7 @@ def plotSeqLenDist(counts, sampleName, outputFile, fileFormat='fasta',
                 ax.plot(bins, y, 'r--')
     else:
         if all([(x == 1) for x in weights]):
-            tmp = Counter(sizes)
+            tmp = lengthHistogram(sizes)
             sizes = tmp.keys()
             weights = map(lambda x: tmp[x], sizes)
         if normed:
@@ -183,27 +185,15 @@ def plotSeqDuplication(frequencies, labels, filename, title='', grouped=False, s
             ax.set_title(title + '\nTotal is {:,}'.format(sum(map(lambda x: sum(x), frequencies))))
     csvData = []
     for freqs, l in zip(frequencies, labels):
-        # sort frequencies in ascending order
-        total = sum(freqs)
-        freqs.sort()
-        freqs = np.array(freqs)
         # create the x-axis ticks [10, 10000]
         ticks = np.linspace(10, 10000, 100).tolist()
-        # calculate the proportion of sequences that are 
-        # duplicated >= x for x in [10, 10000]
-        y = []
-        for x in ticks:
-            y.append(sum(1.0 * freqs[freqs >= x]) / total)
+        less10Ticks = range(1, 10)
+        # calculate the proportion of sequences that are duplicated >= x for x in [10, 10000]
+        # and the proportion of sequences that appear exactly x times for x in [1, 9]
+        y, less10Y = duplicationLevels(freqs, atLeast=ticks, exactly=less10Ticks)
         # scale [10, 10000]  into [10, 20]
         ticks = map(lambda x: (x - 10) * (20 - 10) / (10000 - 10) + 10, ticks)
-        # calculate the proportion of sequences that appear
-        # exactly x times for x in [1, 9]
-        less10Ticks = []
-        less10Y = []
-        for i in range(1, 10):
-            less10Ticks.append(i)
-            less10Y.append(sum(freqs == i) * 1.0 / total)
-            # merge ticks and proportions to construct the final plot data
+        # merge ticks and proportions to construct the final plot data
         y = less10Y + y
         ticks = less10Ticks + ticks
 
@@ -234,28 +224,60 @@ def plotSeqDuplication(frequencies, labels, filename, title='', grouped=False, s
         plt.close()
 
 
-def dedup(population, n, k=5):
+def rarefy(abundances, depths):
     """
-    given a population and a sample size, randomly select n sequences and get the number of unique sequences from them.
-    This experiment is repeated k times and a list of length k is returned
-    :param population: collection of sequences
-    :param n: sample size to randomly pick sequences from
-    :param k: number of times to repeat the deduplication experiment
-    :return: tuple (a, b) where
-            a == n
-            b is a list of length k, each element is the number of deduplicated sequences after randomly picking n
-            from population (i.e. the number will be <= n)
-    """
-    # repeat 5 times for each sample size t
-    hs = [len(set(random.sample(population, n))) for _ in range(k)]
-    # Begin: Very slow
-    #             hs = [ len(set(np.random.choice(setSeqs, j, replace = True, p  = w)))
-    #                   for k in range(5) ]
-    # End: very slow
-    return n, hs
+    expected number of distinct sequences in a random sample (without replacement) of each depth, computed with
+    the hypergeometric formula E[S(n)] = sum_i 1 - C(N - N_i, n) / C(N, n), where N_i is the number of reads of
+    sequence i and N is the total number of reads. Sequences with the same number of reads are computed once.
 
+    :param abundances: array-like of ints, number of reads of each sequence
+    :param depths: array-like of ints, sample sizes (at most the total number of reads)
+    :return: numpy array, expected number of distinct sequences at each depth
 
-def plotSeqRarefaction(seqs, labels, filename, weights=None, title='', threads=2, stream=None):
+    >>> rarefy([1, 1, 2], [1, 2, 4]).round(4).tolist()
+    [1.0, 1.8333, 3.0]
+    """
+    values, freqs = np.unique(np.asarray(abundances, dtype=np.int64), return_counts=True)
+    freqs, values = freqs[values > 0], values[values > 0]
+    total = values.dot(freqs)
+    depths = np.asarray(depths, dtype=np.int64)[:, None]
+    # reads of all the other sequences, a sample larger than that has to contain the sequence
+    others = total - values[None, :]
+    logMissed = gammaln(others + 1) - gammaln(np.maximum(others - depths, 0) + 1) \
+        - gammaln(total + 1) + gammaln(total - depths + 1)
+    seen = np.where(others < depths, 1.0, -np.expm1(logMissed))
+    return seen.dot(freqs)
+
+
+def sampleRarefaction(abundances, depths, replicates, seed=None):
+    """
+    number of distinct sequences in random samples (without replacement) of each depth. Each replicate shuffles all
+    reads once, the samples are the prefixes of the shuffled reads, so a replicate costs O(total reads) for all
+    depths together.
+
+    :param abundances: array-like of ints, number of reads of each sequence
+    :param depths: array-like of ints, sample sizes (at most the total number of reads)
+    :param replicates: int, number of shuffles
+    :param seed: int, seed of the random number generator
+    :return: replicates x len(depths) numpy array, one rarefaction curve per row
+
+    >>> sampleRarefaction([3, 1], [1, 4], 2, seed=0).tolist()
+    [[1, 2], [1, 2]]
+    """
+    abundances = np.asarray(abundances, dtype=np.int64)
+    abundances = abundances[abundances > 0]
+    firstRead = np.concatenate([[0], np.cumsum(abundances)[:-1]])
+    rng = np.random.RandomState(seed)
+    curves = []
+    for _ in range(replicates):
+        # position of each read in the shuffled order, reads of the same sequence are adjacent in positions
+        positions = rng.permutation(abundances.sum())
+        firstSeen = np.sort(np.minimum.reduceat(positions, firstRead))
+        curves.append(np.searchsorted(firstSeen, depths))
+    return np.array(curves)
+
+
+def plotSeqRarefaction(seqs, labels, filename, weights=None, title='', bootstrap=0, seed=None, stream=None):
     """
     In ecology, rarefaction is a technique to assess species richness from the results
     of sampling. Rarefaction allows the calculation of species richness for a given
@@ -263,6 +285,9 @@ def plotSeqRarefaction(seqs, labels, filename, weights=None, title='', threads=2
     This curve is a plot of the number of species as a function of the number of samples.
     Source: https://en.wikipedia.org/wiki/Rarefaction_(ecology )
 
+    The expected number of deduplicated sequences is computed in closed form (see rarefy) instead of
+    by repeated subsampling.
+
     :param seqs: list of lists
                 ith nested list should consist of sequences that correspond to ith element of label
     :param labels: list of strings
@@ -272,7 +297,12 @@ def plotSeqRarefaction(seqs, labels, filename, weights=None, title='', threads=2
                 sequence weights
     :param title: string
                 plot title
-    :param threads: int
+    :param bootstrap: int
+                if > 0, number of sampled rarefaction curves (see sampleRarefaction) used for a 95% confidence band.
+                The CSV then has one row per replicate and sample size, like the sampled curves it used to have,
+                instead of the expected values
+    :param seed: int
+                seed of the sampled curves, the seeds of the regions are all drawn from it
     :param stream: output stream
     :return: None
     """
@@ -287,35 +317,30 @@ def plotSeqRarefaction(seqs, labels, filename, weights=None, title='', threads=2
         ax.set_ylabel('Number of Deduplicated Sequences')
         ax.set_title(title)
     csvData = []
-    for setSeqs, l, w in zip(seqs, labels, weights):
-        if w is not None:
-            total = sum(w)
-        else:
-            total = len(setSeqs)
-        # if (max(w) > 1):
-        #             w = map(lambda x : x * 1.0 / sum(w), w)
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, len(seqs))
+    for setSeqs, l, w, regionSeed in zip(seqs, labels, weights, seeds):
+        if w is None:
+            w = [1] * len(setSeqs)
+        total = sum(w)
         # create x-axis ticks [10, #sequences]
         ticks = []
         S = 10
         while S < total:
             ticks.append(S)
             S = int(S * 1.5)
-        # ticks = np.linspace(10, total, )
         ticks.append(total)
-        # print(len(ticks))
-        # capture-recapture analysis 
-        # sample sequences and estimate diversity
-        pool = multiprocessing.Pool(processes=threads)
-        population = WeightedPopulation(setSeqs, w)
-        result = [pool.apply_async(dedup, args=(population, t)) for t in ticks]
-        pt = sorted([p.get() for p in result], key=lambda tup: tup[0])
-        pool.close()
-        pool.join()
-        # calculate the mean across 5 samples
-        csvData.extend([(x, y, l) for x, ys in pt for y in ys])
+        expected = rarefy(w, ticks)
+        if bootstrap > 0:
+            curves = sampleRarefaction(w, ticks, bootstrap, seed=regionSeed)
+            csvData.extend([(x, y, l) for curve in curves for x, y in zip(ticks, curve)])
+        else:
+            csvData.extend([(x, y, l) for x, y in zip(ticks, expected)])
 
         if PlotManager.pythonPlotOn():
-            ax.plot([d[0] for d in pt], [mean(d[1]) * 1.0 for d in pt], label=l)
+            line, = ax.plot(ticks, expected, label=l)
+            if bootstrap > 0:
+                low, high = np.percentile(curves, [2.5, 97.5], axis=0)
+                ax.fill_between(ticks, low, high, color=line.get_color(), alpha=0.2)
 
     xticks = np.linspace(0, total, 15).astype(int)
     xticks = map(lambda x: x - x % 1000 if x > 1000 else x, xticks[:-1])
@@ -411,27 +436,34 @@ def plotSeqRecapture(seqs, labels, filename, weights=None, title='', stream=None
         plt.close()
 
 
-def recapture(population, n, k=5):
+def recapture(population, ticks, k=5, seed=None):
     """
-    given a population, conducts recapture analysis for sample size = n.
-    This experiment is repeated k times, and a list of length k is returned with percent recapture rate.
-    :param population: collection of sequences
-    :param n: sample size to randomly pick
+    given a population, conducts recapture analysis for each sample size in ticks.
+    Each experiment is repeated k times. Sequences are sampled (with replacement) as integer codes, the recapture of
+    two samples is computed with a boolean mask over the codes of the first one.
+
+    :param population: numpy array of integer codes of the sequences (see pandas.factorize), in [0, max code]
+    :param ticks: list of sample sizes
     :param k: repeat recapture experiment k times
-    :return: tuple of (a, b) where
-            a == n
-            b is a list of length k and each value is the percentage of recapture
+    :param seed: int, seed of the random number generator
+    :return: len(ticks) x k numpy array, percentage of recapture
     """
-    hs = []
-    for _ in range(k):
-        s1 = set(np.random.choice(population, n))
-        s2 = set(np.random.choice(population, n))
-        intersection = s2.intersection(s1)
-        hs.append(len(intersection) * 100.0 / len(s2))
-    return n, hs
-
-
-def plotSeqRecaptureNew(seqs, labels, filename, title='', threads=2, stream=None):
+    hs = np.full((len(ticks), k), np.nan)
+    if not len(population):
+        return hs
+    rng = np.random.RandomState(seed)
+    captured = np.zeros(population.max() + 1, dtype=bool)
+    for i, n in enumerate(ticks):
+        for j in range(k):
+            s1 = population[rng.randint(0, len(population), n)]
+            s2 = np.unique(population[rng.randint(0, len(population), n)])
+            captured[s1] = True
+            hs[i, j] = np.count_nonzero(captured[s2]) * 100.0 / len(s2)
+            captured[s1] = False
+    return hs
+
+
+def plotSeqRecaptureNew(seqs, labels, filename, title='', pool=None, seed=None, stream=None):
     """
     Perform non-redundant capture-recapture analysis and plot the percent recapture.
     Uses sampling without replacement and gives equal properties to all clones.
@@ -450,7 +482,11 @@ def plotSeqRecaptureNew(seqs, labels, filename, title='', threads=2, stream=None
     :param filename: output filename
     :param title: string
                 plot title
-    :param threads: int
+    :param pool: multiprocessing.Pool
+                the regions are analyzed in parallel by this pool, or one after the other if it is None.
+                The pool is left open for the caller
+    :param seed: int
+                seed of the random number generator, the seeds of the regions are all drawn from it
     :param stream: output stream
     :return: None
     """
@@ -463,22 +499,26 @@ def plotSeqRecaptureNew(seqs, labels, filename, title='', threads=2, stream=None
         ax.set_xlabel('Sample size')
         ax.set_ylabel('Percent Recapture')
         ax.set_title(title)
+    total = 35000
+    ticks = np.linspace(100, total, 50).astype(int).tolist()
+    # capture-recapture analysis
+    # sample sequences and estimate diversity
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, len(seqs))
+    populations = [pd.factorize(setSeqs)[0] for setSeqs in seqs]
+    if pool is None:
+        curves = [recapture(population, ticks, seed=regionSeed) for population, regionSeed in zip(populations, seeds)]
+    else:
+        results = [pool.apply_async(recapture, args=(population, ticks), kwds={'seed': regionSeed})
+                   for population, regionSeed in zip(populations, seeds)]
+        curves = [r.get() for r in results]
+
     csvData = []
-    for setSeqs, l in zip(seqs, labels):
-        total = 35000
-        ticks = np.linspace(100, total, 50).astype(int)
-        # capture-recapture analysis 
-        # sample sequences and estimate diversity
-        pool = multiprocessing.Pool(processes=threads)
-        # calculate the mean across 5 samples
-        result = [pool.apply_async(recapture, args=(setSeqs, t)) for t in ticks]
-        pt = sorted([p.get() for p in result], key=lambda tup: tup[0])
-        pool.close()
-        pool.join()
-        csvData.extend([(x, y, l) for x, ys in pt for y in ys])
+    for hs, l in zip(curves, labels):
+        csvData.extend([(x, y, l) for x, ys in zip(ticks, hs) for y in ys])
 
         if PlotManager.pythonPlotOn():
-            ax.plot([d[0] for d in pt], [mean(d[1]) for d in pt], label=l)
+            # calculate the mean across 5 samples
+            ax.plot(ticks, hs.mean(axis=1), label=l)
 
     xticks = np.linspace(0, total, 15).astype(int)
     xticks = map(lambda x: x - x % 1000 if x > 1000 else x, xticks)
@@ -494,17 +534,45 @@ def plotSeqRecaptureNew(seqs, labels, filename, title='', threads=2, stream=None
         plt.close()
 
 
-def plotVenn(sets, filename, title='', stream=None):
+def vennSubsets(sets, weights):
+    """
+    sizes of the regions of the Venn diagram of sets, in the order venn2 and venn3 expect them: a region is
+    numbered by the bits of the sets its elements belong to (A is bit 0, B is bit 1, C is bit 2)
+
+    :param sets: list of sets
+    :param weights: dict, number of times each element is counted, elements not in weights are counted once
+    :return: tuple of 2 ** len(sets) - 1 region sizes
+
+    >>> vennSubsets([{'a', 'b'}, {'b', 'c'}], {'b': 3})
+    (1, 1, 3)
+    """
+    sizes = Counter()
+    for element in set().union(*sets):
+        region = sum(1 << i for i, s in enumerate(sets) if element in s)
+        sizes[region] += weights.get(element, 1)
+    return tuple(sizes[region] for region in range(1, 2 ** len(sets)))
+
+
+def plotVenn(sets, filename, title='', weights=None, stream=None):
+    """
+    :param sets: dict of set name -> set of sequence ids, 2 or 3 sets
+    :param filename: output filename
+    :param title: plot title
+    :param weights: dict of sequence id -> number of reads, if identical reads were collapsed
+    :param stream: output stream
+    :return: None
+    """
     if eitherExists(filename):
         printto(stream, "File found ... " + os.path.basename(filename), LEVEL.WARN)
         return
     fig, ax = plt.subplots()
+    subsets = sets.values() if weights is None else vennSubsets(sets.values(), weights)
     if len(sets) == 2:
         from matplotlib_venn import venn2
-        venn2(sets.values(), sets.keys())
+        venn2(subsets, sets.keys())
     elif len(sets) == 3:
         from matplotlib_venn import venn3
-        venn3(sets.values(), sets.keys())
+        venn3(subsets, sets.keys())
     else:
         printto(stream, "Venn diagram cannot be generated for more than 3 restriction enzymes", LEVEL.ERR)
         return
@@ -624,7 +692,10 @@ def generateStatsHeatmap(data, sampleName, xyCol, axlabels, filename, stream=Non
         return
     x = data[xyCol[0]].tolist()
     y = data[xyCol[1]].tolist()
-    total = len(x)
+    # rows may stand for several identical reads
+    weights = abseqPy.IgRepertoire.igRepUtils.cloneCounts(data)
+    weights = None if weights is None else weights.values
+    total = len(x) if weights is None else weights.sum()
     BINS = 10
     #     fig, ax = plt.subplots()
     #     ax.scatter(x, y, s=3, alpha=0.5, edgecolors='none' )
@@ -636,7 +707,7 @@ def generateStatsHeatmap(data, sampleName, xyCol, axlabels, filename, stream=Non
 
     # plot as heatmap
 
-    heatmap, xedges, yedges = np.histogram2d(x, y, bins=BINS)
+    heatmap, xedges, yedges = np.histogram2d(x, y, bins=BINS, weights=weights)
     heatmap = heatmap / np.sum(heatmap) * 100
     exportMatrix(heatmap.transpose(),
                  centrizeBins(xedges),
@@ -878,51 +949,118 @@ def barLogo(counts, title, filename, removeOutliers=False, scaled=False, stream=
         plt.close()
 
 
+def positionalComposition(seqs, weights, groups=None, positions=30):
+    """
+    weighted amino acid counts of every position. The sequences are packed once into a zero padded uint8 matrix,
+    upper cased, and each position is counted for all groups at once with a weighted bincount.
+
+    :param seqs: list of strings
+    :param weights: list of weights, one per sequence
+    :param groups: list of group numbers 0, 1, ... (e.g. V germlines), one per sequence. All sequences are in
+                group 0 if None
+    :param positions: int, only the first positions are counted
+    :return: list, for each group, of Counters of amino acids (one per position, up to the group's longest sequence)
+
+    >>> composition = positionalComposition(['ARD', 'ak', 'G', 'YY'], [1, 2, 3, 1], groups=[0, 0, 0, 1])
+    >>> [sorted(counts.items()) for counts in composition[0]]
+    [[('A', 3), ('G', 3)], [('K', 2), ('R', 1)], [('D', 1)]]
+    >>> [sorted(counts.items()) for counts in composition[1]]
+    [[('Y', 1)], [('Y', 1)]]
+    """
+    n = len(seqs)
+    weights = np.asarray(weights)
+    groups = np.zeros(n, dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    nGroups = groups.max() + 1 if n else 0
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=n)
+    widths = np.zeros(nGroups, dtype=np.int64)
+    np.maximum.at(widths, groups, np.minimum(lengths, positions))
+    width = max(widths.max() if nGroups else 0, 1)
+
+    packed = np.char.upper(np.array(seqs, dtype='S{}'.format(width)))
+    matrix = np.frombuffer(packed.tobytes(), dtype=np.uint8).reshape(n, width)
+    counts = np.empty((width, nGroups, 256))
+    for x in range(width):
+        counts[x] = np.bincount(groups * 256 + matrix[:, x], weights=weights,
+                                minlength=nGroups * 256).reshape(nGroups, 256)
+    if weights.dtype.kind in 'iub':
+        counts = np.rint(counts).astype(np.int64)
+    # code 0 is padding, sequences shorter than the position
+    counts[:, :, 0] = 0
+
+    composition = []
+    for g in range(nGroups):
+        composition.append([])
+        for x in range(widths[g]):
+            present = np.flatnonzero(counts[x, g])
+            composition[-1].append(Counter(dict(zip(map(chr, present), counts[x, g, present].tolist()))))
+    return composition
+
+
 def generateCumulativeLogo(seqs, weights, region, filename, stream=None):
-    if eitherExists(filename):
-        printto(stream, "\t" + region + " Cumulative Logo was found ", LEVEL.WARN)
-    else:
-        m = min(30, maxlen(seqs))
-        # Calculate AA counts per position
-        aaCounts = []
-        for x in range(m):
-            cnt = defaultdict(int)
-            for i in range(len(seqs)):
-                seq = seqs[i].upper()
-                if x < len(seq):
-                    cnt[seq[x]] += weights[i]
-            aaCounts.append(Counter(cnt))
-
-        # Generate a cumulative bar plot
-        barLogo(aaCounts,
-                "{} ({:,})".format(region.upper(), sum(weights)),
-                filename.replace(".csv", ".png"), removeOutliers=(region != "cdr3"), stream=stream)
-        barLogo(aaCounts,
-                "{} ({:,})".format(region.upper(), sum(weights)),
-                filename.replace(".csv", "_scaled.png"),
-                scaled=True, stream=stream)
-
-        # write raw barLogo csv file - in a human friendly way
-        rawCountsFileName, _ = os.path.splitext(filename)
-        rawCountsFileName += '_raw.csv'
-        allAAs = ''.join(set(itertools.chain.from_iterable(count.keys() for count in aaCounts))).upper()
-        # we take total to get a "scaled" fraction (i.e. the columns now don't always sum to 1)
-        total = max(sum(count.values()) for count in aaCounts)
-        with open(rawCountsFileName, 'w') as fp:
-            # write header
-            positions = range(1, len(aaCounts) + 1)
-            fp.write('AminoAcid/Position,' + ','.join(map(str, positions)) + '\n')
-            for aa in sorted(allAAs):
-                aaBuffer = ""
-                for counter in aaCounts:
-                    aaBuffer += ',' + "{:.3}".format(float(counter.get(aa, 0)) / total)
-                fp.write("{}{}\n".format(aa, aaBuffer))
-
-        # write barLogo csv file - in long format
-        plotFileName, _ = os.path.splitext(filename)
-        plotFileName += '.csv'
-        writeCSV(plotFileName, "position,aa,count\n", "{},{},{}\n", vals=
-                 [(p, aa, counts) for p, cnt in enumerate(aaCounts) for aa, counts in cnt.items()])
+    generateCumulativeLogos(seqs, weights, None, region, [filename], stream=stream)
+
+
+def generateCumulativeLogos(seqs, weights, groups, region, filenames, stream=None):
+    """
+    cumulative logos of several groups of sequences of the same region, their compositions are
+    computed in one pass
+
+    :param seqs: list of strings
+    :param weights: list of weights, one per sequence
+    :param groups: list of group numbers 0, 1, ..., one per sequence, or None for a single group
+    :param region: string, region name
+    :param filenames: list of CSV filenames, one per group
+    :param stream: logging stream
+    :return: None
+    """
+    pending = [not eitherExists(filename) for filename in filenames]
+    for filename, todo in zip(filenames, pending):
+        if not todo:
+            printto(stream, "\t" + region + " Cumulative Logo was found ", LEVEL.WARN)
+    if not any(pending):
+        return
+    weights = np.asarray(weights)
+    groups = np.zeros(len(seqs), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    composition = positionalComposition(seqs, weights, groups)
+    totals = np.bincount(groups, weights=weights, minlength=len(filenames))
+    if weights.dtype.kind in 'iub':
+        totals = np.rint(totals).astype(np.int64)
+    for aaCounts, totalWeight, filename, todo in zip(composition, totals.tolist(), filenames, pending):
+        if todo:
+            _writeCumulativeLogo(aaCounts, totalWeight, region, filename, stream=stream)
+
+
+def _writeCumulativeLogo(aaCounts, totalWeight, region, filename, stream=None):
+    # Generate a cumulative bar plot
+    barLogo(aaCounts,
+            "{} ({:,})".format(region.upper(), totalWeight),
+            filename.replace(".csv", ".png"), removeOutliers=(region != "cdr3"), stream=stream)
+    barLogo(aaCounts,
+            "{} ({:,})".format(region.upper(), totalWeight),
+            filename.replace(".csv", "_scaled.png"),
+            scaled=True, stream=stream)
+
+    # write raw barLogo csv file - in a human friendly way
+    rawCountsFileName, _ = os.path.splitext(filename)
+    rawCountsFileName += '_raw.csv'
+    allAAs = ''.join(set(itertools.chain.from_iterable(count.keys() for count in aaCounts))).upper()
+    # we take total to get a "scaled" fraction (i.e. the columns now don't always sum to 1)
+    total = max(sum(count.values()) for count in aaCounts)
+    with open(rawCountsFileName, 'w') as fp:
+        # write header
+        positions = range(1, len(aaCounts) + 1)
+        fp.write('AminoAcid/Position,' + ','.join(map(str, positions)) + '\n')
+        for aa in sorted(allAAs):
+            aaBuffer = ""
+            for counter in aaCounts:
+                aaBuffer += ',' + "{:.3}".format(float(counter.get(aa, 0)) / total)
+            fp.write("{}{}\n".format(aa, aaBuffer))
+
+    # write barLogo csv file - in long format
+    plotFileName, _ = os.path.splitext(filename)
+    plotFileName += '.csv'
+    writeCSV(plotFileName, "position,aa,count\n", "{},{},{}\n", vals=
+             [(p, aa, counts) for p, cnt in enumerate(aaCounts) for aa, counts in cnt.items()])
 
 
 def writeCSV(filename, header, template, vals, zip=False, metadata=""):
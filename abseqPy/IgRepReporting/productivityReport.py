@@ -9,11 +9,11 @@ import gc
 import pandas as pd
 import os
 
-from collections import Counter, OrderedDict
+from collections import OrderedDict
 from numpy import nan
 
 from abseqPy.IgRepReporting.igRepPlots import plotDist
-from abseqPy.IgRepertoire.igRepUtils import compressCountsFamilyLevel
+from abseqPy.IgRepertoire.igRepUtils import compressCountsFamilyLevel, countColumn, cloneCounts, totalReads
 
 
 def generateProductivityReport(cloneAnnot, cloneSeqs, name, chain, outputDir, stream=None):
@@ -22,7 +22,7 @@ def generateProductivityReport(cloneAnnot, cloneSeqs, name, chain, outputDir, st
     cloneAnnot.fillna(nanString, inplace=True)
 
     productive = extractProductiveClones(cloneAnnot, name, outputDir, stream=stream)
-    productiveFamilyDist = compressCountsFamilyLevel(Counter(productive['vgene'].tolist()))
+    productiveFamilyDist = compressCountsFamilyLevel(countColumn(productive, 'vgene'))
     plotDist(productiveFamilyDist, name, os.path.join(outputDir, name + '_igv_dist_productive.csv'),
              title='IGV Abundance of Productive Clones',
              proportion=True, stream=stream)
@@ -47,13 +47,15 @@ def writeProdStats(cloneAnnot, sampleName, outdir):
     :param outdir: output directory
     :return: None. Produces a csv file in outdir
     """
-    stopcod_inframe = len(cloneAnnot[(cloneAnnot['v-jframe'] == 'In-frame') & (cloneAnnot['stopcodon'] == 'Yes')])
-    outframe_nostop = len(cloneAnnot[(cloneAnnot['v-jframe'] == 'Out-of-frame') & (cloneAnnot['stopcodon'] == 'No')])
-    both = len(cloneAnnot[(cloneAnnot['v-jframe'] == 'Out-of-frame') & (cloneAnnot['stopcodon'] == 'Yes')])
-    prod_reads = len(cloneAnnot[(cloneAnnot['v-jframe'] == 'In-frame') & (cloneAnnot['stopcodon'] == 'No')])
+    inFrame = cloneAnnot['v-jframe'] == 'In-frame'
+    outOfFrame = cloneAnnot['v-jframe'] == 'Out-of-frame'
+    stopcod_inframe = totalReads(cloneAnnot[inFrame & (cloneAnnot['stopcodon'] == 'Yes')])
+    outframe_nostop = totalReads(cloneAnnot[outOfFrame & (cloneAnnot['stopcodon'] == 'No')])
+    both = totalReads(cloneAnnot[outOfFrame & (cloneAnnot['stopcodon'] == 'Yes')])
+    prod_reads = totalReads(cloneAnnot[inFrame & (cloneAnnot['stopcodon'] == 'No')])
 
     # percentage calculated from total sample size
-    total_size = len(cloneAnnot)
+    total_size = totalReads(cloneAnnot)
     if total_size:
         res = {
             'Productivity': ["Productive", "Unproductive", "Unproductive",  "Unproductive"],
@@ -72,31 +74,31 @@ def writeProdStats(cloneAnnot, sampleName, outdir):
 
 def writeGeneStats(cloneAnnot, name, chain, outputDir, suffix, stream=None):
     # V gene stats
-    gaps = Counter(cloneAnnot['vgaps'].tolist())
+    gaps = countColumn(cloneAnnot, 'vgaps')
     plotDist(gaps, name, os.path.join(outputDir, name +
              '_igv_gaps_dist.csv'), title='Gaps in V Gene',
              proportion=True, rotateLabels=False, top=20, stream=stream)
-    mismatches = Counter(cloneAnnot['vmismatches'].tolist())
+    mismatches = countColumn(cloneAnnot, 'vmismatches')
     plotDist(mismatches, name, os.path.join(outputDir, name +
              '_igv_mismatches_dist.csv'), title='Mismatches in V Gene',
              proportion=True, rotateLabels=False, top=20, stream=stream)
     # D gene stats
     if chain == 'hv':
-        gaps = Counter(cloneAnnot['dgaps'].tolist())
+        gaps = countColumn(cloneAnnot, 'dgaps')
         plotDist(gaps, name, os.path.join(outputDir, name +
                  '_igd_gaps_dist.csv'), title='Gaps in D Gene',
                  proportion=False, rotateLabels=False, stream=stream)
-        mismatches = Counter(cloneAnnot['dmismatches'].tolist())
+        mismatches = countColumn(cloneAnnot, 'dmismatches')
 #         print(mismatches)
         plotDist(mismatches, name, os.path.join(outputDir, name +
                  '_igd_mismatches_dist.csv'), title='Mismatches in D Gene',
                  proportion=False, rotateLabels=False, stream=stream)
     # J gene stats
-    gaps = Counter(cloneAnnot['jgaps'].tolist())
+    gaps = countColumn(cloneAnnot, 'jgaps')
     plotDist(gaps, name, os.path.join(outputDir, name +
              '_igj_gaps_dist.csv'), title='Gaps in J Gene',
              proportion=False, rotateLabels=False, stream=stream)
-    mismatches = Counter(cloneAnnot['jmismatches'].tolist())
+    mismatches = countColumn(cloneAnnot, 'jmismatches')
     plotDist(mismatches, name, os.path.join(outputDir, name +
              '_igj_mismatches_dist.csv'), title='Mismatches in J Gene',
              proportion=False, rotateLabels=False, stream=stream)
@@ -104,30 +106,30 @@ def writeGeneStats(cloneAnnot, name, chain, outputDir, suffix, stream=None):
 
 def writeCDRStats(cloneAnnot, name, outputDir, suffix = '', stream=None):
     # CDR1 statistics
-    cdrGaps = Counter(cloneAnnot['cdr1.gaps'].tolist())
+    cdrGaps = countColumn(cloneAnnot, 'cdr1.gaps')
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr1_gaps_dist.csv'), title='Gaps in CDR1',
              proportion=False, rotateLabels=False, stream=stream)
-    cdrMismatches = Counter(cloneAnnot['cdr1.mismatches'].tolist())
+    cdrMismatches = countColumn(cloneAnnot, 'cdr1.mismatches')
     plotDist(cdrMismatches, name, os.path.join(outputDir, name +
              '_cdr1_mismatches_dist.csv'), title='Mismatches in CDR1',
              proportion=False, rotateLabels=False, stream=stream)
     # CDR2 stats    
-    cdrGaps = Counter(cloneAnnot['cdr2.gaps'].tolist())
+    cdrGaps = countColumn(cloneAnnot, 'cdr2.gaps')
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr2_gaps_dist.csv'), title='Gaps in CDR2',
              proportion=False, rotateLabels=False, stream=stream)
-    cdrMismatches = Counter(cloneAnnot['cdr2.mismatches'].tolist())
+    cdrMismatches = countColumn(cloneAnnot, 'cdr2.mismatches')
     plotDist(cdrMismatches, name, os.path.join(outputDir, name +
              '_cdr2_mismatches_dist.csv'), title='Mismatches in CDR2',
              proportion=False, rotateLabels=False, stream=stream)
     # CDR3 stats
-    cdrGaps = Counter(cloneAnnot['cdr3g.gaps'])
+    cdrGaps = countColumn(cloneAnnot, 'cdr3g.gaps')
 #         print(len(cdrGaps))
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr3_gaps_dist.csv'), title='Gaps in CDR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
-    cdrMismatches = Counter(cloneAnnot['cdr3g.mismatches'].tolist())
+    cdrMismatches = countColumn(cloneAnnot, 'cdr3g.mismatches')
     plotDist(cdrMismatches, name, os.path.join(outputDir, name +
              '_cdr3_mismatches_dist.csv'), title='Mismatches in CDR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
@@ -136,29 +138,29 @@ def writeCDRStats(cloneAnnot, name, outputDir, suffix = '', stream=None):
 
 def writeFRStats(cloneAnnot, name, outputDir, suffix = '', stream=None):
     # FR1 statistics 
-    gaps = Counter(cloneAnnot['fr1.gaps'].tolist())
+    gaps = countColumn(cloneAnnot, 'fr1.gaps')
     plotDist(gaps, name, os.path.join(outputDir,  name +
              '_fr1_gaps_dist.csv'), title='Gaps in FR1',
              proportion=False, rotateLabels=False, stream=stream)
-    mismatches = Counter(cloneAnnot['fr1.mismatches'].tolist())
+    mismatches = countColumn(cloneAnnot, 'fr1.mismatches')
     plotDist(mismatches, name, os.path.join(outputDir, name +
              '_fr1_mismatches_dist.csv'), title='Mismatches in FR1',
              proportion=False, rotateLabels=False, stream=stream)
     # FR2 statistics 
-    gaps = Counter(cloneAnnot['fr2.gaps'].tolist())
+    gaps = countColumn(cloneAnnot, 'fr2.gaps')
     plotDist(gaps, name, os.path.join(outputDir, name +
              '_fr2_gaps_dist.csv'), title='Gaps in FR2',
              proportion=False, rotateLabels=False, stream=stream)
-    mismatches = Counter(cloneAnnot['fr2.mismatches'].tolist())
+    mismatches = countColumn(cloneAnnot, 'fr2.mismatches')
     plotDist(mismatches, name, os.path.join(outputDir, name +
              '_fr2_mismatches_dist.csv'), title='Mismatches in FR2',
              proportion=False, rotateLabels=False, stream=stream)
     # FR3 statistics 
-    gaps = Counter(cloneAnnot['fr3g.gaps'].tolist())
+    gaps = countColumn(cloneAnnot, 'fr3g.gaps')
     plotDist(gaps, name, os.path.join(outputDir, name +
              '_fr3_gaps_dist.csv'), title='Gaps in FR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
-    mismatches = Counter(cloneAnnot['fr3g.mismatches'].tolist())
+    mismatches = countColumn(cloneAnnot, 'fr3g.mismatches')
     plotDist(mismatches, name, os.path.join(outputDir, name +
              '_fr3_mismatches_dist.csv'), title='Mismatches in FR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
@@ -168,46 +170,46 @@ def writeFRStats(cloneAnnot, name, outputDir, suffix = '', stream=None):
 
 def extractProductiveClones(cloneAnnot, name, outputDir, stream=None):
     # v-j rearrangement frame distribution 
-    vjframeDist = Counter(cloneAnnot['v-jframe'].tolist())        
+    vjframeDist = countColumn(cloneAnnot, 'v-jframe')        
     plotDist(vjframeDist, name, os.path.join(outputDir, name +
              '_vjframe_dist.csv'), title='V-D-J Rearrangement',
              proportion=False, rotateLabels=False, stream=stream)
     del vjframeDist
     # plot the family distribution of out-of-frame
     outOfFrame = cloneAnnot[cloneAnnot['v-jframe'] != 'In-frame']
-    outOfFrameFamilyDist = compressCountsFamilyLevel(Counter(outOfFrame['vgene'].tolist()))
+    outOfFrameFamilyDist = compressCountsFamilyLevel(countColumn(outOfFrame, 'vgene'))
     plotDist(outOfFrameFamilyDist, name, os.path.join(outputDir, name +
              '_igv_dist_out_of_frame.csv'),
               title='IGV Abundance of Out-Of-frame Clones',
              proportion=True, stream=stream)
     del outOfFrameFamilyDist
     # Indels in CDR1 and FR1    
-    cdrGaps = Counter(outOfFrame['cdr1.gaps'].tolist())
+    cdrGaps = countColumn(outOfFrame, 'cdr1.gaps')
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr1_gaps_dist_out_of_frame.csv'), title='Gaps in CDR1',
              proportion=False, rotateLabels=False, stream=stream)
-    frGaps = Counter(outOfFrame['fr1.gaps'].tolist())
+    frGaps = countColumn(outOfFrame, 'fr1.gaps')
     plotDist(frGaps, name, os.path.join(outputDir, name +
              '_fr1_gaps_dist_out_of_frame.csv'), title='Gaps in FR1',
              proportion=False, rotateLabels=False, stream=stream)
     del  cdrGaps, frGaps
     # Indels in CDR2 and FR2
-    cdrGaps = Counter(outOfFrame['cdr2.gaps'].tolist())
+    cdrGaps = countColumn(outOfFrame, 'cdr2.gaps')
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr2_gaps_dist_out_of_frame.csv'), title='Gaps in CDR2',
              proportion=False, rotateLabels=False, stream=stream)
-    frGaps = Counter(outOfFrame['fr2.gaps'].tolist())
+    frGaps = countColumn(outOfFrame, 'fr2.gaps')
     plotDist(frGaps, name, os.path.join(outputDir, name +
              '_fr2_gaps_dist_out_of_frame.csv'), title='Gaps in FR2',
              proportion=False, rotateLabels=False, stream=stream)
     del cdrGaps, frGaps
     # Indels in CDR3 and FR3
-    cdrGaps = Counter(outOfFrame['cdr3g.gaps'])
+    cdrGaps = countColumn(outOfFrame, 'cdr3g.gaps')
 #         print(len(cdrGaps))
     plotDist(cdrGaps, name, os.path.join(outputDir, name +
              '_cdr3_gaps_dist_out_of_frame.csv'), title='Gaps in CDR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
-    frGaps = Counter(outOfFrame['fr3g.gaps'].tolist())
+    frGaps = countColumn(outOfFrame, 'fr3g.gaps')
     plotDist(frGaps, name, os.path.join(outputDir, name +
              '_fr3_gaps_dist_out_of_frame.csv'), title='Gaps in FR3 (Germline)',
              proportion=False, rotateLabels=False, stream=stream)
@@ -221,13 +223,13 @@ def extractProductiveClones(cloneAnnot, name, outputDir, stream=None):
     # choose only In-frame RNA clones
     inFrame = cloneAnnot[cloneAnnot['v-jframe'] == 'In-frame']
     # Stop Codon 
-    stopcodonInFrameDist = Counter(inFrame['stopcodon'].tolist())
+    stopcodonInFrameDist = countColumn(inFrame, 'stopcodon')
     plotDist(stopcodonInFrameDist, name, os.path.join(outputDir,  name +
              '_stopcodon_dist_in_frame.csv'), title='Stop Codons in In-frame Clones',
              proportion=False, rotateLabels=False, stream=stream)
     
     # stop codon family distribution
-    stopcodFamily = Counter(inFrame[inFrame['stopcodon'] == 'Yes']['vgene'].tolist())
+    stopcodFamily = countColumn(inFrame[inFrame['stopcodon'] == 'Yes'], 'vgene')
     stopcodFamily = compressCountsFamilyLevel(stopcodFamily)
     plotDist(stopcodFamily, name, os.path.join(outputDir, name +
              '_igv_dist_inframe_unproductive.csv'),
@@ -260,9 +262,12 @@ def writeStopCodonStats(cloneAnnot, cloneSeqs, name, outputDir, inframe, stream=
 
     counter = {}
     frameStatus = 'In-frame' if inframe else 'Out-of-frame'
-    cloneSeqs = cloneSeqs.loc[cloneAnnot[cloneAnnot['v-jframe'] == frameStatus].index]
+    cloneAnnot = cloneAnnot[cloneAnnot['v-jframe'] == frameStatus]
+    cloneSeqs = cloneSeqs.loc[cloneAnnot.index]
+    counts = cloneCounts(cloneAnnot)
     for region in regions:
-        counter[region] = sum(cloneSeqs[region.lower()].str.contains("*", regex=False))
+        hasStop = cloneSeqs[region.lower()].str.contains("*", regex=False)
+        counter[region] = sum(hasStop) if counts is None else int(counts[hasStop.values].sum())
     orderedCounter = OrderedDict((reg, counter[reg]) for reg in regions)
     plotDist(orderedCounter, name, os.path.join(outputDir, name
              + '_stopcodon_region_{}.csv').format('inframe' if inframe else 'outframe'),
@@ -20,6 +20,7 @@ def generateOverlapFigures(overlapResults, noSeqs, name, siteHitsFile, stream=No
                            that is identical (i.e. a "named matrix") - see calcRSAOverlapOrder2's return value
             }
             "order1" is always there, "order2" only appears if the number of enzymes is at least 3(len(sitesInfo)) >= 3)
+            "weights" : {'seq_id1': number of reads, ...}, only there if identical reads were collapsed
     :param noSeqs: total number of sequences
     :param name: string. sample name
     :param siteHitsFile: string. output file name
@@ -34,7 +35,8 @@ def generateOverlapFigures(overlapResults, noSeqs, name, siteHitsFile, stream=No
         # Ven Diagram of overlapping sequences
         title = 'Restriction sites in Sample ' + name
         title += '\nTotal is {:,}'.format(int(noSeqs))
-        plotVenn(overlapResults["order1"], siteHitsFile.replace('.csv', '_venn.png'), title, stream=stream)
+        plotVenn(overlapResults["order1"], siteHitsFile.replace('.csv', '_venn.png'), title,
+                 weights=overlapResults.get("weights"), stream=stream)
 
     # if order2 is in overlapResults, then it implies that there's AT LEAST 3 enzymes
     if "order2" in overlapResults:
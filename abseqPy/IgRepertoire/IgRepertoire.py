@@ -7,33 +7,38 @@
 from __future__ import division
 import gc
 import os
+import glob
 import logging
 import sys
 import inspect
 
-from collections import Counter, defaultdict
 from Bio import SeqIO
 from pandas.io.parsers import read_csv
-from pandas.io.pytables import read_hdf
 from numpy import Inf, logical_not
 
 from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
 from abseqPy.IgRepAuxiliary.upstreamAuxiliary import plotUpstreamLenDist, extractUpstreamSeqs, \
     findUpstreamMotifs
 from abseqPy.IgRepAuxiliary.primerAuxiliary import addPrimerData, generatePrimerPlots
-from abseqPy.config import FASTQC, AUX_FOLDER, HDF_FOLDER, DEFAULT_TASK, DEFAULT_MERGER, DEFAULT_TOP_CLONE_VALUE
-from abseqPy.IgRepertoire.igRepUtils import gunzip, fastq2fasta, mergeReads, \
-    writeListToFile, writeSummary, createIfNot, detectFileFormat, countSeqs
-from abseqPy.versionManager import writeParams
+from abseqPy.config import FASTQC, AUX_FOLDER, HDF_FOLDER, DEFAULT_TASK, DEFAULT_MERGER, DEFAULT_TOP_CLONE_VALUE, \
+    VERSION
+from abseqPy.IgRepertoire.cloneStore import saveFrame, loadFrame, frameLength, evaluatePredicates, frameFile
+from abseqPy.IgRepertoire.igRepUtils import mergeReads, safeOpen, \
+    writeListToFile, writeSummary, createIfNot, detectFileFormat, countSeqs, collapseDuplicates, cloneCounts, \
+    totalReads, germlineFingerprint
+from abseqPy.IgRepertoire.stageManifest import StageManifest, fingerprint, fileFingerprint
+from abseqPy.versionManager import writeParams, softwareVersion
 from abseqPy.logger import printto, setupLogger, LEVEL
 from abseqPy.IgRepAuxiliary.productivityAuxiliary import refineClonesAnnotation
 from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, plotSeqLenDistClasses, eitherExists
 from abseqPy.IgRepAuxiliary.annotateAuxiliary import annotateIGSeqRead
+from abseqPy.IgRepAuxiliary.annotationCache import annotateIGSeqReadCached
 from abseqPy.IgRepReporting.abundanceReport import writeAbundanceToFiles
 from abseqPy.IgRepReporting.productivityReport import generateProductivityReport
 from abseqPy.IgRepReporting.diversityReport import generateDiversityReport
+from abseqPy.IgRepAuxiliary.histograms import lengthHistogram
 from abseqPy.IgRepAuxiliary.diversityAuxiliary import annotateSpectratypes, \
-    annotateClonotypes
+    clonotypeTable
 from abseqPy.IgRepAuxiliary.restrictionAuxiliary import scanRestrictionSites
 from abseqPy.IgRepReporting.restrictionReport import generateOverlapFigures
 from abseqPy.utilities import ShortOpts, quote
@@ -55,13 +60,53 @@ class IgRepertoire:
     creates an AbSeq.IgRepertoire object with QC methods
     """
 
+    # filtering criteria, re-applied whenever an annotation is loaded
+    _FILTERS = ('bitscore', 'alignlen', 'sstart', 'qstart')
+
+    # what the outputs of a sample are computed from: (keys of the outputs they are derived from, parameters, tools).
+    # The first keys are the intermediate outputs under hdfDir, the others are the stages and their reports under
+    # auxDir. Files among the parameters are fingerprinted too, a change in any of them propagates downstream
+    _lineage = {
+        'reads': ((), ('f1', 'f2', 'fmt', 'merger'), ('merger',)),
+        'annotation': (('reads',), ('chain', 'seqtype', 'database', 'domainSystem', 'dedup', 'store'), ('igblast',)),
+        'refinement': (('annotation',), ('chain', 'actualqstart', 'fr4cut', 'trim5', 'trim3', 'store'), ()),
+        'primerAnnotation': (('annotation',), ('actualqstart', 'fr4cut', 'trim5', 'trim3', 'primer5end', 'primer3end',
+                                               'primer5endoffset', 'store'), ()),
+        'secretion': (('annotation',), _FILTERS + ('upstream',), ()),
+        'utr5': (('annotation',), _FILTERS + ('upstream',), ()),
+        AbSeqWorker.FASTQC: ((), ('f1', 'f2'), ('fastqc',)),
+        AbSeqWorker.MERGE: (('reads',), (), ()),
+        AbSeqWorker.ANNOT: (('annotation',), _FILTERS, ()),
+        AbSeqWorker.ABUN: (('annotation',), _FILTERS, ()),
+        AbSeqWorker.PROD: (('refinement',), _FILTERS, ()),
+        AbSeqWorker.DIVER: (('refinement',), _FILTERS + ('clonelimit', 'detailedComposition', 'rarefactionbootstrap'),
+                            ()),
+        AbSeqWorker.SECR: (('secretion',), (), ()),
+        AbSeqWorker.UTR5: (('utr5',), (), ()),
+        AbSeqWorker.RSA: (('refinement',), _FILTERS + ('sites',), ()),
+        AbSeqWorker.PRIM: (('primerAnnotation',), _FILTERS, ()),
+        AbSeqWorker.SEQLEN: (('reads',), (), ())
+    }
+
+    # report directories (under auxDir) of the stages that do not share theirs
+    _reportDirs = {
+        AbSeqWorker.FASTQC: 'fastqc',
+        AbSeqWorker.ABUN: 'abundance',
+        AbSeqWorker.PROD: 'productivity',
+        AbSeqWorker.DIVER: 'diversity',
+        AbSeqWorker.SECR: 'secretion',
+        AbSeqWorker.UTR5: 'utr5',
+        AbSeqWorker.PRIM: 'primer_specificity'
+    }
+
     def __init__(self, f1, f2=None, name=None, fmt=None, chain='hv', seqtype='dna', domainSystem='imgt',
                  merger=DEFAULT_MERGER, outdir='.', threads=1, bitscore=(0, Inf), alignlen=(0, Inf),
                  sstart=(1, Inf), qstart=(1, Inf), clonelimit=DEFAULT_TOP_CLONE_VALUE, detailedComposition=False,
                  actualqstart=-1, trim5=0, trim3=0,
                  fr4cut=True, primer5endoffset=0, primer5end=None, primer3end=None,
                  upstream=None, sites=None, database="$IGBLASTDB", task=DEFAULT_TASK, log=None,
-                 yaml=None):
+                 yaml=None, igblaststream='off', annotcache=None, dedup=False, memory=None, store='hdf',
+                 rarefactionbootstrap=0):
         """
 
         :param f1: string
@@ -155,6 +200,28 @@ class IgRepertoire:
                                 path to logger file
         :param yaml: string
                                 dummy variable. Used in commandline mode
+        :param igblaststream: string
+                                off, on or keep. If on, IgBLAST's output is parsed directly from a pipe instead
+                                of being written to (and re-read from) .out files. keep does the same but also
+                                retains a gzip-compressed copy of IgBLAST's raw output
+        :param annotcache: string
+                                path to an SQLite annotation cache. If provided, only sequences that were not
+                                annotated before (with the same germline database and IgBLAST parameters) are
+                                sent to IgBLAST. The cache is created if it does not exist
+        :param dedup: bool
+                                if True, reads with identical sequences are annotated and refined only once. Every
+                                annotation row then carries a count column, used to weigh the abundance,
+                                productivity, diversity, primer specificity, upstream (secretion signal and 5'UTR)
+                                and restriction site analyses so that they are reported in number of reads
+        :param memory: float
+                                memory budget in GB of a multi-sample run, used by IgMultiRepertoire to decide
+                                which stages can run at the same time
+        :param store: string
+                                hdf or parquet, storage format of the clone annotation and sequence dataframes
+                                (see cloneStore.STORES)
+        :param rarefactionbootstrap: int
+                                number of sampled rarefaction curves used for the 95% confidence bands of the
+                                rarefaction plots. 0 plots the expected curves only
         """
         fargs, _, _, values = inspect.getargvalues(inspect.currentframe())
         self.args = dict([(arg, values[arg]) for arg in fargs if arg != 'self'])
@@ -185,11 +252,16 @@ class IgRepertoire:
         self.qStart = qstart
         self.seqType = seqtype
         self.domainSystem = domainSystem
+        self.igblastStream = igblaststream
+        self.annotCache = annotcache
+        self.dedup = dedup
+        self.store = store
 
         self.upstream = upstream
         self.sitesFile = sites
 
         self.detailedComposition = detailedComposition
+        self.rarefactionBootstrap = rarefactionbootstrap
 
         self.actualQstart = actualqstart
 
@@ -215,6 +287,29 @@ class IgRepertoire:
         writeParams(self.args, self.auxDir)
         self._tasks = self._setupTasks()
         self._summaryFile = os.path.join(self.auxDir, "summary.txt")
+        self._manifest = StageManifest(self.auxDir)
+
+    def runStage(self, op, kwargs=None):
+        """
+        runs one stage of the analysis, unless it has completed before with the same inputs, parameters and tool
+        versions (see IgRepertoire._lineage). Otherwise its previous reports are removed first, report files that
+        exist are not rewritten by the analyses
+
+        :param op: string, one of AbSeqWorker.ops
+        :param kwargs: dict, keyword arguments of op
+        :return: None
+        """
+        logger = logging.getLogger(self.name)
+        kwargs = kwargs or {}
+        key = op + ''.join("({}={})".format(k, v) for k, v in sorted(kwargs.items()))
+        stageFingerprint = self._fingerprint(op, sorted(kwargs.items()))
+        if self._manifest.current(key, stageFingerprint):
+            printto(logger, "{} has already been performed with the same inputs and parameters, skipping ..."
+                    .format(key), LEVEL.WARN)
+            return
+        self._manifest.discard(key, self._stageOutputs(op, kwargs))
+        getattr(self, op)(**kwargs)
+        self._manifest.record(key, stageFingerprint, self._stageOutputs(op, kwargs))
 
     def runFastqc(self):
         logger = logging.getLogger(self.name)
@@ -249,8 +344,11 @@ class IgRepertoire:
     def mergePairedReads(self):
         logger = logging.getLogger(self.name)
         if self.merge:
+            seqDir = os.path.join(self.hdfDir, "seq")
+            self._refresh('reads', seqDir)
             mergedFastq = mergeReads(self.readFile1, self.readFile2,
                                      self.threads, self.merger, self.hdfDir, stream=logger)
+            self._record('reads', seqDir)
             self.readFile = mergedFastq
         else:
             self.readFile = self.readFile1
@@ -275,12 +373,14 @@ class IgRepertoire:
         outResDir = os.path.join(self.auxDir, "annot")
         outHdfDir = os.path.join(self.hdfDir, "annot")
 
+        self._refresh('annotation', outHdfDir)
+
         if not os.path.isdir(outResDir):
             os.makedirs(outResDir)
         if not os.path.isdir(outHdfDir):
             os.makedirs(outHdfDir)
 
-        cloneAnnotFile = os.path.join(outHdfDir, self.name + "_clones_annot.h5")
+        cloneAnnotFile = frameFile(os.path.join(outHdfDir, self.name + "_clones_annot"), self.store)
 
         if self.readFile is None:
             self.mergePairedReads()
@@ -295,48 +395,74 @@ class IgRepertoire:
             else:
                 printto(logger, "\tClones annotation file found and being loaded ... " +
                         os.path.basename(cloneAnnotFile))
-                self.cloneAnnot = read_hdf(cloneAnnotFile, "cloneAnnot")
+                self.cloneAnnot = loadFrame(cloneAnnotFile, "cloneAnnot")
             # write (update) number of annotated reads - this is possible because we always
             # save the unfiltered cloneannot dataframe, and re-filter after reloading
-            writeSummary(self._summaryFile, "AnnotatedReads", self.cloneAnnot.shape[0])
+            writeSummary(self._summaryFile, "AnnotatedReads", totalReads(self.cloneAnnot))
         else:
             if not os.path.exists(self.readFile):
                 raise Exception(self.readFile + " does not exist!")
 
-            # Convert FASTQ file into FASTA format
-            if self.format == 'fastq':
-                readFasta = fastq2fasta(self.readFile, self.hdfDir, stream=logger)
-            elif self.format == 'fasta':
-                # unzip the fasta file if need be
-                readFasta = gunzip(self.readFile)
-            else:
+            if self.format not in ('fastq', 'fasta'):
                 raise Exception('unknown file format! ' + self.format)
+
+            # collapsed reads are kept with the merged reads (if any)
+            seqDir = os.path.join(self.hdfDir, "seq")
+            self._refresh('reads', seqDir)
+
+            # the reads are streamed to IgBLAST as FASTA as they are read (compressed or not), no uncompressed or
+            # FASTA copy of the reads is made
+            readFasta, readFormat = self.readFile, self.format
             #             if self.trim3End > 0 or self.trim5End > 0:
             #                 trimSequences(readFasta)
             #                 self.trimmed = True
 
+            # annotate identical reads only once, their multiplicity is kept in the 'count' column
+            readCounts = None
+            if self.dedup:
+                readFasta, readCounts = collapseDuplicates(readFasta, self.hdfDir, format=readFormat, stream=logger)
+                readFormat = 'fasta'
+
             # Estimate the IGV family abundance for each library
-            (self.cloneAnnot, filteredIDs) = annotateIGSeqRead(readFasta, self.chain, self.db, self.threads,
-                                                               self.seqsPerFile, self.seqType, outdir=outHdfDir,
-                                                               domainSystem=self.domainSystem,
-                                                               stream=logger)
+            if self.annotCache:
+                (self.cloneAnnot, filteredIDs, hits, misses) = \
+                    annotateIGSeqReadCached(readFasta, self.chain, self.db, self.threads, self.seqsPerFile,
+                                            self.annotCache, self.seqType, outdir=outHdfDir,
+                                            domainSystem=self.domainSystem, igblastStream=self.igblastStream,
+                                            format=readFormat, stream=logger)
+                writeSummary(self._summaryFile, "AnnotationCacheHits", hits)
+                writeSummary(self._summaryFile, "AnnotationCacheMisses", misses)
+            else:
+                (self.cloneAnnot, filteredIDs) = annotateIGSeqRead(readFasta, self.chain, self.db, self.threads,
+                                                                   self.seqsPerFile, self.seqType, outdir=outHdfDir,
+                                                                   domainSystem=self.domainSystem,
+                                                                   igblastStream=self.igblastStream,
+                                                                   format=readFormat, stream=logger)
             sys.stdout.flush()
             gc.collect()
 
+            if os.path.isdir(seqDir):
+                self._record('reads', seqDir)
+
+            if readCounts is not None and self.cloneAnnot.shape[0] > 0:
+                self.cloneAnnot['count'] = [readCounts[qid] for qid in self.cloneAnnot.index]
+            del readCounts
+
             if len(filteredIDs):
                 writeListToFile(filteredIDs, os.path.join(outHdfDir, self.name + "_unmapped_clones.txt"))
             # export the CDR/FR annotation to a file
             printto(logger, "\tClones annotation file is being written to " +
                     os.path.basename(cloneAnnotFile))
-            self.cloneAnnot.to_hdf(cloneAnnotFile, "cloneAnnot", mode='w')
+            saveFrame(self.cloneAnnot, cloneAnnotFile, "cloneAnnot")
+            self._record('annotation', outHdfDir)
             paramFile = writeParams(self.args, outResDir)
             printto(logger, "The analysis parameters have been written to " + paramFile)
 
             # write number of annotated reads
-            writeSummary(self._summaryFile, "AnnotatedReads", self.cloneAnnot.shape[0])
+            writeSummary(self._summaryFile, "AnnotatedReads", totalReads(self.cloneAnnot))
 
         printto(logger, "Number of clones that are annotated is {0:,}".format(
-            int(self.cloneAnnot.shape[0])), LEVEL.INFO)
+            totalReads(self.cloneAnnot)), LEVEL.INFO)
 
         if self.cloneAnnot.shape[0] <= 0:
             return
@@ -347,29 +473,35 @@ class IgRepertoire:
         filteredIDs = self.cloneAnnot[logical_not(selectedRows)]
 
         if len(filteredIDs) > 0:
-            filteredIDs = filteredIDs[['vgene', 'vstart', 'vqstart', 'bitscore', 'alignlen']]
+            filteredIDs = filteredIDs[['vgene', 'vstart', 'vqstart', 'bitscore', 'alignlen'] +
+                                      (['count'] if cloneCounts(filteredIDs) is not None else [])]
             filteredIDs.to_csv(os.path.join(filterOutDir, self.name + "_filtered_out_clones.txt"),
                                sep="\t", header=True, index=True)
 
-        retained = int(self.cloneAnnot.shape[0]) - len(filteredIDs)
+        before = totalReads(self.cloneAnnot)
+        retained = before - totalReads(filteredIDs)
 
         printto(logger, 'Percentage of retained clones is {:.2%} ({:,}/{:,})'.format(
-            retained / self.cloneAnnot.shape[0],
+            retained / before,
             retained,
-            int(self.cloneAnnot.shape[0])), LEVEL.INFO)
+            before), LEVEL.INFO)
 
         self.cloneAnnot = self.cloneAnnot[selectedRows]
 
         # generate plot of clone sequence length distribution
         outputFile = os.path.join(outResDir, self.name + '_all_clones_len_dist.csv')
         noOutlierOutputFile = os.path.join(outResDir, self.name + '_all_clones_len_dist_no_outliers.csv')
-        seqLengths = defaultdict(int)
         if not eitherExists(outputFile) or not eitherExists(noOutlierOutputFile):
-            for record in SeqIO.parse(gunzip(self.readFile), self.format):
-                if record.id in self.cloneAnnot.index:
-                    seqLengths[len(record)] += 1
+            counts = cloneCounts(self.cloneAnnot)
+            counts = None if counts is None else counts.to_dict()
+            seqLengths, weights = [], []
+            with safeOpen(self.readFile) as fp:
+                for record in SeqIO.parse(fp, self.format):
+                    if record.id in self.cloneAnnot.index:
+                        seqLengths.append(len(record))
+                        weights.append(1 if counts is None else counts[record.id])
 
-            count = Counter(seqLengths)
+            count = lengthHistogram(seqLengths, weights)
 
             plotSeqLenDist(count, self.name, outputFile, self.format,
                            maxbins=40, histtype='bar', removeOutliers=False,
@@ -388,7 +520,7 @@ class IgRepertoire:
             self.cloneAnnot = self.cloneAnnot[(self.cloneAnnot['stopcodon'] == "No") &
                                               (self.cloneAnnot['v-jframe'] == "In-frame")]
         # finally, write number of filtered reads
-        writeSummary(self._summaryFile, "FilteredReads", self.cloneAnnot.shape[0])
+        writeSummary(self._summaryFile, "FilteredReads", totalReads(self.cloneAnnot))
 
     def analyzeAbundance(self):
         # Estimate the IGV family abundance for each library
@@ -401,7 +533,7 @@ class IgRepertoire:
         createIfNot(outHdfDir)
 
         if self.cloneAnnot is None:
-            self.annotateClones(outHdfDir)
+            self._loadAnnot(outHdfDir)
 
         if self.cloneAnnot.shape[0] > 0:
             writeAbundanceToFiles(self.cloneAnnot, self.name, outResDir, self.chain, stream=logger)
@@ -429,17 +561,20 @@ class IgRepertoire:
         outResDir = os.path.join(self.auxDir, "productivity")
         outHdfDir = os.path.join(self.hdfDir, "productivity")
 
+        self._refresh('refinement', outHdfDir)
+
         createIfNot(outResDir)
         createIfNot(outHdfDir)
 
-        refinedCloneAnnotFile = os.path.join(outHdfDir, self.name + "_refined_clones_annot.h5")
-        cloneSeqFile = os.path.join(outHdfDir, self.name + "_clones_seq.h5")
+        refinedCloneAnnotFile = frameFile(os.path.join(outHdfDir, self.name + "_refined_clones_annot"), self.store)
+        cloneSeqFile = frameFile(os.path.join(outHdfDir, self.name + "_clones_seq"), self.store)
 
         if not os.path.exists(refinedCloneAnnotFile) or not os.path.exists(cloneSeqFile):
             if self.cloneAnnot is None:
-                self.annotateClones(outHdfDir)
+                self._loadAnnot(outHdfDir)
             if self.cloneAnnot.shape[0] > 0:
                 self._reloadAnnot()
+                counts = self.cloneAnnot[['count']] if cloneCounts(self.cloneAnnot) is not None else None
                 #             if self.trimmed:
                 #                 self.trim3End = 0
                 #                 self.trim5End = 0
@@ -454,18 +589,24 @@ class IgRepertoire:
                                                                            self.trim5End, self.trim3End,
                                                                            self.seqsPerFile, self.threads,
                                                                            stream=logger)
+                # refinement rebuilds the annotation from its fields, carry the read counts over
+                if cloneCounts(counts) is not None:
+                    self.cloneAnnot['count'] = counts['count'].loc[self.cloneAnnot.index].values
+                del counts
                 gc.collect()
                 # if generateReport:
                 # export the CDR/FR annotation to a file
                 printto(logger, "The refined clone annotation file is being written to "
                         + os.path.basename(refinedCloneAnnotFile))
-                self.cloneAnnot.to_hdf(refinedCloneAnnotFile, "refinedCloneAnnot", mode='w', complib='blosc')
+                saveFrame(self.cloneAnnot, refinedCloneAnnotFile, "refinedCloneAnnot")
 
                 printto(logger, "The clone protein sequences are being written to " + os.path.basename(cloneSeqFile))
-                self.cloneSeqs.to_hdf(cloneSeqFile, "cloneSequences", mode='w', complib='blosc')
+                saveFrame(self.cloneSeqs, cloneSeqFile, "cloneSequences")
+                self._record('refinement', outHdfDir)
 
                 paramFile = writeParams(self.args, outResDir)
                 printto(logger, "The analysis parameters have been written to " + paramFile)
+                before = totalReads(self.cloneAnnot)
                 # although self.cloneAnnot is already filtered,
                 # reapply filtering because vqstart might've changed post refinement
                 printto(logger, "Applying filtering criteria to refined datafames")
@@ -476,31 +617,32 @@ class IgRepertoire:
             printto(logger, "The refined clone annotation files were found and being loaded ... " +
                     os.path.basename(refinedCloneAnnotFile))
 
-            self.cloneAnnot = read_hdf(refinedCloneAnnotFile, "refinedCloneAnnot")
+            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria,
+            # they are applied while the dataframe is being read
+            printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
+            before = frameLength(refinedCloneAnnotFile, "refinedCloneAnnot", weightColumn='count')
+            self.cloneAnnot = loadFrame(refinedCloneAnnotFile, "refinedCloneAnnot",
+                                        predicates=self._filterPredicates())
             printto(logger, "\tClone annotation was loaded successfully")
 
-            self.cloneSeqs = read_hdf(cloneSeqFile, "cloneSequences")
+            self.cloneSeqs = loadFrame(cloneSeqFile, "cloneSequences")
             printto(logger, "\tClone sequences were loaded successfully")
 
-            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria
-            printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
-
-        before = self.cloneAnnot.shape[0]
         if before > 0:
             selectedRows = self._cloneAnnotFilteredRows(logger)
             self.cloneAnnot = self.cloneAnnot[selectedRows]
             self.cloneSeqs = self.cloneSeqs.loc[self.cloneAnnot.index]
             printto(logger, "\tPercentage of retained clones is {:.2%} ({:,}/{:,})"
-                    .format(self.cloneAnnot.shape[0] / before, self.cloneAnnot.shape[0], before))
+                    .format(totalReads(self.cloneAnnot) / before, totalReads(self.cloneAnnot), before))
 
             # update number of filtered reads "POST REFINEMENT"
-            writeSummary(self._summaryFile, "FilteredReads", self.cloneAnnot.shape[0])
+            writeSummary(self._summaryFile, "FilteredReads", totalReads(self.cloneAnnot))
 
             # display statistics
             printto(logger, "Productivity report is being generated ... ")
             generateProductivityReport(self.cloneAnnot, self.cloneSeqs, self.name, self.chain, outResDir, stream=logger)
 
-            before = int(self.cloneAnnot.shape[0])
+            before = totalReads(self.cloneAnnot)
             inFrame = self.cloneAnnot[self.cloneAnnot['v-jframe'] == 'In-frame']
 
             # do not filter out "filtered" yet! - that has nothing to do with productivity
@@ -510,13 +652,13 @@ class IgRepertoire:
             else:
                 cloneAnnot = inFrame[inFrame['stopcodon'] == 'No']
             printto(logger, "Percentage of productive clones {:.2%} ({:,}/{:,})".format(
-                0 if before == 0 else cloneAnnot.shape[0] / before,
-                int(cloneAnnot.shape[0]),
-                int(before)
+                0 if before == 0 else totalReads(cloneAnnot) / before,
+                totalReads(cloneAnnot),
+                before
             ), LEVEL.INFO)
 
             # write number of productive reads
-            writeSummary(self._summaryFile, "ProductiveReads", cloneAnnot.shape[0])
+            writeSummary(self._summaryFile, "ProductiveReads", totalReads(cloneAnnot))
 
             # filter out "filtered" now
             if inplaceFiltered:
@@ -549,10 +691,11 @@ class IgRepertoire:
 
         # Identify clonotypes 
         printto(logger, "Clonotypes are being generated ... ")
-        clonoTypes = annotateClonotypes(self.cloneSeqs, segregate=self.detailedComposition, removeNone=True)
+        clonoTypes = clonotypeTable(self.cloneSeqs, removeNone=True, counts=cloneCounts(self.cloneAnnot))
 
         generateDiversityReport(spectraTypes, clonoTypes, self.name, outResDir, self.clonelimit,
-                                threads=self.threads, segregate=self.detailedComposition, stream=logger)
+                                threads=self.threads, segregate=self.detailedComposition,
+                                bootstrap=self.rarefactionBootstrap, stream=logger)
 
         # todo: remove this for now - it's unoptimized and extremely slow
         # writeClonotypeDiversityRegionAnalysis(self.cloneSeqs, self.name, outResDir, stream=logger)
@@ -571,11 +714,6 @@ class IgRepertoire:
 
         if not os.path.isdir(outHdfDir):
             os.makedirs(outHdfDir)
-        else:
-            # RSA uses filtered dataframes, and saves its data files with filtered results. If the user has changed
-            # any of their filtering criteria, they should remove or rename the directory before regenerating the files
-            printto(logger, "WARNING: remove the 'restriction_sites' directory if you changed the filtering criteria.",
-                    LEVEL.WARN)
 
         # enzyme, restriction site (seq), no. hits, percentage, no molecule, percentage of molecules
         siteHitsFile = os.path.join(outResDir, self.name + "_{}_rsa{}.csv"
@@ -609,7 +747,7 @@ class IgRepertoire:
             if self.cloneAnnot.shape[0] > 0:
                 (rsaResults, overlapResults) = scanRestrictionSites(self.name, self.readFile, self.cloneAnnot,
                                                                     self.sitesFile, self.threads, simple=simple,
-                                                                    stream=logger)
+                                                                    outDir=outHdfDir, stream=logger)
                 rsaResults.to_csv(siteHitsFile, header=True, index=False)
                 printto(logger, "RSA results were written to " + os.path.basename(siteHitsFile))
                 if "order2" in overlapResults:
@@ -633,16 +771,16 @@ class IgRepertoire:
         if not os.path.exists(outResDir):
             os.makedirs(outResDir)
 
+        # abseq loads the files in this directory if they are found, unless they were computed from other reads,
+        # annotations or filtering criteria
+        self._refresh('secretion', outHdfDir)
+
         if not os.path.exists(outHdfDir):
             os.makedirs(outHdfDir)
-        else:
-            # abseq will load the files in this directory if they are found, to reduce time recomputing them
-            printto(logger, "WARNING: Remove 'secretion' directory if you've changed the filtering criteria.",
-                    LEVEL.WARN)
 
         # need self.cloneAnnot dataframe for further analysis
         if self.cloneAnnot is None:
-            self.annotateClones(outHdfDir)
+            self._loadAnnot(outHdfDir)
 
         if self.cloneAnnot.shape[0] <= 0:
             printto(logger, "Skipping secretion signal analysis, no annotated sequences found.", level=LEVEL.WARN)
@@ -687,6 +825,7 @@ class IgRepertoire:
                 findUpstreamMotifs(upstreamFile, self.name, outHdfDir, outResDir, [1, expectLength - 1], level=level,
                                    startCodon=True, threads=self.threads, stream=logger)
 
+        self._record('secretion', outHdfDir)
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
@@ -699,16 +838,16 @@ class IgRepertoire:
         if not os.path.exists(outResDir):
             os.makedirs(outResDir)
 
+        # abseq loads the files in this directory if they are found, unless they were computed from other reads,
+        # annotations or filtering criteria
+        self._refresh('utr5', outHdfDir)
+
         if not os.path.exists(outHdfDir):
             os.makedirs(outHdfDir)
-        else:
-            # abseq will load the files in this directory if they are found, to reduce time recomputing them
-            printto(logger, "WARNING: Remove 'utr5' directory if you've changed the filtering criteria",
-                    LEVEL.WARN)
 
         # requires self.cloneAnnot dataframe for further analysis
         if self.cloneAnnot is None:
-            self.annotateClones(outHdfDir)
+            self._loadAnnot(outHdfDir)
 
         if self.cloneAnnot.shape[0] <= 0:
             printto(logger, "Skipping 5UTR analysis, no annotated sequences found.", level=LEVEL.WARN)
@@ -741,6 +880,7 @@ class IgRepertoire:
                                    level=level, startCodon=True, type='5utr', clusterMotifs=True,
                                    threads=self.threads, stream=logger)
 
+        self._record('utr5', outHdfDir)
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
@@ -750,20 +890,22 @@ class IgRepertoire:
         outResDir = os.path.join(self.auxDir, 'primer_specificity')
         outHdfDir = os.path.join(self.hdfDir, 'primer_specificity')
 
+        self._refresh('primerAnnotation', outHdfDir)
+
         createIfNot(outResDir)
         createIfNot(outHdfDir)
 
-        primerAnnotFile = os.path.join(outHdfDir, self.name + "_primer_annot.h5")
+        primerAnnotFile = frameFile(os.path.join(outHdfDir, self.name + "_primer_annot"), self.store)
 
         # if we can't find hdf file, create it, else read it
         if not os.path.exists(primerAnnotFile):
             # Load self.cloneAnnot for further analysis.
             # skip checking for existence of dataframes, analyzeProd/Abun will do it for us
             if self.cloneAnnot is None:
-                self.annotateClones(outHdfDir)
+                self._loadAnnot(outHdfDir)
 
             if self.cloneAnnot.shape[0] <= 0:
-                printto(logger, "Skipping 5UTR analysis, no annotated sequences found.", level=LEVEL.WARN)
+                printto(logger, "Skipping primer specificity analysis, no annotated sequences found.", level=LEVEL.WARN)
                 return
 
             # addPrimerData on an unfiltered self.cloneAnnot
@@ -773,27 +915,29 @@ class IgRepertoire:
             # before we begin primer analysis
             self.cloneAnnot = addPrimerData(self.cloneAnnot, self.readFile, self.format, self.fr4cut,
                                             self.trim5End, self.trim3End, self.actualQstart,
-                                            self.end5, self.end3, self.end5offset, self.threads, stream=logger)
+                                            self.end5, self.end3, self.end5offset, self.threads,
+                                            outDir=outHdfDir, stream=logger)
             # save new "primer column-ed dataframe" into primer_specificity directory
-            self.cloneAnnot.to_hdf(primerAnnotFile, "primerCloneAnnot", mode='w', complib='blosc')
+            saveFrame(self.cloneAnnot, primerAnnotFile, "primerCloneAnnot")
+            self._record('primerAnnotation', outHdfDir)
 
             # now we can safely apply the filter on self.cloneAnnot
             printto(logger, "\tApplying filtering criteria to primer specificity analysis dataframes")
+            before = totalReads(self.cloneAnnot)
         else:
             printto(logger, "The primer clone annotation files were found and being loaded ... ", LEVEL.WARN)
-            self.cloneAnnot = read_hdf(primerAnnotFile, "primerCloneAnnot")
-            printto(logger, "\tPrimer clone annotation loaded successfully")
-
-            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria
+            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria,
+            # they are applied while the dataframe is being read
             printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
+            before = frameLength(primerAnnotFile, "primerCloneAnnot", weightColumn='count')
+            self.cloneAnnot = loadFrame(primerAnnotFile, "primerCloneAnnot", predicates=self._filterPredicates())
+            printto(logger, "\tPrimer clone annotation loaded successfully")
 
-        before = self.cloneAnnot.shape[0]
         if before > 0:
             selectedRows = self._cloneAnnotFilteredRows(logger)
             self.cloneAnnot = self.cloneAnnot[selectedRows]
-            self.cloneSeqs = self.cloneSeqs.loc[self.cloneAnnot.index]
             printto(logger, "\tPercentage of retained clones is {:.2%} ({:,}/{:,})"
-                    .format(self.cloneAnnot.shape[0] / before, self.cloneAnnot.shape[0], before))
+                    .format(totalReads(self.cloneAnnot) / before, totalReads(self.cloneAnnot), before))
 
             # TODO: Fri Feb 23 17:13:09 AEDT 2018
             # TODO: check findBestMatchAlignment of primer specificity best match, see if align.localxx is used correctly!
@@ -845,17 +989,24 @@ class IgRepertoire:
         printto(logger, "\tAlignment length: " + repr(self.alignLen), LEVEL.INFO)
         printto(logger, "\tSubject V gene start: " + repr(self.sStart), LEVEL.INFO)
         printto(logger, "\tQuery V gene start: " + repr(self.qStart), LEVEL.INFO)
-        selectedRows = (
-                (self.cloneAnnot['bitscore'] >= self.bitScore[0]) &  # check bit-Score
-                (self.cloneAnnot['bitscore'] <= self.bitScore[1]) &
-                (self.cloneAnnot['alignlen'] >= self.alignLen[0]) &  # check alignment length
-                (self.cloneAnnot['alignlen'] <= self.alignLen[1]) &
-                (self.cloneAnnot['vstart'] >= self.sStart[0]) &  # check subject (V gene) start position
-                (self.cloneAnnot['vstart'] <= self.sStart[1]) &
-                (self.cloneAnnot['vqstart'] >= self.qStart[0]) &  # check query (V gene) start position
-                (self.cloneAnnot['vqstart'] <= self.qStart[1])
-        )
-        return selectedRows
+        return evaluatePredicates(self.cloneAnnot, self._filterPredicates())
+
+    def _filterPredicates(self):
+        """
+        the filtering criteria as (column, operator, value) predicates, see cloneStore.loadFrame.
+        All ranges are inclusive, unbounded ends are omitted
+        :return: list of tuples
+        """
+        predicates = []
+        for column, (lower, upper) in (('bitscore', self.bitScore),  # check bit-Score
+                                       ('alignlen', self.alignLen),  # check alignment length
+                                       ('vstart', self.sStart),  # check subject (V gene) start position
+                                       ('vqstart', self.qStart)):  # check query (V gene) start position
+            if lower != -Inf:
+                predicates.append((column, '>=', lower))
+            if upper != Inf:
+                predicates.append((column, '<=', upper))
+        return predicates
 
     def _getBestCloneAnnot(self, outHdfDir, inplaceFiltered, inplaceProductive, stream=None):
         """
@@ -863,7 +1014,7 @@ class IgRepertoire:
             1. if the refined dataframe exists, load it into self.cloneAnnot
             2. if the refined dataframe doesnt exist, but the unrefined one does, load that instead
             3. if the unrefined dataframe also doesn't exist, conduct the UNREFINED annotation step
-               (i.e. call self.annotateClones)
+               (i.e. call self.annotateClones, see self._loadAnnot)
 
         note that self.cloneAnnot will be filtered inplace if any of the inplace* arguments are true, to save space
 
@@ -882,7 +1033,8 @@ class IgRepertoire:
 
         :return: None
         """
-        refinedCloneAnnotFile = os.path.join(self.hdfDir, "productivity", self.name + "_refined_clones_annot.h5")
+        refinedCloneAnnotFile = frameFile(os.path.join(self.hdfDir, "productivity", self.name + "_refined_clones_annot"),
+                                          self.store)
         if os.path.exists(refinedCloneAnnotFile):
             printto(stream, "Found refined clone annotation file {}, loading dataframe ..."
                     .format(os.path.basename(refinedCloneAnnotFile)))
@@ -897,7 +1049,34 @@ class IgRepertoire:
             printto(stream, "\t\tFR1, FR2, FR3, FR4 consensus lengths: {}".format(str(inplaceFiltered)))
             printto(stream, "\t\tUnrefined productivity: {}".format(str(inplaceProductive)))
             # take the unrefined "productive" clones, since we do not have refined dataframe
-            self.annotateClones(outHdfDir, inplaceProductive=inplaceProductive)
+            self._loadAnnot(outHdfDir, inplaceProductive=inplaceProductive)
+
+    def _loadAnnot(self, filterOutDir, inplaceProductive=False):
+        """
+        populate self.cloneAnnot with the filtered annotation. If the annotation stage (annotateClones) has completed
+        with the current inputs and filtering criteria, it has already counted the reads, written the summary and
+        reported the filtered out clones, so the annotation is only loaded and filtered while it is read. Otherwise,
+        self.annotateClones is called
+
+        :param filterOutDir: string, see annotateClones
+        :param inplaceProductive: bool, see annotateClones
+        :return: None
+        """
+        cloneAnnotFile = frameFile(os.path.join(self.hdfDir, "annot", self.name + "_clones_annot"), self.store)
+        if not (os.path.exists(cloneAnnotFile) and
+                self._manifest.current(AbSeqWorker.ANNOT, self._fingerprint(AbSeqWorker.ANNOT, []))):
+            self.annotateClones(filterOutDir, inplaceProductive=inplaceProductive)
+            return
+        logger = logging.getLogger(self.name)
+        if self.readFile is None:
+            self.mergePairedReads()
+        printto(logger, "\tClones annotation file found and being loaded with the filtering criteria applied ... " +
+                os.path.basename(cloneAnnotFile))
+        self.cloneAnnot = loadFrame(cloneAnnotFile, "cloneAnnot", predicates=self._filterPredicates())
+        if inplaceProductive:
+            # un-refined "productivity" classification, as in annotateClones
+            self.cloneAnnot = self.cloneAnnot[(self.cloneAnnot['stopcodon'] == "No") &
+                                              (self.cloneAnnot['v-jframe'] == "In-frame")]
 
     def _reloadAnnot(self):
         """
@@ -909,29 +1088,75 @@ class IgRepertoire:
         :return: None
         """
         aux = os.path.join(self.hdfDir, "annot")
-        cloneAnnotFile = os.path.join(aux, self.name + "_clones_annot.h5")
+        cloneAnnotFile = frameFile(os.path.join(aux, self.name + "_clones_annot"), self.store)
         if os.path.exists(cloneAnnotFile):
-            self.cloneAnnot = read_hdf(cloneAnnotFile, "cloneAnnot")
+            self.cloneAnnot = loadFrame(cloneAnnotFile, "cloneAnnot")
         else:
             raise Exception("Cannot reload self.cloneAnnot, file {} not found".format(cloneAnnotFile))
 
-    def _minimize(self):
-        # XXX: cloneAnnot and cloneSeqs are the largest objects in a IgReportoire object,
-        # we remove them so that we can pickle them into the queue again.
-        # When needed, these files will be loaded automatically later on anyway
-        self.cloneAnnot = None
-        self.cloneSeqs = None
+    def _fingerprint(self, key, *extra):
+        """
+        :param key: string, a key of IgRepertoire._lineage
+        :param extra: other values the output depends on (e.g. a stage's keyword arguments)
+        :return: string, fingerprint of the inputs, parameters and tool versions that key is computed from
+        """
+        upstream, params, tools = self._lineage[key]
+        values = {}
+        for param in params:
+            value = self.args[param]
+            if param == 'database':
+                # the germline files IgBLAST reads, by their contents (as the annotation cache does)
+                value = germlineFingerprint(self.db, self.chain, protein=self.seqType.lower() != 'dna')
+            elif isinstance(value, str) and os.path.exists(os.path.expandvars(value)):
+                value = fileFingerprint(os.path.expandvars(value))
+            values[param] = value
+        # 'merger' stands for the merger in use
+        tools = [self.merger if tool == 'merger' else tool for tool in tools]
+        versions = dict((tool, softwareVersion(tool)) for tool in tools if tool)
+        return fingerprint(key, VERSION, values, versions, [self._fingerprint(dep) for dep in upstream], list(extra))
+
+    def _refresh(self, key, *outputs):
+        """
+        :param key: string, a key of IgRepertoire._lineage
+        :param outputs: files or directories produced under key
+        :return: bool, True if the outputs are current and can be reused. Otherwise they are removed, they were
+                 computed from other inputs or parameters (or by a version of abseqPy without a manifest)
+        """
+        if self._manifest.current(key, self._fingerprint(key)):
+            return True
+        if any(os.path.exists(output) for output in outputs):
+            printto(logging.getLogger(self.name), "\tPrevious {} outputs are out of date and will be recomputed"
+                    .format(key), LEVEL.WARN)
+        self._manifest.discard(key, outputs)
+        return False
+
+    def _record(self, key, *outputs):
+        """
+        :param key: string, a key of IgRepertoire._lineage
+        :param outputs: files or directories produced under key
+        :return: None
+        """
+        self._manifest.record(key, self._fingerprint(key), outputs)
 
-    def _nextTask(self):
-        if len(self._tasks) > 0:
-            pack = self._tasks.pop()
-            if isinstance(pack, str):
-                return pack, [], {}
-            else:
-                # type(pack) = tuple: (str, dict) - see SeqLenClass
-                return pack[0], [], pack[1]
-        else:
-            return None, [], {}
+    def _stageOutputs(self, op, kwargs):
+        """
+        :param op: string, one of AbSeqWorker.ops
+        :param kwargs: dict, keyword arguments of op
+        :return: list of the reports of a stage (files or directories)
+        """
+        annotPrefix = os.path.join(self.auxDir, 'annot', self.name)
+        if op == AbSeqWorker.ANNOT:
+            return glob.glob(annotPrefix + '_all_clones_len_dist*')
+        elif op == AbSeqWorker.SEQLEN:
+            return glob.glob(annotPrefix + '_seq_length_dist*')
+        elif op == AbSeqWorker.RSA:
+            sites = os.path.splitext(os.path.basename(self.sitesFile))[0]
+            return glob.glob(os.path.join(self.auxDir, 'restriction_sites', self.name + "_{}_rsa{}*"
+                                          .format(sites, 'simple' if kwargs.get('simple') else 'detailed')))
+        elif op in self._reportDirs:
+            return [os.path.join(self.auxDir, self._reportDirs[op])]
+        # merged reads are an intermediate output
+        return []
 
     def _setupTasks(self):
         logger = logging.getLogger(self.name)
@@ -972,8 +1197,19 @@ class IgRepertoire:
                             "analysis in addition to {} ... ".format(self.task), LEVEL.INFO)
             todo.append(AbSeqWorker.PRIM)
 
-        # reverse it so that the first to be popped out is the original first element
-        return todo[::-1]
+        # the reads are annotated once, by their own stage, before any of the analyses that need the annotation.
+        # Otherwise these analyses would all annotate the reads at the same time, into the same directory
+        ops = [task if isinstance(task, str) else task[0] for task in todo]
+        if AbSeqWorker.ANNOT not in ops and \
+                any(AbSeqWorker.dependencies(op, [AbSeqWorker.ANNOT]) for op in ops):
+            todo.insert(0, AbSeqWorker.ANNOT)
+
+        # paired-end reads are merged once, before any of the analyses that need them
+        if self.merge and any(task != AbSeqWorker.FASTQC for task in todo):
+            todo.insert(0, AbSeqWorker.MERGE)
+
+        # (op, kwargs) tuples, in order
+        return [(task, {}) if isinstance(task, str) else task for task in todo]
 
     def analyzeIgProtein(self):
         raise NotImplementedError
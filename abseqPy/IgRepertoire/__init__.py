@@ -1,4 +1,6 @@
 __all__ = [
+    'cloneStore',
     'IgRepertoire',
-    'igRepUtils'
+    'igRepUtils',
+    'stageManifest'
 ]
@@ -0,0 +1,249 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+import operator
+import warnings
+
+import pandas as pd
+
+from tables import NaturalNameWarning
+
+
+# low cardinality string columns, stored dictionary-encoded
+CATEGORICAL_COLUMNS = ['vgene', 'dgene', 'jgene', 'chain', 'strand', 'stopcodon', 'v-jframe', 'filtered', 'germline']
+
+# columns that predicates can be pushed down to (they are indexed separately in the table)
+QUERYABLE_COLUMNS = ['bitscore', 'alignlen', 'vstart', 'vqstart', 'count']
+
+_OPERATORS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+
+# storage formats of the clone dataframes (-st / --store) and the extension of their files. saveFrame, loadFrame and
+# frameLength pick the backend from the extension of the file
+STORES = {
+    'hdf': '.h5',
+    'parquet': '.parquet'
+}
+
+
+def frameFile(prefix, store='hdf'):
+    """
+    :param prefix: string, path of the file without extension
+    :param store: string, one of STORES
+    :return: string, filename of a dataframe saved in the given format
+    """
+    return prefix + STORES[store]
+
+
+def saveFrame(df, filename, key, complib='blosc'):
+    """
+    writes a clone dataframe (cloneAnnot, cloneSeqs, ...) into a HDF5 table or a Parquet file, depending on the
+    extension of filename. Gene names and other low cardinality strings are dictionary-encoded and the filtering
+    columns can be queried (see loadFrame) without materializing the whole dataframe.
+
+    :param df: DataFrame
+    :param filename: string, overwritten
+    :param key: string, HDF5 key (not used by Parquet files, they hold a single dataframe)
+    :param complib: string, compression library of HDF5 files
+    :return: None
+    """
+    _backend(filename).save(df, filename, key, complib=complib)
+
+
+def loadFrame(filename, key, columns=None, predicates=None):
+    """
+    reads a dataframe written by saveFrame (or by DataFrame.to_hdf)
+
+    :param filename: string, HDF5 or Parquet file
+    :param key: string, HDF5 key
+    :param columns: list of column names to load, None for all columns
+    :param predicates: list of (column, operator, value) tuples, e.g. [('bitscore', '>=', 80)]. Only rows
+                satisfying all predicates are loaded
+    :return: DataFrame with the same dtypes as the saved dataframe
+    """
+    df = _backend(filename).load(filename, key, columns=columns, predicates=predicates or [])
+    for col in df.columns:
+        if str(df[col].dtype) == 'category':
+            df[col] = df[col].astype(object)
+    return df
+
+
+def frameLength(filename, key, weightColumn=None):
+    """
+    :param filename: string, HDF5 or Parquet file
+    :param key: string, HDF5 key
+    :param weightColumn: if the dataframe has this column, sum it instead of counting rows
+    :return: number of rows (or total count) in the saved dataframe, only the count column is loaded
+    """
+    return _backend(filename).length(filename, key, weightColumn=weightColumn)
+
+
+def _backend(filename):
+    return _ParquetBackend if filename.endswith(STORES['parquet']) else _HDFBackend
+
+
+def _encode(df):
+    encoded = df.copy(deep=False)
+    for col in CATEGORICAL_COLUMNS:
+        if col in encoded.columns and encoded[col].dtype == object:
+            encoded[col] = encoded[col].astype('category')
+    return encoded
+
+
+class _HDFBackend:
+    """
+    PyTables HDF5 files. The QUERYABLE_COLUMNS are stored as separate data columns, predicates on them are evaluated
+    by PyTables
+    """
+
+    @staticmethod
+    def save(df, filename, key, complib='blosc'):
+        encoded = _encode(df)
+        dataColumns = [col for col in QUERYABLE_COLUMNS if col in encoded.columns]
+        with warnings.catch_warnings():
+            # column names like fr1.start are not valid python identifiers, they are only ever queried by position
+            warnings.simplefilter('ignore', NaturalNameWarning)
+            try:
+                encoded.to_hdf(filename, key, mode='w', format='table', data_columns=dataColumns, complib=complib)
+            except (TypeError, ValueError):
+                # dataframes that cannot be written as a table (e.g. mixed-type columns) are written in the
+                # fixed format instead
+                df.to_hdf(filename, key, mode='w', complib=complib)
+
+    @staticmethod
+    def load(filename, key, columns=None, predicates=()):
+        with pd.HDFStore(filename, 'r') as store:
+            if store.get_storer(key).is_table:
+                pushed = [p for p in predicates if p[0] in QUERYABLE_COLUMNS]
+                remaining = [p for p in predicates if p[0] not in QUERYABLE_COLUMNS]
+                where = ' & '.join('({} {} {!r})'.format(*p) for p in pushed) or None
+                df = store.select(key, where=where, columns=_neededColumns(columns, remaining))
+            else:
+                # fixed format (files written by older versions), everything has to be loaded
+                df, remaining = store.select(key), predicates
+        return _select(df, columns, remaining)
+
+    @staticmethod
+    def length(filename, key, weightColumn=None):
+        with pd.HDFStore(filename, 'r') as store:
+            storer = store.get_storer(key)
+            if not storer.is_table:
+                df = store.select(key)
+                return df.shape[0] if weightColumn not in df.columns else int(df[weightColumn].sum())
+            if weightColumn in (storer.data_columns or []):
+                return int(store.select_column(key, weightColumn).sum())
+            return storer.nrows
+
+
+class _ParquetBackend:
+    """
+    Parquet files (requires pyarrow), read through a memory map. Only the row groups whose column statistics can
+    satisfy the predicates are read
+    """
+
+    # rows per row group, the granularity at which predicates skip data
+    ROW_GROUP_SIZE = 50000
+
+    @staticmethod
+    def save(df, filename, key, complib=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pandas(_encode(df), preserve_index=True), filename,
+                       row_group_size=_ParquetBackend.ROW_GROUP_SIZE)
+
+    @staticmethod
+    def load(filename, key, columns=None, predicates=()):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(filename, memory_map=True)
+        needed = _neededColumns(columns, predicates)
+        names = parquet.schema.names
+        groups = [i for i in range(parquet.num_row_groups)
+                  if _mayMatch(parquet.metadata.row_group(i), names, predicates)]
+        if len(groups) == parquet.num_row_groups:
+            table = parquet.read(columns=needed, use_pandas_metadata=True)
+        elif groups:
+            table = _concatTables([parquet.read_row_group(i, columns=needed, use_pandas_metadata=True)
+                                   for i in groups])
+        else:
+            # nothing matches, read an empty slice to keep the columns and their types
+            table = parquet.read_row_group(0, columns=needed, use_pandas_metadata=True).slice(0, 0)
+        return _select(table.to_pandas(), columns, predicates)
+
+    @staticmethod
+    def length(filename, key, weightColumn=None):
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(filename, memory_map=True)
+        if weightColumn in parquet.schema.names:
+            return int(parquet.read(columns=[weightColumn]).column(0).to_pandas().sum())
+        return parquet.metadata.num_rows
+
+
+def _concatTables(tables):
+    import pyarrow as pa
+    return pa.concat_tables(tables)
+
+
+def _mayMatch(rowGroup, names, predicates):
+    """
+    :param rowGroup: pyarrow RowGroupMetaData
+    :param names: list of column names of the file, in the order of its columns
+    :param predicates: list of (column, operator, value) tuples
+    :return: bool, False if the statistics of the row group rule out every row for one of the predicates
+    """
+    for column, op, value in predicates:
+        if column not in QUERYABLE_COLUMNS or column not in names or op not in ('>=', '<=', '>', '<', '=='):
+            continue
+        stats = rowGroup.column(names.index(column)).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if (op in ('>=', '>') and not _OPERATORS[op](stats.max, value)) or \
+                (op in ('<=', '<') and not _OPERATORS[op](stats.min, value)) or \
+                (op == '==' and not stats.min <= value <= stats.max):
+            return False
+    return True
+
+
+def _neededColumns(columns, predicates):
+    """
+    :return: columns and the columns of predicates, None (every column) if columns is None
+    """
+    if columns is None:
+        return None
+    return list(columns) + [p[0] for p in predicates if p[0] not in columns]
+
+
+def _select(df, columns, predicates):
+    """
+    :return: the rows of df that satisfy predicates, restricted to columns (all of them if None)
+    """
+    if predicates:
+        df = df[evaluatePredicates(df, predicates)]
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def evaluatePredicates(df, predicates):
+    """
+    :param df: DataFrame
+    :param predicates: list of (column, operator, value) tuples
+    :return: boolean Series, True for rows of df satisfying all predicates
+
+    >>> df = pd.DataFrame({'bitscore': [10, 50, 90], 'vstart': [1, 3, 1]})
+    >>> evaluatePredicates(df, [('bitscore', '>=', 20), ('vstart', '<=', 2)]).tolist()
+    [False, False, True]
+    """
+    selected = pd.Series(True, index=df.index)
+    for column, op, value in predicates:
+        selected &= _OPERATORS[op](df[column], value)
+    return selected
@@ -7,6 +7,9 @@
 from __future__ import print_function
 
 import gzip
+import json
+import fcntl
+import hashlib
 import shutil
 import glob
 import re
@@ -14,19 +17,22 @@ import os
 import sys
 
 from os.path import exists
+from contextlib import contextmanager
 from Bio import SeqIO, AlignIO
 from subprocess import CalledProcessError
-from pandas.core.frame import DataFrame
-from numpy import isnan, nan
+from pandas import DataFrame, Series
+from numpy import isnan, nan, argsort
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
-from collections import Counter, defaultdict
+from collections import Counter
+from itertools import islice
 from Bio.pairwise2 import align, format_alignment
 from Bio.SubsMat import MatrixInfo as matlist
 
+from abseqPy.IgRepAuxiliary.fr4Search import localAlignment, PROTEIN_GAP, DNA_MATCH, DNA_MISMATCH, DNA_GAP
 from abseqPy.config import CLUSTALOMEGA, IGBLASTN, IGBLASTP, LEEHOM, PEAR, FLASH
 from abseqPy.logger import printto, LEVEL
-from abseqPy.utilities import hasLargeMem, ShortOpts, quote
+from abseqPy.utilities import ShortOpts, quote
 
 
 def detectFileFormat(fname, noRaise=False):
@@ -114,44 +120,6 @@ def gunzip(gzipFile):
     return newFileName
 
 
-def fastq2fasta(fastqFile, outputDir, stream=None):
-    """
-    Converts a fastq file into fasta file. Fastq can be compressed if it was provided as such
-    :param fastqFile: (un)compressed fastq file. If compressed, will leave original compressed untouched
-    :param outputDir: Where to produce the new fasta file
-    :param stream: debugging stream
-    :return: fasta filename
-    """
-    # FASTQ to FASTA
-    # awk 'NR % 4 == 1 {print ">" $0 } NR % 4 == 2 {print $0}' my.fastq > my.fasta
-    filename = os.path.basename(fastqFile)
-    seqOut = os.path.join(outputDir, "seq")
-
-    if not os.path.isdir(seqOut):
-        os.makedirs(seqOut)
-
-    # rename all fastq files to fasta, including gzipped files
-    if filename.endswith(".gz"):
-        filename = os.path.join(seqOut, filename.replace(filename.split('.')[-2] + ".gz", 'fasta'))
-        fastqFile = gunzip(fastqFile)
-    else:
-        filename = os.path.join(seqOut, filename.replace(filename.split('.')[-1], 'fasta'))
-
-    if exists(filename):
-        printto(stream, "\tThe FASTA file was found!", LEVEL.WARN)
-        return filename
-
-    printto(stream, "\t" + os.path.basename(fastqFile) + " is being converted into FASTA ...")
-    SeqIO.convert(fastqFile, 'fastq', filename, 'fasta')
-
-    # not all systems have AWK by default (cough, windows)
-    # command = ("awk 'NR % 4 == 1 {sub(\"@\", \"\", $0) ; print \">\" $0} NR % 4 == 2 "
-    #            "{print $0}' " + fastqFile + " > " + filename
-    #            )
-    # os.system(command)
-    return filename
-
-
 def runIgblastn(blastInput, chain, threads=8,
                 db='$IGBLASTDB', igdata="$IGDATA", domainSystem='imgt',
                 outputDir="", species='human', stream=None):
@@ -251,23 +219,118 @@ def runIgblastp(blastInput, chain, threads=8, db='$IGBLASTDB', igdata='$IGDATA',
     return blastOutput
 
 
+class _TeeReader(object):
+    """
+    file-like reader that copies everything read from source into sink
+    """
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+
+@contextmanager
+def streamIgblast(blastInput, chain, threads=8, db='$IGBLASTDB', igdata='$IGDATA', domainSystem='imgt',
+                  protein=False, rawOutput=None, species='human', stream=None):
+    """
+    runs igblastn (or igblastp if protein is True) with its output piped back instead of being written to a file.
+    This is a context manager that yields a file-like object from which IgBLAST's outfmt 7 output can be read
+    while IgBLAST is still running. On exit, a CalledProcessError is raised if IgBLAST failed.
+
+    :param blastInput: path to input fasta file
+    :param chain: chain type, one of hv, kv, lv, or klv
+    :param threads: int
+    :param db: path to the directory containing imgt_<species>_ig[hkl][vdj]
+    :param igdata: path to the directory containing optional and internal data used by IgBLAST
+    :param domainSystem: string, one of imgt or kabat
+    :param protein: bool, run igblastp (V germline only) instead of igblastn
+    :param rawOutput: string, optional. If provided, a gzip-compressed copy of IgBLAST's raw output is kept under
+    this filename for auditing, along with the parameters that produced it (rawOutput + '.params'). If this file
+    already exists and was produced from the same input, germline files and parameters, IgBLAST is not executed and
+    the file is read instead
+    :param species: human is the only species supported currently
+    :param stream: logger stream object
+    :return: file-like object (only read() is guaranteed to be supported)
+    """
+    command = buildIgBLASTCommand(igdata, db, chain, species, domainSystem, blastInput, None, threads,
+                                  vOnly=protein, protein=protein, stream=stream)
+    if rawOutput:
+        # what the output depends on: the command (apart from where it reads its input from and its threads),
+        # the input's contents and the germline files
+        parameters = {
+            'command': str(buildIgBLASTCommand(igdata, db, chain, species, domainSystem, '-', None, 1,
+                                               vOnly=protein, protein=protein)),
+            'query': fileDigest(blastInput),
+            'germline': germlineFingerprint(db, chain, species, igdata, protein=protein)
+        }
+        if exists(rawOutput):
+            try:
+                with open(rawOutput + '.params') as fp:
+                    reusable = json.load(fp) == parameters
+            except (IOError, ValueError):
+                reusable = False
+            if reusable:
+                printto(stream, "\tBlast results were found ... " + os.path.basename(rawOutput))
+                with gzip.open(rawOutput, 'rb' if sys.version_info[0] == 2 else 'rt') as fp:
+                    yield fp
+                return
+            printto(stream, "\tBlast results " + os.path.basename(rawOutput) + " were produced from a different input "
+                            "or with different parameters, IgBLAST is run again", LEVEL.WARN)
+
+    printto(stream, '\tRunning igblast (streaming) ... ' + os.path.basename(blastInput))
+    proc = command.popen(stderr=sys.stderr)
+    partialOutput = (rawOutput + ".part") if rawOutput else None
+    raw = None
+    completed = False
+    try:
+        output = proc.stdout
+        if rawOutput:
+            raw = gzip.open(partialOutput, 'wb' if sys.version_info[0] == 2 else 'wt')
+            output = _TeeReader(output, raw)
+        yield output
+        # consume whatever the caller did not read so that IgBLAST can terminate
+        while output.read(1 << 20):
+            pass
+        proc.stdout.close()
+        if proc.wait() != 0:
+            printto(stream, "Command {} failed with error code {}.".format(command, proc.returncode), LEVEL.CRIT)
+            raise CalledProcessError(proc.returncode, str(command))
+        completed = True
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if raw is not None:
+            raw.close()
+            if completed:
+                os.rename(partialOutput, rawOutput)
+                with open(rawOutput + '.params', 'w') as fp:
+                    json.dump(parameters, fp, indent=1, sort_keys=True)
+            else:
+                os.remove(partialOutput)
+
+
 def writeClonoTypesToFile(clonoTypes, filename, top=100, overRepresented=True, stream=None):
     if exists(filename):
         printto(stream, "\tThe clonotype file " + os.path.basename(filename) + " was found!", LEVEL.WARN)
         return
 
-    total = sum(clonoTypes.values()) * 1.0
-    dic = defaultdict(list)
-    t = 0
-    for k in sorted(clonoTypes, key=clonoTypes.get, reverse=overRepresented):
-        dic['Clonotype'].append(str(k))
-        dic['Count'].append(clonoTypes[k])
-        dic['Percentage (%)'].append(clonoTypes[k] / total * 100)
-        t += 1
-        if t >= top:
-            break
-
-    df = DataFrame(dic)
+    # clonoTypes is a Series of counts indexed by clonotype (a dict of counts is accepted too)
+    counts = clonoTypes if isinstance(clonoTypes, Series) else Series(clonoTypes)
+    total = counts.sum() * 1.0
+    # stable sort, equally frequent clonotypes keep their order
+    counts = counts.iloc[argsort(-counts.values if overRepresented else counts.values, kind='mergesort')]
+    if top != float('inf'):
+        counts = counts[:int(top)]
+
+    df = DataFrame({'Clonotype': counts.index.astype(str), 'Count': counts.values,
+                    'Percentage (%)': counts.values / total * 100},
+                   columns=['Clonotype', 'Count', 'Percentage (%)'])
     # fixed format (fast read/write) sacrificing search
     # (should change to table format(t) if search is needed for clonotype clustering/comparison)
     # df.to_hdf(filename, "clonotype", mode="w", format="f")
@@ -288,9 +351,16 @@ def writeCountsToFile(dist, filename):
 
 def findBestAlignment(seq, query, dna=False, offset=0, show=False):
     if not dna:
-        alignments = align.localds(seq.replace('*', 'X'), query, matlist.blosum62, -100, -100)
+        seq = seq.replace('*', 'X')
+    alignment = localAlignment(seq, query, dna=dna)
+    if alignment is None:
+        # ties and gapped optima are left to pairwise2, it decides which of the optimal alignments comes first
+        if not dna:
+            alignments = align.localds(seq, query, matlist.blosum62, PROTEIN_GAP, PROTEIN_GAP)
+        else:
+            alignments = align.localms(seq, query, DNA_MATCH, DNA_MISMATCH, DNA_GAP, DNA_GAP)
     else:
-        alignments = align.localms(seq, query, 1, -2, -2, -2)
+        alignments = [alignment] if alignment else []
 
     #     print(seq, query, alignments)
     scores = [a[2] for a in alignments]
@@ -448,7 +518,8 @@ def mergeReads(readFile1, readFile2, threads=3, merger='leehom', outDir="./", st
         else:
             printto(stream, "\tMerged reads file " + os.path.basename(mergedFastq) + ' was found!', LEVEL.WARN)
     elif merger == 'leehom':
-        mergedFastq = outputPrefix + '.fq'
+        # leeHom compresses its output, the merged reads are read as they are
+        mergedFastq = outputPrefix + '.fq.gz'
         if not exists(mergedFastq):
             printto(stream, "{} and {} are being merged ...".format(os.path.basename(readFile1)
                                                                     , os.path.basename(readFile2)))
@@ -456,7 +527,6 @@ def mergeReads(readFile1, readFile2, threads=3, merger='leehom', outDir="./", st
                                fqo=quote(outputPrefix), t=threads)
             # printto(stream, "Executing: " + str(leehom))
             leehom()
-            gunzip(mergedFastq + '.gz')
         else:
             printto(stream, "\tMerged reads file " + os.path.basename(mergedFastq) + ' was found!', LEVEL.WARN)
     elif merger == 'flash':
@@ -773,34 +843,26 @@ def splitFastaFile(fastaFile, totalFiles, seqsPerFile, filesDir,
         printto(stream, "\tThe clones are distributed into multiple workers .. ")
         if not os.path.isdir(filesDir):
             os.makedirs(filesDir)
-        if hasLargeMem():
-            with safeOpen(fastaFile) as fp:
-                recordsAll = SeqIO.to_dict(SeqIO.parse(fp, 'fasta'))
-            queryIds = recordsAll.keys()
-        else:
-            # SeqIO.index can only open string filenames and they must be unzipped
-            recordsAll = SeqIO.index(gunzip(fastaFile), 'fasta')
-            # recordsAll.keys() is of type <dictionary-keyiterator object>, need to cast to list
-            queryIds = list(recordsAll.keys())
-        for i in range(totalFiles):
-            ids = queryIds[i * seqsPerFile: (i + 1) * seqsPerFile]
-            records = map(lambda x: recordsAll[x], ids)
-            out = os.path.join(filesDir, prefix + 'part' + str(i + 1) + ext)
-            SeqIO.write(records, out, 'fasta')
+        # stream the records into the parts, only one record is held in memory at a time
+        with safeOpen(fastaFile) as fp:
+            records = SeqIO.parse(fp, 'fasta')
+            for i in range(totalFiles):
+                out = os.path.join(filesDir, prefix + 'part' + str(i + 1) + ext)
+                SeqIO.write(islice(records, seqsPerFile), out, 'fasta')
 
 
 def writeSummary(filename, key, value):
-    if os.path.exists(filename):
-        with open(filename) as fp:
-            string = fp.read()
-    else:
-        string = ""
-
-    with open(filename, 'w') as fp:
+    with open(filename, 'a+') as fp:
+        # stages of the same sample may run concurrently, updates must not overwrite each other
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.seek(0)
+        string = fp.read()
         if re.search("^" + key + ":.*$", string, re.MULTILINE):
             string = re.sub("^" + key + ":.*$", "{}:{}".format(key, value), string, flags=re.MULTILINE)
         else:
             string += "{}:{}\n".format(key, value)
+        fp.seek(0)
+        fp.truncate()
         fp.write(string)
 
 
@@ -819,6 +881,103 @@ def countSeqs(filename):
         raise ValueError("Unrecognized format {}, expected FASTA or FASTQ".format(ext))
 
 
+def collapseDuplicates(fastaFile, outputDir, format='fasta', stream=None):
+    """
+    collapses reads with identical sequences (case-insensitive) into a single FASTA record. The first
+    read of every group is kept as the group's representative, in the order of first appearance.
+
+    :param fastaFile: (un)compressed FASTA or FASTQ file
+    :param outputDir: where to produce the collapsed FASTA file
+    :param format: "fasta" or "fastq"
+    :param stream: debugging stream
+    :return: (filename of the collapsed FASTA file, dict of representative read ID -> number of identical reads)
+    """
+    seqOut = os.path.join(outputDir, "seq")
+    if not os.path.isdir(seqOut):
+        os.makedirs(seqOut)
+    base = os.path.basename(fastaFile.replace(".gz", ""))
+    filename = os.path.join(seqOut, os.path.splitext(base)[0] + "_unique.fasta")
+
+    printto(stream, "\tIdentical sequences in " + os.path.basename(fastaFile) + " are being collapsed ...")
+    representatives = {}
+    counts = {}
+    with safeOpen(fastaFile) as fp, open(filename + ".part", "w") as out:
+        if format == 'fastq':
+            records = ((title, seq) for title, seq, _ in SeqIO.QualityIO.FastqGeneralIterator(fp))
+        else:
+            records = SeqIO.FastaIO.SimpleFastaParser(fp)
+        for title, seq in records:
+            key = seq.upper()
+            qid = representatives.get(key)
+            if qid is None:
+                qid = title.split(None, 1)[0]
+                representatives[key] = qid
+                counts[qid] = 1
+                out.write(">{}\n{}\n".format(title, seq))
+            else:
+                counts[qid] += 1
+    os.rename(filename + ".part", filename)
+
+    total = sum(counts.values())
+    printto(stream, "\t{:,} reads were collapsed into {:,} unique sequences".format(total, len(counts)),
+            LEVEL.INFO)
+    return filename, counts
+
+
+def cloneCounts(cloneAnnot):
+    """
+    :param cloneAnnot: clone annotation (or any per-read) dataframe
+    :return: the 'count' column (number of identical reads each row stands for), or None if reads were not collapsed
+    """
+    if cloneAnnot is not None and 'count' in cloneAnnot.columns:
+        return cloneAnnot['count']
+    return None
+
+
+def totalReads(cloneAnnot):
+    """
+    :param cloneAnnot: clone annotation (or any per-read) dataframe
+    :return: number of reads in cloneAnnot, taking collapsed identical reads into account
+
+    >>> from pandas import DataFrame
+    >>> totalReads(DataFrame({'vgene': ['a', 'b']}))
+    2
+    >>> totalReads(DataFrame({'vgene': ['a', 'b'], 'count': [3, 1]}))
+    4
+    """
+    counts = cloneCounts(cloneAnnot)
+    return cloneAnnot.shape[0] if counts is None else int(counts.sum())
+
+
+def weightedCounter(values, weights=None):
+    """
+    same as Counter(values), but every value is counted weights[i] times
+
+    :param values: iterable
+    :param weights: iterable of the same length as values, or None for a plain Counter
+    :return: Counter
+
+    >>> weightedCounter(['a', 'b', 'a'], [2, 1, 3]) == Counter({'a': 5, 'b': 1})
+    True
+    """
+    if weights is None:
+        return Counter(values)
+    counter = Counter()
+    for value, weight in zip(values, weights):
+        counter[value] += weight
+    return counter
+
+
+def countColumn(cloneAnnot, column):
+    """
+    :param cloneAnnot: clone annotation dataframe
+    :param column: column to tally
+    :return: Counter of cloneAnnot[column] values, in number of reads
+    """
+    counts = cloneCounts(cloneAnnot)
+    return weightedCounter(cloneAnnot[column].tolist(), None if counts is None else counts.tolist())
+
+
 def createIfNot(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -830,34 +989,84 @@ def buildIgBLASTCommand(igdata, db, chain, species, domainSystem, blastInput, bl
         raise ValueError("Unsupported chain type {}, expected one of 'lv', 'hv', 'kv', 'klv'.".format(chain))
 
     igdata = os.path.expandvars(igdata)
-    db = os.path.expandvars(db)
     exe = IGBLASTP if protein else IGBLASTN
-    # construct arguments for germline database (VDJ)
-    germs = "V" if vOnly else "VDJ"
-
-    cmd = {}
-    for germ in germs:
-        # if germline is D, then even the light chain will borrow imgt_<species>_ighd's database
-        # otherwise it'll just be imgt_<species>_ig[kl(kl)][vj]
-        chainLetter = 'h' if germ == 'D' else chain[:chain.find('v')]
-        cmd['germline_db_' + germ] = os.path.join(db, 'imgt_{}_ig{}{}{}'.format(species,
-                                                                                chainLetter,
-                                                                                germ.lower(),
-                                                                                '_p' if protein else ''))
+    cmd = dict(('germline_db_' + germ, prefix)
+               for germ, prefix in germlineDatabases(db, chain, species, vOnly=vOnly, protein=protein).items())
+    # without an output file, IgBLAST writes to its standard output
+    if blastOutput is not None:
+        cmd['out'] = quote(blastOutput)
     blast = ShortOpts(exe,
                       show_translation="",
                       extend_align5end="",
                       domain_system=domainSystem,
                       query=quote(blastInput),
                       organism=species,
-                      auxiliary_data=os.path.join(igdata, 'optional_file', '{}_gl.aux'.format(species)),
+                      auxiliary_data=_auxiliaryData(igdata, species),
                       outfmt=7,
-                      num_threads=threads,
-                      out=quote(blastOutput), **cmd)
+                      num_threads=threads, **cmd)
     # printto(stream, "Executing : " + str(blast))
     return blast
 
 
+def germlineDatabases(db, chain, species='human', vOnly=False, protein=False):
+    """
+    :param db: path to the directory containing imgt_<species>_ig[hkl][vdj]
+    :param chain: chain type, one of hv, kv, lv, or klv
+    :param species: string
+    :param vOnly: bool, only the V germline database
+    :param protein: bool, the protein (_p) germline databases
+    :return: dict of germline ('V', 'D' and 'J') -> path of its database, as passed to IgBLAST
+    """
+    db = os.path.expandvars(db)
+    databases = {}
+    for germ in ("V" if vOnly else "VDJ"):
+        # if germline is D, then even the light chain will borrow imgt_<species>_ighd's database
+        # otherwise it'll just be imgt_<species>_ig[kl(kl)][vj]
+        chainLetter = 'h' if germ == 'D' else chain[:chain.find('v')]
+        databases[germ] = os.path.join(db, 'imgt_{}_ig{}{}{}'.format(species, chainLetter, germ.lower(),
+                                                                     '_p' if protein else ''))
+    return databases
+
+
+def _auxiliaryData(igdata, species):
+    return os.path.join(os.path.expandvars(igdata), 'optional_file', '{}_gl.aux'.format(species))
+
+
+def germlineFingerprint(db, chain, species='human', igdata='$IGDATA', protein=False):
+    """
+    digest of the contents of the germline files IgBLAST reads for chain, i.e. every file of its V, D and J
+    databases and the auxiliary data file. Unlike the modification time of the database directory, it changes
+    when these files are replaced in place
+
+    :param db: path to the directory containing imgt_<species>_ig[hkl][vdj]
+    :param chain: chain type, one of hv, kv, lv, or klv
+    :param species: string
+    :param igdata: path to the directory containing optional and internal data used by IgBLAST
+    :param protein: bool, the protein (_p) germline databases
+    :return: string
+    """
+    files = [_auxiliaryData(igdata, species)]
+    for prefix in germlineDatabases(db, chain, species, protein=protein).values():
+        files += [prefix] + glob.glob(prefix + '.*')
+    digest = hashlib.sha1()
+    for filename in sorted(set(files)):
+        if os.path.isfile(filename):
+            digest.update((os.path.basename(filename) + ' ' + fileDigest(filename) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fileDigest(filename):
+    """
+    :param filename: string
+    :return: string, SHA-1 of the contents of filename
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def ntIUPACEqual(sequence, iupac):
     """
     compares 2 nucleotide sequence based on the IUPAC format. If they are not of equal length,
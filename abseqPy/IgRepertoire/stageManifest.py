@@ -0,0 +1,118 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+
+from contextlib import contextmanager
+
+
+def fileFingerprint(filename):
+    """
+    :param filename: string, file or directory
+    :return: list of [basename, size, modification time], None if filename does not exist. The contents are not
+             read, moving or copying a file (with its time stamps) keeps its fingerprint
+    """
+    if not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    return [os.path.basename(os.path.normpath(filename)), stat.st_size, int(stat.st_mtime)]
+
+
+def fingerprint(*parts):
+    """
+    :param parts: JSON serializable values (anything else is represented by its repr)
+    :return: string, digest of parts
+
+    >>> fingerprint('annotateClones', {'chain': 'hv'}) == fingerprint('annotateClones', {'chain': 'hv'})
+    True
+    >>> fingerprint('annotateClones', {'chain': 'hv'}) == fingerprint('annotateClones', {'chain': 'kl'})
+    False
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+class StageManifest(object):
+    """
+    per-sample record of the outputs that were computed, each under a key with the fingerprint of what it was
+    computed from (inputs, parameters, tool versions and the fingerprints of the outputs it was derived from).
+    Outputs are only reused when their recorded fingerprint matches the current one, stale outputs are removed
+    so that they, and everything derived from them, are recomputed.
+
+    Stages of the same sample run in separate processes, every access locks the manifest file.
+    """
+
+    FILENAME = "manifest.json"
+
+    def __init__(self, directory):
+        """
+        :param directory: string, the sample's auxiliary directory. Output paths are stored relative to it
+        """
+        self.directory = directory
+        self.filename = os.path.join(directory, self.FILENAME)
+
+    @contextmanager
+    def _entries(self):
+        with open(self.filename, 'a+') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                entries = json.loads(fp.read() or '{}')
+            except ValueError:
+                # unreadable manifest, nothing can be trusted
+                entries = {}
+            yield entries
+            fp.seek(0)
+            fp.truncate()
+            json.dump(entries, fp, indent=1, sort_keys=True)
+
+    def _path(self, output):
+        return os.path.normpath(os.path.join(self.directory, output))
+
+    def current(self, key, fingerprint):
+        """
+        :param key: string
+        :param fingerprint: string, the current fingerprint of key
+        :return: bool, True if key was recorded with fingerprint and all of its outputs still exist
+        """
+        with self._entries() as entries:
+            entry = entries.get(key)
+        return entry is not None and entry['fingerprint'] == fingerprint and \
+            all(os.path.exists(self._path(output)) for output in entry['outputs'])
+
+    def record(self, key, fingerprint, outputs=()):
+        """
+        :param key: string
+        :param fingerprint: string
+        :param outputs: iterable of the files or directories produced under key
+        :return: None
+        """
+        outputs = sorted(set(os.path.relpath(os.path.abspath(output), self.directory) for output in outputs))
+        with self._entries() as entries:
+            entries[key] = {'fingerprint': fingerprint, 'outputs': outputs}
+
+    def discard(self, key, outputs=()):
+        """
+        forgets key and removes its outputs
+
+        :param key: string
+        :param outputs: iterable of files or directories to remove in addition to the recorded outputs of key
+                        (e.g. outputs of a run that did not record them)
+        :return: None
+        """
+        with self._entries() as entries:
+            entry = entries.pop(key, None)
+        paths = set(os.path.abspath(output) for output in outputs)
+        if entry is not None:
+            paths.update(self._path(output) for output in entry['outputs'])
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
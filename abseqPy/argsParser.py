@@ -7,6 +7,7 @@
 from __future__ import print_function
 import os
 import sys
+import imp
 import argparse
 import yaml
 
@@ -180,6 +181,16 @@ def parseArgs(arguments=None):
                          "and --database argument is not specified.\nPlease refer "
                          "to the README file for instructions on configuring $IGBLASTDB "
                          "or alternatively specify the --database argument.")
+    if args.annotcache is not None:
+        args.annotcache = os.path.abspath(args.annotcache)
+        if not os.path.isdir(os.path.dirname(args.annotcache)):
+            parser.error("Directory of -ac / --annotcache {} does not exist!".format(args.annotcache))
+    if args.store == 'parquet':
+        try:
+            imp.find_module('pyarrow')
+        except ImportError:
+            parser.error("-fs / --store parquet requires pyarrow, please install it or use the hdf store.")
+
     if os.getenv("IGDATA") is None:
         parser.error("$IGDATA environment variable is not configured.\nPlease refer to "
                      "the README file for instructions on configuring $IGDATA.")
@@ -250,6 +261,12 @@ def parseCommandLineArguments(arguments=None):
                                                                "Otherwise, FR and CDR composition logos will "
                                                                "be a collection of all IGV genes. "
                                                                "[default = not segregated]", action='store_true')
+    optional.add_argument('-rb', '--rarefactionbootstrap', help="number of sampled rarefaction curves used to draw "
+                                                                "95%% confidence bands around the expected "
+                                                                "rarefaction curves. The rarefaction CSV files then "
+                                                                "hold the sampled curves instead of the expected "
+                                                                "values. [default=0, no confidence bands]",
+                          type=int, default=0)
     # line 173 in IgRepertoire.py, all ranges are inclusive when filtering rows from pandas's df
     filtering.add_argument('-b', '--bitscore', help="filtering criterion (V gene bitscore):"
                                                     " Bitscore range (inclusive) to apply on V gene."
@@ -318,6 +335,32 @@ def parseCommandLineArguments(arguments=None):
                                                    "the environment variable $IGBLASTDB should contain the "
                                                    "fully qualified path. See abseqPy's README for more information.",
                           default=None)
+    optional.add_argument('-ibs', '--igblaststream', help="if on, IgBLAST's output is parsed while IgBLAST is "
+                                                          "running instead of being written to temporary .out "
+                                                          "files first. keep does the same but also retains a "
+                                                          "gzip-compressed copy (.out.gz) of IgBLAST's output "
+                                                          "for auditing. [default=off]",
+                          default='off', choices=['off', 'on', 'keep'])
+    optional.add_argument('-ac', '--annotcache', help="path to an annotation cache (SQLite database, created if "
+                                                      "missing). Sequences found in the cache are not re-annotated "
+                                                      "by IgBLAST as long as the germline database, chain, "
+                                                      "domain system and IgBLAST version are unchanged. "
+                                                      "Can be shared between samples. [default=no cache]",
+                          default=None)
+    optional.add_argument('-fs', '--store', help="storage format of the clone annotation and sequence dataframes. "
+                                                 "parquet requires pyarrow. [default=hdf]",
+                          default='hdf', choices=['hdf', 'parquet'])
+    optional.add_argument('-dd', '--dedup', help="if specified, reads with identical sequences are collapsed into "
+                                                 "one before annotation and counted once per read in the "
+                                                 "abundance, productivity, diversity, primer specificity, "
+                                                 "upstream and restriction site analyses. Reduces "
+                                                 "IgBLAST and refinement time on highly redundant libraries. "
+                                                 "[default = not collapsed]", action='store_true')
+    optional.add_argument('-mem', '--memory', help="memory budget in GB shared by all samples. Stages whose "
+                                                   "estimated peak memory does not fit in what is left of the "
+                                                   "budget wait for running stages to complete. "
+                                                   "[default = 80%% of the physical memory]", type=float,
+                          default=None)
     optional.add_argument('-q', '--threads', help="number of threads to use (spawns separate processes). [default=1]",
                           type=int, default=1)
     optional.add_argument('-v', '--version', action='version', version='%(prog)s ' + VERSION)
@@ -142,19 +142,41 @@ class CommandLine:
         if not stderr:
             stderr, closeErr = open(os.devnull, "w"), True
 
-        if sys.version_info[0] == 2:
-            # escape paths containing '\' (windows path)
-            subprocess.check_call(shlex.split(str(self).encode('string-escape')), stdout=stdout, stderr=stderr)
-        else:
-            subprocess.check_call(shlex.split(str(self).encode('unicode_escape').decode()),
-                                  stdout=stdout, stderr=stderr)
-
+        subprocess.check_call(self._argv(), stdout=stdout, stderr=stderr)
 
         if closeOut:
             stdout.close()
         if closeErr:
             stderr.close()
 
+    def popen(self, stderr=sys.stderr):
+        """
+        starts the built command without waiting for it to finish. The command's standard output
+        is available (in text mode) from the returned object's stdout attribute. It is up to the caller
+        to wait() for the process and check its returncode
+
+        :param stderr: std error stream. A value of None will flush it to /dev/null
+        :return: subprocess.Popen object
+
+        >>> proc = ShortOpts("python", m='this').popen()
+        >>> proc.stdout.readline().strip()
+        'The Zen of Python, by Tim Peters'
+        >>> _ = proc.stdout.read()
+        >>> proc.wait()
+        0
+        """
+        if stderr:
+            return subprocess.Popen(self._argv(), stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+        # the child process has its own copy of the handle
+        with open(os.devnull, "w") as devnull:
+            return subprocess.Popen(self._argv(), stdout=subprocess.PIPE, stderr=devnull, universal_newlines=True)
+
+    def _argv(self):
+        if sys.version_info[0] == 2:
+            # escape paths containing '\' (windows path)
+            return shlex.split(str(self).encode('string-escape'))
+        return shlex.split(str(self).encode('unicode_escape').decode())
+
     def __str__(self):
         """
         :return: string representation
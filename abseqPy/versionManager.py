@@ -51,6 +51,19 @@ def writeParams(args, outDir):
     return os.path.basename(filename)
 
 
+_versions = {}
+
+
+def softwareVersion(prog):
+    """
+    :param prog: program name, see _getSoftwareVersion
+    :return: string, version of prog. Looked up once per process
+    """
+    if prog not in _versions:
+        _versions[prog] = _getSoftwareVersion(prog)
+    return _versions[prog]
+
+
 def _getSoftwareVersion(prog):
     """
     taken as-is from setup.py (flash version modification)
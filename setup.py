@@ -40,6 +40,8 @@ setup(name="abseqPy",
       install_requires=['numpy==1.15.2', 'pandas==0.23.4', 'biopython==1.72', 'matplotlib==2.2.3',
                         'tables==3.4.4', 'psutil', 'matplotlib-venn==0.11.5', 'pyyaml', 'scipy==1.1.0'] +
                        ['weblogo==3.6.0'] if platform.system() != 'Windows' else [],
+      # optional Parquet store of the clone dataframes (-fs parquet), pyarrow 0.16 needs numpy >= 1.16
+      extras_require={'parquet': ['pyarrow==0.15.1']},
       packages=filter(windows_filter, find_packages()),
       ext_modules=([
                        Extension('TAMO.MD._MDsupport',
@@ -0,0 +1,41 @@
+import gzip
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgMultiRepertoire.MemoryModel import MemoryModel, estimateReads, MB
+
+
+def test_estimateReadsOfGzippedFastq(tmpdir):
+    filename = str(tmpdir.join("reads.fastq.gz"))
+    with gzip.open(filename, 'wb') as fp:
+        for i in range(5000):
+            fp.write("@read{}\nACGTACGTAC\n+\nIIIIIIIIII\n".format(i))
+    assert estimateReads(filename) == 5000
+    # estimated from a prefix of the file
+    assert 4000 < estimateReads(filename, sampleSize=2048) < 6000
+
+
+def test_estimateReadsOfMultiMemberGzip(tmpdir):
+    # BGZF and concatenated gzip files are made of many gzip members
+    filename = str(tmpdir.join("reads.fastq.gz"))
+    with open(filename, 'wb') as out:
+        for block in range(50):
+            member = str(tmpdir.join("block.gz"))
+            with gzip.open(member, 'wb') as fp:
+                for i in range(100):
+                    fp.write("@read{}\nACGTACGTAC\n+\nIIIIIIIIII\n".format(block * 100 + i))
+            with open(member, 'rb') as fp:
+                out.write(fp.read())
+    assert estimateReads(filename) == 5000
+    assert 4000 < estimateReads(filename, sampleSize=2048) < 6000
+
+
+def test_measurementsAreReloaded(tmpdir):
+    model = MemoryModel()
+    default = model.estimate(AbSeqWorker.ANNOT, 10 ** 6)
+    model.record(AbSeqWorker.ANNOT, 10 ** 6, default * 2, str(tmpdir))
+
+    reloaded = MemoryModel()
+    reloaded.load(str(tmpdir))
+    assert reloaded.estimate(AbSeqWorker.ANNOT, 10 ** 6) == default * 2
+    assert reloaded.estimate(AbSeqWorker.PROD, 10 ** 6) == model.estimate(AbSeqWorker.PROD, 10 ** 6)
+    assert reloaded.estimate(AbSeqWorker.ANNOT, 0) >= 256 * MB
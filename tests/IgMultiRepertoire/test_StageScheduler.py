@@ -0,0 +1,112 @@
+import os
+import time
+
+from multiprocessing import Queue
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgMultiRepertoire.IgMultiRepertoire import IgMultiRepertoire
+from abseqPy.IgMultiRepertoire.MemoryModel import MemoryModel
+from abseqPy.IgMultiRepertoire.StageScheduler import Stage, StageScheduler
+from abseqPy.IgRepertoire.IgRepertoire import IgRepertoire
+
+
+def test_schedulerKeepsBudgetAndOrder():
+    scheduler = StageScheduler(6)
+    ops = [AbSeqWorker.MERGE, AbSeqWorker.ANNOT, AbSeqWorker.ABUN, AbSeqWorker.PROD, AbSeqWorker.DIVER]
+    for sample in range(5):
+        for op in ops:
+            cores = 1 if op in AbSeqWorker.singleThreaded else 4
+            scheduler.add(Stage(sample, op, cores=cores, after=AbSeqWorker.dependencies(op, ops)))
+
+    finished = []
+    while not scheduler.done():
+        admitted = scheduler.admit()
+        assert scheduler.running, "nothing is running, the scheduler is stuck"
+        assert sum(cores for cores, _ in scheduler.running.values()) <= 6
+        for stage, cores in admitted:
+            assert all(dep in scheduler.completed for dep in stage.after)
+        # complete the oldest running stage
+        key = sorted(scheduler.running)[0]
+        scheduler.finish(key)
+        finished.append(key)
+    assert len(finished) == 25
+
+
+def test_dependenciesSkipOpsThatAreNotRun():
+    assert AbSeqWorker.dependencies(AbSeqWorker.DIVER, [AbSeqWorker.MERGE, AbSeqWorker.DIVER]) == [AbSeqWorker.MERGE]
+    assert AbSeqWorker.dependencies(AbSeqWorker.DIVER, [AbSeqWorker.ANNOT, AbSeqWorker.PROD, AbSeqWorker.DIVER]) \
+        == [AbSeqWorker.PROD]
+    assert AbSeqWorker.dependencies(AbSeqWorker.FASTQC, AbSeqWorker.ops) == []
+
+
+class _Sample(object):
+    """
+    stands in for IgRepertoire, each op appends (op, start, end, threads) to a file
+    """
+
+    def __init__(self, name, log, threads):
+        self.name = name
+        self.log = log
+        self.auxDir = os.path.dirname(log)
+        self.threads = threads
+        self._tasks = [(AbSeqWorker.MERGE, {}), (AbSeqWorker.ANNOT, {}), (AbSeqWorker.ABUN, {}),
+                       (AbSeqWorker.PROD, {}), (AbSeqWorker.DIVER, {})]
+
+    def runStage(self, op, kwargs):
+        getattr(self, op)(**kwargs)
+
+    def __getattr__(self, op):
+        if op not in AbSeqWorker.ops:
+            raise AttributeError(op)
+
+        def run():
+            start = time.time()
+            time.sleep(0.05)
+            with open(self.log, 'a') as fp:
+                fp.write("{} {} {} {}\n".format(op, start, time.time(), self.threads))
+        return run
+
+
+class _MultiRepertoire(IgMultiRepertoire):
+    def __init__(self, samples, cores):
+        self.result = Queue()
+        self.buffer = samples
+        self.cores = cores
+        self.memory = None
+        self.memoryModel = MemoryModel()
+        self.reads = [1000] * len(samples)
+
+
+def test_stagesOfSamplesRunInDependencyOrder(tmpdir):
+    multi = _MultiRepertoire([_Sample("s{}".format(i), str(tmpdir.join("s{}.log".format(i))), 2)
+                              for i in range(3)], cores=3)
+    multi.start()
+
+    for sample in multi.buffer:
+        runs = dict((line.split()[0], map(float, line.split()[1:])) for line in open(sample.log))
+        assert sorted(runs) == sorted(op for op, _ in sample._tasks)
+        for op in runs:
+            for dep in AbSeqWorker.dependencies(op, runs):
+                assert runs[dep][1] <= runs[op][0]
+        assert runs[AbSeqWorker.ABUN][2] == 1
+    # measured peaks are kept for the next run
+    assert tmpdir.join(MemoryModel.HISTORY).check()
+
+
+def test_annotationRunsOnceBeforeTheStagesThatNeedIt(tmpdir):
+    reads = tmpdir.join("reads.fasta")
+    reads.write(">r1\nACGTACGTAA\n")
+    primers = tmpdir.join("primers.fasta")
+    primers.write(">IGKV1\nGACATCCAGATGACC\n")
+    # productivity with primer files: PROD and PRIM both need the annotation, which is not part of the task
+    sample = IgRepertoire(str(reads), name='sample', outdir=str(tmpdir), task='productivity', database=str(tmpdir),
+                          merger=None, primer5end=str(primers), log=str(tmpdir.join("sample.log")))
+    ops = [op for op, _ in sample._tasks]
+    assert sorted(ops) == sorted([AbSeqWorker.ANNOT, AbSeqWorker.PROD, AbSeqWorker.PRIM])
+
+    scheduler = StageScheduler(8)
+    for op in ops:
+        scheduler.add(Stage(0, op, cores=2, after=AbSeqWorker.dependencies(op, ops)))
+    assert [stage.op for stage, _ in scheduler.admit()] == [AbSeqWorker.ANNOT]
+    scheduler.finish((0, AbSeqWorker.ANNOT))
+    assert sorted(stage.op for stage, _ in scheduler.admit()) == sorted([AbSeqWorker.PROD, AbSeqWorker.PRIM])
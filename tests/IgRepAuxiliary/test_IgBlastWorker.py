@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+
+from abseqPy.IgRepAuxiliary.IgBlastWorker import *
+
+
+HEAVY_RECORD = """# IGBLASTN 2.7.1+
+# Query: {qid}
+# Database: imgt_human_ighv imgt_human_ighd imgt_human_ighj
+# Domain classification requested: imgt
+
+# V-(D)-J rearrangement summary for query sequence (Top V gene match, Top D gene match, Top J gene match, Chain type, stop codon, V-J frame, Productive, Strand).  Multiple equivalent top matches having the same score and percent identity, if present, are separated by a comma.
+IGHV3-23*01,IGHV3-23D*01\tIGHD3-10*01\tIGHJ4*02\tVH\tNo\tIn-frame\tYes\t+
+
+# V-(D)-J junction details based on top germline gene matches (V end, V-D junction, D region, D-J junction, J start).
+AGAGA\tTCGG\tGTATTACTATGG\tTTC\tACTAC
+
+# Sub-region sequence details (nucleotide sequence, translation, start, end)
+CDR3\tGCGAAAGATCGGGTATTACTATGGTTCACTAC\tAKDRVLLWFT\t289\t{cdr3end}
+
+# Alignment summary between query and top germline V gene hit (from, to, length, matches, mismatches, gaps, percent identity)
+FR1-IMGT\t1\t75\t75\t75\t0\t0\t100
+CDR1-IMGT\t76\t99\t24\t24\t0\t0\t100
+FR2-IMGT\t100\t150\t51\t50\t1\t0\t98
+CDR2-IMGT\t151\t174\t24\t24\t0\t0\t100
+FR3-IMGT\t175\t288\t114\t113\t1\t0\t99.1
+CDR3-IMGT (germline)\t289\t296\t8\t8\t0\t0\t100
+Total\tN/A\tN/A\t296\t294\t2\t0\t99.3
+
+# Hit table (the first field indicates the chain type of the hit)
+# Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, gaps, q. start, q. end, s. start, s. end, evalue, bit score
+# 3 hits found
+V\t{qid}\tIGHV3-23*01\t99.32\t296\t2\t0\t0\t1\t296\t{vstart}\t296\t1e-120\t{bitscore}
+D\t{qid}\tIGHD3-10*01\t100.00\t12\t0\t0\t0\t300\t311\t5\t16\t0.5\t23.5
+J\t{qid}\tIGHJ4*02\t100.00\t40\t0\t0\t0\t315\t354\t9\t48\t1e-15\t79.2
+
+"""
+
+NO_HIT_RECORD = """# IGBLASTN 2.7.1+
+# Query: {qid}
+# Database: imgt_human_ighv imgt_human_ighd imgt_human_ighj
+# Domain classification requested: imgt
+
+# 0 hits found
+"""
+
+
+# annotation of HEAVY_RECORD, apart from the fields that vary with the query (see _writeBlastOutput).
+# IgBLAST does not report FR4, it is left missing
+HEAVY_ANNOTATION = {
+    'vgene': 'IGHV3-23*01', 'vqstart': 1, 'vmismatches': 2, 'vgaps': 0, 'identity': 99.32, 'alignlen': 296,
+    'chain': 'VH', 'dgene': 'IGHD3-10*01', 'dqstart': 300, 'dqend': 311, 'dstart': 5, 'dmismatches': 0, 'dgaps': 0,
+    'jgene': 'IGHJ4*02', 'jqstart': 315, 'jqend': 354, 'jstart': 9, 'jend': 48, 'jmismatches': 0, 'jgaps': 0,
+    'strand': 'forward', 'stopcodon': 'No', 'v-jframe': 'In-frame',
+    'fr1.start': 1, 'fr1.end': 75, 'fr1.mismatches': 0, 'fr1.gaps': 0,
+    'cdr1.start': 76, 'cdr1.end': 99, 'cdr1.mismatches': 0, 'cdr1.gaps': 0,
+    'fr2.start': 100, 'fr2.end': 150, 'fr2.mismatches': 1, 'fr2.gaps': 0,
+    'cdr2.start': 151, 'cdr2.end': 174, 'cdr2.mismatches': 0, 'cdr2.gaps': 0,
+    'fr3.start': 175, 'fr3g.end': 288, 'fr3g.mismatches': 1, 'fr3g.gaps': 0, 'fr3.end': 288,
+    'cdr3g.start': 289, 'cdr3g.end': 296, 'cdr3g.mismatches': 0, 'cdr3g.gaps': 0, 'cdr3.start': 289
+}
+
+
+def _writeBlastOutput(tmpdir, n):
+    fname = str(tmpdir.join("part1.out"))
+    with open(fname, 'w') as fp:
+        for i in range(n):
+            if i % 7 == 3:
+                fp.write(NO_HIT_RECORD.format(qid="read{}".format(i)))
+            else:
+                fp.write(HEAVY_RECORD.format(qid="read{}".format(i), cdr3end=320 + i % 5,
+                                             vstart=1 + i % 3, bitscore=round(350.3 + i * 0.5, 1)))
+        fp.write("# BLAST processed {} queries\n".format(n))
+    return fname
+
+
+def _expectedAnnotation(n, chain):
+    fields = getAnnotationFields(chain)
+    rows, index = [], []
+    for i in range(n):
+        if i % 7 == 3:
+            continue
+        row = dict(HEAVY_ANNOTATION, vstart=1 + i % 3, bitscore=round(350.3 + i * 0.5, 1))
+        row['cdr3.end'] = 320 + i % 5
+        rows.append(row)
+        index.append("read{}".format(i))
+    return pd.DataFrame(rows, columns=fields[1:], index=pd.Index(index, name='queryid'))
+
+
+def test_columnarParserExtractsTopHits(tmpdir):
+    fname = _writeBlastOutput(tmpdir, 50)
+    for chain in ('hv', 'kv'):
+        expected = _expectedAnnotation(50, chain)
+        got, gotFiltered = extractCDRInfoColumnar(fname, chain, batchSize=8)
+
+        assert gotFiltered == ["read{}".format(i) for i in range(3, 50, 7)]
+        assert list(got.columns) == list(expected.columns)
+        assert list(got.index) == list(expected.index)
+        for col in expected.columns:
+            if col in CATEGORICAL_FIELDS:
+                assert list(got[col]) == list(expected[col])
+            else:
+                assert np.array_equal(got[col].fillna(-1).values, expected[col].fillna(-1).values)
+
+
+def test_columnarBatchesAreTyped(tmpdir):
+    fname = _writeBlastOutput(tmpdir, 20)
+    batches = list(iterCDRInfoBatches(fname, 'hv', batchSize=8))
+    # 20 queries, 3 of which have no hits => 17 annotated rows
+    assert [len(df) for df, _ in batches] == [8, 8, 1]
+    assert sum(len(filtered) for _, filtered in batches) == 3
+
+    df = batches[0][0]
+    assert df['vstart'].dtype == np.int32
+    # scores are compared against the -b / identity thresholds, they keep their full precision
+    assert df['bitscore'].dtype == np.float64
+    assert df['bitscore'].iloc[0] == 350.3
+    assert str(df['vgene'].dtype) == 'category'
+    assert df['vgene'].iloc[0] == 'IGHV3-23*01'
+    # fr4 is never reported by IgBLAST, missing values are NaN
+    assert df['fr4.start'].isnull().all()
+
+
+def test_streamedIgBlastOutputIsParsedAndKept(tmpdir, monkeypatch):
+    fname = _writeBlastOutput(tmpdir, 30)
+    # stand-in for igblastn that prints a canned outfmt 7 output to stdout
+    fakeBin = tmpdir.mkdir("bin")
+    fakeIgblast = fakeBin.join("igblastn")
+    fakeIgblast.write("#!/bin/sh\ncat {}\n".format(fname))
+    fakeIgblast.chmod(0o755)
+    monkeypatch.setenv("PATH", str(fakeBin) + os.pathsep + os.environ["PATH"])
+    fasta = tmpdir.join("seqs.fasta")
+    fasta.write(">read0\nGAGGTGCAGCTG\n")
+    outdir = str(tmpdir.mkdir("out"))
+
+    expected, expectedFiltered = extractCDRInfoColumnar(fname, 'hv')
+    for mode in ('on', 'keep'):
+        got, gotFiltered = analyzeSmallFile(str(fasta), 'hv', str(tmpdir), threads=1, outdir=outdir,
+                                            igblastStream=mode)
+        assert gotFiltered == expectedFiltered
+        assert got.equals(expected)
+    assert sorted(os.listdir(outdir)) == ["seqs.out.gz", "seqs.out.gz.params"]
+
+
+def test_keptIgBlastOutputIsOnlyReusedWithTheSameGermlines(tmpdir, monkeypatch):
+    fakeBin = tmpdir.mkdir("bin")
+    fakeIgblast = fakeBin.join("igblastn")
+    monkeypatch.setenv("PATH", str(fakeBin) + os.pathsep + os.environ["PATH"])
+    db = tmpdir.mkdir("db")
+    db.join("imgt_human_ighv.fasta").write(">IGHV3-23*01\nGAGGTGCAGCTG\n")
+    fasta = tmpdir.join("seqs.fasta")
+    fasta.write(">read0\nGAGGTGCAGCTG\n")
+    outdir = str(tmpdir.mkdir("out"))
+
+    def annotate(n):
+        fakeIgblast.write("#!/bin/sh\ncat {}\n".format(_writeBlastOutput(tmpdir, n)))
+        fakeIgblast.chmod(0o755)
+        got, _ = analyzeSmallFile(str(fasta), 'hv', str(db), threads=1, outdir=outdir, igblastStream='keep')
+        return len(got)
+
+    assert annotate(10) == 9
+    # same input, same germlines: IgBLAST's kept output is read
+    assert annotate(20) == 9
+    # germlines updated in place
+    db.join("imgt_human_ighv.fasta").write(">IGHV3-23*01\nGAGGTGCAGCTA\n")
+    assert annotate(20) == 17
+    fasta.write(">read0\nGAGGTGCAGCTA\n")
+    assert annotate(30) == 26
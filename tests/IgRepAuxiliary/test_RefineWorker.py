@@ -0,0 +1,266 @@
+import random
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from numpy import isnan
+
+from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
+from abseqPy.IgRepAuxiliary.productivityAuxiliary import loadRefineFlagInfo
+from abseqPy.IgRepAuxiliary.RefineWorker import refineChunk, refineCloneAnnotation, refineGapsAndMismatches, \
+    refineInFramePredictions, _addToColumn, _recordFRLengths, _defaultdefaultInt
+
+
+def _frames():
+    base = {'v-jframe': 'In-frame', 'vqstart': 1, 'vstart': 1, 'fr1.start': 1, 'fr4.start': 331, 'fr4.end': 363,
+            'cdr3.start': 289, 'cdr3.end': 330, 'fr1.gaps': 0, 'fr2.gaps': 0, 'fr3g.gaps': 0, 'cdr1.gaps': 0,
+            'cdr2.gaps': 0, 'cdr3g.gaps': np.nan}
+    variants = [{}, {'v-jframe': 'N/A'}, {'v-jframe': np.nan}, {'vqstart': 3, 'vstart': 5}, {'vqstart': 2},
+                {'fr4.start': np.nan}, {'cdr3.end': 200}, {'fr4.end': 364}, {'fr2.gaps': 1}, {'cdr3g.gaps': 2},
+                {'cdr3g.gaps': 3, 'vqstart': 4}, {'vqstart': np.nan}]
+    rows = []
+    for variant in variants:
+        row = dict(base)
+        row.update(variant)
+        rows.append(row)
+    return pd.DataFrame(rows, index=['q{}'.format(i) for i in range(len(rows))])
+
+
+# flag raised for each clone of _frames(), None if the clone stays in frame, per actualQstart
+EXPECTED_FRAME_FLAGS = {
+    -1: [None, 'NA', 'NA', 'Conc', None, 'No3or4', 'No3or4', '3x', 'Indel', 'Indel', None, 'Conc'],
+    0: [None, 'NA', 'NA', 'Conc', 'Conc', 'No3or4', 'No3or4', '3x', 'Indel', 'Indel', None, 'Conc'],
+    1: ['Conc', 'NA', 'NA', 'Conc', '3x', 'Conc', 'Conc', 'Conc', 'Conc', 'Conc', 'Conc', 'Conc'],
+}
+
+
+def test_inFramePredictionFlags():
+    for actualQstart, expected in EXPECTED_FRAME_FLAGS.items():
+        df = _frames()
+        got = refineInFramePredictions(df, actualQstart, np.ones(df.shape[0], bool))
+        assert list(got['updatedInFrame']) == [flag is not None for flag in expected]
+        for flag in ('NA', 'Conc', 'No3or4', '3x', 'Indel'):
+            assert list(got['updatedInFrame' + flag]) == [f == flag for f in expected]
+
+
+def test_inFramePredictionFlagsMissingVStartAsDiscordant():
+    df = _frames()
+    got = refineInFramePredictions(df, -1, np.ones(df.shape[0], bool))
+    assert got['updatedInFrameConc'][-1] and got['updatedInFrame'][-1]
+
+    # clones already known to be out of frame are never flagged
+    got = refineInFramePredictions(df, -1, np.zeros(df.shape[0], bool))
+    assert not any(mask.any() for mask in got.values())
+
+
+# one codon per amino acid, enough to back-translate the simulated V domains
+CODONS = {'A': 'GCT', 'C': 'TGT', 'D': 'GAT', 'E': 'GAA', 'F': 'TTT', 'G': 'GGT', 'H': 'CAT', 'I': 'ATT',
+          'K': 'AAA', 'L': 'CTG', 'M': 'ATG', 'N': 'AAT', 'P': 'CCG', 'Q': 'CAG', 'R': 'CGT', 'S': 'AGC',
+          'T': 'ACC', 'V': 'GTG', 'W': 'TGG', 'Y': 'TAT', '*': 'TAA'}
+
+# amino acid lengths of FR1, CDR1, FR2, CDR2 and FR3
+V_REGIONS = (('fr1', 25), ('cdr1', 8), ('fr2', 17), ('cdr2', 8), ('fr3', 38))
+
+
+def _randomProtein(rand, n):
+    return ''.join(rand.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(n))
+
+
+@pytest.fixture
+def heavyChunk():
+    """
+    simulated IgBLAST annotation of heavy chain reads and the reads themselves. IgBLAST does not report FR4, the
+    reads have random 5' overhangs, V starts, gaps, frames, strands, mutated or missing FR4s and stop codons
+    """
+    rand = random.Random(11)
+    fields = getAnnotationFields('hv')
+    rows, records = [], []
+    for i in range(120):
+        protein = ''.join(_randomProtein(rand, n) for _, n in V_REGIONS) + _randomProtein(rand, rand.randint(6, 14))
+        fr4 = 'WGQGTLVTVSS'
+        if rand.random() < 0.3:
+            fr4 = ''.join(c if rand.random() < 0.7 else rand.choice('ACDEFGHIKLMNPQRSTVWY*') for c in fr4)
+        protein += fr4
+        if rand.random() < 0.1:
+            at = rand.randint(0, len(protein) - 1)
+            protein = protein[:at] + '*' + protein[at + 1:]
+        overhang = ''.join(rand.choice('ACGT') for _ in range(rand.randint(0, 5)))
+        dna = overhang + ''.join(CODONS[aa] for aa in protein) + ''.join(rand.choice('ACGT')
+                                                                         for _ in range(rand.randint(0, 4)))
+        row = dict((f, 0) for f in fields[1:])
+        vstart = rand.randint(1, 4)
+        row.update({'vgene': rand.choice(['IGHV1-2*02', 'IGHV3-23*01', 'IGHV3-23*04']), 'chain': 'VH',
+                    'jgene': rand.choice(['IGHJ4*02', 'IGHJ6*01']), 'dgene': 'IGHD3-10*01',
+                    'vstart': vstart, 'vqstart': len(overhang) + vstart + rand.choice([0, 0, 0, -1, 2, -3]),
+                    'v-jframe': rand.choice(['In-frame'] * 6 + ['Out-of-frame', 'N/A', np.nan]),
+                    'strand': 'forward', 'stopcodon': 'No', 'identity': 95.5, 'bitscore': 350.3,
+                    'jqend': len(overhang) + 3 * len(protein) - 6,
+                    'fr4.start': np.nan, 'fr4.end': np.nan, 'fr4.mismatches': np.nan, 'fr4.gaps': np.nan,
+                    'cdr3.start': np.nan, 'cdr3.end': np.nan,
+                    'cdr3g.gaps': rand.choice([np.nan, 0, 0, 1, 3])})
+        start = len(overhang) + 1
+        for region, n in V_REGIONS:
+            end = start + 3 * n - 1
+            row[region + '.start'] = start
+            row[(region if region != 'fr3' else 'fr3g') + '.end'] = end
+            row[region + '.gaps'] = rand.choice([0, 0, 0, 1, 3]) if region != 'fr3' else 0
+            start = end + 1
+        row['fr3.end'] = row['fr3g.end']
+        row['fr3g.gaps'] = rand.choice([0, 0, 0, 2])
+        if rand.random() < 0.05:
+            row['vqstart'] = np.nan
+        qid = 'read{}'.format(i)
+        if rand.random() < 0.2:
+            row['strand'] = 'reversed'
+            dna = str(Seq(dna).reverse_complement())
+        rows.append(row)
+        records.append(SeqRecord(Seq(dna), id=qid, name='', description=''))
+    cloneAnnot = pd.DataFrame(rows, columns=fields[1:], index=pd.Index([r.id for r in records], name='queryid'))
+    return cloneAnnot, records
+
+
+def _oldRefineGapsAndMismatches(qsRec, offset):
+    gaps = int(abs(qsRec['vqstart'] - qsRec['vstart']) - offset)
+    mismatches = qsRec['vstart'] - 1
+    if qsRec['vstart'] > qsRec['vqstart'] and gaps > 0:
+        mismatches -= gaps
+    if gaps > 0:
+        qsRec['fr1.gaps'] += gaps
+        qsRec['vgaps'] += gaps
+    if mismatches > 0:
+        qsRec['fr1.mismatches'] += mismatches
+        qsRec['vmismatches'] += mismatches
+        qsRec['vstart'] -= mismatches
+        qsRec['vqstart'] -= mismatches
+
+
+def _oldRefineInFramePrediction(qsRec, qid, actualQstart, flags):
+    inframe = True
+    if qsRec['v-jframe'] == 'N/A' or (not isinstance(qsRec['v-jframe'], str) and isnan(qsRec['v-jframe'])):
+        flags['updatedInFrameNA'] += [qid]
+        inframe = False
+    # the only departure from the old check, which raised on an unknown V start
+    offset = qsRec['vqstart'] - qsRec['vstart']
+    offset = offset if isnan(offset) else int(offset) + 1
+    if inframe and (isnan(offset) or offset < 1 or (actualQstart != -1 and (offset - 1 - actualQstart) % 3 != 0)):
+        inframe = False
+        flags['updatedInFrameConc'] += [qid]
+    if inframe and (isnan(qsRec['fr4.start']) or isnan(qsRec['fr4.end']) or isnan(qsRec['cdr3.start']) or
+                    qsRec['cdr3.start'] >= qsRec['cdr3.end']):
+        inframe = False
+        flags['updatedInFrameNo3or4'] += [qid]
+    if inframe and ((qsRec['fr4.end'] - qsRec['fr1.start'] + 1) % 3 != 0 or
+                    (actualQstart != -1 and ((qsRec['fr4.end'] - actualQstart) % 3 != 0))):
+        inframe = False
+        flags['updatedInFrame3x'] += [qid]
+    if inframe and (qsRec['fr1.gaps'] % 3 != 0 or qsRec['fr2.gaps'] % 3 != 0 or qsRec['fr3g.gaps'] % 3 != 0 or
+                    qsRec['cdr1.gaps'] % 3 != 0 or qsRec['cdr2.gaps'] % 3 != 0 or
+                    (not isnan(qsRec['cdr3g.gaps']) and qsRec['cdr3g.gaps'] % 3 != 0)):
+        inframe = False
+        flags['updatedInFrameIndel'] += [qid]
+    if not inframe:
+        qsRec['v-jframe'] = 'Out-of-frame'
+        flags['updatedInFrame'] += [qid]
+    return inframe
+
+
+def _oldRecordFRLength(qsRec, germlineConsensusLength):
+    vgene = qsRec['vgene'].split('*')[0]
+    jgene = qsRec['jgene'].split('*')[0]
+    for region in ('fr1', 'fr2', 'fr3', 'fr4'):
+        length = qsRec[region + '.end'] - qsRec[region + '.start'] + 1
+        if not isnan(length):
+            germlineConsensusLength[vgene if region != 'fr4' else jgene][region][length] += 1
+
+
+def _oldRefineChunk(cloneAnnot, records, actualQstart, chain, fr4cut, trim5End, trim3End, refineFlagNames):
+    """
+    the refinement as RefineWorker used to run it, one record at a time
+    """
+    qsRecs, seqsAll, recordLengths = [], [], defaultdict(_defaultdefaultInt)
+    flags = dict((f, []) for f in refineFlagNames)
+    for record, qsRec in zip(records, cloneAnnot.to_dict('records')):
+        seqs, offset = refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut, trim5End, trim3End, flags)
+        # the old refinement raised on an unknown V start before updating anything
+        if offset is not None and not isnan(qsRec['vqstart']):
+            _oldRefineGapsAndMismatches(qsRec, offset)
+        if qsRec['v-jframe'] != 'Out-of-frame':
+            if _oldRefineInFramePrediction(qsRec, record.id, actualQstart, flags):
+                _oldRecordFRLength(qsRec, recordLengths)
+        qsRec['queryid'] = record.id
+        qsRecs.append([qsRec[f] for f in getAnnotationFields(chain)])
+        seqsAll.append(seqs)
+    return qsRecs, seqsAll, flags, recordLengths
+
+
+def _nested(lengths):
+    return dict((gene, dict((region, dict(counts)) for region, counts in regions.items()))
+                for gene, regions in lengths.items())
+
+
+@pytest.mark.parametrize('actualQstart,fr4cut', [(-1, True), (-1, False), (0, True), (2, True)])
+def test_refineChunkMatchesPerRecordRefinement(heavyChunk, actualQstart, fr4cut):
+    cloneAnnot, records = heavyChunk
+    refineFlagNames, _ = loadRefineFlagInfo()
+    got = refineChunk(cloneAnnot, records, actualQstart, 'hv', fr4cut, 0, 0, refineFlagNames)
+    expected = _oldRefineChunk(cloneAnnot, records, actualQstart, 'hv', fr4cut, 0, 0, refineFlagNames)
+
+    fields = getAnnotationFields('hv')
+    pd.testing.assert_frame_equal(pd.DataFrame(got[0], columns=fields), pd.DataFrame(expected[0], columns=fields),
+                                  check_dtype=False)
+    assert got[1] == expected[1]
+    assert got[2] == expected[2]
+    assert _nested(got[3]) == _nested(expected[3])
+    # the simulated reads exercise every branch that is computed on columns
+    for flag in ('updatedInFrame', 'updatedInFrameNA', 'updatedInFrameConc', 'updatedInFrameIndel', 'CDR3dna'):
+        assert got[2][flag]
+
+
+def test_refineGapsAndMismatchesMatchesPerRecordUpdates(heavyChunk):
+    cloneAnnot, records = heavyChunk
+    rand = np.random.RandomState(1)
+    offsets = rand.randint(0, 5, cloneAnnot.shape[0]).astype(float)
+    offsets[rand.rand(len(offsets)) < 0.2] = np.nan
+    got = cloneAnnot.copy()
+    refineGapsAndMismatches(got, offsets)
+
+    qsRecs = cloneAnnot.to_dict('records')
+    for qsRec, offset in zip(qsRecs, offsets):
+        if not isnan(offset) and not isnan(qsRec['vqstart']):
+            _oldRefineGapsAndMismatches(qsRec, offset)
+    expected = pd.DataFrame(qsRecs, columns=cloneAnnot.columns, index=cloneAnnot.index)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+    assert (got['vstart'] != cloneAnnot['vstart']).any() and (got['fr1.gaps'] != cloneAnnot['fr1.gaps']).any()
+
+
+def test_addToColumnOnlyUpdatesTheMaskedRows():
+    df = pd.DataFrame({'ints': np.array([1, 2, 3], dtype=np.int32), 'floats': [1., np.nan, 3.]})
+    delta = np.array([1., 2., np.nan])
+    mask = np.array([True, True, False])
+    _addToColumn(df, 'ints', mask, delta)
+    _addToColumn(df, 'floats', mask, delta)
+    assert df['ints'].dtype == np.int32 and df['ints'].tolist() == [2, 4, 3]
+    assert df['floats'].tolist()[0] == 2. and isnan(df['floats'][1]) and df['floats'][2] == 3.
+
+
+def test_recordFRLengthsMatchesPerRecordCounts(heavyChunk):
+    cloneAnnot, _ = heavyChunk
+    cloneAnnot = cloneAnnot.copy()
+    cloneAnnot['fr4.start'] = 340.
+    cloneAnnot['fr4.end'] = 372.
+    cloneAnnot.loc[cloneAnnot.index[::7], 'fr4.end'] = np.nan
+    cloneAnnot.loc[cloneAnnot.index[::5], 'fr2.end'] += 3
+    expected = defaultdict(_defaultdefaultInt)
+    for qsRec in cloneAnnot.to_dict('records'):
+        _oldRecordFRLength(qsRec, expected)
+    assert _nested(_recordFRLengths(cloneAnnot)) == _nested(expected)
+    assert _nested(_recordFRLengths(cloneAnnot.iloc[:0])) == {}
+
+    # collapsed reads count once per read
+    weighted = cloneAnnot.assign(count=3)
+    assert _nested(_recordFRLengths(weighted)) == \
+        dict((gene, dict((region, dict((length, 3 * n) for length, n in counts.items()))
+                         for region, counts in regions.items())) for gene, regions in _nested(expected).items())
@@ -0,0 +1,60 @@
+import os
+import gzip
+
+from abseqPy.IgRepAuxiliary.annotateAuxiliary import *
+
+
+def test_chunkSchedulerAdaptsToThroughput():
+    scheduler = ChunkScheduler(100000, 4, maxChunkSize=50000, minChunkSize=100, targetSeconds=10)
+    # before any measurement, chunks are small enough for every core to get several of them
+    size, threads = scheduler.nextChunk(4)
+    assert size == 100000 // 32 and threads == 1
+    scheduler.dispatched(size)
+    scheduler.completed(size, 1, 5.0)
+    # 625 seqs/s/thread => 6250 seqs per 10s chunk
+    assert scheduler.nextChunk(4) == (6250, 1)
+
+    # at the tail, the idle cores are shared by the last chunks
+    scheduler.remaining = 150
+    assert scheduler.nextChunk(4) == (100, 2)
+
+
+def test_annotateIGSeqReadWithDynamicChunks(tmpdir, fakeIgblast):
+    fasta = tmpdir.join("seqs.fasta")
+    fasta.write(''.join(">read{}\nACGTACGTAC\nGTACGT\n".format(i) for i in range(2500)))
+    outdir = str(tmpdir.mkdir("out"))
+
+    cloneAnnot, filteredIDs = annotateIGSeqRead(str(fasta), 'kv', str(tmpdir), 3, 1000, outdir=outdir)
+    assert filteredIDs == []
+    assert sorted(cloneAnnot.index) == sorted("read{}".format(i) for i in range(2500))
+    assert (cloneAnnot['vgene'] == 'IGKV1-39*01').all()
+    # chunk FASTA files and IgBLAST's outputs are cleaned up
+    assert os.listdir(os.path.join(outdir, "tmp")) == []
+
+
+def test_annotateIGSeqReadKeepsCompressedOutputs(tmpdir, fakeIgblast):
+    fasta = tmpdir.join("seqs.fasta")
+    fasta.write(''.join(">read{}\nACGTACGTAC\n".format(i) for i in range(2500)))
+    outdir = tmpdir.mkdir("out")
+    # audit copy of an earlier run
+    outdir.mkdir("tmp").join("chunk99.out.gz").write("")
+
+    cloneAnnot, _ = annotateIGSeqRead(str(fasta), 'kv', str(tmpdir), 3, 1000, outdir=str(outdir),
+                                      igblastStream='keep')
+    assert len(cloneAnnot) == 2500
+    kept = os.listdir(str(outdir.join("tmp")))
+    assert "chunk99.out.gz" in kept and "chunk1.out.gz" in kept
+    assert all(f.endswith(".out.gz") or f.endswith(".out.gz.params") for f in kept)
+
+
+def test_annotateIGSeqReadStreamsCompressedFastq(tmpdir, fakeIgblast):
+    fastq = tmpdir.join("seqs.fastq.gz")
+    with gzip.open(str(fastq), 'wb') as fp:
+        fp.write(''.join("@read{}\nACGTACGTAC\n+\nIIIIIIIIII\n".format(i) for i in range(1200)))
+    outdir = str(tmpdir.mkdir("out"))
+
+    cloneAnnot, filteredIDs = annotateIGSeqRead(str(fastq), 'kv', str(tmpdir), 1, 500, outdir=outdir)
+    assert sorted(cloneAnnot.index) == sorted("read{}".format(i) for i in range(1200))
+    # neither an uncompressed nor a FASTA copy of the reads is left behind
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['fakebin', 'out', 'seqs.fastq.gz']
+    assert not [f for f in os.listdir(os.path.join(outdir, "tmp")) if f.endswith(".fasta")]
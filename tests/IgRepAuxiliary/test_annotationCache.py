@@ -0,0 +1,57 @@
+import os
+
+from abseqPy.IgRepAuxiliary.annotationCache import *
+
+
+def _writeFasta(tmpdir, name, noReads, noUnique):
+    fasta = tmpdir.join(name)
+    fasta.write(''.join(">{}read{}\nACGT{}\n".format(name[0], i, "A" * (i % noUnique)) for i in range(noReads)))
+    return str(fasta)
+
+
+def test_annotationCacheSkipsKnownSequences(tmpdir, fakeIgblast):
+    cacheFile = str(tmpdir.join("cache.sqlite"))
+    outdir = str(tmpdir.mkdir("out"))
+    db = tmpdir.mkdir("db")
+    db.join("imgt_human_igkv.fasta").write(">IGKV1-39*01\nGACATCCAGATG\n")
+    first = _writeFasta(tmpdir, "first.fasta", 600, 200)
+
+    cloneAnnot, filteredIDs, hits, misses = annotateIGSeqReadCached(first, 'kv', str(db), 1, 1000,
+                                                                    cacheFile, outdir=outdir)
+    assert (hits, misses) == (0, 600)
+    assert len(cloneAnnot) == 600 and filteredIDs == []
+
+    # a different sample sharing half of its sequences with the first one
+    second = _writeFasta(tmpdir, "second.fasta", 400, 400)
+    cached, filteredIDs, hits, misses = annotateIGSeqReadCached(second, 'kv', str(db), 1, 1000,
+                                                                cacheFile, outdir=outdir)
+    assert (hits, misses) == (200, 200)
+    assert sorted(cached.index) == sorted("sread{}".format(i) for i in range(400))
+    assert (cached['vgene'] == 'IGKV1-39*01').all()
+    assert (cached['jend'] == 38).all()
+    assert not [f for f in os.listdir(outdir) if f.endswith("_cache_misses.fasta")]
+
+    # germlines updated in place, nothing that was annotated with the old ones is reused
+    db.join("imgt_human_igkv.fasta").write(">IGKV1-39*01\nGACATCCAGATA\n")
+    _, _, hits, misses = annotateIGSeqReadCached(second, 'kv', str(db), 1, 1000, cacheFile, outdir=outdir)
+    assert (hits, misses) == (0, 400)
+
+
+def test_annotationCacheEvictsLeastRecentlyUsed(tmpdir):
+    with AnnotationCache(str(tmpdir.join("cache.sqlite")), "fp", maxEntries=2) as cache:
+        cache.put(['vgene'], [("a", ["IGHV1"])])
+        cache.put(['vgene'], [("b", ["IGHV2"])])
+        # touch "a" so that "b" becomes the least recently used entry
+        assert cache.get(["a"]) == {"a": (["vgene"], ["IGHV1"])}
+        cache.put(['vgene'], [("c", None)])
+        assert sorted(cache.get(["a", "b", "c"])) == ["a", "c"]
+        assert cache.get(["c"])["c"] == (["vgene"], None)
+
+
+def test_annotationCacheEvictsInBatches(tmpdir):
+    with AnnotationCache(str(tmpdir.join("cache.sqlite")), "fp", maxEntries=20) as cache:
+        for i in range(20):
+            cache.put(['vgene'], [(str(i), ["IGHV1"])])
+        # evicted down to 18 entries (one batch less than the maximum), the new one included
+        cache.put(['vgene'], [("new", ["IGHV1"])])
+        assert sorted(cache.get(str(i) for i in range(20))) == sorted(str(i) for i in range(3, 20))
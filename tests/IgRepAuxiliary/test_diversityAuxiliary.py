@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+from pandas import DataFrame
+
+from abseqPy.IgRepAuxiliary.diversityAuxiliary import *
+from abseqPy.IgRepertoire.igRepUtils import collapseDuplicates
+
+
+REGIONS = ['fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3', 'fr4']
+
+
+def _frames(rows):
+    """
+    :param rows: list of (query id, CDR3 amino acids) tuples
+    :return: cloneAnnot and cloneSeqs dataframes, each region being 3 amino acids long except CDR3
+    """
+    annot = DataFrame(index=[qid for qid, _ in rows])
+    start = 1
+    for region in REGIONS:
+        length = [9 if region != 'cdr3' else 3 * len(cdr3) for _, cdr3 in rows]
+        annot[region + '.start'] = start
+        annot[region + '.end'] = annot[region + '.start'] + length - 1
+        start = annot[region + '.end'] + 1
+    seqs = DataFrame(dict((region, [cdr3 if region == 'cdr3' else region.upper() for _, cdr3 in rows])
+                          for region in REGIONS), index=annot.index)
+    seqs['germline'] = 'IGHV1-2*02'
+    return annot, seqs
+
+
+def test_collapsedReadsAreCountedOncePerRead(tmpdir):
+    fasta = tmpdir.join("reads.fasta")
+    fasta.write(">r1\nACGT\n>r2\nACGA\n>r3 dup\nacgt\n>r4\nACGT\n")
+    unique, counts = collapseDuplicates(str(fasta), str(tmpdir))
+    assert open(unique).read() == ">r1\nACGT\n>r2\nACGA\n"
+    assert counts == {'r1': 3, 'r2': 1}
+
+    rows = [('r1', 'ARDY'), ('r2', 'GG'), ('r3', 'ARDY'), ('r4', 'ARDY')]
+    annot, seqs = _frames(rows)
+    collapsedAnnot, collapsedSeqs = _frames(rows[:2])
+    collapsedAnnot['count'] = [3, 1]
+
+    assert annotateSpectratypes(collapsedAnnot) == annotateSpectratypes(annot)
+    for segregate in (False, True):
+        expected = annotateClonotypes(seqs, segregate=segregate)
+        got = annotateClonotypes(collapsedSeqs, segregate=segregate, counts=collapsedAnnot['count'])
+        assert json.dumps(got, sort_keys=True) == json.dumps(expected, sort_keys=True)
+
+
+def test_clonotypeTableFlattensOverGenes():
+    rows = [('r1', 'ARDY'), ('r2', 'GG'), ('r3', 'ARDY'), ('r4', 'None')]
+    _, seqs = _frames(rows)
+    seqs['germline'] = ['IGHV1-2*01', 'IGHV1-2*02', 'IGHV3-3*01', 'IGHV3-3*01']
+    clonoTypes = clonotypeTable(seqs)
+
+    assert clonoTypes.counts('cdr3').sort_index().to_dict() == {'ARDY': 2, 'GG': 1}
+    assert clonoTypes.counts('cdr3', gene='IGHV1-2').sort_index().to_dict() == {'ARDY': 1, 'GG': 1}
+    assert clonoTypes.counts('fr1').to_dict() == {'FR1': 4}
+    # the V domain of r4 has a None region
+    assert clonoTypes.counts('v').sum() == 3
+    segregated = annotateClonotypes(seqs, segregate=True)
+    assert segregated['IGHV3-3']['cdr3'] == {'ARDY': 1}
+    assert segregated['IGHV3-3']['fr4'] == {'FR4': 2}
+
+
+def test_clonesWithoutGermlineAreNotGivenAnotherGene():
+    rows = [('r1', 'ARDY'), ('r2', 'GG'), ('r3', 'ARDY')]
+    _, seqs = _frames(rows)
+    seqs['germline'] = ['IGHV1-2*01', 'IGHV3-3*01', np.nan]
+    clonoTypes = clonotypeTable(seqs)
+
+    assert clonoTypes.counts('cdr3').sort_index().to_dict() == {'ARDY': 2, 'GG': 1}
+    assert clonoTypes.counts('cdr3', gene='IGHV3-3').to_dict() == {'GG': 1}
+    assert clonoTypes.counts('cdr3', gene='NaN').to_dict() == {'ARDY': 1}
+
+    seqs['germline'] = np.nan
+    assert annotateClonotypes(seqs, segregate=True).keys() == ['NaN']
@@ -0,0 +1,82 @@
+import random
+import timeit
+
+import pytest
+from Bio import pairwise2
+from Bio.SubsMat import MatrixInfo as matlist
+
+from abseqPy.IgRepertoire import igRepUtils
+from abseqPy.IgRepertoire.igRepUtils import findBestAlignment
+from abseqPy.config import FR4_CONSENSUS, FR4_CONSENSUS_DNA
+from abseqPy.IgRepAuxiliary.fr4Search import *
+
+
+def _pairwise2(seq, query, dna):
+    if dna:
+        return pairwise2.align.localms(seq, query, DNA_MATCH, DNA_MISMATCH, DNA_GAP, DNA_GAP)
+    return pairwise2.align.localds(seq, query, matlist.blosum62, PROTEIN_GAP, PROTEIN_GAP)
+
+
+def test_localAlignmentAgreesWithPairwise2():
+    rand = random.Random(42)
+    for dna, alphabet, query in ((False, 'ACDEFGHIKLMNPQRSTVWY', 'WGQGTXVTVSS'), (True, 'ACGT', 'TGGGGCCAGGGAC')):
+        for _ in range(200):
+            seq = ''.join(rand.choice(alphabet) for _ in range(rand.randint(5, 40)))
+            if rand.random() < 0.5:
+                # plant a mutated copy of the consensus
+                planted = ''.join(c if rand.random() < 0.8 else rand.choice(alphabet) for c in query)
+                at = rand.randint(0, len(seq))
+                seq = seq[:at] + planted + seq[at:]
+            alignment = localAlignment(seq, query, dna=dna)
+            if alignment is None:
+                continue
+            expected = _pairwise2(seq, query, dna)
+            if not expected:
+                assert alignment == []
+            else:
+                assert len(expected) == 1 and tuple(expected[0]) == alignment
+
+
+def test_localAlignmentDefersTies():
+    assert localAlignment('WGQGTWGQGT', 'WGQGT') is None
+    assert localAlignment('', 'WGQG') == []
+
+
+def _fr4SearchRegions(n, alphabet, consensus, rand):
+    """
+    search regions as seen by the refinement: a CDR3, a mutated FR4 consensus and part of the constant region
+    """
+    regions = []
+    for _ in range(n):
+        cdr3 = ''.join(rand.choice(alphabet) for _ in range(rand.randint(5, 25)))
+        fr4 = ''.join(c if rand.random() < 0.9 else rand.choice(alphabet) for c in consensus)
+        tail = ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 15)))
+        regions.append(cdr3 + fr4 + tail)
+    return regions
+
+
+@pytest.mark.slow
+def test_fr4SearchBenchmark(monkeypatch):
+    rand = random.Random(7)
+    inputs = [(seq, FR4_CONSENSUS['VH'], False) for seq in
+              _fr4SearchRegions(2000, 'ACDEFGHIKLMNPQRSTVWY', FR4_CONSENSUS['VH'], rand)] + \
+             [(seq, FR4_CONSENSUS_DNA['VH'], True) for seq in
+              _fr4SearchRegions(500, 'ACGT', FR4_CONSENSUS_DNA['VH'], rand)]
+
+    def search():
+        return [findBestAlignment(seq, query, dna=dna) for seq, query, dna in inputs]
+
+    elapsed = timeit.default_timer()
+    found = search()
+    elapsed = timeit.default_timer() - elapsed
+
+    # without the diagonal search every region goes through pairwise2, as it used to
+    monkeypatch.setattr(igRepUtils, 'localAlignment', lambda seq, query, dna=False: None)
+    elapsed2 = timeit.default_timer()
+    expected = search()
+    elapsed2 = timeit.default_timer() - elapsed2
+
+    print("\nFR4 search of {} regions: {:.2f}s, pairwise2: {:.2f}s ({:.1f}x)"
+          .format(len(inputs), elapsed, elapsed2, elapsed2 / elapsed))
+    assert found == expected
+    assert elapsed < elapsed2
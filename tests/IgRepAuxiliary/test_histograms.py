@@ -0,0 +1,24 @@
+import numpy as np
+
+from abseqPy.IgRepAuxiliary.histograms import lengthHistogram, duplicationLevels
+
+
+def test_lengthHistogramMatchesCounter():
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(-3, 40, 500)
+    weights = rng.randint(1, 5, 500)
+    expected = {}
+    for length, weight in zip(lengths.tolist(), weights.tolist()):
+        expected[length] = expected.get(length, 0) + weight
+    assert dict(lengthHistogram(lengths, weights)) == expected
+    # garbage coordinates take the sparse path
+    assert dict(lengthHistogram([-2 ** 62, 5, 5])) == {-2 ** 62: 1, 5: 2}
+
+
+def test_duplicationLevelsMatchesThresholdSums():
+    freqs = np.random.RandomState(1).randint(1, 50, 300)
+    ticks = [1, 3, 10, 25, 49, 50]
+    atLeast, exactly = duplicationLevels(freqs.tolist(), atLeast=ticks, exactly=range(1, 10))
+    total = float(freqs.sum())
+    assert atLeast == [freqs[freqs >= x].sum() / total for x in ticks]
+    assert exactly == [(freqs == i).sum() / total for i in range(1, 10)]
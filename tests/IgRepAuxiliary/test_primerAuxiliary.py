@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+from pandas import DataFrame
+
+from abseqPy.IgRepAuxiliary.primerAuxiliary import writePrimerStats
+
+
+def _primerStats(tmpdir, name, cloneAnnot):
+    outDir = tmpdir.mkdir(name)
+    writePrimerStats('5', 'sample', cloneAnnot, os.path.join(str(outDir), 'sample_all_5end_'))
+    return dict((f.basename, f.read()) for f in outDir.listdir())
+
+
+def test_collapsedReadsAreCountedOncePerRead(tmpdir):
+    rows = [('r1', 'P1', 0, 2, 'IGHV1-2*02'), ('r2', 'P2', 1, 0, 'IGHV3-23*01'), ('r3', str(np.nan), 0, 0, 'IGHV1-2*02'),
+            ('r4', 'P1', 0, 2, 'IGHV1-2*02'), ('r5', 'P1', 0, 2, 'IGHV1-2*02'), ('r6', 'P2', 0, 0, 'IGHV3-23*01')]
+    cloneAnnot = DataFrame([row[1:] for row in rows], index=[row[0] for row in rows],
+                           columns=['5endPrimer', '5endMismatchIndex', '5endIndelIndex', 'vgene'])
+    expected = _primerStats(tmpdir, "all", cloneAnnot)
+    assert 'sample_all_5end_P1_igv_dist.csv' in expected
+
+    # r4 and r5 are identical to r1
+    collapsed = cloneAnnot.loc[['r1', 'r2', 'r3', 'r6']].assign(count=[3, 1, 1, 1])
+    assert _primerStats(tmpdir, "collapsed", collapsed) == expected
@@ -0,0 +1,39 @@
+import gzip
+
+import pytest
+
+from multiprocessing import Process, Queue
+
+from abseqPy.IgRepAuxiliary.readStore import ReadStore
+
+
+def _readRows(store, start, ids, queue):
+    queue.put([(record.id, str(record.seq)) for record in store.records(start, ids)])
+
+
+def test_readStoreFollowsQueryOrder(tmpdir):
+    fastq = tmpdir.join("reads.fastq.gz")
+    with gzip.open(str(fastq), 'wb') as fp:
+        fp.write(b"@r1 extra\nACGT\n+\nIIII\n@r2\nGG\n+\nII\n@r3\n\n+\n\n@r4\nTTTAC\n+\nIIIII\n")
+
+    with ReadStore.build(str(fastq), ['r4', 'r3', 'r1'], outDir=str(tmpdir)) as store:
+        assert len(store) == 3
+        assert [store[i] for i in range(3)] == ['TTTAC', '', 'ACGT']
+
+        # workers attach to the same store and are only given row ranges
+        queue = Queue()
+        worker = Process(target=_readRows, args=(store, 1, ['r3', 'r1'], queue))
+        worker.start()
+        assert queue.get() == [('r3', ''), ('r1', 'ACGT')]
+        worker.join()
+    assert not tmpdir.listdir(lambda p: p.basename.startswith("reads_"))
+
+
+def test_readStoreRejectsUnknownReads(tmpdir):
+    fasta = tmpdir.join("reads.fasta")
+    fasta.write(">r1\nACGT\nAC\n")
+    with ReadStore.build(str(fasta), ['r1'], outDir=str(tmpdir)) as store:
+        assert store[0] == 'ACGTAC'
+    with pytest.raises(KeyError):
+        ReadStore.build(str(fasta), ['r1', 'r2'], outDir=str(tmpdir))
+    assert not tmpdir.listdir(lambda p: p.basename.startswith("reads_"))
@@ -1,3 +1,8 @@
+import random
+import re
+
+from pandas import DataFrame
+
 from abseqPy.IgRepAuxiliary.restrictionAuxiliary import *
 
 
@@ -42,7 +47,6 @@ def test_replaceIUPACLetters():
 
 def test_findHits():
     # test simple definition of re.finditer
-    import re
     simple_seq = "ACGTACGT"
     site1 = re.compile(r"[ACG][ACG][GT]T")
     site2 = re.compile(r"[ACG][ACG][GT]TAC[GT][TA]")
@@ -51,3 +55,53 @@ def test_findHits():
 
     assert findHits(simple_seq, site1) == [0, 4]
     assert findHits(simple_seq, site2) == [0]
+
+
+def test_scanRestrictionSitesNeedsOnlyItsColumns(tmpdir):
+    reads = tmpdir.join("reads.fasta")
+    reads.write(">r1\nTTGAATTCTT\n>r2\nGGATCCAAAA\n>r3\nAAAAAAAAAA\n")
+    sites = tmpdir.join("sites.txt")
+    sites.write("EcoRI\tGAATTC\nBamHI\tGGATCC\n")
+    cloneAnnot = DataFrame({'vqstart': [1, 2, 1], 'vstart': [1, 2, 1], 'fr4.end': [float('nan'), 10, 10]},
+                           index=['r1', 'r2', 'r3'])
+
+    rsaResults, overlap = scanRestrictionSites('sample', str(reads), cloneAnnot, str(sites), 2, outDir=str(tmpdir))
+    assert overlap['order1'] == {'EcoRI': {'r1'}, 'BamHI': {'r2'}}
+    molecules = rsaResults.set_index('Enzyme')['No.Molecules']
+    assert molecules['EcoRI'] == 1 and molecules['BamHI'] == 1
+
+
+def test_collapsedReadsAreCountedOncePerRead(tmpdir):
+    reads = tmpdir.join("reads.fasta")
+    # r4 and r5 are identical to r1, r6 to r3
+    reads.write(">r1\nTTGAATTCGGATCC\n>r2\nGGATCCAAAAAAAA\n>r3\nAAGCTTAAAAAAAA\n>r4\nTTGAATTCGGATCC\n"
+                ">r5\nTTGAATTCGGATCC\n>r6\nAAGCTTAAAAAAAA\n")
+    sites = tmpdir.join("sites.txt")
+    sites.write("EcoRI\tGAATTC\nBamHI\tGGATCC\nHindIII\tAAGCTT\n")
+    ids = ['r1', 'r2', 'r3', 'r4', 'r5', 'r6']
+    cloneAnnot = DataFrame({'vqstart': [1] * 6, 'vstart': [1] * 6, 'fr4.end': [14.] * 6}, index=ids)
+
+    expected, expectedOverlap = scanRestrictionSites('sample', str(reads), cloneAnnot, str(sites), 2,
+                                                     outDir=str(tmpdir))
+    collapsed = cloneAnnot.loc[['r1', 'r2', 'r3']].assign(count=[3, 1, 2])
+    got, overlap = scanRestrictionSites('sample', str(reads), collapsed, str(sites), 2, outDir=str(tmpdir))
+
+    assert got.equals(expected)
+    assert expected.set_index('Enzyme')['No.Molecules']['Total'] == 6
+    assert overlap['order2'].equals(expectedOverlap['order2'])
+    assert overlap['weights'] == {'r1': 3, 'r2': 1, 'r3': 2}
+
+
+def test_sitesMatcherAgreesWithFindHits():
+    rand = random.Random(7)
+    sites = {}
+    for i in range(120):
+        site = ''.join(rand.choice('ACGTACGTACGTRYSWKMBDHVN') for _ in range(rand.randint(3, 8)))
+        sites['ENZ{}'.format(i)] = re.compile(replaceIUPACLetters(site))
+    sites['REGEX'] = re.compile('GA+TC')
+    matcher = SitesMatcher(sites)
+    for _ in range(100):
+        seq = ''.join(rand.choice('ACGTacgtN') for _ in range(rand.randint(0, 300)))
+        hits = matcher.findAll(seq)
+        for enzyme, site in sites.items():
+            assert hits.get(enzyme, []) == findHits(seq, site)
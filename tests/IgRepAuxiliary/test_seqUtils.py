@@ -0,0 +1,48 @@
+from abseqPy.IgRepAuxiliary import seqUtils
+from abseqPy.IgRepAuxiliary.seqUtils import generateMotifs
+
+
+GROUPS = {
+    'IGHV3-23*01': ['ATGGAGTTTGGGCTGAGC', 'ATGGAGTTTGGGCTGAGC', 'ATGGAATTTGGGCTGAGC'],
+    'IGHV1-2*02': ['ATGGACTGGACCTGGAGG', 'ATGGACTGGACCTGGAGC'],
+    'IGHV4-34*01': ['ATGAAACACCTGTGGTTC', 'ATGAAACACCTGTGGTTC', 'ATGAAACATCTGTGGTTC', 'ATGAAGCACCTGTGGTTC']
+}
+
+
+def test_motifsAreWrittenInGroupOrderWhateverTheThreads(tmpdir):
+    outputs = []
+    for threads in [1, 3]:
+        prefix = str(tmpdir.join("sample_{}_dna_variant".format(threads)))
+        generateMotifs(GROUPS, align=False, outputPrefix=prefix, threads=threads)
+        outputs.append((open(prefix + '_pwm.txt').read(), open(prefix + '_consensus.txt').read()))
+
+    assert outputs[0] == outputs[1]
+    pwm, consensus = outputs[0]
+    assert [line.split()[0] for line in pwm.splitlines() if line.startswith('#')] == \
+        ['#IGHV1-2*02', '#IGHV3-23*01', '#IGHV4-34*01']
+    assert consensus.startswith('>IGHV1-2*02 max_count\nATGGACTGGACCTGGAG')
+    for threads in [1, 3]:
+        logos = tmpdir.join("sample_{}_dna_variant_logos".format(threads))
+        assert sorted(logo.basename for logo in logos.listdir()) == ['IGHV1-2*02.png', 'IGHV3-23*01.png',
+                                                                      'IGHV4-34*01.png']
+
+
+def test_motifsOfAnEarlierRunAreNotRebuilt(tmpdir, monkeypatch):
+    prefix = str(tmpdir.join("sample_dna_variant"))
+    generateMotifs(GROUPS, align=False, outputPrefix=prefix, threads=1)
+    outputs = (open(prefix + '_pwm.txt').read(), open(prefix + '_consensus.txt').read())
+
+    built = []
+
+    def groupMotif(seqs, group, *args, **kwargs):
+        built.append(group)
+        return None
+    monkeypatch.setattr(seqUtils, "_groupMotif", groupMotif)
+    generateMotifs(GROUPS, align=False, outputPrefix=prefix, threads=1)
+    assert built == []
+    assert (open(prefix + '_pwm.txt').read(), open(prefix + '_consensus.txt').read()) == outputs
+
+    # only the groups before the first logo found are built
+    tmpdir.join("sample_dna_variant_logos", "IGHV1-2*02.png").remove()
+    generateMotifs(GROUPS, align=False, outputPrefix=prefix, threads=1)
+    assert built == ['IGHV1-2*02']
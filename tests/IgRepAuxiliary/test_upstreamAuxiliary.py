@@ -0,0 +1,28 @@
+from Bio import SeqIO
+from pandas import DataFrame
+
+from abseqPy.IgRepAuxiliary.upstreamAuxiliary import extractUpstreamSeqs
+
+
+def _upstream(tmpdir, name, cloneAnnot):
+    upstreamFile = str(tmpdir.join(name + "_upstream.fasta"))
+    extractUpstreamSeqs(cloneAnnot, str(tmpdir.join("reads.fasta")), [1, 6], upstreamFile)
+    return [(rec.id, str(rec.seq)) for rec in SeqIO.parse(upstreamFile, 'fasta')]
+
+
+def test_collapsedReadsAreWrittenOncePerRead(tmpdir):
+    # r3 is identical to r1, r4 is on the reverse strand
+    tmpdir.join("reads.fasta").write(">r1\nAAACCCGAGGTG\n>r2\nTTTGGGGAGGTG\n>r3\nAAACCCGAGGTG\n>r4\nCACCTCGGGTTA\n")
+    cloneAnnot = DataFrame({'strand': ['forward', 'forward', 'forward', 'reversed'], 'vstart': [1] * 4,
+                            'vqstart': [7] * 4, 'vgene': ['IGHV1-2*02', 'IGHV3-23*01', 'IGHV1-2*02', 'IGHV3-23*01']},
+                           index=['r1', 'r2', 'r3', 'r4'])
+    expected = _upstream(tmpdir, "all", cloneAnnot)
+    assert [seq for _, seq in expected] == ['AAACCC', 'TTTGGG', 'AAACCC', 'TAACCC']
+
+    collapsed = cloneAnnot.loc[['r1', 'r2', 'r4']].assign(count=[2, 1, 1])
+    got = _upstream(tmpdir, "collapsed", collapsed)
+    assert got == [('r1|IGHV1-2*02', 'AAACCC'), ('r1#1|IGHV1-2*02', 'AAACCC'), ('r2|IGHV3-23*01', 'TTTGGG'),
+                   ('r4|IGHV3-23*01', 'TAACCC')]
+    # the analyses only look at the genes and the sequences
+    assert sorted((qid.split('|')[1], seq) for qid, seq in got) == \
+        sorted((qid.split('|')[1], seq) for qid, seq in expected)
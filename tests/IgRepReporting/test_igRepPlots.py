@@ -0,0 +1,76 @@
+import gzip
+import multiprocessing
+
+import numpy as np
+
+from abseqPy.IgRepReporting.igRepPlots import plotSeqRecaptureNew, plotSeqRarefaction, rarefy
+
+
+def _regions():
+    rand = np.random.RandomState(3)
+    return [['CDR{}'.format(i) for i in rand.zipf(2.0, 2000)],
+            ['FR{}'.format(i) for i in rand.randint(0, 300, 1000)]]
+
+
+def _recaptureCurves(tmpdir, name, **kwargs):
+    filename = str(tmpdir.join(name + "_recapture.csv"))
+    plotSeqRecaptureNew(_regions(), ['CDR', 'FR'], filename, **kwargs)
+    with gzip.open(filename + ".gz") as fp:
+        return fp.read()
+
+
+def test_recaptureIsReproducibleWithTheSameSeed(tmpdir):
+    curves = _recaptureCurves(tmpdir, "a", seed=42)
+    assert curves == _recaptureCurves(tmpdir, "b", seed=42)
+    assert curves != _recaptureCurves(tmpdir, "c", seed=43)
+
+    # the curves do not depend on the pool analyzing the regions
+    pool = multiprocessing.Pool(processes=2)
+    try:
+        assert curves == _recaptureCurves(tmpdir, "d", pool=pool, seed=42)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_recaptureCurveOfEachRegion(tmpdir):
+    rows = [line.split(',') for line in _recaptureCurves(tmpdir, "a", seed=7).splitlines()[2:]]
+    assert len(rows) == 2 * 50 * 5
+    assert set(region for _, _, region in rows) == {'CDR', 'FR'}
+    # with 300 distinct FRs, large samples recapture (almost) all of them
+    largest = [float(y) for x, y, region in rows if region == 'FR' and x == '35000']
+    assert len(largest) == 5 and min(largest) > 99
+
+
+def _rarefactionCurves(tmpdir, name, weights, **kwargs):
+    filename = str(tmpdir.join(name + "_rarefaction.csv"))
+    plotSeqRarefaction([range(len(w)) for w in weights], ['CDR', 'FR'], filename, weights, **kwargs)
+    with gzip.open(filename + ".gz") as fp:
+        return [line.split(',') for line in fp.read().splitlines()[2:]]
+
+
+def test_rarefactionBandsBracketTheExpectedCurve(tmpdir):
+    rand = np.random.RandomState(5)
+    weights = [rand.zipf(2.0, 300).tolist(), rand.randint(1, 20, 100).tolist()]
+    rows = _rarefactionCurves(tmpdir, "a", weights, bootstrap=200, seed=11)
+    assert rows == _rarefactionCurves(tmpdir, "b", weights, bootstrap=200, seed=11)
+
+    for w, region in zip(weights, ['CDR', 'FR']):
+        sampled = [(int(x), int(y)) for x, y, r in rows if r == region]
+        ticks = sorted(set(x for x, _ in sampled))
+        assert ticks[-1] == sum(w)
+        curves = np.array([[y for x, y in sampled if x == tick] for tick in ticks]).T
+        assert curves.shape == (200, len(ticks))
+        low, high = np.percentile(curves, [2.5, 97.5], axis=0)
+        expected = rarefy(w, ticks)
+        assert (low <= expected).all() and (expected <= high).all()
+        # all the reads contain every sequence
+        assert (curves[:, -1] == len(w)).all()
+
+
+def test_rarefactionWithoutBootstrapIsTheExpectedCurve(tmpdir):
+    weights = [[1, 1, 2] * 10, [5] * 4]
+    rows = _rarefactionCurves(tmpdir, "a", weights)
+    fr = [(int(x), float(y)) for x, y, r in rows if r == 'FR']
+    assert [x for x, _ in fr] == [10, 15, 20]
+    assert np.allclose([y for _, y in fr], rarefy([5] * 4, [10, 15, 20]))
@@ -0,0 +1,43 @@
+import pytest
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgRepertoire import IgRepertoire as igRepertoireModule
+from abseqPy.IgRepertoire.IgRepertoire import IgRepertoire
+
+READ = "GACATCCAGATGACCCAGTCTCCATCCTCCCTGTCTGCATCTGTAGGAGACAGAGTCACCATCACTTGCCGGGCAAGT"
+
+
+@pytest.fixture
+def primerSample(tmpdir, fakeIgblast):
+    reads = tmpdir.join("reads.fasta")
+    reads.write(''.join(">read{}\n{}\n".format(i, READ) for i in range(30)))
+    primers = tmpdir.join("primers.fasta")
+    primers.write(">IGKV1\nGACATCCAGATGACC\n")
+
+    def repertoire():
+        # every stage runs on a fresh repertoire, as it does in its own AbSeqWorker
+        return IgRepertoire(str(reads), name='sample', outdir=str(tmpdir), chain='kv', task='primer',
+                            database=str(tmpdir), merger=None, primer5end=str(primers),
+                            log=str(tmpdir.join("sample.log")))
+    return repertoire
+
+
+def _primerIntegrity(tmpdir):
+    report = tmpdir.join("auxiliary", "sample", "primer_specificity", "sample_all_5end_integrity_dist.csv")
+    return report.read().splitlines()[2]
+
+
+def test_primerStageRunsInIsolation(tmpdir, primerSample):
+    primerSample().runStage(AbSeqWorker.PRIM)
+    assert _primerIntegrity(tmpdir) == "Intact,100.0,30"
+    assert tmpdir.join("hdf", "sample", "primer_specificity", "sample_primer_annot.h5").check()
+
+
+def test_stagesReuseTheAnnotationStage(tmpdir, primerSample, monkeypatch):
+    primerSample().runStage(AbSeqWorker.ANNOT)
+
+    def countSeqs(filename):
+        raise AssertionError("the reads were counted again")
+    monkeypatch.setattr(igRepertoireModule, "countSeqs", countSeqs)
+    primerSample().runStage(AbSeqWorker.PRIM)
+    assert _primerIntegrity(tmpdir) == "Intact,100.0,30"
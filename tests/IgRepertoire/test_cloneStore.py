@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from abseqPy.IgRepertoire import cloneStore
+from abseqPy.IgRepertoire.cloneStore import *
+
+
+def _cloneAnnot():
+    df = pd.DataFrame({'vgene': ['IGHV1-2*02', 'IGHV3-23*01', 'IGHV1-2*02', np.nan],
+                       'v-jframe': ['In-frame', 'Out-of-frame', np.nan, 'In-frame'],
+                       'bitscore': np.array([50., 150., 250., 350.3]),
+                       'vstart': np.array([1, 1, 5, 1], dtype=np.int32),
+                       'fr1.start': [1., np.nan, 3., 4.],
+                       'count': [1, 2, 3, 4]},
+                      index=pd.Index(['r1', 'r2', 'r3', 'r4'], name='queryid'))
+    return df[['vgene', 'v-jframe', 'bitscore', 'vstart', 'fr1.start', 'count']]
+
+
+def test_roundTripWithProjectionAndPushdown(tmpdir):
+    fname = str(tmpdir.join("annot.h5"))
+    df = _cloneAnnot()
+    saveFrame(df, fname, "cloneAnnot")
+    with pd.HDFStore(fname, 'r') as store:
+        assert store.get_storer("cloneAnnot").is_table
+
+    loaded = loadFrame(fname, "cloneAnnot")
+    assert loaded.equals(df)
+    assert frameLength(fname, "cloneAnnot") == 4
+    assert frameLength(fname, "cloneAnnot", weightColumn='count') == 10
+
+    subset = loadFrame(fname, "cloneAnnot", columns=['vgene'],
+                       predicates=[('bitscore', '>=', 100), ('vstart', '<=', 2), ('v-jframe', '==', 'In-frame')])
+    assert list(subset.columns) == ['vgene']
+    assert list(subset.index) == ['r4']
+    # a read scored exactly at the threshold is kept
+    assert list(loadFrame(fname, "cloneAnnot", predicates=[('bitscore', '>=', 350.3)]).index) == ['r4']
+
+
+def test_fixedFormatFilesAreStillReadable(tmpdir):
+    fname = str(tmpdir.join("annot.h5"))
+    df = _cloneAnnot()
+    df.to_hdf(fname, "cloneAnnot", mode='w')
+    assert loadFrame(fname, "cloneAnnot", predicates=[('bitscore', '<=', 200)]).equals(df.iloc[:2])
+    assert frameLength(fname, "cloneAnnot", weightColumn='count') == 10
+
+
+def test_parquetStoreWithProjectionAndPushdown(tmpdir, monkeypatch):
+    pytest.importorskip('pyarrow')
+    fname = frameFile(str(tmpdir.join("annot")), 'parquet')
+    assert fname.endswith(".parquet")
+    df = _cloneAnnot()
+    # one row per row group, the predicates on bitscore skip all but the last one
+    monkeypatch.setattr(cloneStore._ParquetBackend, 'ROW_GROUP_SIZE', 1)
+    saveFrame(df, fname, "cloneAnnot")
+
+    assert loadFrame(fname, "cloneAnnot").equals(df)
+    assert frameLength(fname, "cloneAnnot") == 4
+    assert frameLength(fname, "cloneAnnot", weightColumn='count') == 10
+
+    subset = loadFrame(fname, "cloneAnnot", columns=['vgene'],
+                       predicates=[('bitscore', '>=', 300), ('v-jframe', '==', 'In-frame')])
+    assert list(subset.columns) == ['vgene'] and list(subset.index) == ['r4']
+    assert loadFrame(fname, "cloneAnnot", predicates=[('bitscore', '>', 1000)]).empty
@@ -0,0 +1,66 @@
+import os
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgRepertoire.IgRepertoire import IgRepertoire
+from abseqPy.IgRepertoire.stageManifest import StageManifest
+
+
+def test_staleOutputsAreDiscarded(tmpdir):
+    manifest = StageManifest(str(tmpdir))
+    output = tmpdir.mkdir("annot")
+    output.join("annot.h5").write("")
+
+    assert not manifest.current('annotation', 'a')
+    manifest.record('annotation', 'a', [str(output)])
+    assert manifest.current('annotation', 'a')
+    assert not manifest.current('annotation', 'b')
+
+    manifest.discard('annotation')
+    assert not output.check()
+    assert not manifest.current('annotation', 'a')
+
+
+def _repertoire(tmpdir, reads):
+    return IgRepertoire(reads, name='sample', outdir=str(tmpdir), task='seqlen', database=str(tmpdir),
+                        merger=None, log=str(tmpdir.join("sample.log")))
+
+
+def test_stagesRerunOnlyWhenTheirInputsChange(tmpdir):
+    reads = tmpdir.join("reads.fasta")
+    reads.write(">r1\nACGTACGTAA\n>r2\nACGTAC\n")
+    report = tmpdir.join("auxiliary", "sample", "annot", "sample_seq_length_dist.csv")
+
+    _repertoire(tmpdir, str(reads)).runStage(AbSeqWorker.SEQLEN)
+    assert report.check()
+    report.write("kept")
+    _repertoire(tmpdir, str(reads)).runStage(AbSeqWorker.SEQLEN)
+    assert report.read() == "kept"
+
+    reads.write(">r1\nACGTACGTAA\n>r2\nACGTAC\n>r3\nACG\n")
+    os.utime(str(reads), (0, 0))
+    _repertoire(tmpdir, str(reads)).runStage(AbSeqWorker.SEQLEN)
+    assert report.read() != "kept"
+
+
+def test_annotationFollowsTheGermlineContents(tmpdir):
+    reads = tmpdir.join("reads.fasta")
+    reads.write(">r1\nACGTACGTAA\n")
+    db = tmpdir.mkdir("db")
+    germline = db.join("imgt_human_igkv.fasta")
+    germline.write(">IGKV1-39*01\nGACATCCAGATGACC\n")
+
+    def annotationFingerprint():
+        return IgRepertoire(str(reads), name='sample', outdir=str(tmpdir), task='annotate', chain='kv',
+                            database=str(db), merger=None, log=str(tmpdir.join("sample.log"))) \
+            ._fingerprint('annotation')
+
+    original = annotationFingerprint()
+    # other files in the database directory do not matter
+    db.join("notes.txt").write("")
+    assert annotationFingerprint() == original
+
+    # a germline replaced in place, with the same size and time stamps
+    stat = os.stat(str(germline))
+    germline.write(">IGKV1-39*02\nGACATCCAGATGACC\n")
+    os.utime(str(germline), (stat.st_atime, stat.st_mtime))
+    assert annotationFingerprint() != original
@@ -0,0 +1,54 @@
+import os
+import sys
+import pytest
+
+
+# stand-in for igblastn: annotates every query of -query with the same top V/J hits
+FAKE_IGBLASTN = """#!{python}
+import sys
+args = sys.argv[1:]
+if '-version' in args:
+    print('igblastn: 1.0.0')
+    print('Package: igblast 1.0.0, build Jan  1 2018 00:00:00')
+    sys.exit(0)
+query = args[args.index('-query') + 1]
+out = open(args[args.index('-out') + 1], 'w') if '-out' in args else sys.stdout
+for line in open(query):
+    if line.startswith('>'):
+        qid = line[1:].split()[0]
+        out.write('# Query: %s\\n' % qid)
+        out.write('# V-(D)-J rearrangement summary for query sequence\\n')
+        out.write('IGKV1-39*01\\tIGKJ1*01\\tVK\\tNo\\tIn-frame\\tYes\\t+\\n')
+        out.write('# Alignment summary between query and top germline V gene hit\\n')
+        out.write('FR1-IMGT\\t1\\t78\\t78\\t78\\t0\\t0\\t100\\n')
+        out.write('# Fields: query id, subject id\\n')
+        out.write('# 2 hits found\\n')
+        out.write('V\\t%s\\tIGKV1-39*01\\t100.00\\t280\\t0\\t0\\t0\\t1\\t280\\t1\\t280\\t1e-100\\t400\\n' % qid)
+        out.write('J\\t%s\\tIGKJ1*01\\t100.00\\t38\\t0\\t0\\t0\\t281\\t318\\t1\\t38\\t1e-10\\t70\\n' % qid)
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="run the tests marked as slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skipSlow = pytest.mark.skip(reason="slow, use --runslow to run it")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skipSlow)
+
+
+@pytest.fixture
+def fakeIgblast(tmpdir, monkeypatch):
+    """
+    puts a fake igblastn on PATH
+    """
+    fakeBin = tmpdir.mkdir("fakebin")
+    script = fakeBin.join("igblastn")
+    script.write(FAKE_IGBLASTN.format(python=sys.executable))
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(fakeBin) + os.pathsep + os.environ["PATH"])
+    return script